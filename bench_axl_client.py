@@ -0,0 +1,61 @@
+"""
+Benchmark del cliente AXL: costo de armar el servicio SOAP de CUCM.
+
+Compara tres formas de obtener el servicio, sin conectarse a CUCM:
+  - "antes":  zeep.Client nuevo desde schema/AXLAPI.wsdl en cada pedido
+  - "nuevo":  registro nuevo (lo que cuesta el primer pedido de cada proceso)
+  - "tibio":  registro ya caliente (lo que cuesta cada pedido de /api/fac*)
+
+Uso:
+    python bench_axl_client.py [--repeticiones 3]
+"""
+import argparse
+import statistics
+import time
+
+from requests import Session
+from requests.auth import HTTPBasicAuth
+from zeep import Client, Settings
+from zeep.transports import Transport
+
+from tarificador.cliente_axl import BINDING_AXL, RegistroClientesAXL
+
+WSDL_FILE = "schema/AXLAPI.wsdl"
+HOST = "127.0.0.1"
+
+
+def servicio_sin_cache():
+    session = Session()
+    session.verify = False
+    session.auth = HTTPBasicAuth("admin", "admin")
+    client = Client(WSDL_FILE, settings=Settings(strict=False, xml_huge_tree=True),
+                    transport=Transport(session=session, timeout=10))
+    return client.create_service(BINDING_AXL, f"https://{HOST}:8443/axl/")
+
+
+def medir(nombre, funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    print(f"{nombre:>6}: mediana={statistics.median(tiempos):.2f} ms "
+          f"min={min(tiempos):.2f} max={max(tiempos):.2f} (n={repeticiones})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    medir("antes", servicio_sin_cache, args.repeticiones)
+
+    medir("nuevo", lambda: RegistroClientesAXL(WSDL_FILE).servicio(HOST, "admin", "admin"), args.repeticiones)
+
+    registro = RegistroClientesAXL(WSDL_FILE)
+    print(f"arranque: {registro.calentar(HOST, 'admin', 'admin')}")
+    medir("tibio", lambda: registro.servicio(HOST, "admin", "admin"), args.repeticiones * 100)
+
+
+if __name__ == "__main__":
+    main()
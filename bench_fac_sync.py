@@ -0,0 +1,199 @@
+"""
+Banco de pruebas de la sincronización FAC contra un CUCM simulado.
+
+Levanta un servidor AXL local (HTTP, sin TLS) que responde listFacInfo con
+skip/first, addFacInfo y updateFacInfo sobre N códigos en memoria, con
+latencia por petición y un tope de peticiones simultáneas que, como CUCM,
+responde 503 cuando se supera. Mide:
+
+  - "lectura":   listFacInfo paginado de los N códigos
+  - "escritura": M updateFacInfo a través del pool acotado del motor
+  - "completa":  sincronizar() de punta a punta (solo con --database-url;
+                 BORRA fac_codes y fac_audit de esa base: usar una de prueba)
+  - "incremental": sincronizar_incremental() sin cambios y con un código
+                 modificado de cada lado (también con --database-url)
+
+Uso:
+    python bench_fac_sync.py [--codigos 10000] [--pagina 1000] [--trabajadores 4]
+                             [--latencia-ms 5] [--limite-concurrente 8]
+                             [--database-url postgresql://.../tarificador_prueba]
+"""
+import argparse
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from zeep import Client, Settings
+from zeep.transports import Transport
+
+from tarificador.cliente_axl import BINDING_AXL, RegistroClientesAXL
+from tarificador.sincronizacion_fac import (
+    MODO_HACIA_CUCM, MODO_IMPORTAR, FacLocal, PlanSincronizacion, SincronizadorFac,
+)
+
+WSDL_FILE = "schema/AXLAPI.wsdl"
+NS_AXL = "http://www.cisco.com/AXL/API/12.5"
+SOBRE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soapenv:Body>{}</soapenv:Body></soapenv:Envelope>'
+)
+
+
+class CucmSimulado:
+    def __init__(self, codigos, latencia, limite_concurrente):
+        self.facs = {
+            str(100000 + i): {"name": f"FAC_{i}", "level": i % 256, "uuid": "{%s}" % str(uuid.uuid4()).upper()}
+            for i in range(codigos)
+        }
+        self.latencia = latencia
+        self.cupos = threading.BoundedSemaphore(limite_concurrente)
+        self.lock = threading.Lock()
+        self.peticiones = 0
+        self.rechazos = 0
+
+    def responder(self, operacion, cuerpo):
+        time.sleep(self.latencia)
+        with self.lock:
+            self.peticiones += 1
+            if operacion == "listFacInfo":
+                skip = int(cuerpo.findtext(".//skip") or 0)
+                first = cuerpo.findtext(".//first")
+                codigos = sorted(self.facs)
+                codigos = codigos[skip:skip + int(first)] if first else codigos[skip:]
+                filas = "".join(
+                    f'<facInfo uuid="{self.facs[c]["uuid"]}"><name>{escape(self.facs[c]["name"])}</name>'
+                    f'<code>{c}</code><authorizationLevel>{self.facs[c]["level"]}</authorizationLevel></facInfo>'
+                    for c in codigos
+                )
+                return f'<ns:listFacInfoResponse xmlns:ns="{NS_AXL}"><return>{filas}</return></ns:listFacInfoResponse>'
+            if operacion == "addFacInfo":
+                codigo = cuerpo.findtext(".//code")
+                self.facs[codigo] = {
+                    "name": cuerpo.findtext(".//name"),
+                    "level": int(cuerpo.findtext(".//authorizationLevel") or 0),
+                    "uuid": "{%s}" % str(uuid.uuid4()).upper(),
+                }
+                return f'<ns:addFacInfoResponse xmlns:ns="{NS_AXL}"><return>{self.facs[codigo]["uuid"]}</return></ns:addFacInfoResponse>'
+            if operacion == "updateFacInfo":
+                nombre = cuerpo.findtext(".//name")
+                codigo = next(c for c, f in self.facs.items() if f["name"] == nombre)
+                self.facs[codigo]["name"] = cuerpo.findtext(".//newName") or nombre
+                self.facs[codigo]["level"] = int(cuerpo.findtext(".//authorizationLevel") or 0)
+                return f'<ns:updateFacInfoResponse xmlns:ns="{NS_AXL}"><return>{self.facs[codigo]["uuid"]}</return></ns:updateFacInfoResponse>'
+        raise ValueError(f"Operación no simulada: {operacion}")
+
+
+def servidor(cucm):
+    class Manejador(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _enviar(self, estado, contenido):
+            datos = contenido.encode()
+            self.send_response(estado)
+            self.send_header("Content-Type", "text/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+
+        def do_POST(self):
+            cuerpo = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not cucm.cupos.acquire(blocking=False):
+                with cucm.lock:
+                    cucm.rechazos += 1
+                self._enviar(503, "AXL service is busy")
+                return
+            try:
+                operacion = self.headers.get("SOAPAction", "").strip('"').split()[-1]
+                self._enviar(200, SOBRE.format(cucm.responder(operacion, ET.fromstring(cuerpo))))
+            except Exception as e:
+                self._enviar(500, SOBRE.format(
+                    f"<soapenv:Fault><faultcode>soapenv:Server</faultcode><faultstring>{escape(str(e))}</faultstring></soapenv:Fault>"
+                ))
+            finally:
+                cucm.cupos.release()
+
+    http = ThreadingHTTPServer(("127.0.0.1", 0), Manejador)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    return http
+
+
+def medir(nombre, funcion):
+    inicio = time.perf_counter()
+    resultado = funcion()
+    print(f"{nombre:>11}: {time.perf_counter() - inicio:.3f}s")
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codigos", type=int, default=10000)
+    parser.add_argument("--pagina", type=int, default=1000)
+    parser.add_argument("--trabajadores", type=int, default=4)
+    parser.add_argument("--actualizar", type=int, default=1000, help="updateFacInfo a medir")
+    parser.add_argument("--latencia-ms", type=float, default=5)
+    parser.add_argument("--limite-concurrente", type=int, default=8)
+    parser.add_argument("--database-url", help="base de PRUEBA para la sincronización completa")
+    args = parser.parse_args()
+
+    cucm = CucmSimulado(args.codigos, args.latencia_ms / 1000, args.limite_concurrente)
+    http = servidor(cucm)
+    documento = RegistroClientesAXL(WSDL_FILE).documento()
+    client = Client(documento, settings=Settings(strict=False, xml_huge_tree=True), transport=Transport(timeout=30))
+    servicio = client.create_service(BINDING_AXL, f"http://127.0.0.1:{http.server_port}/axl/")
+
+    session_factory = None
+    if args.database_url:
+        session_factory = sessionmaker(bind=create_engine(args.database_url))
+    motor = SincronizadorFac(
+        servicio=lambda: servicio, session_factory=session_factory,
+        pagina=args.pagina, trabajadores=args.trabajadores, espera_base=0.05,
+    )
+
+    leidos = medir("lectura", lambda: motor.leer_cucm(servicio))
+    print(f"             {len(leidos)} códigos en {-(-len(leidos) // args.pagina)} páginas")
+
+    plan = PlanSincronizacion(actualizar_cucm=[
+        (FacLocal(0, fac.codigo, fac.nombre, (fac.nivel + 1) % 256, True, False), fac)
+        for fac in list(leidos.values())[:args.actualizar]
+    ])
+    hechos, errores = medir("escritura", lambda: motor.escribir_cucm(servicio, plan))
+    print(f"             {len(hechos)} actualizados, {len(errores)} errores, {cucm.rechazos} respuestas 503")
+
+    if session_factory:
+        db = session_factory()
+        db.execute(text("DELETE FROM fac_audit"))
+        db.execute(text("DELETE FROM fac_codes"))
+        db.commit()
+        db.close()
+        resultado = medir("completa", lambda: motor.sincronizar(MODO_IMPORTAR, "bench"))
+        print(f"             importar: {resultado['stats']}")
+        resultado = medir("completa", lambda: motor.sincronizar(MODO_HACIA_CUCM, "bench"))
+        print(f"             hacia CUCM sin cambios: {resultado['stats']}")
+
+        resultado = medir("incremental", lambda: motor.sincronizar_incremental("bench"))
+        print(f"             sin cambios: {resultado['stats']}")
+        primero, segundo = sorted(cucm.facs)[:2]
+        cucm.facs[primero]["level"] = (cucm.facs[primero]["level"] + 1) % 256
+        db = session_factory()
+        db.execute(text("UPDATE fac_codes SET authorization_code_name = 'BENCH', cucm_synced = FALSE, "
+                        "updated_at = now() AT TIME ZONE 'utc' WHERE authorization_code = :c"), {"c": segundo})
+        db.commit()
+        db.close()
+        resultado = medir("incremental", lambda: motor.sincronizar_incremental("bench"))
+        print(f"             un cambio por lado: {resultado['stats']}")
+
+    print(f"Peticiones al CUCM simulado: {cucm.peticiones}")
+    http.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Benchmark de latencia del login bajo una tanda de intentos simultáneos.
+
+Simula dentro del proceso lo que hace la API, sin base ni servidor HTTP:
+  - "antes": bcrypt síncrono en el threadpool de anyio (el de los endpoints
+             `def`), como el /auth/login anterior
+  - "ahora": VerificadorPasswords (pool de procesos con tope de intentos en
+             curso), como el /auth/login actual
+
+Durante la tanda, una sonda llama en bucle a una función corta por el mismo
+threadpool de anyio, como los /cdr y /check_balance* del listener Java, y
+mide cuánto tardan: es lo que sufren cuando los logins acaparan los hilos.
+Al final muestra cuántos intentos de una IP corta LimitadorIntentos antes de
+llegar a bcrypt.
+
+Uso:
+    python bench_login.py [--logins 200] [--procesos 2] [--max-en-curso 16]
+                          [--consulta-ms 5]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import anyio
+from passlib.context import CryptContext
+
+from tarificador.autenticacion import LimitadorIntentos, VerificacionSaturada, VerificadorPasswords
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def resumen(tiempos):
+    if not tiempos:
+        return "sin muestras"
+    tiempos = sorted(tiempos)
+    p99 = tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.99))]
+    return (f"mediana={statistics.median(tiempos):.1f} p99={p99:.1f} "
+            f"max={tiempos[-1]:.1f} ms (n={len(tiempos)})")
+
+
+async def sonda(consulta, tiempos, detener):
+    """Latencia de un endpoint síncrono corto mientras dura la tanda"""
+    while not detener.is_set():
+        inicio = time.perf_counter()
+        await anyio.to_thread.run_sync(time.sleep, consulta)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+        await asyncio.sleep(0.01)
+
+
+async def medir(nombre, intento, logins, consulta):
+    tiempos_login, tiempos_sonda, rechazos = [], [], [0]
+    detener = asyncio.Event()
+    tarea_sonda = asyncio.create_task(sonda(consulta, tiempos_sonda, detener))
+
+    async def uno():
+        inicio = time.perf_counter()
+        try:
+            await intento()
+        except VerificacionSaturada:
+            rechazos[0] += 1
+            return
+        tiempos_login.append((time.perf_counter() - inicio) * 1000)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(uno() for _ in range(logins)))
+    total = time.perf_counter() - inicio
+    detener.set()
+    await tarea_sonda
+
+    print(f"{nombre}: {logins} logins en {total:.2f}s, {rechazos[0]} rechazados por saturación")
+    print(f"        login:         {resumen(tiempos_login)}")
+    print(f"        check_balance: {resumen(tiempos_sonda)}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--procesos", type=int, default=2)
+    parser.add_argument("--max-en-curso", type=int, default=16)
+    parser.add_argument("--consulta-ms", type=float, default=5, help="duración de la consulta simulada")
+    args = parser.parse_args()
+
+    hash_password = pwd_context.hash("secreto")
+    consulta = args.consulta_ms / 1000
+
+    await medir("antes", lambda: anyio.to_thread.run_sync(pwd_context.verify, "otra", hash_password),
+                args.logins, consulta)
+
+    verificador = VerificadorPasswords(max_procesos=args.procesos, max_en_curso=args.max_en_curso)
+    await asyncio.to_thread(verificador.calentar)
+    try:
+        await medir("ahora", lambda: verificador.verificar("otra", hash_password), args.logins, consulta)
+        print(f"        verificador: {verificador.stats()}")
+    finally:
+        verificador.detener()
+
+    limite_ip = LimitadorIntentos(max_intentos=30, ventana=60)
+    admitidos = 0
+    for _ in range(args.logins):
+        if not limite_ip.espera("10.0.0.1"):
+            limite_ip.registrar("10.0.0.1")
+            admitidos += 1
+    print(f"límite por IP: {admitidos} de {args.logins} intentos llegan a bcrypt, {limite_ip.stats()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
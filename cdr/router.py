@@ -63,7 +63,9 @@ def get_cdr_list(
     status: Optional[str] = Query(None, description="Estado de la llamada"),
     direction: Optional[str] = Query(None, description="Dirección de la llamada"),
     page: int = Query(1, ge=1, description="Página"),
-    per_page: int = Query(10, ge=1, le=100, description="Registros por página")
+    per_page: int = Query(10, ge=1, le=100, description="Registros por página"),
+    cursor: Optional[str] = Query(None, description="next_cursor / prev_cursor de la respuesta anterior"),
+    exact_count: bool = Query(False, description="Contar el total exacto en lugar de estimarlo")
 ) -> CDRListResponse:
     """
     Obtiene lista paginada de CDR con filtros - Funcionalidad extraída del main.py
@@ -81,11 +83,16 @@ def get_cdr_list(
             status=status,
             direction=direction,
             page=page,
-            per_page=per_page
+            per_page=per_page,
+            cursor=cursor,
+            exact_count=exact_count
         )
         
         cdr_service = CDRService(db)
         return cdr_service.get_cdr_list(filters)
+    except ValueError as e:
+        # Cursor inválido
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error obteniendo lista CDR: {e}")
         raise HTTPException(status_code=500, detail=str(e))
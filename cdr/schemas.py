@@ -18,6 +18,8 @@ class CallEvent(BaseModel):
     dialing_time: Optional[Any] = None
     network_reached_time: Optional[Any] = None
     network_alerting_time: Optional[Any] = None
+    idempotency_key: Optional[str] = None
+    call_id: Optional[str] = None
 
     @field_validator('start_time', 'end_time', 'answer_time', 'dialing_time', 
                     'network_reached_time', 'network_alerting_time', mode='before')
@@ -72,6 +74,8 @@ class CDRFilter(BaseModel):
     direction: Optional[str] = None
     page: int = Field(1, ge=1)
     per_page: int = Field(10, ge=1, le=100)
+    cursor: Optional[str] = None  # Cursor opaco de next_cursor / prev_cursor
+    exact_count: bool = False
 
 class CDRResponse(BaseModel):
     """Schema para respuesta CDR"""
@@ -108,4 +112,7 @@ class CDRListResponse(BaseModel):
     total_pages: int
     current_page: int
     stats: CDRStats
-    filters_applied: CDRFilter
\ No newline at end of file
+    filters_applied: CDRFilter
+    total_is_exact: bool = True
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
\ No newline at end of file
@@ -8,10 +8,14 @@ import logging
 
 from .models import CDR, ActiveCall
 from .schemas import CallEvent, CDRFilter, CDRResponse, CDRStats, CDRListResponse, ActiveCallRequest
-from main import SessionLocal, Zona, Prefijo, Tarifa  # Importar del main.py existente
+from main import SessionLocal, Zona, Prefijo, Tarifa, rating_snapshot  # Importar del main.py existente
+from tarificador import ConteoCDR, armar_pagina, condicion_cursor, filtros_cdr
 
 logger = logging.getLogger(__name__)
 
+# Conteos exactos recientes por filtro; sin caché se usa la estimación del planner
+_conteos = ConteoCDR(ttl=300)
+
 class CDRService:
     """Servicio para gestión de CDR - Extraído del main.py"""
     
@@ -70,12 +74,7 @@ class CDRService:
             self.db.commit()
             
             # 10. Obtener información de la zona para respuesta
-            zona_info = self.db.execute(
-                text("SELECT nombre FROM zonas WHERE id = :zona_id"),
-                {"zona_id": zona_id}
-            ).fetchone()
-            
-            zona_nombre = zona_info[0] if zona_info else "Desconocida"
+            zona_nombre = rating_snapshot.actual.nombre_zona(zona_id)
             
             logger.info(f"CDR creado: {event.calling_number} -> {event.called_number}, "
                        f"Zona: {zona_nombre}, Costo: ${cost:.4f}")
@@ -97,7 +96,7 @@ class CDRService:
     
     def get_zone_by_prefix(self, called_number: str) -> int:
         """
-        Determina la zona basándose en el prefijo - Extraído del main.py
+        Determina la zona basándose en el prefijo - Usa el índice compartido de main.py
         """
         if not called_number:
             return 1  # Zona por defecto para números vacíos
@@ -109,29 +108,10 @@ class CDRService:
             return 1  # Zona por defecto si no hay dígitos
         
         try:
-            # Obtener todos los prefijos ordenados por longitud descendente
-            # Esto prioriza prefijos más específicos (más largos) sobre los generales
-            query = text("""
-                SELECT zona_id, prefijo, longitud_minima, longitud_maxima
-                FROM prefijos 
-                ORDER BY LENGTH(prefijo) DESC, prefijo
-            """)
-            
-            prefijos = self.db.execute(query).fetchall()
-            
-            for prefijo_row in prefijos:
-                zona_id, prefijo, long_min, long_max = prefijo_row
-                
-                # Verificar si el número empieza con este prefijo
-                if clean_number.startswith(str(prefijo)):
-                    # Verificar longitud del número
-                    if long_min and len(clean_number) < long_min:
-                        continue
-                    if long_max and len(clean_number) > long_max:
-                        continue
-                    
-                    # ¡Encontramos la zona!
-                    return zona_id
+            # Misma instantánea de tarifas en memoria que usa main.py
+            regla = rating_snapshot.buscar(clean_number)
+            if regla:
+                return regla.zona_id
             
             # Si no se encuentra ningún prefijo, usar zona por defecto
             logger.warning(f"No se encontró zona para el número: {called_number}")
@@ -143,23 +123,14 @@ class CDRService:
     
     def get_rate_by_zone(self, zona_id: int) -> float:
         """
-        Obtiene la tarifa por minuto para una zona específica - Extraído del main.py
+        Obtiene la tarifa por minuto para una zona específica - Usa la instantánea de main.py
         """
         try:
-            query = text("""
-                SELECT tarifa_segundo 
-                FROM tarifas 
-                WHERE zona_id = :zona_id 
-                  AND activa = true
-                ORDER BY fecha_inicio DESC
-                LIMIT 1
-            """)
+            tarifa = rating_snapshot.actual.tarifa(zona_id)
             
-            result = self.db.execute(query, {"zona_id": zona_id}).fetchone()
-            
-            if result and result[0] is not None:
+            if tarifa:
                 # Convertir de tarifa por segundo a tarifa por minuto
-                tarifa_por_segundo = float(result[0])
+                tarifa_por_segundo = tarifa.tarifa_segundo
                 tarifa_por_minuto = tarifa_por_segundo * 60
                 return tarifa_por_minuto
             else:
@@ -245,59 +216,30 @@ class CDRService:
                 WHERE 1=1
             """)
             
-            # Aplicar filtros
-            params = {}
-            conditions = []
-            
-            if filters.phone_number:
-                conditions.append("(c.calling_number LIKE :phone_pattern OR c.called_number LIKE :phone_pattern)")
-                params['phone_pattern'] = f"%{filters.phone_number}%"
-            
-            if filters.calling_number:
-                conditions.append("c.calling_number = :calling_number")
-                params['calling_number'] = filters.calling_number
-            
-            if filters.called_number:
-                conditions.append("c.called_number = :called_number")
-                params['called_number'] = filters.called_number
-            
-            if filters.start_date:
-                conditions.append("c.start_time >= :start_date")
-                params['start_date'] = f"{filters.start_date} 00:00:00"
-            
-            if filters.end_date:
-                conditions.append("c.start_time <= :end_date")
-                params['end_date'] = f"{filters.end_date} 23:59:59"
-            
-            if filters.min_duration and filters.min_duration > 0:
-                conditions.append("COALESCE(c.duration_seconds, 0) >= :min_duration")
-                params['min_duration'] = filters.min_duration
-            
-            if filters.status and filters.status != 'all':
-                conditions.append("COALESCE(c.status, 'unknown') = :status")
-                params['status'] = filters.status
-            
-            if filters.direction and filters.direction != 'all':
-                conditions.append("COALESCE(c.direction, 'unknown') = :direction")
-                params['direction'] = filters.direction
-            
-            # Agregar condiciones a la query
-            if conditions:
-                query_str = str(query) + " AND " + " AND ".join(conditions)
-            else:
-                query_str = str(query)
-            
-            # Contar total de registros
-            count_query = f"SELECT COUNT(*) FROM ({query_str}) as count_query"
-            total_records = self.db.execute(text(count_query), params).scalar()
+            # Aplicar filtros (misma forma que los índices de cdr)
+            criterios = filters.model_dump(include={
+                "phone_number", "calling_number", "called_number", "start_date",
+                "end_date", "min_duration", "status", "direction",
+            })
+            where, params = filtros_cdr(alias="c", **criterios)
+            
+            # Total estimado (o exacto si se pide); el filtro no necesita el JOIN con zonas
+            filtro_where, filtro_params = filtros_cdr(**criterios)
+            total_records, total_is_exact = _conteos.total(
+                self.db, filtro_where, filtro_params, exacto=filters.exact_count
+            )
             total_pages = (total_records + filters.per_page - 1) // filters.per_page
             
-            # Agregar ordenamiento y paginación
-            offset = (filters.page - 1) * filters.per_page
-            query_str += f" ORDER BY c.start_time DESC LIMIT {filters.per_page} OFFSET {offset}"
+            # Paginación por cursor sobre (start_time, id); una fila extra indica si hay más
+            condicion, cursor_params, orden, _ = condicion_cursor(filters.cursor, alias="c")
+            query_str = str(query) + where + condicion + orden + f" LIMIT {filters.per_page + 1}"
+            params.update(cursor_params)
             
             # Ejecutar query principal
             rows = self.db.execute(text(query_str), params).fetchall()
+            rows, next_cursor, prev_cursor = armar_pagina(
+                rows, filters.per_page, filters.cursor, clave=lambda row: (row[3], row[0])
+            )
             
             # Procesar resultados
             records = []
@@ -340,7 +282,10 @@ class CDRService:
                 total_pages=total_pages,
                 current_page=filters.page,
                 stats=stats,
-                filters_applied=filters
+                filters_applied=filters,
+                total_is_exact=total_is_exact,
+                next_cursor=next_cursor,
+                prev_cursor=prev_cursor
             )
             
         except Exception as e:
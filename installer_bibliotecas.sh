@@ -61,7 +61,7 @@ echo -e "${GREEN}Creando lista final de requisitos...${NC}"
 touch $TEMP_DIR/final_requirements.txt
 
 # Agregar dependencias principales que sabemos que son necesarias
-echo -e "xlwt\nopenpyxl\nfastapi\nuvicorn\nsqlalchemy\npydantic\npasslib\npython-multipart\nstarlette\npsycopg2-binary\nfastapi-login\nweasyprint\njinja2\njwt\nxlsxwriter\nxlrd\npandas" > $TEMP_DIR/final_requirements.txt
+echo -e "xlwt\nopenpyxl\nfastapi\nuvicorn\nsqlalchemy\npydantic\npasslib\npython-multipart\nstarlette\npsycopg2-binary\nasyncpg\nfastapi-login\nweasyprint\njinja2\njwt\nxlsxwriter\nxlrd\npandas" > $TEMP_DIR/final_requirements.txt
 
 # Agregar otras dependencias encontradas si hay archivos de requisitos
 if [ -f "$TEMP_DIR/installed_packages.txt" ]; then
@@ -17,7 +17,6 @@ import java.time.Instant;
 import java.util.concurrent.ConcurrentHashMap;
 import java.util.concurrent.Executors;
 import java.util.concurrent.ScheduledExecutorService;
-import java.util.concurrent.ScheduledFuture;
 import java.util.concurrent.TimeUnit;
 import java.time.Duration;
 import com.fasterxml.jackson.databind.DeserializationFeature;
@@ -55,8 +54,13 @@ public class CallListener implements CallControlCallObserver {
         int releaseCause = 0;
         boolean hasDialedNumber = false;
 
-        // Nuevo campo para la tarea de reporte periódico
-        ScheduledFuture<?> reporterTask;
+        // Desde cuándo la llamada está registrada para reportarse (null = no se reporta)
+        volatile Instant reportingSince;
+        // Listener que registró la llamada, para aplicar el fallback de dirección
+        CallListener reporter;
+        // Eventos ya enviados al servidor (solo se tocan desde el hilo reportScheduler)
+        boolean startReported = false;
+        boolean answerReported = false;
 
         // Modificar el constructor para incluir el callId
         CallData(String callId, String callingNumber, String calledNumber) {
@@ -308,6 +312,11 @@ public class CallListener implements CallControlCallObserver {
                     callData.status = "answered";  // ✅ Cambiar estado a "answered"
                     System.out.println("  *** DESTINO CONTESTÓ (ESTABLISHED) ***: " + callId + 
                                     " en " + callData.destinationEstablishedTime);
+                    
+                    // ✅ Si el inicio ya se reportó, avisar la respuesta (el servidor cuenta desde aquí)
+                    if (callData.reportingSince != null) {
+                        reportScheduler.execute(() -> reportCallState(callData));
+                    }
                 } else {
                     // ✅ Si no es el destino, solo es establecimiento de origen/red
                     System.out.println("  CONEXIÓN ORIGEN/RED ESTABLECIDA: " + address + " (no es respuesta del destino)");
@@ -318,9 +327,9 @@ public class CallListener implements CallControlCallObserver {
                     }
                 }
                 
-                // ✅ PROGRAMAR REPORTES PERIÓDICOS PARA TODAS LAS LLAMADAS (contestadas o no)
-                if (callData.reporterTask == null || callData.reporterTask.isCancelled()) {
-                    schedulePeriodicReporting(callId, callData);
+                // ✅ REPORTAR INICIO PARA TODAS LAS LLAMADAS (contestadas o no)
+                if (callData.reportingSince == null) {
+                    scheduleStartReport(callId, callData);
                 }
                 
             } catch (Exception e) {
@@ -329,36 +338,31 @@ public class CallListener implements CallControlCallObserver {
         }
     }
 
-    // ✅ NUEVO: Método para programar reportes periódicos
-    private void schedulePeriodicReporting(String callId, CallData callData) {
-        // ✅ SOLO crear reporterTask si no existe uno ya
-        if (callData.reporterTask == null || callData.reporterTask.isCancelled()) {
-            ScheduledExecutorService scheduler = Executors.newSingleThreadScheduledExecutor();
-            ScheduledFuture<?> task = scheduler.scheduleAtFixedRate(() -> {
-                try {
-                    // ✅ Verificar que la llamada aún existe
-                    if (activeCalls.containsKey(callId)) {
-                        // ✅ Aplicar último fallback si aún no hay dirección
-                        if ("pending".equals(callData.direction) || "unknown".equals(callData.direction)) {
-                            applyDirectionFallback(callData);
-                        }
-                        
-                        reportActiveCall(callData);
-                    } else {
-                        // Si la llamada ya no existe, cancelar el task
-                        Thread.currentThread().interrupt();
-                        scheduler.shutdown();
-                    }
-                } catch (Exception e) {
-                    System.err.println("Error en reporte periódico para llamada " + callId + ": " + e.getMessage());
-                }
-            }, 2, 5, TimeUnit.SECONDS); // ✅ Delay inicial de 2 segundos
-            
-            callData.reporterTask = task;
-            System.out.println("✅ Reporting task scheduled successfully for call: " + callId);
+    // ✅ El servidor calcula duración y costo de las llamadas activas: el listener
+    // solo informa inicio, respuesta y fin. Un único hilo agenda esos envíos.
+    private static final long REPORT_INITIAL_DELAY_MS = 2_000;
+
+    private static final ScheduledExecutorService reportScheduler = Executors.newSingleThreadScheduledExecutor(r -> {
+        Thread t = new Thread(r, "active-call-reporter");
+        t.setDaemon(true);
+        return t;
+    });
+
+    // ✅ Agenda el reporte de inicio; la demora da tiempo a resolver la dirección
+    private void scheduleStartReport(String callId, CallData callData) {
+        if (callData.reportingSince == null) {
+            callData.reporter = this;
+            callData.reportingSince = Instant.now();
+            reportScheduler.schedule(() -> reportCallState(callData),
+                    REPORT_INITIAL_DELAY_MS, TimeUnit.MILLISECONDS);
+            System.out.println("✅ Reporte de inicio agendado para llamada: " + callId);
         }
     }
 
+    public static void shutdownReporting() {
+        reportScheduler.shutdownNow();
+    }
+
     private void handleCallCtlTermConnTalking(CallCtlTermConnTalkingEv ev, String callId) {
         CallData callData = activeCalls.get(callId);
         if (callData != null) {
@@ -613,11 +617,8 @@ public class CallListener implements CallControlCallObserver {
             
             System.out.println("  Llamada desconectada - ID: " + callId + " Estado final: " + callData.status);
 
-            // ✅ Cancelar task y limpiar recursos
-            if (callData.reporterTask != null && !callData.reporterTask.isCancelled()) {
-                boolean cancelled = callData.reporterTask.cancel(true);
-                System.out.println("  Tarea de reporte periódico cancelada para llamada: " + callId + " (success: " + cancelled + ")");
-            }
+            // ✅ Sacar la llamada del reporte periódico
+            callData.reportingSince = null;
 
             // ✅ Limpiar maps de tracking
             callDirections.remove(callId);
@@ -694,10 +695,7 @@ public class CallListener implements CallControlCallObserver {
             
             System.out.println("  Llamada fallida - ID: " + callId);
 
-            if (callData.reporterTask != null) {
-                callData.reporterTask.cancel(false);
-                System.out.println("  Tarea de reporte periódico cancelada para llamada fallida: " + callId);
-            }
+            callData.reportingSince = null;
 
             // Limpiar maps de tracking
             callDirections.remove(callId);
@@ -735,6 +733,7 @@ public class CallListener implements CallControlCallObserver {
             System.out.println("====================");
             
             Map<String, Object> cdr = new HashMap<>();
+            cdr.put("call_id", callData.callId);  // Para liquidar la reserva de saldo
             cdr.put("calling_number", callData.callingNumber);
             cdr.put("called_number", callData.calledNumber);
             cdr.put("start_time", callData.startTime.toString());
@@ -765,24 +764,15 @@ public class CallListener implements CallControlCallObserver {
             }
             cdr.put("duration_billable", durationBillable);
             
-            String json = objectMapper.writeValueAsString(cdr);
-            System.out.println("JSON CDR: " + json);
-            
-            HttpRequest request = HttpRequest.newBuilder()
-                    .uri(URI.create("http://localhost:8000/cdr"))
-                    .header("Content-Type", "application/json")
-                    .POST(HttpRequest.BodyPublishers.ofString(json))
-                    .build();
-            
-            HttpResponse<String> response = client.send(request, HttpResponse.BodyHandlers.ofString());
-            System.out.println("CDR enviado. Respuesta: " + response.statusCode());
-            
-            if (response.statusCode() >= 400) {
-                System.err.println("Error en respuesta CDR: " + response.body());
+            // El envío HTTP lo hace el hilo del spool; aquí solo se encola
+            if (CdrSpool.getInstance().enqueue(cdr)) {
+                System.out.println("CDR encolado (" + CdrSpool.getInstance().depth() + " pendientes)");
+            } else {
+                System.err.println("Spool de CDR lleno, CDR rechazado");
             }
             
         } catch (Exception e) {
-            System.err.println("Error enviando CDR: " + e.getMessage());
+            System.err.println("Error encolando CDR: " + e.getMessage());
             e.printStackTrace();
         }
     }
@@ -853,16 +843,24 @@ public class CallListener implements CallControlCallObserver {
         }
     }
 
-    // ✅ CORREGIDO: reportActiveCall mejorado
-    private void reportActiveCall(CallData callData) {
+    // ✅ Envía el estado de la llamada (inicio o respuesta). Corre siempre en reportScheduler.
+    private static void reportCallState(CallData callData) {
         try {
-            if (!activeCalls.containsKey(callData.callId)) {
-                System.out.println("⚠️  Llamada " + callData.callId + " ya no existe, cancelando reporte");
+            if (callData.reportingSince == null || callData.endTime != null || !activeCalls.containsKey(callData.callId)) {
                 return;
             }
 
-            if ("disconnected".equals(callData.status) || callData.endTime != null) {
-                System.out.println("⚠️  Llamada " + callData.callId + " ya terminó, cancelando reporte");
+            boolean answered = callData.destinationEstablishedTime != null;
+            if (!callData.startReported) {
+                // Un aviso de respuesta que llega antes del reporte de inicio viaja con él
+                if (System.currentTimeMillis() - callData.reportingSince.toEpochMilli() < REPORT_INITIAL_DELAY_MS) {
+                    return;
+                }
+                // ✅ Aplicar último fallback si aún no hay dirección
+                if ("pending".equals(callData.direction) || "unknown".equals(callData.direction)) {
+                    callData.reporter.applyDirectionFallback(callData);
+                }
+            } else if (!answered || callData.answerReported) {
                 return;
             }
 
@@ -872,71 +870,36 @@ public class CallListener implements CallControlCallObserver {
             activeCall.put("called_number", callData.calledNumber);
             activeCall.put("direction", callData.direction);
             activeCall.put("start_time", callData.startTime.toString());
-
-            long durationSeconds = 0;
-            if (callData.destinationEstablishedTime != null) {
-                durationSeconds = Instant.now().getEpochSecond() - 
-                                callData.destinationEstablishedTime.getEpochSecond();
-            }
-            activeCall.put("current_duration", durationSeconds);
-
-            double tarifaSegundo = 0.0;
-            String zona = "Desconocida";
-            
-            if ("outbound".equals(callData.direction)) {
-                try {
-                    String url = String.format("http://localhost:8000/check_balance_for_call/%s/%s", 
-                                            callData.callingNumber, callData.calledNumber);
-                    HttpRequest request = HttpRequest.newBuilder()
-                            .uri(URI.create(url))
-                            .timeout(Duration.ofSeconds(2))
-                            .GET()
-                            .build();
-                    HttpResponse<String> response = client.send(request, HttpResponse.BodyHandlers.ofString());
-                    BalanceCheckResponse result = objectMapper.readValue(response.body(), BalanceCheckResponse.class);
-                    
-                    tarifaSegundo = result.tarifa_segundo;
-                    zona = result.zona;
-                } catch (Exception e) {
-                    System.err.println("Error obteniendo tarifa: " + e.getMessage());
-                }
-            } else {
-                zona = "Entrante";
-            }
-            
-            double costoEstimado = durationSeconds * tarifaSegundo;
-            activeCall.put("current_cost", costoEstimado);
-            activeCall.put("zone", zona);
+            activeCall.put("answer_time", answered ? callData.destinationEstablishedTime.toString() : null);
             activeCall.put("connection_id", callData.callId);
-            
-            System.out.println("Enviando reporte de llamada activa: " + callData.callingNumber + 
-                            " -> " + callData.calledNumber + 
-                            " (" + callData.direction + ") " +
-                            "(dur: " + durationSeconds + "s, costo: $" + 
-                            String.format("%.2f", costoEstimado) + ")");
-            
-            String json = objectMapper.writeValueAsString(activeCall);
+
+            callData.startReported = true;
+            callData.answerReported = answered;
+
+            System.out.println("Reportando " + (answered ? "respuesta" : "inicio") + " de llamada activa: " +
+                            callData.callingNumber + " -> " + callData.calledNumber +
+                            " (" + callData.direction + ")");
+
             HttpRequest reportRequest = HttpRequest.newBuilder()
                     .uri(URI.create("http://localhost:8000/api/active-calls"))
+                    .timeout(Duration.ofSeconds(5))
                     .header("Content-Type", "application/json")
-                    .POST(HttpRequest.BodyPublishers.ofString(json))
+                    .POST(HttpRequest.BodyPublishers.ofString(objectMapper.writeValueAsString(activeCall)))
                     .build();
-                    
-            HttpResponse<String> reportResponse = client.send(reportRequest, HttpResponse.BodyHandlers.ofString());
-            
-            if (reportResponse.statusCode() >= 400) {
-                System.err.println("Error reportando llamada activa: " + reportResponse.statusCode() + 
-                                " - " + reportResponse.body());
-            }
-        
+
+            // Sin bloquear el hilo del scheduler
+            client.sendAsync(reportRequest, HttpResponse.BodyHandlers.ofString())
+                    .whenComplete((response, error) -> {
+                        if (error != null) {
+                            System.err.println("Error reporting active call: " + error.getMessage());
+                        } else if (response.statusCode() >= 400) {
+                            System.err.println("Error reportando llamada activa: " + response.statusCode() +
+                                            " - " + response.body());
+                        }
+                    });
+
         } catch (Exception e) {
             System.err.println("Error reporting active call: " + e.getMessage());
-            e.printStackTrace();
         }
     }
-
-    // Caches para evitar llamadas HTTP repetidas
-    private static final Map<String, Double> tarifaCache = new ConcurrentHashMap<>();
-    private static final Map<String, String> zonaCache = new ConcurrentHashMap<>();
-    private static final Map<String, Long> tarifaCacheTime = new ConcurrentHashMap<>();
 }
\ No newline at end of file
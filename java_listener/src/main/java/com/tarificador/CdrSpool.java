@@ -0,0 +1,520 @@
+package com.tarificador;
+
+import java.io.BufferedReader;
+import java.io.BufferedWriter;
+import java.io.File;
+import java.io.IOException;
+import java.net.URI;
+import java.net.http.HttpClient;
+import java.net.http.HttpRequest;
+import java.net.http.HttpResponse;
+import java.nio.ByteBuffer;
+import java.nio.channels.FileChannel;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.nio.file.StandardCopyOption;
+import java.nio.file.StandardOpenOption;
+import java.time.Duration;
+import java.util.ArrayDeque;
+import java.util.ArrayList;
+import java.util.HashSet;
+import java.util.LinkedHashMap;
+import java.util.List;
+import java.util.Map;
+import java.util.Set;
+import java.util.UUID;
+import java.util.concurrent.atomic.AtomicLong;
+import com.fasterxml.jackson.core.type.TypeReference;
+import com.fasterxml.jackson.databind.JsonNode;
+import com.fasterxml.jackson.databind.ObjectMapper;
+import org.apache.logging.log4j.LogManager;
+import org.apache.logging.log4j.Logger;
+
+/**
+ * Cola persistente de CDR pendientes de envío.
+ *
+ * Los callbacks JTAPI solo encolan el CDR (memoria + una línea en el journal),
+ * nunca esperan al HTTP. Un hilo de envío drena la cola en lotes hacia
+ * POST /cdr/batch, con reintentos y backoff exponencial. Cada CDR lleva una
+ * idempotency_key, así un lote reintentado no se cobra dos veces.
+ *
+ * Los fallos de red y las respuestas 429/502/503/504 (API caído o reiniciando)
+ * se reintentan sin límite. Cualquier otra respuesta no 2xx puede deberse a un
+ * CDR del lote: tras spool.max.failures fallos seguidos el lote se parte a la
+ * mitad, y un CDR solo que sigue fallando pasa al archivo de descarte
+ * (spool.deadletter) para que no frene a los siguientes.
+ *
+ * Cada línea del journal se escribe con force(): un CDR encolado sobrevive a
+ * una caída del proceso o del equipo.
+ *
+ * Formato del journal (JSON por línea, solo se agrega al final):
+ *   {"t":"add","k":"<clave>","ts":<epoch ms>,"cdr":{...}}
+ *   {"t":"ack","k":["<clave>", ...]}
+ * Al arrancar se reproduce el journal: quedan pendientes los "add" sin "ack".
+ */
+public class CdrSpool {
+    private static final Logger logger = LogManager.getLogger(CdrSpool.class);
+    private static final ObjectMapper objectMapper = new ObjectMapper();
+    private static final HttpClient client = HttpClient.newBuilder()
+            .connectTimeout(Duration.ofSeconds(5))
+            .build();
+
+    private static final long INITIAL_BACKOFF_MS = 1_000;
+    private static final long MAX_BACKOFF_MS = 60_000;
+    private static final long LINGER_MS = 200;
+    private static final long STATS_INTERVAL_MS = 60_000;
+    private static final int COMPACT_AFTER_ACKS = 10_000;
+
+    private enum ShipResult { OK, TRANSIENT, REJECTED }
+
+    private static volatile CdrSpool instance;
+
+    private static class SpoolEntry {
+        final String key;
+        final long enqueuedAt;
+        final Map<String, Object> cdr;
+
+        SpoolEntry(String key, long enqueuedAt, Map<String, Object> cdr) {
+            this.key = key;
+            this.enqueuedAt = enqueuedAt;
+            this.cdr = cdr;
+        }
+    }
+
+    private final ArrayDeque<SpoolEntry> queue = new ArrayDeque<>();
+    private final Path journalPath;
+    private final int capacity;
+    private final int batchSize;
+    private final int maxFailures;
+    private final Path deadLetterPath;
+    private final String batchUrl;
+    private FileChannel journal;
+    // Tamaño de lote vigente: se reduce a la mitad mientras se aísla un CDR que el servidor rechaza
+    private int batchLimit;
+    // Último CDR del lote rechazado: hasta confirmarlo (o descartarlo) se sigue con lotes reducidos
+    private String suspectUntilKey;
+    private int acksSinceCompaction = 0;
+    private volatile boolean running = true;
+    private final Thread shipper;
+
+    // Contadores
+    private final AtomicLong enqueuedTotal = new AtomicLong();
+    private final AtomicLong shippedTotal = new AtomicLong();
+    private final AtomicLong duplicatesTotal = new AtomicLong();
+    private final AtomicLong rejectedTotal = new AtomicLong();
+    private final AtomicLong droppedInvalidTotal = new AtomicLong();
+    private final AtomicLong deadLetteredTotal = new AtomicLong();
+    private final AtomicLong batchesOk = new AtomicLong();
+    private final AtomicLong batchesFailed = new AtomicLong();
+    private volatile long lastBatchLatencyMs = 0;
+    private volatile long lastShippedAt = 0;
+
+    public static CdrSpool getInstance() {
+        if (instance == null) {
+            synchronized (CdrSpool.class) {
+                if (instance == null) {
+                    instance = new CdrSpool();
+                }
+            }
+        }
+        return instance;
+    }
+
+    private CdrSpool() {
+        String apiUrl = ConfigurationManager.getConfig().getProperty("api.url", "http://localhost:8000");
+        this.batchUrl = apiUrl + "/cdr/batch";
+        this.journalPath = Paths.get(ConfigurationManager.getConfig().getProperty(
+                "spool.journal", "/opt/tarificador/java_listener/spool/cdr-spool.journal"));
+        this.capacity = Integer.parseInt(ConfigurationManager.getConfig().getProperty("spool.capacity", "50000"));
+        this.batchSize = Integer.parseInt(ConfigurationManager.getConfig().getProperty("spool.batch.size", "100"));
+        this.maxFailures = Integer.parseInt(ConfigurationManager.getConfig().getProperty("spool.max.failures", "3"));
+        this.deadLetterPath = Paths.get(ConfigurationManager.getConfig().getProperty(
+                "spool.deadletter", journalPath.resolveSibling("cdr-spool.dead").toString()));
+        this.batchLimit = batchSize;
+
+        try {
+            File parent = journalPath.toAbsolutePath().getParent().toFile();
+            if (!parent.exists() && !parent.mkdirs()) {
+                logger.warn("No se pudo crear el directorio del spool: {}", parent);
+            }
+            replayJournal();
+            compactJournal();
+        } catch (IOException e) {
+            logger.error("Error abriendo journal del spool {}: {}", journalPath, e.getMessage(), e);
+        }
+
+        shipper = new Thread(this::shipLoop, "cdr-spool-shipper");
+        shipper.setDaemon(true);
+        shipper.start();
+
+        logger.info("Spool de CDR iniciado: {} pendientes, journal {}", queue.size(), journalPath);
+    }
+
+    /**
+     * Encola un CDR. No bloquea por red; solo escribe una línea en el journal.
+     * @return false si el spool está lleno y el CDR fue rechazado
+     */
+    public boolean enqueue(Map<String, Object> cdr) {
+        String key = UUID.randomUUID().toString();
+        cdr.put("idempotency_key", key);
+        SpoolEntry entry = new SpoolEntry(key, System.currentTimeMillis(), cdr);
+
+        synchronized (this) {
+            if (queue.size() >= capacity) {
+                rejectedTotal.incrementAndGet();
+                logger.error("Spool de CDR lleno ({} entradas), CDR rechazado: {}", capacity, cdr);
+                return false;
+            }
+
+            Map<String, Object> line = new LinkedHashMap<>();
+            line.put("t", "add");
+            line.put("k", key);
+            line.put("ts", entry.enqueuedAt);
+            line.put("cdr", cdr);
+            appendJournal(line);
+
+            queue.addLast(entry);
+            enqueuedTotal.incrementAndGet();
+            notifyAll();
+        }
+        return true;
+    }
+
+    private void shipLoop() {
+        long backoff = INITIAL_BACKOFF_MS;
+        long lastStats = System.currentTimeMillis();
+        int failures = 0;
+
+        while (running) {
+            try {
+                List<SpoolEntry> batch = awaitBatch();
+
+                if (System.currentTimeMillis() - lastStats >= STATS_INTERVAL_MS) {
+                    logger.info("Spool de CDR: {}", getStats());
+                    lastStats = System.currentTimeMillis();
+                }
+
+                if (batch.isEmpty()) {
+                    continue;
+                }
+
+                ShipResult result = ship(batch);
+                if (result == ShipResult.OK) {
+                    backoff = INITIAL_BACKOFF_MS;
+                    failures = 0;
+                    continue;
+                }
+
+                batchesFailed.incrementAndGet();
+                if (result == ShipResult.REJECTED && ++failures >= maxFailures) {
+                    failures = 0;
+                    backoff = INITIAL_BACKOFF_MS;
+                    if (batch.size() == 1) {
+                        deadLetter(batch.get(0));
+                    } else {
+                        narrowBatch(batch);
+                    }
+                    continue;
+                }
+                logger.warn("Envío de lote fallido, reintentando en {} ms ({} pendientes)", backoff, depth());
+                Thread.sleep(backoff);
+                backoff = Math.min(backoff * 2, MAX_BACKOFF_MS);
+            } catch (InterruptedException e) {
+                Thread.currentThread().interrupt();
+                break;
+            } catch (Exception e) {
+                logger.error("Error en el hilo de envío del spool: {}", e.getMessage(), e);
+            }
+        }
+    }
+
+    // Espera a que haya CDR pendientes y devuelve hasta batchSize desde la cabeza (sin retirarlos)
+    private synchronized List<SpoolEntry> awaitBatch() throws InterruptedException {
+        if (queue.isEmpty()) {
+            wait(STATS_INTERVAL_MS);
+        }
+        if (queue.isEmpty()) {
+            return new ArrayList<>();
+        }
+        // Breve espera para agrupar CDR que llegan casi juntos
+        if (queue.size() < batchSize) {
+            wait(LINGER_MS);
+        }
+
+        List<SpoolEntry> batch = new ArrayList<>(Math.min(batchLimit, queue.size()));
+        for (SpoolEntry entry : queue) {
+            if (batch.size() >= batchLimit) {
+                break;
+            }
+            batch.add(entry);
+        }
+        return batch;
+    }
+
+    // Parte a la mitad el lote rechazado; la primera mitad es la nueva cabeza a enviar
+    private synchronized void narrowBatch(List<SpoolEntry> batch) {
+        batchLimit = Math.max(1, batch.size() / 2);
+        if (suspectUntilKey == null) {
+            suspectUntilKey = batch.get(batch.size() - 1).key;
+        }
+        logger.warn("Lote de {} CDR rechazado {} veces, se reintenta en lotes de {}",
+                batch.size(), maxFailures, batchLimit);
+    }
+
+    // Mueve al archivo de descarte el CDR que el servidor rechaza aun enviado solo
+    private void deadLetter(SpoolEntry entry) {
+        Map<String, Object> line = new LinkedHashMap<>();
+        line.put("k", entry.key);
+        line.put("ts", entry.enqueuedAt);
+        line.put("failed_at", System.currentTimeMillis());
+        line.put("cdr", entry.cdr);
+        try (FileChannel channel = FileChannel.open(deadLetterPath,
+                StandardOpenOption.CREATE, StandardOpenOption.WRITE, StandardOpenOption.APPEND)) {
+            writeLine(channel, line);
+        } catch (IOException e) {
+            // Sin el descarte escrito el CDR no se retira: se sigue reintentando
+            logger.error("Error escribiendo descarte del spool {}: {}", deadLetterPath, e.getMessage(), e);
+            return;
+        }
+        deadLetteredTotal.incrementAndGet();
+        logger.error("CDR rechazado {} veces por el servidor, movido a {}: {}", maxFailures, deadLetterPath, entry.cdr);
+        synchronized (this) {
+            // Aislado el CDR culpable, el resto vuelve a ir en lotes normales
+            suspectUntilKey = null;
+            batchLimit = batchSize;
+        }
+        acknowledge(List.of(entry));
+    }
+
+    private ShipResult ship(List<SpoolEntry> batch) {
+        try {
+            List<Map<String, Object>> payload = new ArrayList<>(batch.size());
+            for (SpoolEntry entry : batch) {
+                payload.add(entry.cdr);
+            }
+
+            long start = System.currentTimeMillis();
+            HttpRequest request = HttpRequest.newBuilder()
+                    .uri(URI.create(batchUrl))
+                    .timeout(Duration.ofSeconds(30))
+                    .header("Content-Type", "application/json")
+                    .POST(HttpRequest.BodyPublishers.ofString(objectMapper.writeValueAsString(payload)))
+                    .build();
+            HttpResponse<String> response = client.send(request, HttpResponse.BodyHandlers.ofString());
+            lastBatchLatencyMs = System.currentTimeMillis() - start;
+
+            int httpStatus = response.statusCode();
+            if (httpStatus < 200 || httpStatus >= 300) {
+                logger.warn("Respuesta {} de /cdr/batch: {}", httpStatus, response.body());
+                // API caído, reiniciando o saturado: no es culpa del lote
+                boolean unavailable = httpStatus == 429 || httpStatus == 502 || httpStatus == 503 || httpStatus == 504;
+                return unavailable ? ShipResult.TRANSIENT : ShipResult.REJECTED;
+            }
+
+            // Los errores de validación no se resuelven reintentando: se registran y se descartan
+            JsonNode results = objectMapper.readTree(response.body()).path("results");
+            for (JsonNode result : results) {
+                String status = result.path("status").asText();
+                if ("duplicate".equals(status)) {
+                    duplicatesTotal.incrementAndGet();
+                } else if ("error".equals(status)) {
+                    droppedInvalidTotal.incrementAndGet();
+                    int index = result.path("index").asInt(-1);
+                    logger.error("CDR descartado por el servidor: {} - {}",
+                            index >= 0 && index < batch.size() ? batch.get(index).cdr : "?",
+                            result.path("error").asText());
+                }
+            }
+
+            acknowledge(batch);
+            shippedTotal.addAndGet(batch.size());
+            batchesOk.incrementAndGet();
+            lastShippedAt = System.currentTimeMillis();
+            logger.debug("Lote de {} CDR enviado en {} ms", batch.size(), lastBatchLatencyMs);
+            return ShipResult.OK;
+
+        } catch (InterruptedException e) {
+            Thread.currentThread().interrupt();
+            return ShipResult.TRANSIENT;
+        } catch (Exception e) {
+            logger.warn("Error enviando lote de CDR: {}", e.getMessage());
+            return ShipResult.TRANSIENT;
+        }
+    }
+
+    private synchronized void acknowledge(List<SpoolEntry> batch) {
+        List<String> keys = new ArrayList<>(batch.size());
+        for (SpoolEntry entry : batch) {
+            keys.add(entry.key);
+            if (entry.key.equals(suspectUntilKey)) {
+                // El tramo del lote rechazado ya salió: se vuelve al tamaño de lote normal
+                suspectUntilKey = null;
+                batchLimit = batchSize;
+            }
+        }
+        // El lote es siempre la cabeza de la cola
+        for (int i = 0; i < batch.size() && !queue.isEmpty(); i++) {
+            queue.pollFirst();
+        }
+
+        Map<String, Object> line = new LinkedHashMap<>();
+        line.put("t", "ack");
+        line.put("k", keys);
+        appendJournal(line);
+
+        acksSinceCompaction += keys.size();
+        if (acksSinceCompaction >= COMPACT_AFTER_ACKS) {
+            try {
+                compactJournal();
+            } catch (IOException e) {
+                logger.error("Error compactando journal del spool: {}", e.getMessage(), e);
+            }
+        }
+    }
+
+    private void appendJournal(Map<String, Object> line) {
+        try {
+            if (journal == null) {
+                journal = FileChannel.open(journalPath,
+                        StandardOpenOption.CREATE, StandardOpenOption.WRITE, StandardOpenOption.APPEND);
+            }
+            writeLine(journal, line);
+        } catch (IOException e) {
+            logger.error("Error escribiendo journal del spool: {}", e.getMessage(), e);
+        }
+    }
+
+    // Una línea JSON llevada hasta el disco (flush() solo la dejaría en el caché del sistema)
+    private static void writeLine(FileChannel channel, Map<String, Object> line) throws IOException {
+        ByteBuffer buffer = ByteBuffer.wrap(
+                (objectMapper.writeValueAsString(line) + "\n").getBytes(StandardCharsets.UTF_8));
+        while (buffer.hasRemaining()) {
+            channel.write(buffer);
+        }
+        channel.force(false);
+    }
+
+    private synchronized void replayJournal() throws IOException {
+        if (!Files.exists(journalPath)) {
+            return;
+        }
+
+        Map<String, SpoolEntry> pending = new LinkedHashMap<>();
+        int corrupt = 0;
+        try (BufferedReader reader = Files.newBufferedReader(journalPath, StandardCharsets.UTF_8)) {
+            String raw;
+            while ((raw = reader.readLine()) != null) {
+                if (raw.isBlank()) {
+                    continue;
+                }
+                try {
+                    JsonNode line = objectMapper.readTree(raw);
+                    if ("add".equals(line.path("t").asText())) {
+                        Map<String, Object> cdr = objectMapper.convertValue(
+                                line.get("cdr"), new TypeReference<Map<String, Object>>() {});
+                        String key = line.path("k").asText();
+                        pending.put(key, new SpoolEntry(key, line.path("ts").asLong(), cdr));
+                    } else if ("ack".equals(line.path("t").asText())) {
+                        for (JsonNode key : line.path("k")) {
+                            pending.remove(key.asText());
+                        }
+                    }
+                } catch (Exception e) {
+                    // Una línea truncada (p.ej. corte de energía) no debe impedir el arranque
+                    corrupt++;
+                }
+            }
+        }
+
+        queue.addAll(pending.values());
+        if (corrupt > 0) {
+            logger.warn("Journal del spool: {} líneas ilegibles ignoradas", corrupt);
+        }
+    }
+
+    // Reescribe el journal con solo los pendientes y lo reemplaza de forma atómica
+    private synchronized void compactJournal() throws IOException {
+        if (journal != null) {
+            journal.close();
+            journal = null;
+        }
+
+        Path tmp = journalPath.resolveSibling(journalPath.getFileName() + ".tmp");
+        Set<String> written = new HashSet<>();
+        try (BufferedWriter writer = Files.newBufferedWriter(tmp, StandardCharsets.UTF_8)) {
+            for (SpoolEntry entry : queue) {
+                if (!written.add(entry.key)) {
+                    continue;
+                }
+                Map<String, Object> line = new LinkedHashMap<>();
+                line.put("t", "add");
+                line.put("k", entry.key);
+                line.put("ts", entry.enqueuedAt);
+                line.put("cdr", entry.cdr);
+                writer.write(objectMapper.writeValueAsString(line));
+                writer.newLine();
+            }
+        }
+        // El archivo compactado tiene que estar en disco antes de reemplazar al journal
+        try (FileChannel channel = FileChannel.open(tmp, StandardOpenOption.WRITE)) {
+            channel.force(true);
+        }
+        Files.move(tmp, journalPath, StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE);
+        acksSinceCompaction = 0;
+    }
+
+    public synchronized int depth() {
+        return queue.size();
+    }
+
+    /** Antigüedad en ms del CDR pendiente más viejo (0 si no hay pendientes) */
+    public synchronized long oldestAgeMs() {
+        SpoolEntry head = queue.peekFirst();
+        return head == null ? 0 : System.currentTimeMillis() - head.enqueuedAt;
+    }
+
+    public Map<String, Object> getStats() {
+        Map<String, Object> stats = new LinkedHashMap<>();
+        stats.put("depth", depth());
+        stats.put("oldest_age_ms", oldestAgeMs());
+        stats.put("enqueued_total", enqueuedTotal.get());
+        stats.put("shipped_total", shippedTotal.get());
+        stats.put("duplicates_total", duplicatesTotal.get());
+        stats.put("dropped_invalid_total", droppedInvalidTotal.get());
+        stats.put("dead_lettered_total", deadLetteredTotal.get());
+        stats.put("batch_limit", batchLimit);
+        stats.put("rejected_full_total", rejectedTotal.get());
+        stats.put("batches_ok", batchesOk.get());
+        stats.put("batches_failed", batchesFailed.get());
+        stats.put("last_batch_latency_ms", lastBatchLatencyMs);
+        stats.put("last_shipped_at", lastShippedAt);
+        return stats;
+    }
+
+    public static void shutdown() {
+        CdrSpool spool = instance;
+        if (spool == null) {
+            return;
+        }
+        spool.running = false;
+        spool.shipper.interrupt();
+        try {
+            spool.shipper.join(5_000);
+        } catch (InterruptedException e) {
+            Thread.currentThread().interrupt();
+        }
+        synchronized (spool) {
+            try {
+                if (spool.journal != null) {
+                    spool.journal.close();
+                    spool.journal = null;
+                }
+            } catch (IOException e) {
+                logger.warn("Error cerrando journal del spool: {}", e.getMessage());
+            }
+        }
+        logger.info("Spool de CDR detenido: {}", spool.getStats());
+    }
+}
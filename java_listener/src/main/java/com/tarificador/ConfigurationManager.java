@@ -64,6 +64,11 @@ public class ConfigurationManager {
             config.setProperty("monitor.extensions", "all");
             config.setProperty("reconnect.delay", "60");
             config.setProperty("log.level", "INFO");
+            config.setProperty("spool.journal", "/opt/tarificador/java_listener/spool/cdr-spool.journal");
+            config.setProperty("spool.capacity", "50000");
+            config.setProperty("spool.batch.size", "100");
+            config.setProperty("spool.max.failures", "3");
+            config.setProperty("spool.deadletter", "/opt/tarificador/java_listener/spool/cdr-spool.dead");
             
             // Guardar archivo
             config.store(new FileOutputStream(CONFIG_FILE), "Configuración por defecto del Tarificador");
@@ -25,6 +25,9 @@ public class TarificadorService {
         // Inicializar el gestor de configuración
         ConfigurationManager.initialize();
 
+        // Reproducir CDR pendientes del journal e iniciar su envío
+        CdrSpool.getInstance();
+
         // Iniciar servicio de monitoreo
         startMonitoring();
 
@@ -187,6 +190,11 @@ public class TarificadorService {
             }
         }
 
+        CallListener.shutdownReporting();
+
+        // Vaciar el journal a disco; lo no enviado se reenvía al arrancar
+        CdrSpool.shutdown();
+
         ConfigurationManager.shutdown();
 
         scheduler.shutdownNow();
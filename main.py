@@ -1,22 +1,37 @@
 from fastapi import FastAPI, Depends, Request, Form, Query, UploadFile, File, HTTPException
-from fastapi.responses import RedirectResponse, StreamingResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, JSONResponse, FileResponse
 from fastapi.templating import Jinja2Templates
 from fastapi_login import LoginManager
 from fastapi.staticfiles import StaticFiles
 from passlib.context import CryptContext
-from sqlalchemy import create_engine, Column, Integer, String, Numeric, DateTime, text, Boolean, ForeignKey, and_
+from sqlalchemy import create_engine, Column, Integer, String, Numeric, DateTime, text, Boolean, ForeignKey, and_, insert, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import InterfaceError, OperationalError
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from datetime import datetime, timedelta
 from collections import Counter
 import io
-import csv
 import os
+import tempfile
 import asyncio
 from typing import Optional, List, Dict, Union, Any
 from pydantic import BaseModel, validator, Field, ValidationError
 from decimal import Decimal
 from fastapi import WebSocket, WebSocketDisconnect
 import logging
+from tarificador import (
+    ActiveCallRegistry, CacheUsuarios, CdrPartitionManager, GestorExportaciones, HasheadorPines,
+    LimitadorIntentos, RatingSnapshotStore, RegistroCargas, RegistroClientesAXL, ReservationLedger,
+    SincronizadorFac, TIPOS_EXPORTACION, TrabajoPines, VerificacionSaturada, VerificadorPasswords,
+    WebSocketBroadcaster, MODO_CUCM_AUTORIDAD, MODO_DESDE_CUCM, MODO_HACIA_CUCM, MODO_IMPORTAR, ConteoCDR,
+    EstadoExportacion, acumular_resumenes, completar_backfill, aplicar_pines, aplicar_recargas, armar_pagina,
+    asegurar_indices_cdr, cargar_staging, escuchar_invalidaciones, huella_password, token_vigente,
+    condicion_cursor, consulta_exportacion_cdr, contar_pines_pendientes, csv_por_bloques, filas_validas,
+    filtros_cdr, fusionar_staging, leer_archivo_recargas, leer_filas, leer_por_bloques, nombre_archivo,
+    pdf_por_bloques, pines_pendientes, preparar_tablas_resumen, preparar_pines_pendientes, regenerar_pines,
+    registros_anexos, resumen_filtros, validar_staging, xlsx_por_bloques
+)
 
 # Configurar logging al inicio del archivo
 logging.basicConfig(
@@ -41,7 +56,19 @@ SECRET = "secreto-super-importante"
 
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Sesiones asíncronas (asyncpg) para los handlers async: no bloquean el event loop
+ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=int(os.getenv("ASYNC_DB_POOL_SIZE", "10")),
+    max_overflow=int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "10")),
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
 Base = declarative_base()
+# Instantánea en memoria de zonas, prefijos y tarifas, compartida por todas las rutas de tarificación
+rating_snapshot = RatingSnapshotStore(SessionLocal)
 app = FastAPI()
 # Montar archivos estáticos
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -67,216 +94,140 @@ class ActiveCall(BaseModel):
     estimatedCost: float
     zone: Optional[str] = "Desconocida"
 
-# Gestor de conexiones WebSocket
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self._lock = asyncio.Lock()  # Añadir un lock para evitar condiciones de carrera
+# Registro en memoria de llamadas activas (la tabla se escribe en diferido)
+active_call_registry = ActiveCallRegistry()
+last_update = datetime.now()
 
-    async def connect(self, websocket: WebSocket) -> None:
-        await websocket.accept()
-        async with self._lock:
-            self.active_connections.append(websocket)
+# Cada cuánto se vuelcan los cambios del registro a la tabla active_calls
+ACTIVE_CALLS_FLUSH_SECONDS = 2
+# Cada cuánto se envía a los clientes la duración y costo en curso
+ACTIVE_CALLS_TICK_SECONDS = 1
+
+# Retenciones de saldo de las llamadas salientes en curso
+reservation_ledger = ReservationLedger(segundos_tramo=60)
+# Errores de validación que se muestran tras una carga masiva (el resto se resume)
+CARGA_MASIVA_MAX_ERRORES = 200
+
+# Cargas masivas de anexos en curso y pool de procesos para hashear sus PINs
+cargas_anexos = RegistroCargas(ttl=3600)
+hasheador_pines = HasheadorPines(max_procesos=int(os.getenv("PINES_PROCESOS", "0")) or None)
+# Regeneraciones masivas de PINs (el CSV en claro vive en memoria hasta descargarse o vencer)
+trabajos_pines = RegistroCargas(ttl=3600, fabrica=TrabajoPines)
+
+# Clientes AXL de CUCM: el WSDL (~4.6 MB de XML) se parsea una vez por proceso;
+# una sesión keep-alive por host
+clientes_axl = RegistroClientesAXL(
+    wsdl='schema/AXLAPI.wsdl',
+    timeout=10,
+    conexiones_por_host=int(os.getenv("AXL_CONEXIONES_POR_HOST", "10")),
+)
 
-    def disconnect(self, websocket: WebSocket) -> None:
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+# Cada cuánto se renuevan tramos de reserva, y cuánto se espera el CDR de una llamada terminada
+RESERVAS_INTERVALO_SECONDS = 5
+RESERVAS_ESPERA_CDR_SECONDS = 600
 
-    async def broadcast(self, message: dict) -> None:
-        closed_connections = []
-        
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception:
-                # Marcar la conexión para eliminarla después
-                closed_connections.append(connection)
-                
-        # Eliminar las conexiones cerradas
-        for conn in closed_connections:
-            self.disconnect(conn)
+# Particiones mensuales de cdr: se crean con anticipación y se retiran al vencer la retención
+# (CDR_RETENCION_MESES=0 conserva todo el histórico)
+cdr_particiones = CdrPartitionManager(
+    meses_adelante=int(os.getenv("CDR_PARTICIONES_ADELANTE", "3")),
+    meses_retencion=int(os.getenv("CDR_RETENCION_MESES", "0")) or None,
+    modo_retencion=os.getenv("CDR_RETENCION_MODO", "archivar"),
+)
+CDR_PARTICIONES_INTERVALO_SECONDS = 6 * 3600
+# Claves de idempotencia de /cdr/batch: deben durar más que lo que un CDR puede quedar
+# reintentándose en el spool del listener (una caída larga del API incluida)
+CDR_IDEMPOTENCIA_RETENCION_DIAS = int(os.getenv("CDR_IDEMPOTENCIA_RETENCION_DIAS", "7"))
+CDR_IDEMPOTENCIA_LOTE_PURGA = 10000
+# Espera entre intentos del backfill inicial de resúmenes de CDR si falla
+RESUMENES_REINTENTO_SECONDS = 300
+
+# Exportaciones de CDR: filas por bloque del cursor y tope de filas por archivo
+# (CDR_EXPORT_MAX_ROWS=0 no pone tope; con tope, el archivo avisa si quedaron filas afuera)
+CDR_EXPORT_MAX_ROWS = int(os.getenv("CDR_EXPORT_MAX_ROWS", "1000000"))
+CDR_EXPORT_BLOQUE = int(os.getenv("CDR_EXPORT_BLOQUE", "5000"))
+
+# Exportaciones en segundo plano: pool de procesos acotado, archivos con TTL en disco
+# y pedidos idénticos dentro de la ventana de deduplicación resueltos por un único trabajo
+exportaciones = GestorExportaciones(
+    directorio=os.getenv("EXPORTACIONES_DIR", os.path.join(tempfile.gettempdir(), "tarificador_exportaciones")),
+    database_url=DATABASE_URL,
+    max_procesos=int(os.getenv("EXPORTACIONES_PROCESOS", "2")),
+    ttl=int(os.getenv("EXPORTACIONES_TTL_SECONDS", "3600")),
+    ventana_dedup=int(os.getenv("EXPORTACIONES_DEDUP_SECONDS", "300")),
+)
+EXPORTACIONES_LIMPIEZA_SECONDS = 300
+# Cuánto esperan los enlaces de descarga directa antes de devolver el id del trabajo
+EXPORTACIONES_ESPERA_SECONDS = 60
 
-ws_manager = ConnectionManager()
+# Conteos exactos recientes por filtro de búsqueda de CDR (el resto se estima con el planner)
+cdr_conteos = ConteoCDR(ttl=300)
 
-# Almacenamiento de llamadas activas con timestamp
-active_calls: Dict[str, Dict] = {}
-last_update = datetime.now()
+# Gestor de conexiones WebSocket: cola acotada y tarea de envío por cliente
+ws_manager = WebSocketBroadcaster(snapshot=active_call_registry.snapshot)
 
 # Estadísticas de WebSocket
+# (las conexiones y mensajes enviados los lleva ws_manager)
 ws_stats = {
-    "total_connections": 0,
-    "messages_sent": 0,
     "messages_received": 0
 }
 
 @app.get("/api/active-calls")
 async def get_active_calls():
     """Obtiene la lista de llamadas activas para la API"""
-    try:
-        db = SessionLocal()
-        
-        # ✅ Agregar direction a la consulta SELECT
-        active_calls_rows = db.execute(
-            text("""SELECT call_id, calling_number, called_number, direction, start_time, 
-            current_duration, current_cost, zone
-            FROM active_calls ORDER BY start_time DESC""")
-        ).fetchall()
-        
-        active_calls = []
-        for row in active_calls_rows:
-            # ✅ Extraer direction (nuevo campo en posición 3)
-            direction = row[3] if len(row) > 3 and row[3] else "unknown"
-            
-            # ✅ Crear display version con iconos
-            direction_displays = {
-                "inbound": "📱 Entrante",
-                "outbound": "📞 Saliente", 
-                "internal": "🏢 Interna",
-                "transit": "🔄 Tránsito"
-            }
-            direction_display = direction_displays.get(direction, f"❓ {direction}")
-            
-            call = {
-                "call_id": row[0],
-                "calling_number": row[1],
-                "called_number": row[2],
-                "direction": direction,                    # ✅ Campo direction
-                "direction_display": direction_display,   # ✅ Para mostrar en UI
-                "start_time": row[4].isoformat() if row[4] else None,  # ✅ Ajustar índice
-                "current_duration": row[5] if row[5] is not None else 0,  # ✅ Ajustar índice
-                "current_cost": float(row[6]) if row[6] is not None else 0.0,  # ✅ Ajustar índice
-                "zone": row[7] if len(row) > 7 else "Desconocida"  # ✅ Ajustar índice
-            }
-            active_calls.append(call)
-        
-        db.close()
-        return active_calls
-        
-    except Exception as e:
-        print(f"Error obteniendo llamadas activas: {str(e)}")
-        return {"status": "error", "message": str(e)}
+    return active_call_registry.listar()
             
 @app.get("/api/active-calls-list")
 def get_active_calls_list():
-    db = SessionLocal()
-    try:
-        active_calls_rows = db.execute(
-            text("SELECT * FROM active_calls ORDER BY start_time DESC")
-        ).fetchall()
-        
-        active_calls = []
-        for row in active_calls_rows:
-            call = {
-                "call_id": row[1],
-                "calling_number": row[2],
-                "called_number": row[3],
-                "start_time": row[4].isoformat() if row[4] else None,
-                "current_duration": row[6] if row[6] is not None else 0,
-                "current_cost": float(row[7]) if row[7] is not None else 0.0
-            }
-            active_calls.append(call)
-        
-        return active_calls
-    finally:
-        db.close()
+    return [
+        {
+            "call_id": call["call_id"],
+            "calling_number": call["calling_number"],
+            "called_number": call["called_number"],
+            "start_time": call["start_time"],
+            "current_duration": call["current_duration"],
+            "current_cost": call["current_cost"]
+        }
+        for call in active_call_registry.listar()
+    ]
 
 # Endpoint WebSocket principal
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
+    # Al conectar se encola el estado completo; después solo se envían deltas
     await ws_manager.connect(websocket)
-    print(f"Nueva conexión WebSocket establecida. Total conexiones: {len(ws_manager.active_connections)}")
+    print(f"Nueva conexión WebSocket establecida. Total conexiones: {ws_manager.connection_count}")
     
     try:
-        # Envía todas las llamadas activas al cliente que se acaba de conectar
-        db = SessionLocal()
-        active_calls_rows = db.execute(
-            text("""SELECT call_id, calling_number, called_number, start_time, 
-            current_duration, current_cost, connection_id 
-            FROM active_calls""")
-        ).fetchall()
-        db.close()
-        
-        # Convertir resultados a lista de diccionarios con exactamente los campos esperados
-        active_calls = []
-        for row in active_calls_rows:
-            call = {
-                "call_id": row[0],
-                "calling_number": row[1],
-                "called_number": row[2],
-                "start_time": row[3].isoformat() if row[3] else None,
-                "current_duration": row[4] if row[4] is not None else 0,
-                "current_cost": float(row[5]) if row[5] is not None else 0.0
-            }
-            active_calls.append(call)
-        
-        print(f"Enviando {len(active_calls)} llamadas activas iniciales: {active_calls}")
-        
-        # Asegurarse de que el formato sea exactamente lo que el cliente espera
-        await websocket.send_json({
-            "type": "update",
-            "active_calls": active_calls
-        })
-        
         # Bucle principal para recibir mensajes del cliente
         while True:
             data = await websocket.receive_text()
+            ws_stats["messages_received"] += 1
             print(f"Mensaje recibido del cliente: {data}")
             
             try:
                 message = json.loads(data)
                 action = message.get("action")
                 
-                if action == "get_active_calls":
-                    # Actualización manual solicitada por el cliente
-                    db = SessionLocal()
-                    active_calls_rows = db.execute(
-                        text("""SELECT call_id, calling_number, called_number, start_time, 
-                        current_duration, current_cost, connection_id 
-                        FROM active_calls ORDER BY start_time DESC""")
-                    ).fetchall()
-                    db.close()
-                    
-                    # Convertir resultados a lista de diccionarios
-                    active_calls = []
-                    for row in active_calls_rows:
-                        call = {
-                            "call_id": row[0],
-                            "calling_number": row[1],
-                            "called_number": row[2],
-                            "start_time": row[3].isoformat() if row[3] else None,
-                            "current_duration": row[4] if row[4] is not None else 0,
-                            "current_cost": float(row[5]) if row[5] is not None else 0.0,
-                            "connection_id": row[6]
-                        }
-                        active_calls.append(call)
-                    
-                    await websocket.send_json({
-                        "type": "update",
-                        "active_calls": active_calls
-                    })
+                if action in ("get_active_calls", "resync"):
+                    # El cliente detectó un hueco en la secuencia o pidió actualizar
+                    ws_manager.request_snapshot(websocket)
                 
                 elif action == "terminate_call" and "call_id" in message:
                     # Procesar solicitud para terminar una llamada
                     call_id = message["call_id"]
                     print(f"Solicitud para terminar llamada: {call_id}")
                     
-                    # Obtener connection_id de la llamada
-                    db = SessionLocal()
-                    result = db.execute(
-                        text(f"SELECT connection_id FROM active_calls WHERE call_id = :call_id"),
-                        {"call_id": call_id}
-                    ).fetchone()
-                    db.close()
+                    call = active_call_registry.get(call_id)
                     
-                    if result and result[0]:
+                    if call and call["connection_id"]:
                         # Implementar la terminación de la llamada
-                        await websocket.send_json({
+                        await ws_manager.send(websocket, {
                             "type": "terminate_result",
                             "call_id": call_id,
                             "success": True
                         })
                     else:
-                        await websocket.send_json({
+                        await ws_manager.send(websocket, {
                             "type": "terminate_result",
                             "call_id": call_id,
                             "success": False,
@@ -290,12 +241,75 @@ async def websocket_endpoint(websocket: WebSocket):
     
     except WebSocketDisconnect:
         ws_manager.disconnect(websocket)
-        print(f"Cliente WebSocket desconectado. Conexiones restantes: {len(ws_manager.active_connections)}")
+        print(f"Cliente WebSocket desconectado. Conexiones restantes: {ws_manager.connection_count}")
     except Exception as e:
         print(f"Error en WebSocket: {str(e)}")
         ws_manager.disconnect(websocket)    
 
 
+def _reservar_llamada(db_call: dict) -> Optional[Dict]:
+    """Abre o actualiza la reserva de saldo de una llamada saliente tarificada"""
+    if db_call["direction"] != "outbound" or db_call.get("tarifa_segundo") is None:
+        return None
+    
+    reserva = reservation_ledger.reservar(
+        db_call["call_id"], db_call["calling_number"], db_call["tarifa_segundo"],
+        called_number=db_call["called_number"], answer_time=db_call["answer_time"]
+    )
+    if reserva is None:
+        print(f"🚨 Sin saldo para reservar: {db_call['calling_number']} → {db_call['called_number']}")
+        return {"can_call": False, "segundos": 0, "monto": 0.0}
+    
+    if db_call["answer_time"]:
+        reservation_ledger.contestada(db_call["call_id"], db_call["answer_time"])
+    return {"can_call": True, "segundos": reserva.segundos, "monto": round(reserva.monto, 4)}
+
+
+def _parse_instante(valor):
+    """ISO-8601 del listener (Instant de Java, en UTC) -> hora local sin zona"""
+    if not valor:
+        return None
+    instante = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+    if instante.tzinfo:
+        instante = instante.astimezone().replace(tzinfo=None)
+    return instante
+
+
+def _mapear_llamada_activa(call_data: dict) -> dict:
+    """
+    Convierte el reporte del listener en una fila de active_calls.
+
+    Si el reporte no trae costo, la llamada se tarifica aquí una sola vez con
+    la instantánea de tarifas y el servidor calcula duración y costo en curso.
+    """
+    call_id = call_data.get("call_id")
+    fila = {
+        "call_id": call_id,
+        "calling_number": call_data.get("calling_number") or call_data.get("origin"),
+        "called_number": call_data.get("called_number") or call_data.get("destination"),
+        "direction": call_data.get("direction", "unknown"),  # ✅ Nuevo campo
+        "zone": call_data.get("zone", "Desconocida"),        # ✅ Nuevo campo
+        "start_time": _parse_instante(call_data.get("start_time")) or datetime.now(),
+        "answer_time": _parse_instante(call_data.get("answer_time")),
+        "last_updated": datetime.now(),
+        "current_duration": call_data.get("current_duration") or call_data.get("duration", 0),
+        "current_cost": call_data.get("current_cost") or call_data.get("estimatedCost", 0),
+        "connection_id": call_data.get("connection_id") or call_id
+    }
+    
+    if "current_cost" not in call_data and "estimatedCost" not in call_data:
+        if fila["direction"] == "outbound" and fila["called_number"]:
+            tarifa = determinar_zona_y_tarifa(fila["called_number"], None)
+            fila["zone"] = tarifa["zona_nombre"] or "Desconocida"
+            fila["zona_id"] = tarifa["zona_id"]
+            fila["tarifa_segundo"] = tarifa["tarifa_segundo"]
+        else:
+            fila["zone"] = "Entrante"
+            fila["tarifa_segundo"] = 0.0
+    
+    return fila
+
+
 @app.post("/api/active-calls")
 async def report_active_call(call_data: dict):
     print(f"Recibido reporte de llamada activa: {call_data}")
@@ -308,19 +322,7 @@ async def report_active_call(call_data: dict):
             return {"status": "error", "message": "call_id es requerido"}
         
         # ✅ Mapear campos incluyendo direction y zone
-        db_call = {
-            "call_id": call_id,
-            "calling_number": call_data.get("calling_number") or call_data.get("origin"),
-            "called_number": call_data.get("called_number") or call_data.get("destination"),
-            "direction": call_data.get("direction", "unknown"),  # ✅ Nuevo campo
-            "zone": call_data.get("zone", "Desconocida"),        # ✅ Nuevo campo
-            "start_time": datetime.fromisoformat(call_data.get("start_time").replace('Z', '+00:00')) 
-                if call_data.get("start_time") else datetime.now(),
-            "last_updated": datetime.now(),
-            "current_duration": call_data.get("current_duration") or call_data.get("duration", 0),
-            "current_cost": call_data.get("current_cost") or call_data.get("estimatedCost", 0),
-            "connection_id": call_data.get("connection_id") or call_id
-        }
+        db_call = _mapear_llamada_activa(call_data)
         
         # ✅ Logging mejorado con iconos
         direction_icons = {
@@ -333,148 +335,37 @@ async def report_active_call(call_data: dict):
         
         print(f"{icon} {db_call['calling_number']} → {db_call['called_number']} "
               f"[{db_call['direction'].upper()}] "
-              f"(dur: {db_call['current_duration']}s, costo: ${db_call['current_cost']:.2f})")
+              f"(zona: {db_call['zone']}, contestada: {db_call['answer_time'] or 'no'})")
         
-        # Actualizar en la base de datos
-        db = SessionLocal()
+        # Actualizar el registro; la tabla se escribe en el próximo volcado
+        delta = active_call_registry.upsert(db_call)
         
-        try:
-            # Verificar si ya existe
-            existing = db.execute(
-                text("SELECT id FROM active_calls WHERE call_id = :call_id"),
-                {"call_id": call_id}
-            ).fetchone()
-            
-            if existing:
-                # Actualizar
-                set_clause = ", ".join([f"{k} = :{k}" for k in db_call.keys()])
-                query = text(f"UPDATE active_calls SET {set_clause} WHERE call_id = :call_id")
-                db.execute(query, db_call)
-            else:
-                # Insertar nuevo
-                columns = ", ".join(db_call.keys())
-                placeholders = ", ".join([f":{k}" for k in db_call.keys()])
-                query = text(f"INSERT INTO active_calls ({columns}) VALUES ({placeholders})")
-                db.execute(query, db_call)
-            
-            db.commit()
-            
-            # ✅ Consulta actualizada para incluir direction y zone
-            db = SessionLocal()
-            active_calls_rows = db.execute(
-                text("""SELECT id, call_id, calling_number, called_number, direction, 
-                        start_time, current_duration, current_cost, zone 
-                        FROM active_calls ORDER BY start_time DESC""")
-            ).fetchall()
-            
-            # Convertir a formato que el cliente espera
-            active_calls = []
-            for row in active_calls_rows:
-                # ✅ Mapear todos los campos incluyendo direction
-                direction = row[4] if len(row) > 4 and row[4] else "unknown"
-                zone = row[8] if len(row) > 8 and row[8] else "Desconocida"
-                
-                # ✅ Crear display version para el frontend
-                direction_displays = {
-                    "inbound": "📱 Entrante",
-                    "outbound": "📞 Saliente", 
-                    "internal": "🏢 Interna",
-                    "transit": "🔄 Tránsito"
-                }
-                direction_display = direction_displays.get(direction, f"❓ {direction}")
-                
-                call = {
-                    "call_id": row[1],
-                    "calling_number": row[2],
-                    "called_number": row[3],
-                    "direction": direction,                    # ✅ Campo original
-                    "direction_display": direction_display,   # ✅ Para mostrar en UI
-                    "start_time": row[5].isoformat() if row[5] else None,
-                    "current_duration": row[6] if row[6] is not None else 0,
-                    "current_cost": float(row[7]) if row[7] is not None else 0.0,
-                    "zone": zone                              # ✅ Zona
-                }
-                active_calls.append(call)
-            
-            # Broadcast con debug
-            if ws_manager.active_connections:
-                message = {
-                    "type": "update",
-                    "active_calls": active_calls
-                }
-                print(f"Enviando broadcast con {len(active_calls)} llamadas activas")
-                # ✅ Solo mostrar detalles de la primera llamada para evitar spam
-                if active_calls:
-                    first_call = active_calls[0]
-                    print(f"  Ejemplo: {first_call['calling_number']} → {first_call['called_number']} [{first_call['direction']}]")
-                
-                await ws_manager.broadcast(message)
-                print(f"Broadcast enviado a {len(ws_manager.active_connections)} conexiones")
-            
-            return {"status": "ok", "active_calls_count": len(active_calls)}
-                
-        except Exception as e:
-            db.rollback()
-            print(f"Error en BD: {str(e)}")
-            raise
-        finally:
-            db.close()
+        if delta and ws_manager.active_connections:
+            await ws_manager.broadcast(delta)
+        
+        respuesta = {"status": "ok", "active_calls_count": len(active_call_registry)}
+        reserva = _reservar_llamada(db_call)
+        if reserva is not None:
+            respuesta["reservation"] = reserva
+        return respuesta
             
     except Exception as e:
         print(f"Error general: {str(e)}")
         return {"status": "error", "message": str(e)}
-    
+
 
 @app.delete("/api/active-calls/{call_id}")
 async def remove_active_call(call_id: str):
     try:
-        db = SessionLocal()
+        delta = active_call_registry.remove(call_id)
         
-        # Buscar primero por call_id
-        result = db.execute(
-            text("SELECT id FROM active_calls WHERE call_id = :call_id"),
-            {"call_id": call_id}
-        ).fetchone()
-        
-        # Si no se encuentra, buscar por connection_id como alternativa
-        if not result:
-            result = db.execute(
-                text("SELECT id FROM active_calls WHERE connection_id = :call_id"),
-                {"call_id": call_id}
-            ).fetchone()
-        
-        if result:
-            # Eliminar la llamada
-            db.execute(
-                text("DELETE FROM active_calls WHERE id = :id"),
-                {"id": result[0]}
-            )
-            db.commit()
+        if delta:
             print(f"Llamada eliminada: {call_id}")
+            # La retención queda reducida a lo consumido hasta que llegue el CDR
+            reservation_ledger.finalizar(delta["call_id"])
             
-            # Obtener lista actualizada para broadcast
-            active_calls_rows = db.execute(
-                text("SELECT call_id, calling_number, called_number, start_time, current_duration, current_cost FROM active_calls")
-            ).fetchall()
-            
-            # Broadcast a clientes WebSocket
             if ws_manager.active_connections:
-                active_calls = []
-                for row in active_calls_rows:
-                    call = {
-                        "call_id": row[0],
-                        "calling_number": row[1],
-                        "called_number": row[2],
-                        "start_time": row[3].isoformat() if row[3] else None,
-                        "current_duration": row[4] if row[4] is not None else 0,
-                        "current_cost": float(row[5]) if row[5] is not None else 0.0
-                    }
-                    active_calls.append(call)
-                
-                await ws_manager.broadcast({
-                    "type": "update",
-                    "active_calls": active_calls
-                })
+                await ws_manager.broadcast(delta)
             
             return {"status": "ok", "message": f"Llamada {call_id} eliminada correctamente"}
         else:
@@ -484,17 +375,300 @@ async def remove_active_call(call_id: str):
     except Exception as e:
         print(f"Error al eliminar llamada activa: {str(e)}")
         return {"status": "error", "message": str(e)}
-        
+
+
+def volcar_llamadas_activas():
+    db = SessionLocal()
+    try:
+        return active_call_registry.volcar(db)
+    finally:
+        db.close()
+
+
+async def _volcado_llamadas_activas():
+    """Escribe periódicamente en active_calls los cambios del registro"""
+    while True:
+        await asyncio.sleep(ACTIVE_CALLS_FLUSH_SECONDS)
+        try:
+            await asyncio.to_thread(volcar_llamadas_activas)
+        except Exception as e:
+            print(f"Error volcando llamadas activas: {str(e)}")
+
+
+async def _tick_llamadas_activas():
+    """Envía a los clientes la duración y el costo en curso de las llamadas contestadas"""
+    while True:
+        await asyncio.sleep(ACTIVE_CALLS_TICK_SECONDS)
+        try:
+            if ws_manager.connection_count:
+                tick = active_call_registry.ticks()
+                if tick["calls"]:
+                    await ws_manager.broadcast(tick)
+        except Exception as e:
+            print(f"Error enviando tick de llamadas activas: {str(e)}")
+
+
+async def _mantenimiento_reservas():
+    """Renueva tramos de las llamadas en curso y libera reservas sin CDR"""
+    while True:
+        await asyncio.sleep(RESERVAS_INTERVALO_SECONDS)
+        try:
+            for reserva in reservation_ledger.renovar():
+                print(f"🚨 Saldo agotado durante la llamada {reserva.call_id}: "
+                      f"{reserva.calling_number} → {reserva.called_number}")
+                await ws_manager.broadcast({
+                    "type": "balance_exhausted",
+                    "call_id": reserva.call_id,
+                    "calling_number": reserva.calling_number
+                })
+            reservation_ledger.liberar_vencidas(RESERVAS_ESPERA_CDR_SECONDS)
+        except Exception as e:
+            print(f"Error en mantenimiento de reservas: {str(e)}")
+
+
+def mantener_particiones_cdr():
+    db = SessionLocal()
+    try:
+        # Una base nueva se particiona sola; un histórico existente se migra a mano
+        cdr_particiones.migrar(db, solo_si_vacia=True)
+        resultado = cdr_particiones.mantener(db)
+    finally:
+        db.close()
+    if resultado["creadas"] or resultado["retiradas"]:
+        print(f"🗂️  Particiones de cdr creadas: {resultado['creadas']} | retiradas: {resultado['retiradas']}")
+    return resultado
+
+
+def purgar_idempotencia_cdr():
+    """Borra, de a lotes, las claves de idempotencia más viejas que la retención"""
+    limite = datetime.utcnow() - timedelta(days=CDR_IDEMPOTENCIA_RETENCION_DIAS)
+    db = SessionLocal()
+    total = 0
+    try:
+        db.execute(text("CREATE INDEX IF NOT EXISTS ix_cdr_idempotencia_fecha ON cdr_idempotencia (fecha)"))
+        db.commit()
+        while True:
+            borradas = db.execute(text("""
+                DELETE FROM cdr_idempotencia
+                WHERE clave IN (
+                    SELECT clave FROM cdr_idempotencia
+                    WHERE fecha < :limite OR fecha IS NULL
+                    LIMIT :lote
+                )
+            """), {"limite": limite, "lote": CDR_IDEMPOTENCIA_LOTE_PURGA}).rowcount
+            db.commit()
+            total += borradas
+            if borradas < CDR_IDEMPOTENCIA_LOTE_PURGA:
+                break
+    finally:
+        db.close()
+    if total:
+        print(f"🗑️  Claves de idempotencia de CDR purgadas: {total}")
+    return total
+
+
+def preparar_indices_cdr():
+    db = SessionLocal()
+    try:
+        creados = asegurar_indices_cdr(db)
+    finally:
+        db.close()
+    if creados:
+        print(f"🗂️  Índices de cdr creados: {creados}")
+
+
+async def _mantenimiento_particiones_cdr():
+    """Crea las particiones de los próximos meses, aplica la retención y purga claves de idempotencia"""
+    # Primera vuelta: particionar (si corresponde) y luego crear los índices de búsqueda
+    try:
+        await asyncio.to_thread(mantener_particiones_cdr)
+        await asyncio.to_thread(preparar_indices_cdr)
+    except Exception as e:
+        print(f"Error preparando particiones e índices de cdr: {str(e)}")
+    while True:
+        try:
+            await asyncio.to_thread(purgar_idempotencia_cdr)
+        except Exception as e:
+            print(f"Error purgando claves de idempotencia de CDR: {str(e)}")
+        await asyncio.sleep(CDR_PARTICIONES_INTERVALO_SECONDS)
+        try:
+            await asyncio.to_thread(mantener_particiones_cdr)
+        except Exception as e:
+            print(f"Error en mantenimiento de particiones de cdr: {str(e)}")
+
+
+def preparar_resumenes_cdr():
+    db = SessionLocal()
+    try:
+        preparar_tablas_resumen(db)
+        # Backfill desde el histórico de cdr hasta que quede registrado como completo
+        filas = completar_backfill(db)
+        if filas is not None:
+            print(f"📊 Resúmenes de CDR generados desde el histórico: {filas} filas horarias")
+    finally:
+        db.close()
+
+
+async def _reintentar_resumenes_cdr():
+    while True:
+        await asyncio.sleep(RESUMENES_REINTENTO_SECONDS)
+        try:
+            await asyncio.to_thread(preparar_resumenes_cdr)
+            return
+        except Exception as e:
+            print(f"Error preparando resúmenes de CDR (se reintenta en {RESUMENES_REINTENTO_SECONDS}s): {str(e)}")
+
+
+@app.on_event("startup")
+async def iniciar_resumenes_cdr():
+    try:
+        await asyncio.to_thread(preparar_resumenes_cdr)
+    except Exception as e:
+        print(f"Error preparando resúmenes de CDR (se reintenta en {RESUMENES_REINTENTO_SECONDS}s): {str(e)}")
+        asyncio.create_task(_reintentar_resumenes_cdr())
+
+
+def revisar_pines_pendientes():
+    db = SessionLocal()
+    try:
+        preparar_pines_pendientes(db)
+        pendientes = contar_pines_pendientes(db)
+    finally:
+        db.close()
+    if pendientes:
+        print(f"⚠️  {pendientes} anexos de cargas masivas sin PIN guardado: "
+              f"reanudar con POST /anexos/pines_pendientes")
+
+
+@app.on_event("startup")
+async def iniciar_revision_pines_pendientes():
+    try:
+        await asyncio.to_thread(revisar_pines_pendientes)
+    except Exception as e:
+        print(f"Error revisando PINs pendientes de anexos: {str(e)}")
+
+
+@app.on_event("startup")
+async def iniciar_registro_llamadas_activas():
+    db = SessionLocal()
+    try:
+        active_call_registry.preparar_tabla(db)
+        active_call_registry.cargar(db)
+        # Saldos desde saldo_anexos más una reserva por cada llamada abierta
+        reservation_ledger.cargar(db, active_call_registry.filas())
+    except Exception as e:
+        print(f"Error cargando llamadas activas: {str(e)}")
+    finally:
+        db.close()
+    asyncio.create_task(_volcado_llamadas_activas())
+    asyncio.create_task(_tick_llamadas_activas())
+    asyncio.create_task(_mantenimiento_reservas())
+    asyncio.create_task(_mantenimiento_particiones_cdr())
+
+
+@app.on_event("shutdown")
+def detener_registro_llamadas_activas():
+    try:
+        volcar_llamadas_activas()
+    except Exception as e:
+        print(f"Error en el volcado final de llamadas activas: {str(e)}")
+
+
+@app.on_event("startup")
+async def iniciar_invalidacion_usuarios():
+    asyncio.create_task(escuchar_invalidaciones(DATABASE_URL, usuarios_cache))
+
+
+@app.on_event("startup")
+async def iniciar_verificador_passwords():
+    # Los procesos del pool se arrancan ya, no en el primer login
+    async def calentar():
+        try:
+            await asyncio.to_thread(verificador_passwords.calentar)
+        except Exception as e:
+            print(f"Error arrancando el pool de verificación de contraseñas: {str(e)}")
+    asyncio.create_task(calentar())
+
+
+@app.on_event("shutdown")
+async def cerrar_pool_asincrono():
+    await async_engine.dispose()
+
+
+async def _limpieza_exportaciones():
+    """Borra los archivos de exportación cuyo TTL venció"""
+    while True:
+        await asyncio.sleep(EXPORTACIONES_LIMPIEZA_SECONDS)
+        try:
+            borrados = exportaciones.limpiar()
+            if borrados:
+                print(f"🧹 Exportaciones vencidas eliminadas: {borrados}")
+        except Exception as e:
+            print(f"Error limpiando exportaciones: {str(e)}")
+
+
+@app.on_event("startup")
+async def iniciar_exportaciones():
+    try:
+        exportaciones.iniciar()
+    except Exception as e:
+        print(f"Error preparando el directorio de exportaciones: {str(e)}")
+    asyncio.create_task(_limpieza_exportaciones())
+
+
+def _calentar_cliente_axl():
+    medicion = clientes_axl.calentar(
+        os.getenv('CUCM_ADDRESS', '190.105.250.127'),
+        os.getenv('CUCM_USERNAME', 'admin'),
+        os.getenv('CUCM_PASSWORD', 'fr4v4t3l'),
+    )
+    print(
+        f"📡 Cliente AXL listo: frío {medicion['frio_ms']} ms, "
+        f"tibio {medicion['tibio_ms']} ms"
+    )
+
+
+@app.on_event("startup")
+async def iniciar_cliente_axl():
+    # En un hilo: el primer parseo del WSDL no debe frenar el arranque
+    async def calentar():
+        try:
+            await asyncio.to_thread(_calentar_cliente_axl)
+        except Exception as e:
+            print(f"Error preparando el cliente AXL: {str(e)}")
+    asyncio.create_task(calentar())
+
+
+@app.on_event("shutdown")
+def detener_exportaciones():
+    exportaciones.detener()
+    hasheador_pines.detener()
+    verificador_passwords.detener()
+
 # Endpoints para estadísticas y monitoreo
 @app.get("/api/ws-stats")
 async def get_ws_stats():
+    connections = ws_manager.stats()
     return {
         **ws_stats,
+        "total_connections": ws_manager.total_conexiones,
+        "messages_published": ws_manager.mensajes_publicados,
+        "messages_sent": sum(conn["messages_sent"] for conn in connections),
+        "clients_dropped": ws_manager.clientes_expulsados,
         "active_connections": ws_manager.connection_count,
-        "active_calls_count": len(active_calls),
+        "connections": connections,
+        "active_calls_count": len(active_call_registry),
         "timestamp": datetime.now().isoformat()
     }
 
+
+@app.get("/api/reservas")
+async def get_reservas():
+    """Retenciones de saldo vigentes"""
+    return reservation_ledger.stats()
+
+# En la base, cdr está particionada por mes sobre start_time (ver tarificador/particiones.py):
+# no tiene PK física, el id sigue siendo único porque lo asigna la secuencia
 class CDR(Base):
     __tablename__ = "cdr"
     id = Column(Integer, primary_key=True, index=True)
@@ -546,6 +720,8 @@ class Anexo(Base):
     area_nivel2 = Column(String, nullable=True)
     area_nivel3 = Column(String, nullable=True)
     pin = Column(String)  # Almacenaremos un hash del PIN
+    # Creado por carga masiva y con el hash del PIN todavía sin guardar
+    pin_pendiente = Column(Boolean, nullable=False, default=False, server_default="false")
     saldo_actual = Column(Numeric(10, 2), default=0)
     fecha_creacion = Column(DateTime, default=datetime.utcnow)
     activo = Column(Boolean, default=True)
@@ -612,6 +788,13 @@ class Tarifa(Base):
     activa = Column(Boolean, default=True)
     zona = relationship("Zona", back_populates="tarifas")
 
+# Claves de idempotencia de los CDR recibidos por /cdr/batch
+class CdrIdempotencia(Base):
+    __tablename__ = "cdr_idempotencia"
+    clave = Column(String, primary_key=True)
+    cdr_id = Column(Integer, nullable=True)
+    fecha = Column(DateTime, default=datetime.utcnow)
+
 Base.metadata.create_all(bind=engine)
 
 # Función para inicializar zonas y prefijos
@@ -724,56 +907,40 @@ def inicializar_zonas_y_prefijos():
 def determinar_zona_y_tarifa(numero_marcado: str, db):
     """
     Determina la zona del número marcado y obtiene la tarifa correspondiente.
-    Usa SQLAlchemy ORM con los modelos Zona, Prefijo y Tarifa.
+    Zona y tarifa se resuelven con la instantánea de tarifas en memoria.
     """
     # Limpiar el número (quitar caracteres especiales)
     numero_limpio = ''.join(filter(str.isdigit, numero_marcado))
     longitud_numero = len(numero_limpio)
-    
-    # Buscar prefijos que coincidan con la longitud del número
-    prefijos_candidatos = db.query(Prefijo).filter(
-        Prefijo.longitud_minima <= longitud_numero,
-        Prefijo.longitud_maxima >= longitud_numero
-    ).all()
-    
-    # Encontrar el prefijo más específico (más largo) que coincida
-    mejor_prefijo = None
-    mejor_longitud = 0
-    
-    for prefijo_obj in prefijos_candidatos:
-        # Verificar si el número comienza con este prefijo
-        if numero_limpio.startswith(prefijo_obj.prefijo):
-            # Si este prefijo es más específico (más largo), usarlo
-            if len(prefijo_obj.prefijo) > mejor_longitud:
-                mejor_prefijo = prefijo_obj
-                mejor_longitud = len(prefijo_obj.prefijo)
-    
+
+    snapshot = rating_snapshot.actual
+
+    # Prefijo más específico (más largo) que admite la longitud del número
+    mejor_prefijo = snapshot.buscar(numero_limpio)
+
     if mejor_prefijo:
-        # Obtener la tarifa activa para esta zona usando la relación
-        tarifa_activa = db.query(Tarifa).filter(
-            Tarifa.zona_id == mejor_prefijo.zona_id,
-            Tarifa.activa == True
-        ).order_by(Tarifa.fecha_inicio.desc()).first()
+        # Tarifa activa de la zona según la instantánea vigente
+        tarifa_activa = snapshot.tarifa(mejor_prefijo.zona_id)
         
         if tarifa_activa:
             return {
-                'prefijo_id': mejor_prefijo.id,
+                'prefijo_id': mejor_prefijo.prefijo_id,
                 'zona_id': mejor_prefijo.zona_id,
                 'prefijo': mejor_prefijo.prefijo,
-                'zona_nombre': mejor_prefijo.zona.nombre,
-                'zona_descripcion': mejor_prefijo.zona.descripcion,
-                'tarifa_segundo': float(tarifa_activa.tarifa_segundo),
-                'tarifa_id': tarifa_activa.id,
+                'zona_nombre': mejor_prefijo.zona_nombre,
+                'zona_descripcion': mejor_prefijo.zona_descripcion,
+                'tarifa_segundo': tarifa_activa.tarifa_segundo,
+                'tarifa_id': tarifa_activa.tarifa_id,
                 'numero_valido': True
             }
         else:
             # No hay tarifa activa para esta zona
             return {
-                'prefijo_id': mejor_prefijo.id,
+                'prefijo_id': mejor_prefijo.prefijo_id,
                 'zona_id': mejor_prefijo.zona_id,
                 'prefijo': mejor_prefijo.prefijo,
-                'zona_nombre': mejor_prefijo.zona.nombre,
-                'zona_descripcion': f"Sin tarifa activa: {mejor_prefijo.zona.descripcion}",
+                'zona_nombre': mejor_prefijo.zona_nombre,
+                'zona_descripcion': f"Sin tarifa activa: {mejor_prefijo.zona_descripcion}",
                 'tarifa_segundo': 0.0,
                 'tarifa_id': None,
                 'numero_valido': False
@@ -798,51 +965,55 @@ def check_balance_for_call(calling_number: str, called_number: str):
     Sistema basado completamente en segundos.
     """
     try:
-        # Obtener saldo actual
-        with SessionLocal() as db:
-            saldo_anexo = db.query(SaldoAnexo).filter(
-                SaldoAnexo.calling_number == calling_number
-            ).first()
-            
-            if not saldo_anexo:
-                return {
-                    "has_balance": False, 
-                    "balance": 0.0, 
-                    "can_call": False, 
-                    "reason": "No account found"
-                }
-            
-            saldo_actual = float(saldo_anexo.saldo)
-            
-            # Determinar zona y tarifa para el número de destino
-            zona_info = determinar_zona_y_tarifa(called_number, db)
-            
-            if not zona_info['numero_valido']:
-                return {
-                    "has_balance": saldo_actual > 0,
-                    "balance": saldo_actual,
-                    "can_call": False,
-                    "reason": f"Invalid destination number: {called_number}"
-                }
-            
-            # Todo basado en segundos
-            tarifa_segundo = zona_info['tarifa_segundo']
-            
-            # Verificar si puede realizar al menos 1 segundo de llamada
-            can_call = saldo_actual >= tarifa_segundo
-            
-            # Calcular tiempo disponible en segundos
-            tiempo_disponible_segundos = int(saldo_actual / tarifa_segundo) if tarifa_segundo > 0 else 999999
-            
+        # Saldo disponible = saldo en BD menos lo retenido por llamadas en curso
+        if not reservation_ledger.tiene_cuenta(calling_number):
+            # Anexo creado después de cargar el libro
+            with SessionLocal() as db:
+                reservation_ledger.refrescar_saldos(db, [calling_number])
+        
+        cuenta = reservation_ledger.consultar(calling_number)
+        if cuenta is None:
+            return {
+                "has_balance": False, 
+                "balance": 0.0, 
+                "can_call": False, 
+                "reason": "No account found"
+            }
+        
+        saldo_actual = cuenta["saldo"]
+        disponible = cuenta["disponible"]
+        
+        # Determinar zona y tarifa para el número de destino
+        zona_info = determinar_zona_y_tarifa(called_number, None)
+        
+        if not zona_info['numero_valido']:
             return {
                 "has_balance": saldo_actual > 0,
                 "balance": saldo_actual,
-                "can_call": can_call,
-                "zona": zona_info['zona_nombre'],
-                "tarifa_segundo": tarifa_segundo,
-                "tiempo_disponible_segundos": tiempo_disponible_segundos
+                "can_call": False,
+                "reason": f"Invalid destination number: {called_number}"
             }
         
+        # Todo basado en segundos
+        tarifa_segundo = zona_info['tarifa_segundo']
+        
+        # Verificar si puede realizar al menos 1 segundo de llamada
+        can_call = disponible >= tarifa_segundo
+        
+        # Calcular tiempo disponible en segundos
+        tiempo_disponible_segundos = int(disponible / tarifa_segundo) if tarifa_segundo > 0 else 999999
+        
+        return {
+            "has_balance": saldo_actual > 0,
+            "balance": saldo_actual,
+            "reserved": cuenta["retenido"],
+            "available": disponible,
+            "can_call": can_call,
+            "zona": zona_info['zona_nombre'],
+            "tarifa_segundo": tarifa_segundo,
+            "tiempo_disponible_segundos": tiempo_disponible_segundos
+        }
+    
     except Exception as e:
         print(f"Error verificando saldo para llamada: {e}")
         import traceback
@@ -858,29 +1029,13 @@ def check_balance_for_call(calling_number: str, called_number: str):
 @app.on_event("startup")
 def startup_event():
     inicializar_zonas_y_prefijos()
+    rating_snapshot.recargar()
 
 # Función para determinar la zona de un número
 def determinar_zona(numero):
-    db = SessionLocal()
-    
-    # Consultar todos los prefijos ordenados por longitud descendente
-    query = text("""
-        SELECT id, zona_id, prefijo, longitud_minima, longitud_maxima 
-        FROM prefijos 
-        ORDER BY LENGTH(prefijo) DESC
-    """)
-    
-    prefijos = db.execute(query).fetchall()
-    db.close()
-    
-    for prefijo in prefijos:
-        prefijo_str = prefijo[2]
-        longitud_minima = prefijo[3]
-        longitud_maxima = prefijo[4]
-        
-        if (numero.startswith(prefijo_str) and 
-            longitud_minima <= len(numero) <= longitud_maxima):
-            return prefijo[1]  # Retornar zona_id
+    regla = rating_snapshot.buscar(numero)
+    if regla:
+        return regla.zona_id  # Retornar zona_id
     
     return None  # Si no se encuentra una zona
 
@@ -889,85 +1044,134 @@ def obtener_tarifa(zona_id):
     if not zona_id:
         return 0.0005  # Tarifa por defecto si no se encuentra zona
     
-    db = SessionLocal()
-    
-    query = text("""
-        SELECT tarifa_segundo 
-        FROM tarifas 
-        WHERE zona_id = :zona_id AND activa = TRUE 
-        ORDER BY fecha_inicio DESC 
-        LIMIT 1
-    """)
-    
-    result = db.execute(query, {"zona_id": zona_id}).fetchone()
-    db.close()
-    
-    if result:
-        return float(result[0])
+    tarifa = rating_snapshot.actual.tarifa(zona_id)
+    if tarifa:
+        return tarifa.tarifa_segundo
     
     return 0.0005  # Tarifa por defecto si no hay tarifa activa
 
-@manager.user_loader()
-def load_user(username: str):
+def consultar_usuario(username: str):
+    """Usuario desde la tabla 'usuarios' (las excepciones se propagan para no cachear errores)"""
+    db = SessionLocal()
     try:
-        # Usar SQLAlchemy para consultar el usuario en la tabla 'usuarios'
-        db = SessionLocal()
         # Usamos text para ejecutar una consulta SQL directa
         query = text("SELECT username, password, role FROM usuarios WHERE username = :username")
         result = db.execute(query, {"username": username}).fetchone()
-        
-        if result:
-            # Devolver un diccionario con los datos del usuario
-            user_dict = {
-                "username": result[0],
-                "password": result[1],
-                "role": result[2]
-            }
-            db.close()
-            return user_dict
-        else:
-            db.close()
+        if not result:
             return None
+        # Devolver un diccionario con los datos del usuario
+        return {
+            "username": result[0],
+            "password": result[1],
+            "role": result[2]
+        }
+    finally:
+        db.close()
+
+# Usuarios recientes en memoria: se invalidan por NOTIFY (cambiar_password.py) o al vencer el TTL
+usuarios_cache = CacheUsuarios(
+    consultar_usuario,
+    ttl=int(os.getenv("USUARIOS_CACHE_TTL_SECONDS", "60")),
+    max_entradas=int(os.getenv("USUARIOS_CACHE_MAX", "1024")),
+)
+
+# bcrypt del login en un pool de procesos: no ocupa hilos del threadpool que usan /cdr y /check_balance*
+verificador_passwords = VerificadorPasswords(
+    max_procesos=int(os.getenv("LOGIN_PROCESOS", "2")),
+    max_en_curso=int(os.getenv("LOGIN_MAX_EN_CURSO", "0")) or None,
+)
+# Intentos de login: fallidos por usuario y todos por IP (0 desactiva el límite)
+limite_login_usuario = LimitadorIntentos(
+    max_intentos=int(os.getenv("LOGIN_FALLOS_POR_USUARIO", "5")),
+    ventana=int(os.getenv("LOGIN_VENTANA_USUARIO_SECONDS", "300")),
+)
+limite_login_ip = LimitadorIntentos(
+    max_intentos=int(os.getenv("LOGIN_INTENTOS_POR_IP", "30")),
+    ventana=int(os.getenv("LOGIN_VENTANA_IP_SECONDS", "60")),
+)
+
+@manager.user_loader()
+def load_user(username: str):
+    try:
+        return usuarios_cache.obtener(username)
     except Exception as e:
         print(f"Error cargando usuario desde DB: {e}")
         return None
-        
-async def authenticated_user(request: Request):
+
+async def _usuario_del_token(request: Request, role: Optional[str] = None):
     token = request.cookies.get(manager.cookie_name)
     if token is None:
         return RedirectResponse(url="/login")
     try:
-        user = await manager.get_current_user(token)
+        payload = manager._get_payload(token)
     except Exception:
         return RedirectResponse(url="/login")
-    return user
+    username = payload.get("sub")
+    # El rol viaja en el token: un rol equivocado se rechaza sin buscar al usuario
+    if username is None or (role and payload.get("role") not in (None, role)):
+        return RedirectResponse(url="/login")
 
-async def admin_only(request: Request):
-    user = await authenticated_user(request)
-    # Si authenticated_user devuelve un RedirectResponse, simplemente devuélvelo
-    if isinstance(user, RedirectResponse):
-        return user
-    if user["role"] != "admin":
+    encontrado, user = usuarios_cache.buscar(username)
+    if not encontrado:
+        user = await asyncio.to_thread(load_user, username)
+    if user is None or not token_vigente(payload, user):
+        return RedirectResponse(url="/login")
+    if role and user["role"] != role:
         return RedirectResponse(url="/login")
     return user
 
+async def authenticated_user(request: Request):
+    return await _usuario_del_token(request)
+
+async def admin_only(request: Request):
+    return await _usuario_del_token(request, role="admin")
+
+def _login_rechazado(request: Request, error: str, status_code: int, espera: float):
+    return templates.TemplateResponse(
+        "login.html", {"request": request, "error": error},
+        status_code=status_code, headers={"Retry-After": str(int(espera) + 1)},
+    )
+
 @app.post("/auth/login")
-def login(request: Request, username: str = Form(...), password: str = Form(...)):
-    user = load_user(username)
-    if not user or not pwd_context.verify(password, user['password']):
+async def login(request: Request, username: str = Form(...), password: str = Form(...)):
+    ip = request.client.host if request.client else "desconocida"
+    # Rechazo barato, antes de consultar la base o hashear
+    espera = max(limite_login_ip.espera(ip), limite_login_usuario.espera(username))
+    if espera:
+        return _login_rechazado(
+            request, f"Demasiados intentos. Intente de nuevo en {int(espera) + 1} segundos", 429, espera
+        )
+    limite_login_ip.registrar(ip)
+
+    try:
+        # Siempre desde la base: el login también refresca la caché
+        user = await asyncio.to_thread(usuarios_cache.recargar, username)
+    except Exception as e:
+        print(f"Error cargando usuario desde DB: {e}")
+        user = None
+    try:
+        valido = bool(user) and await verificador_passwords.verificar(password, user['password'])
+    except VerificacionSaturada:
+        return _login_rechazado(request, "Servidor ocupado. Intente de nuevo en unos segundos", 503, 1)
+    if not valido:
+        limite_login_usuario.registrar(username)
         return templates.TemplateResponse("login.html", {"request": request, "error": "Credenciales inválidas"})
+    limite_login_usuario.limpiar(username)
 
     # Actualizar último login
+    db = AsyncSessionLocal()
     try:
-        db = SessionLocal()
         update_query = text("UPDATE usuarios SET ultimo_login = CURRENT_TIMESTAMP WHERE username = :username")
-        db.execute(update_query, {"username": username})
-        db.commit()
-        db.close()
+        await db.execute(update_query, {"username": username})
+        await db.commit()
     except Exception as e:
         print(f"Error actualizando último login: {e}")
+    finally:
+        await db.close()
 
-    access_token = manager.create_access_token(data={"sub": username})
+    access_token = manager.create_access_token(
+        data={"sub": username, "role": user["role"], "pv": huella_password(user["password"])}
+    )
     resp = RedirectResponse(url="/dashboard/saldo", status_code=302)
     manager.set_cookie(resp, access_token)
     return resp
@@ -976,12 +1180,26 @@ def login(request: Request, username: str = Form(...), password: str = Form(...)
 def login_page(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
+@app.get("/api/auth/cache-stats")
+async def get_auth_cache_stats(user=Depends(admin_only)):
+    if isinstance(user, RedirectResponse):
+        return user
+    return usuarios_cache.stats()
+
+@app.get("/api/auth/login-stats")
+async def get_auth_login_stats(user=Depends(admin_only)):
+    if isinstance(user, RedirectResponse):
+        return user
+    return {
+        "verificador": verificador_passwords.stats(),
+        "limite_usuario": limite_login_usuario.stats(),
+        "limite_ip": limite_login_ip.stats(),
+    }
+
 # Modelos para entrada de datos
 from pydantic import BaseModel, field_validator
 from fastapi import BackgroundTasks
 from fastapi.staticfiles import StaticFiles
-from weasyprint import HTML
-from jinja2 import Template
 from typing import Optional, Any
 from datetime import datetime
 import json
@@ -1000,6 +1218,8 @@ class CallEvent(BaseModel):
     dialing_time: Optional[Any] = None
     network_reached_time: Optional[Any] = None
     network_alerting_time: Optional[Any] = None
+    idempotency_key: Optional[str] = None  # Usado por /cdr/batch para reintentos seguros
+    call_id: Optional[str] = None  # Para liquidar la reserva de saldo de la llamada
 
     @field_validator('start_time', 'end_time', 'answer_time', 'dialing_time', 'network_reached_time', 'network_alerting_time', mode='before')
     @classmethod
@@ -1046,33 +1266,25 @@ class TarifaCreate(BaseModel):
     tarifa_segundo: float
 
 
-def get_rate_by_zone(db, zona_id: int) -> float:
+def get_rate_by_zone(db, zona_id: int, snapshot=None) -> float:
     """
     Obtiene la tarifa por minuto para una zona específica
-    CORREGIDA: Usa tarifa_segundo y la convierte a tarifa por minuto
+    desde la instantánea de tarifas (tarifa_segundo convertida a minuto)
     
     Args:
         db: Sesión de base de datos
         zona_id: ID de la zona
+        snapshot: Instantánea a usar (por defecto la vigente)
     
     Returns:
         float: Tarifa por minuto, o tarifa por defecto si no encuentra
     """
     try:
-        query = text("""
-            SELECT tarifa_segundo 
-            FROM tarifas 
-            WHERE zona_id = :zona_id 
-              AND activa = true
-            ORDER BY fecha_inicio DESC
-            LIMIT 1
-        """)
-        
-        result = db.execute(query, {"zona_id": zona_id}).fetchone()
+        tarifa = (snapshot or rating_snapshot.actual).tarifa(zona_id)
         
-        if result and result[0] is not None:
+        if tarifa:
             # Convertir de tarifa por segundo a tarifa por minuto
-            tarifa_por_segundo = float(result[0])
+            tarifa_por_segundo = tarifa.tarifa_segundo
             tarifa_por_minuto = tarifa_por_segundo * 60
             return tarifa_por_minuto
         else:
@@ -1085,14 +1297,15 @@ def get_rate_by_zone(db, zona_id: int) -> float:
 
 
 # ===== FUNCIÓN CORREGIDA PARA DETERMINAR ZONA POR PREFIJO =====
-def get_zone_by_prefix(db, called_number: str) -> int:
+def get_zone_by_prefix(db, called_number: str, snapshot=None) -> int:
     """
     Determina la zona basándose en el prefijo del número marcado
-    CORREGIDA: Mejor manejo de errores y casos edge
+    usando el índice de prefijos en memoria (sin consultar la BD)
     
     Args:
         db: Sesión de base de datos
         called_number: Número de destino marcado
+        snapshot: Instantánea a usar (por defecto la vigente)
     
     Returns:
         int: ID de la zona correspondiente, o zona por defecto si no encuentra
@@ -1107,29 +1320,9 @@ def get_zone_by_prefix(db, called_number: str) -> int:
         return 1  # Zona por defecto si no hay dígitos
     
     try:
-        # Obtener todos los prefijos ordenados por longitud descendente
-        # Esto prioriza prefijos más específicos (más largos) sobre los generales
-        query = text("""
-            SELECT zona_id, prefijo, longitud_minima, longitud_maxima
-            FROM prefijos 
-            ORDER BY LENGTH(prefijo) DESC, prefijo
-        """)
-        
-        prefijos = db.execute(query).fetchall()
-        
-        for prefijo_row in prefijos:
-            zona_id, prefijo, long_min, long_max = prefijo_row
-            
-            # Verificar si el número empieza con este prefijo
-            if clean_number.startswith(str(prefijo)):
-                # Verificar longitud del número
-                if long_min and len(clean_number) < long_min:
-                    continue
-                if long_max and len(clean_number) > long_max:
-                    continue
-                
-                # ¡Encontramos la zona!
-                return zona_id
+        regla = (snapshot or rating_snapshot.actual).buscar(clean_number)
+        if regla:
+            return regla.zona_id
         
         # Si no se encuentra ningún prefijo, usar zona por defecto
         print(f"⚠️  No se encontró zona para el número: {called_number} (limpio: {clean_number})")
@@ -1140,43 +1333,67 @@ def get_zone_by_prefix(db, called_number: str) -> int:
         return 1  # Zona por defecto en caso de error
 
 
+def tarificar_evento(event: CallEvent, snapshot=None) -> Dict:
+    """
+    Determina zona, tarifa y costo de un evento de llamada y arma la fila CDR.
+    Todo se resuelve con la instantánea de tarifas, sin consultar la BD.
+    """
+    snapshot = snapshot or rating_snapshot.actual
+    
+    # 1. Determinar la zona basándose en el prefijo
+    zona_id = get_zone_by_prefix(None, event.called_number, snapshot=snapshot)
+    
+    # 2. Obtener la tarifa específica para esa zona
+    rate_per_minute = get_rate_by_zone(None, zona_id, snapshot=snapshot)
+    
+    # 3. Calcular el costo basado en duration_billable y tarifa de la zona
+    cost = (event.duration_billable / 60) * rate_per_minute
+    
+    # 4. Crear el CDR con la zona determinada automáticamente
+    cdr_data = {
+        "calling_number": event.calling_number,
+        "called_number": event.called_number,
+        "start_time": event.start_time,
+        "end_time": event.end_time,
+        "duration_seconds": event.duration_seconds,
+        "duration_billable": event.duration_billable,
+        "cost": cost,
+        "status": event.status,
+        "direction": event.direction,
+        "release_cause": event.release_cause,
+        "connect_time": event.answer_time,  # Mapear answer_time a connect_time
+        "dialing_time": event.dialing_time,
+        "network_reached_time": event.network_reached_time,
+        "network_alerting_time": event.network_alerting_time,
+        "zona_id": zona_id  # ¡Ahora se calcula automáticamente!
+    }
+    
+    return {
+        "cdr": cdr_data,
+        "zona_id": zona_id,
+        "zona_nombre": snapshot.nombre_zona(zona_id),
+        "rate_per_minute": rate_per_minute,
+        "cost": cost
+    }
+
+
 # API Principal - Modificada para usar zonas y tarifas
 @app.post("/cdr")
 def create_cdr(event: CallEvent):
     db = SessionLocal()
     
     try:
-        # 1. Determinar la zona basándose en el prefijo
-        zona_id = get_zone_by_prefix(db, event.called_number)
-        
-        # 2. Obtener la tarifa específica para esa zona
-        rate_per_minute = get_rate_by_zone(db, zona_id)
-        
-        # 3. Calcular el costo basado en duration_billable y tarifa de la zona
-        cost = (event.duration_billable / 60) * rate_per_minute
-        
-        # 4. Crear el CDR con la zona determinada automáticamente
-        cdr_data = {
-            "calling_number": event.calling_number,
-            "called_number": event.called_number,
-            "start_time": event.start_time,
-            "end_time": event.end_time,
-            "duration_seconds": event.duration_seconds,
-            "duration_billable": event.duration_billable,
-            "cost": cost,
-            "status": event.status,
-            "direction": event.direction,
-            "release_cause": event.release_cause,
-            "connect_time": event.answer_time,  # Mapear answer_time a connect_time
-            "dialing_time": event.dialing_time,
-            "network_reached_time": event.network_reached_time,
-            "network_alerting_time": event.network_alerting_time,
-            "zona_id": zona_id  # ¡Ahora se calcula automáticamente!
-        }
-        
-        # 5. Guardar el CDR
+        # 1-4. Zona, tarifa y costo desde la instantánea de tarifas
+        tarificacion = tarificar_evento(event)
+        zona_id = tarificacion["zona_id"]
+        rate_per_minute = tarificacion["rate_per_minute"]
+        cost = tarificacion["cost"]
+        cdr_data = tarificacion["cdr"]
+        
+        # 5. Guardar el CDR y sumarlo a los resúmenes en la misma transacción
         cdr = CDR(**cdr_data)
         db.add(cdr)
+        acumular_resumenes(db, [cdr_data])
         
         # 6. Actualizar el saldo del anexo
         update_result = db.execute(
@@ -1209,13 +1426,12 @@ def create_cdr(event: CallEvent):
         # 9. Confirmar transacción
         db.commit()
         
-        # 10. Obtener información de la zona para logging/debugging
-        zona_info = db.execute(
-            text("SELECT nombre FROM zonas WHERE id = :zona_id"),
-            {"zona_id": zona_id}
-        ).fetchone()
+        # Liquidar la reserva de la llamada contra el costo real
+        reservation_ledger.liquidar(event.calling_number, cost, call_id=event.call_id,
+                                    called_number=event.called_number)
         
-        zona_nombre = zona_info[0] if zona_info else "Desconocida"
+        # 10. Obtener información de la zona para logging/debugging
+        zona_nombre = tarificacion["zona_nombre"]
         
         return {
             "message": "CDR saved successfully",
@@ -1235,6 +1451,151 @@ def create_cdr(event: CallEvent):
         db.close()
 
 
+@app.post("/cdr/batch")
+def create_cdr_batch(events: List[Dict[str, Any]]):
+    """
+    Ingesta de CDR por lotes en una sola transacción.
+    
+    - Todos los eventos se tarifican con la misma instantánea de tarifas
+    - Los CDR se insertan con un único INSERT multi-fila
+    - Se aplica un único débito agregado por calling_number
+    - Los eventos con idempotency_key ya procesada se informan como 'duplicate',
+      así el listener puede reintentar un lote completo sin duplicar cobros
+    """
+    snapshot = rating_snapshot.actual
+    results: List[Optional[Dict]] = [None] * len(events)
+    pendientes = []  # (índice, evento, tarificación)
+    claves_lote = set()
+    
+    # 1. Validar y tarificar en memoria
+    for index, raw_event in enumerate(events):
+        try:
+            event = CallEvent.model_validate(raw_event)
+        except ValidationError as e:
+            results[index] = {"index": index, "status": "error", "error": str(e)}
+            continue
+        
+        clave = event.idempotency_key
+        if clave and clave in claves_lote:
+            results[index] = {"index": index, "status": "duplicate", "idempotency_key": clave}
+            continue
+        if clave:
+            claves_lote.add(clave)
+        
+        pendientes.append((index, event, tarificar_evento(event, snapshot)))
+    
+    db = SessionLocal()
+    
+    try:
+        # 2. Reservar las claves de idempotencia; las que ya existían son reintentos
+        if claves_lote:
+            reservadas = set(db.execute(
+                pg_insert(CdrIdempotencia)
+                .values([{"clave": clave, "fecha": datetime.utcnow()} for clave in claves_lote])
+                .on_conflict_do_nothing(index_elements=["clave"])
+                .returning(CdrIdempotencia.clave)
+            ).scalars().all())
+            
+            repetidas = claves_lote - reservadas
+            if repetidas:
+                cdr_previos = dict(db.execute(
+                    select(CdrIdempotencia.clave, CdrIdempotencia.cdr_id)
+                    .where(CdrIdempotencia.clave.in_(repetidas))
+                ).all())
+                
+                nuevos = []
+                for index, event, tarificacion in pendientes:
+                    if event.idempotency_key in repetidas:
+                        results[index] = {
+                            "index": index,
+                            "status": "duplicate",
+                            "idempotency_key": event.idempotency_key,
+                            "cdr_id": cdr_previos.get(event.idempotency_key)
+                        }
+                    else:
+                        nuevos.append((index, event, tarificacion))
+                pendientes = nuevos
+        
+        if pendientes:
+            # 3. Insertar todos los CDR en un único INSERT multi-fila
+            cdr_ids = db.execute(
+                insert(CDR).returning(CDR.id, sort_by_parameter_order=True),
+                [tarificacion["cdr"] for _, _, tarificacion in pendientes]
+            ).scalars().all()
+            
+            claves_cdr = [
+                {"clave": event.idempotency_key, "cdr_id": cdr_id}
+                for (_, event, _), cdr_id in zip(pendientes, cdr_ids)
+                if event.idempotency_key
+            ]
+            if claves_cdr:
+                db.execute(update(CdrIdempotencia), claves_cdr)
+            
+            acumular_resumenes(db, [tarificacion["cdr"] for _, _, tarificacion in pendientes])
+            
+            # 4. Un único débito agregado por anexo
+            debitos: Dict[str, float] = {}
+            for _, event, tarificacion in pendientes:
+                debitos[event.calling_number] = debitos.get(event.calling_number, 0.0) + tarificacion["cost"]
+            
+            saldos = dict(db.execute(
+                text("""
+                    UPDATE saldo_anexos AS s
+                    SET saldo = s.saldo - d.total
+                    FROM unnest(CAST(:numeros AS text[]), CAST(:totales AS numeric[])) AS d(calling_number, total)
+                    WHERE s.calling_number = d.calling_number
+                    RETURNING s.calling_number, s.saldo
+                """),
+                {"numeros": list(debitos.keys()), "totales": list(debitos.values())}
+            ).fetchall())
+            
+            for calling_number in debitos:
+                if calling_number not in saldos:
+                    print(f"⚠️  Anexo {calling_number} no encontrado en saldo_anexos")
+                elif saldos[calling_number] < 1.0:
+                    print(f"🚨 ALERTA: Anexo {calling_number} con saldo bajo: ${saldos[calling_number]:.2f}")
+            
+            for (index, event, tarificacion), cdr_id in zip(pendientes, cdr_ids):
+                results[index] = {
+                    "index": index,
+                    "status": "created",
+                    "idempotency_key": event.idempotency_key,
+                    "cdr_id": cdr_id,
+                    "cost": round(tarificacion["cost"], 4),
+                    "zona_id": tarificacion["zona_id"],
+                    "zona_nombre": tarificacion["zona_nombre"],
+                    "rate_per_minute": tarificacion["rate_per_minute"]
+                }
+        
+        # 5. Confirmar todo el lote
+        db.commit()
+        
+        # 6. Liquidar las reservas de saldo contra los costos reales
+        for _, event, tarificacion in pendientes:
+            reservation_ledger.liquidar(event.calling_number, tarificacion["cost"],
+                                        call_id=event.call_id, called_number=event.called_number)
+        
+    except (OperationalError, InterfaceError) as e:
+        db.rollback()
+        print(f"Base no disponible creando lote de CDR: {e}")
+        # 503: el spool del listener reintenta el lote sin culpar a sus CDR
+        raise HTTPException(status_code=503, detail=f"Base de datos no disponible: {str(e)}")
+    except Exception as e:
+        db.rollback()
+        print(f"Error creando lote de CDR: {e}")
+        raise HTTPException(status_code=500, detail=f"Error guardando lote de CDR: {str(e)}")
+    finally:
+        db.close()
+    
+    return {
+        "message": "CDR batch processed",
+        "snapshot_version": snapshot.version,
+        "created": sum(1 for r in results if r["status"] == "created"),
+        "duplicates": sum(1 for r in results if r["status"] == "duplicate"),
+        "errors": sum(1 for r in results if r["status"] == "error"),
+        "results": results
+    }
+
 # Nuevo endpoint para verificar saldo con destino
 @app.get("/check_balance/{calling_number}/{called_number}")
 def check_balance_with_destination(calling_number: str, called_number: str):
@@ -1276,29 +1637,29 @@ def check_balance(calling_number: str):
 
 @app.post("/recargar/{calling_number}/{amount}")
 async def recargar_saldo(calling_number: str, amount: float, user=Depends(admin_only)):
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     # Check if the record exists
     query = text("SELECT saldo FROM saldo_anexos WHERE calling_number = :calling_number")
-    saldo_actual = db.execute(query, {"calling_number": calling_number}).fetchone()
+    saldo_actual = (await db.execute(query, {"calling_number": calling_number})).fetchone()
 
     if saldo_actual:
         update_query = text(
             "UPDATE saldo_anexos SET saldo = saldo + :amount, fecha_ultima_recarga = CURRENT_TIMESTAMP WHERE calling_number = :calling_number"
         )
-        db.execute(update_query, {"amount": amount, "calling_number": calling_number})
+        await db.execute(update_query, {"amount": amount, "calling_number": calling_number})
     else:
         insert_query = text(
             "INSERT INTO saldo_anexos (calling_number, saldo, fecha_ultima_recarga) VALUES (:calling_number, :amount, CURRENT_TIMESTAMP)"
         )
-        db.execute(insert_query, {"calling_number": calling_number, "amount": amount})
+        await db.execute(insert_query, {"calling_number": calling_number, "amount": amount})
 
     # Logging the audit record  
     audit_query = text(
         "INSERT INTO saldo_auditoria (calling_number, saldo_anterior, saldo_nuevo, tipo_accion) "
         "VALUES (:calling_number, :saldo_anterior, :saldo_nuevo, 'recarga')"
     )
-    db.execute(audit_query, {
+    await db.execute(audit_query, {
         "calling_number": calling_number, 
         "saldo_anterior": saldo_actual[0] if saldo_actual else 0,
         "saldo_nuevo": saldo_actual[0] + Decimal(str(amount)) if saldo_actual else Decimal(str(amount))
@@ -1307,18 +1668,19 @@ async def recargar_saldo(calling_number: str, amount: float, user=Depends(admin_
 
     # Record the recharge
     recharge_query = text("INSERT INTO recargas (calling_number, monto) VALUES (:calling_number, :amount)")
-    db.execute(recharge_query, {"calling_number": calling_number, "amount": amount})
+    await db.execute(recharge_query, {"calling_number": calling_number, "amount": amount})
 
-    db.commit()
-    db.close()
+    await db.commit()
+    await db.close()
+    reservation_ledger.acreditar(calling_number, amount)
     return {"message": f"Recargado {amount} al número {calling_number}"}
 
 # DASHBOARD: SALDO
 @app.get("/dashboard/saldo")
 async def dashboard_saldo(request: Request, user=Depends(authenticated_user)):
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     query = text("SELECT calling_number, saldo FROM saldo_anexos ORDER BY calling_number ASC")
-    rows = db.execute(query).fetchall()
+    rows = (await db.execute(query)).fetchall()
     saldos_bajos = [row for row in rows if float(row[1]) < 1.0]
     labels = [row[0] for row in rows]
     data = [float(row[1]) for row in rows]
@@ -1326,7 +1688,7 @@ async def dashboard_saldo(request: Request, user=Depends(authenticated_user)):
     # Pre-calculate the background colors based on saldo values
     background_colors = ['rgba(220, 53, 69, 0.8)' if float(row[1]) < 1.0 else 'rgba(13, 110, 253, 0.8)' for row in rows]
     
-    db.close()
+    await db.close()
     return templates.TemplateResponse("dashboard_saldo.html", {
         "request": request, 
         "rows": rows, 
@@ -1432,10 +1794,11 @@ def dashboard_cdr(request: Request,
                   end_date: str = Query(None),
                   min_duration: int = Query(0),
                   status: str = Query(None),
-                  direction: str = Query(None)):
+                  direction: str = Query(None),
+                  cursor: str = Query(None),
+                  exact_count: bool = Query(False)):
 
     db = SessionLocal()
-    offset = (page - 1) * per_page
     
     # ✅ CONSULTA CORREGIDA con sintaxis SQLAlchemy :parameter
     query = """
@@ -1449,52 +1812,40 @@ def dashboard_cdr(request: Request,
             COALESCE(duration_billable, 0) as duration_billable,
             COALESCE(status, 'unknown') as status,
             COALESCE(direction, 'unknown') as direction,
-            COALESCE(release_cause, 0) as release_cause
+            COALESCE(release_cause, 0) as release_cause,
+            id
         FROM cdr 
         WHERE 1=1
     """
     
-    # Parámetros para la consulta parametrizada
-    params = {}
-    
-    # ✅ Aplicar filtros con sintaxis :parameter
-    #if phone_number:
-    #    query += " AND calling_number = :calling_number"
-    #    params['calling_number'] = calling_number
-    if phone_number:
-        query += " AND (calling_number LIKE :phone_pattern OR called_number LIKE :phone_pattern)"
-        params['phone_pattern'] = f"%{phone_number}%"
-
-    if start_date:
-        query += " AND start_time >= :start_date"
-        params['start_date'] = f"{start_date} 00:00:00"
-    
-    if end_date:
-        query += " AND start_time <= :end_date"
-        params['end_date'] = f"{end_date} 23:59:59"
-    
-    # ✅ IMPORTANTE: Solo filtrar por duración si se especifica explícitamente > 0
-    if min_duration and min_duration > 0:
-        query += " AND COALESCE(duration_seconds, 0) >= :min_duration"
-        params['min_duration'] = min_duration
-    
-    # ✅ NUEVOS FILTROS
-    if status and status != 'all':
-        query += " AND COALESCE(status, 'unknown') = :status"
-        params['status'] = status
-        
-    if direction and direction != 'all':
-        query += " AND COALESCE(direction, 'unknown') = :direction"
-        params['direction'] = direction
+    # Filtros con la misma forma que los índices de cdr (ver tarificador/consultas_cdr.py)
+    where, filtro_params = filtros_cdr(
+        phone_number=phone_number,
+        start_date=start_date,
+        end_date=end_date,
+        min_duration=min_duration,
+        status=status,
+        direction=direction
+    )
+    query += where
+    params = dict(filtro_params)
+    next_cursor = prev_cursor = None
     
-    # Ordenar y paginar - ✅ SINTAXIS CORREGIDA
-    query += " ORDER BY start_time DESC LIMIT :limit OFFSET :offset"
-    params['limit'] = per_page
-    params['offset'] = offset
+    # Paginación por cursor sobre (start_time, id); una fila extra indica si hay más
+    try:
+        condicion, cursor_params, orden, _ = condicion_cursor(cursor)
+    except ValueError as e:
+        db.close()
+        raise HTTPException(status_code=400, detail=str(e))
     
     try:
+        query += condicion + orden + " LIMIT :limit"
+        params.update(cursor_params)
+        params['limit'] = per_page + 1
+        
         # Ejecutar consulta
         rows = db.execute(text(query), params).fetchall()
+        rows, next_cursor, prev_cursor = armar_pagina(rows, per_page, cursor, clave=lambda row: (row[2], row[10]))
         
         # ✅ Procesar filas con información adicional
         processed_rows = []
@@ -1536,7 +1887,7 @@ def dashboard_cdr(request: Request,
                 'unknown': '❓ Desconocida'
             }.get(direction_value, '❓ Desconocida')
             
-            processed_row = list(row) + [call_type, direction_display]
+            processed_row = list(row[:10]) + [call_type, direction_display]
             processed_rows.append(tuple(processed_row))
         
         # ✅ Estadísticas para gráficos
@@ -1561,51 +1912,21 @@ def dashboard_cdr(request: Request,
             status_labels = status_data = []
             direction_labels = direction_data = []
         
-        # ✅ Consulta de conteo con sintaxis corregida
-        count_query = "SELECT COUNT(*) FROM cdr WHERE 1=1"
-        count_params = {}
-
-        if phone_number:
-            count_query += " AND (calling_number LIKE :phone_pattern OR called_number LIKE :phone_pattern)"
-            count_params['phone_pattern'] = f"%{phone_number}%"
-        #if calling_number:
-        #    count_query += " AND calling_number = :calling_number"
-        #    count_params['calling_number'] = calling_number
-        
-        if start_date:
-            count_query += " AND start_time >= :start_date"
-            count_params['start_date'] = f"{start_date} 00:00:00"
-        
-        if end_date:
-            count_query += " AND start_time <= :end_date"
-            count_params['end_date'] = f"{end_date} 23:59:59"
-        
-        if min_duration and min_duration > 0:
-            count_query += " AND COALESCE(duration_seconds, 0) >= :min_duration"
-            count_params['min_duration'] = min_duration
-            
-        if status and status != 'all':
-            count_query += " AND COALESCE(status, 'unknown') = :status"
-            count_params['status'] = status
-            
-        if direction and direction != 'all':
-            count_query += " AND COALESCE(direction, 'unknown') = :direction"
-            count_params['direction'] = direction
-        
-        total_records = db.execute(text(count_query), count_params).fetchone()[0]
+        # Total estimado por el planner (o exacto si se pidió o hay uno reciente en caché)
+        total_records, total_exact = cdr_conteos.total(db, where, filtro_params, exacto=exact_count)
         total_pages = -(-total_records // per_page)
         
         # ✅ Estadísticas generales del día
         stats_query = """
             SELECT 
-                COUNT(*) as total_calls,
-                COUNT(CASE WHEN COALESCE(status, 'unknown') = 'disconnected' AND COALESCE(duration_seconds, 0) > 0 THEN 1 END) as completed_calls,
-                COUNT(CASE WHEN COALESCE(status, 'unknown') = 'failed' THEN 1 END) as failed_calls,
-                COUNT(CASE WHEN COALESCE(status, 'unknown') = 'disconnected' AND COALESCE(duration_seconds, 0) = 0 THEN 1 END) as unanswered_calls,
-                COALESCE(SUM(cost), 0) as total_cost,
-                COALESCE(SUM(duration_seconds), 0) as total_duration
-            FROM cdr 
-            WHERE start_time >= CURRENT_DATE
+                COALESCE(SUM(llamadas), 0) as total_calls,
+                COALESCE(SUM(contestadas) FILTER (WHERE status = 'disconnected'), 0) as completed_calls,
+                COALESCE(SUM(llamadas) FILTER (WHERE status = 'failed'), 0) as failed_calls,
+                COALESCE(SUM(llamadas - contestadas) FILTER (WHERE status = 'disconnected'), 0) as unanswered_calls,
+                COALESCE(SUM(costo), 0) as total_cost,
+                COALESCE(SUM(segundos), 0) as total_duration
+            FROM cdr_resumen_dia 
+            WHERE dia = CURRENT_DATE
         """
         
         try:
@@ -1621,6 +1942,7 @@ def dashboard_cdr(request: Request,
         status_labels = status_data = []
         direction_labels = direction_data = []
         total_records = total_pages = 0
+        total_exact = True
         stats = (0, 0, 0, 0, 0, 0)
     
     finally:
@@ -1639,6 +1961,9 @@ def dashboard_cdr(request: Request,
         "per_page": per_page, 
         "total_pages": total_pages,
         "total_records": total_records,
+        "total_exact": total_exact,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
         "stats": {
             "total_calls": stats[0] if stats else 0,
             "completed_calls": stats[1] if stats else 0,
@@ -1660,16 +1985,17 @@ def dashboard_cdr(request: Request,
 
 @app.get("/dashboard/finanzas")
 async def dashboard_finanzas(request: Request, user=Depends(authenticated_user)):
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     query = text("""
-        SELECT DATE(start_time) as fecha, SUM(cost) as total_cost
-        FROM cdr
-        GROUP BY DATE(start_time)
+        SELECT dia as fecha, SUM(costo) as total_cost
+        FROM cdr_resumen_dia
+        WHERE dia >= CURRENT_DATE - 29
+        GROUP BY dia
         ORDER BY fecha DESC
         LIMIT 30
     """)
-    rows = db.execute(query).fetchall()
-    db.close()
+    rows = (await db.execute(query)).fetchall()
+    await db.close()
 
     labels = [str(row[0]) for row in rows]
     data = [float(row[1]) for row in rows]
@@ -1681,10 +2007,10 @@ async def dashboard_finanzas(request: Request, user=Depends(authenticated_user))
 
 @app.get("/dashboard/recargas")
 async def dashboard_recargas(request: Request, user=Depends(authenticated_user)):
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     query = text("SELECT calling_number, monto, fecha FROM recargas ORDER BY fecha DESC LIMIT 100")
-    rows = db.execute(query).fetchall()
-    db.close()
+    rows = (await db.execute(query)).fetchall()
+    await db.close()
 
     return templates.TemplateResponse("dashboard_recargas.html", {
         "request": request, "rows": rows, "user": user
@@ -1692,10 +2018,10 @@ async def dashboard_recargas(request: Request, user=Depends(authenticated_user))
 
 @app.get("/dashboard/auditoria")
 async def dashboard_auditoria(request: Request, user=Depends(admin_only)):
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     query = text("SELECT calling_number, saldo_anterior, saldo_nuevo, tipo_accion, fecha FROM saldo_auditoria ORDER BY fecha DESC LIMIT 100")
-    rows = db.execute(query).fetchall()
-    db.close()
+    rows = (await db.execute(query)).fetchall()
+    await db.close()
 
     return templates.TemplateResponse("dashboard_auditoria.html", {
         "request": request, "rows": rows, "user": user
@@ -1703,16 +2029,16 @@ async def dashboard_auditoria(request: Request, user=Depends(admin_only)):
 
 @app.get("/dashboard/ranking_consumo")
 async def dashboard_ranking_consumo(request: Request, user=Depends(authenticated_user)):
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     query = text("""
-        SELECT calling_number, SUM(cost) as consumo_total
-        FROM cdr
+        SELECT calling_number, SUM(costo) as consumo_total
+        FROM cdr_resumen_dia
         GROUP BY calling_number
         ORDER BY consumo_total DESC
         LIMIT 10
     """)
-    rows = db.execute(query).fetchall()
-    db.close()
+    rows = (await db.execute(query)).fetchall()
+    await db.close()
 
     labels = [row[0] for row in rows]
     data = [float(row[1]) for row in rows]
@@ -1737,38 +2063,12 @@ async def dashboard_ranking_consumo(request: Request, user=Depends(authenticated
 
 @app.get("/export/saldo/pdf")
 async def export_saldo_pdf(user=Depends(admin_only)):
-    db = SessionLocal()
-    query = text("SELECT calling_number, saldo FROM saldo_anexos ORDER BY calling_number ASC")
-    rows = db.execute(query).fetchall()
-    db.close()
-
-    html_template = """
-    <html>
-    <body>
-    <h1>Reporte de Saldos</h1>
-    <table border="1">
-        <thead>
-            <tr><th>Anexo</th><th>Saldo</th></tr>
-        </thead>
-        <tbody>
-        {% for row in rows %}
-            <tr><td>{{ row[0] }}</td><td>${{ "%.2f"|format(row[1]) }}</td></tr>
-        {% endfor %}
-        </tbody>
-    </table>
-    </body>
-    </html>
-    """
-    template = Template(html_template)
-    html_content = template.render(rows=rows)
-
-    pdf = HTML(string=html_content).write_pdf()
+    if isinstance(user, RedirectResponse):
+        return user
 
-    return StreamingResponse(
-        io.BytesIO(pdf),
-        media_type="application/pdf",
-        headers={"Content-Disposition": "attachment; filename=saldo_report.pdf"}
-    )
+    # El render de WeasyPrint corre en el pool de exportaciones, no en el worker de la API
+    trabajo, _ = exportaciones.enviar("saldo_pdf", {})
+    return _archivo_trabajo(await exportaciones.esperar(trabajo.id, EXPORTACIONES_ESPERA_SECONDS))
 
 
 @app.get("/dashboard/recarga_masiva")
@@ -1779,128 +2079,39 @@ async def form_recarga_masiva(request: Request, user=Depends(admin_only)):
 
 @app.post("/dashboard/recarga_masiva")
 async def recarga_masiva(request: Request, file: UploadFile = File(...), user=Depends(admin_only)):
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     try:
-        # Leer el contenido del archivo
-        content = await file.read()
-        
-        # Determinar tipo de archivo por extensión
-        filename = file.filename.lower()
-        
-        # Lista para almacenar las filas a procesar
-        rows = []
-        
-        # Procesar según el tipo de archivo
-        if filename.endswith('.xlsx') or filename.endswith('.xls'):
-            # Archivo Excel
-            try:
-                import io
-                import openpyxl
-                
-                # Cargar el archivo Excel
-                wb = openpyxl.load_workbook(io.BytesIO(content))
-                ws = wb.active
-                
-                # Leer filas (omitir la primera fila de encabezados)
-                first_row = True
-                for row in ws.rows:
-                    if first_row:
-                        first_row = False
-                        continue
-                    
-                    if len(row) >= 2 and row[0].value and row[1].value:
-                        rows.append([str(row[0].value), str(row[1].value)])
-            except Exception as e:
-                return templates.TemplateResponse("recarga_masiva.html", {
-                    "request": request, 
-                    "user": user,
-                    "error": f"Error procesando archivo Excel: {str(e)}"
-                })
-        else:
-            # Archivo CSV - intentar con diferentes codificaciones
-            encodings = ['utf-8', 'latin-1', 'windows-1252', 'iso-8859-1']
-            decoded = False
-            
-            for encoding in encodings:
-                try:
-                    # Intentar decodificar con esta codificación
-                    text_content = content.decode(encoding).splitlines()
-                    reader = csv.reader(text_content)
-                    
-                    # Omitir encabezados
-                    next(reader, None)
-                    
-                    # Leer filas
-                    for row in reader:
-                        if len(row) >= 2:
-                            rows.append(row)
-                    
-                    decoded = True
-                    break  # Si llegamos aquí, la decodificación fue exitosa
-                except UnicodeDecodeError:
-                    continue  # Probar con la siguiente codificación
-            
-            if not decoded:
-                return templates.TemplateResponse("recarga_masiva.html", {
-                    "request": request, 
-                    "user": user,
-                    "error": "No se pudo decodificar el archivo. Asegúrese de que sea un CSV válido."
-                })
-        
-        # Procesar las filas y actualizar la base de datos
-        procesados = 0
+        # Validación por línea mientras el COPY consume el archivo
         errores = []
+        registros = filas_validas(leer_archivo_recargas(file.file, file.filename or ""), errores)
         
-        for row in rows:
-            try:
-                if len(row) >= 2:
-                    # Extraer anexo y monto
-                    calling_number = str(row[0]).strip()
-                    
-                    # Convertir monto a float, manejando posibles formatos
-                    try:
-                        amount = float(str(row[1]).strip().replace(',', '.'))
-                    except ValueError:
-                        errores.append(f"Error en anexo {calling_number}: '{row[1]}' no es un monto válido.")
-                        continue
-                    
-                    # Buscar saldo actual
-                    saldo_query = text("SELECT saldo FROM saldo_anexos WHERE calling_number = :calling_number")
-                    saldo_actual = db.execute(saldo_query, {"calling_number": calling_number}).fetchone()
-
-                    # Actualizar o insertar saldo
-                    if saldo_actual:
-                        update_query = text(
-                            "UPDATE saldo_anexos SET saldo = saldo + :amount, fecha_ultima_recarga = CURRENT_TIMESTAMP WHERE calling_number = :calling_number"
-                        )
-                        db.execute(update_query, {"amount": amount, "calling_number": calling_number})
-                    else:
-                        insert_query = text(
-                            "INSERT INTO saldo_anexos (calling_number, saldo, fecha_ultima_recarga) VALUES (:calling_number, :amount, CURRENT_TIMESTAMP)"
-                        )
-                        db.execute(insert_query, {"calling_number": calling_number, "amount": amount})
-
-                    # Registrar en auditoría
-                    audit_query = text(
-                        "INSERT INTO saldo_auditoria (calling_number, saldo_anterior, saldo_nuevo, tipo_accion) "
-                        "VALUES (:calling_number, :saldo_anterior, :saldo_nuevo, 'recarga_masiva')"
-                    )
-                    db.execute(audit_query, {
-                        "calling_number": calling_number,
-                        "saldo_anterior": saldo_actual[0] if saldo_actual else 0,
-                        "saldo_nuevo": saldo_actual[0] + Decimal(str(amount)) if saldo_actual else Decimal(str(amount))
-                    })
-                    
-                    procesados += 1
-            except Exception as e:
-                errores.append(f"Error procesando anexo {calling_number}: {str(e)}")
+        try:
+            aplicadas = await aplicar_recargas(db, registros)
+        except ValueError as e:
+            # Archivo ilegible (codificación o formato)
+            await db.rollback()
+            return templates.TemplateResponse("recarga_masiva.html", {
+                "request": request, 
+                "user": user,
+                "error": str(e)
+            })
         
         # Confirmar transacción
-        db.commit()
+        await db.commit()
+        
+        for calling_number, saldo_anterior, saldo_nuevo in aplicadas:
+            reservation_ledger.acreditar(calling_number, float(saldo_nuevo - saldo_anterior))
+        
+        procesados = len(aplicadas)
+        print(f"💰 Recarga masiva: {procesados} anexos recargados, {len(errores)} líneas con errores")
         
         # Generar mensaje de éxito
-        success_message = f"Se procesaron {procesados} recargas exitosamente."
+        success_message = f"Se procesaron recargas para {procesados} anexos exitosamente."
+        if len(errores) > CARGA_MASIVA_MAX_ERRORES:
+            errores = errores[:CARGA_MASIVA_MAX_ERRORES] + [
+                f"... y {len(errores) - CARGA_MASIVA_MAX_ERRORES} líneas más con errores."
+            ]
         
         # Devolver respuesta
         return templates.TemplateResponse("recarga_masiva.html", {
@@ -1912,7 +2123,7 @@ async def recarga_masiva(request: Request, file: UploadFile = File(...), user=De
             
     except Exception as e:
         # Revertir cambios en caso de error
-        db.rollback()
+        await db.rollback()
         
         return templates.TemplateResponse("recarga_masiva.html", {
             "request": request, 
@@ -1920,7 +2131,7 @@ async def recarga_masiva(request: Request, file: UploadFile = File(...), user=De
             "error": f"Error procesando el archivo: {str(e)}"
         })
     finally:
-        db.close()
+        await db.close()
 
 @app.get("/")
 def root():
@@ -2237,7 +2448,7 @@ async def actualizar_anexo(anexo_id: int, anexo: AnexoCreate, user=Depends(admin
     # Si se proporciona PIN, actualizarlo
     if anexo.pin:
         #hashed_pin = pwd_context.hash(anexo.pin)
-        update_query_str += ", pin = :pin"
+        update_query_str += ", pin = :pin, pin_pendiente = FALSE"
         params["pin"] = anexo.pin
     
     update_query_str += " WHERE id = :anexo_id"
@@ -2323,53 +2534,71 @@ async def actualizar_longitud_pin(pin_length: int = Form(...), user=Depends(admi
 # Generación masiva de PINs
 @app.post("/anexos/generar_pines")
 async def generar_pines_masivos(request: Request, user=Depends(admin_only)):
+    """
+    Inicia la regeneración de PINs de todos los anexos activos en segundo plano.
+    El CSV con los PINs se descarga una sola vez, cuando el trabajo termina.
+    """
     if isinstance(user, RedirectResponse):
         return user
-        
-    db = SessionLocal()
-    
-    # Obtener longitud configurada del PIN
-    pin_length_query = text("SELECT valor FROM configuracion WHERE clave = 'pin_length'")
-    pin_length_row = db.execute(pin_length_query).fetchone()
-    pin_length = int(pin_length_row[0]) if pin_length_row else 6
-    
-    # Obtener todos los anexos activos
-    anexos_query = text("SELECT id, numero FROM anexos WHERE activo = TRUE")
-    anexos = db.execute(anexos_query).fetchall()
-    
-    import random
-    resultados = []
-    
-    for anexo in anexos:
-        anexo_id, numero = anexo
-        
-        # Generar nuevo PIN
-        pin = ''.join(random.choices('0123456789', k=pin_length))
-        hashed_pin = pwd_context.hash(pin)
-        
-        # Actualizar PIN
-        update_query = text("UPDATE anexos SET pin = :pin WHERE id = :anexo_id")
-        db.execute(update_query, {"pin": hashed_pin, "anexo_id": anexo_id})
-        
-        resultados.append({"numero": numero, "pin": pin})
-    
-    db.commit()
-    db.close()
-    
-    # Generar CSV para descarga
-    csv_content = io.StringIO()
-    writer = csv.writer(csv_content)
-    writer.writerow(["Número de Anexo", "PIN"])
-    
-    for resultado in resultados:
-        writer.writerow([resultado["numero"], resultado["pin"]])
+    # Una carga en curso todavía puede guardar sus propios PINs
+    if cargas_anexos.activas():
+        raise HTTPException(status_code=409, detail="Hay una carga masiva de anexos en curso")
+    
+    # Un solo trabajo a la vez: dos regeneraciones seguidas dejarían inválido el primer CSV
+    en_curso = trabajos_pines.activas()
+    if en_curso:
+        trabajo = en_curso[0]
+    else:
+        db = AsyncSessionLocal()
+        try:
+            # Obtener longitud configurada del PIN
+            pin_length_query = text("SELECT valor FROM configuracion WHERE clave = 'pin_length'")
+            pin_length_row = (await db.execute(pin_length_query)).fetchone()
+            pin_length = int(pin_length_row[0]) if pin_length_row else 6
+        finally:
+            await db.close()
+        
+        trabajo = trabajos_pines.nueva()
+        asyncio.get_running_loop().run_in_executor(
+            None, regenerar_pines, SessionLocal, hasheador_pines, trabajo, pin_length
+        )
     
-    csv_content.seek(0)
+    return JSONResponse(status_code=202, content={
+        **trabajo.como_dict(),
+        "status_url": f"/anexos/generar_pines/{trabajo.id}",
+        "download_url": f"/anexos/generar_pines/{trabajo.id}/csv",
+    })
+
+@app.get("/anexos/generar_pines/{job_id}")
+async def progreso_generar_pines(job_id: str, user=Depends(admin_only)):
+    if isinstance(user, RedirectResponse):
+        return user
+    trabajo = trabajos_pines.obtener(job_id)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail="Trabajo de PINs no encontrado o vencido")
+    return trabajo.como_dict()
+
+@app.get("/anexos/generar_pines/{job_id}/csv")
+async def descargar_pines_generados(job_id: str, user=Depends(admin_only)):
+    if isinstance(user, RedirectResponse):
+        return user
+    trabajo = trabajos_pines.obtener(job_id)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail="Trabajo de PINs no encontrado o vencido")
+    if trabajo.etapa == "error":
+        raise HTTPException(status_code=500, detail=trabajo.error)
+    if trabajo.etapa != "terminado":
+        raise HTTPException(status_code=409, detail=f"La generación de PINs todavía está en curso ({trabajo.como_dict()['progreso']}%)")
+    
+    archivo = trabajo.retirar_csv()
+    if archivo is None:
+        raise HTTPException(status_code=410, detail="El CSV de PINs ya fue descargado")
+    contenido, filename = archivo
     
     return StreamingResponse(
-        io.BytesIO(csv_content.getvalue().encode()),
+        io.BytesIO(contenido),
         media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename=pines_anexos_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"}
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
 # Conexion CUCM
@@ -2406,318 +2635,189 @@ async def carga_masiva_anexos(
     - file: Archivo CSV o Excel con los datos de anexos
     - generar_pin: Si se debe generar PIN automáticamente cuando no se proporciona
     - continuar_errores: Si se debe continuar procesando a pesar de errores
+    
+    Las filas se cargan con COPY a staging, se validan en bloque y se insertan
+    en una sola sentencia; los PINs se hashean después, en segundo plano.
     """
     if isinstance(user, RedirectResponse):
         return user
     
-    db = SessionLocal()
-    
-    # Variables para el seguimiento
-    procesados = 0
-    exitosos = 0
-    errores = []
+    progreso = cargas_anexos.nueva()
+    db = AsyncSessionLocal()
     
     try:
-        # Leer el contenido del archivo
-        content = await file.read()
-        
-        # Determinar tipo de archivo por extensión
-        filename = file.filename.lower()
-        
-        # Lista para almacenar las filas a procesar
-        rows = []
-        headers = []
-        
-        # Procesar según el tipo de archivo
-        if filename.endswith('.xlsx') or filename.endswith('.xls'):
-            # Procesar archivo Excel
-            try:
-                # Intentar usar la biblioteca openpyxl si está disponible
-                try:
-                    import io
-                    import openpyxl
-                    
-                    # Cargar el archivo Excel
-                    wb = openpyxl.load_workbook(io.BytesIO(content))
-                    ws = wb.active
-                    
-                    # Leer encabezados (primera fila)
-                    headers = [str(cell.value).strip() if cell.value else "" for cell in next(ws.rows)]
-                    
-                    # Verificar encabezados mínimos requeridos
-                    if not headers or 'numero' not in headers or 'usuario' not in headers or 'area_nivel1' not in headers:
-                        return templates.TemplateResponse("carga_masiva_anexos.html", {
-                            "request": request, 
-                            "user": user,
-                            "error": "El archivo no tiene los encabezados requeridos: numero, usuario, area_nivel1"
-                        })
-                    
-                    # Leer filas (omitir la primera fila de encabezados)
-                    for row in list(ws.rows)[1:]:
-                        # Convertir celdas a valores de texto
-                        row_values = [str(cell.value).strip() if cell.value is not None else "" for cell in row]
-                        if any(row_values):  # Omitir filas vacías
-                            rows.append(row_values)
-                    
-                except ImportError:
-                    # Si openpyxl no está disponible, intentar usar xlrd (para archivos .xls)
-                    try:
-                        import io
-                        import xlrd
-                        
-                        # Abrir el libro Excel
-                        workbook = xlrd.open_workbook(file_contents=content)
-                        sheet = workbook.sheet_by_index(0)
-                        
-                        # Leer encabezados (primera fila)
-                        headers = [str(sheet.cell_value(0, col)).strip() for col in range(sheet.ncols)]
-                        
-                        # Verificar encabezados mínimos requeridos
-                        if not headers or 'numero' not in headers or 'usuario' not in headers or 'area_nivel1' not in headers:
-                            return templates.TemplateResponse("carga_masiva_anexos.html", {
-                                "request": request, 
-                                "user": user,
-                                "error": "El archivo no tiene los encabezados requeridos: numero, usuario, area_nivel1"
-                            })
-                        
-                        # Leer filas (omitir la primera fila de encabezados)
-                        for row_idx in range(1, sheet.nrows):
-                            row_values = [str(sheet.cell_value(row_idx, col)).strip() for col in range(sheet.ncols)]
-                            if any(row_values):  # Omitir filas vacías
-                                rows.append(row_values)
-                    
-                    except ImportError:
-                        # Si ninguna biblioteca Excel está disponible, intentar con pandas
-                        try:
-                            import io
-                            import pandas as pd
-                            
-                            # Leer el archivo Excel con pandas
-                            df = pd.read_excel(io.BytesIO(content))
-                            
-                            # Verificar encabezados mínimos requeridos
-                            df_columns = df.columns.tolist()
-                            headers = [str(col).strip() for col in df_columns]
-                            
-                            if not headers or 'numero' not in headers or 'usuario' not in headers or 'area_nivel1' not in headers:
-                                return templates.TemplateResponse("carga_masiva_anexos.html", {
-                                    "request": request, 
-                                    "user": user,
-                                    "error": "El archivo no tiene los encabezados requeridos: numero, usuario, area_nivel1"
-                                })
-                            
-                            # Convertir DataFrame a lista de filas
-                            rows = df.values.tolist()
-                            
-                        except ImportError:
-                            # Si ninguna de las bibliotecas está disponible
-                            return templates.TemplateResponse("carga_masiva_anexos.html", {
-                                "request": request, 
-                                "user": user,
-                                "error": "No se pueden procesar archivos Excel en este servidor. Por favor, exporte a CSV e intente de nuevo."
-                            })
-            
-            except Exception as e:
-                print(f"Error procesando archivo Excel: {str(e)}")
-                return templates.TemplateResponse("carga_masiva_anexos.html", {
-                    "request": request, 
-                    "user": user,
-                    "error": f"Error procesando archivo Excel: {str(e)}"
-                })
-        
-        else:
-            # Archivo CSV - intentar con diferentes codificaciones
-            encodings = ['utf-8', 'latin-1', 'windows-1252', 'iso-8859-1']
-            decoded = False
-            
-            for encoding in encodings:
-                try:
-                    # Intentar decodificar con esta codificación
-                    text_content = content.decode(encoding).splitlines()
-                    reader = csv.reader(text_content)
-                    
-                    # Leer encabezados
-                    headers = next(reader, None)
-                    
-                    # Verificar encabezados mínimos requeridos
-                    if not headers or 'numero' not in headers or 'usuario' not in headers or 'area_nivel1' not in headers:
-                        return templates.TemplateResponse("carga_masiva_anexos.html", {
-                            "request": request, 
-                            "user": user,
-                            "error": "El archivo no tiene los encabezados requeridos: numero, usuario, area_nivel1"
-                        })
-                    
-                    # Leer filas
-                    rows = list(reader)
-                    decoded = True
-                    print(f"✅ Archivo decodificado correctamente con codificación: {encoding}")
-                    break  # Si llegamos aquí, la decodificación fue exitosa
-                except UnicodeDecodeError:
-                    print(f"❌ Fallo al decodificar con {encoding}")
-                    continue  # Probar con la siguiente codificación
-            
-            if not decoded:
-                return templates.TemplateResponse("carga_masiva_anexos.html", {
-                    "request": request, 
-                    "user": user,
-                    "error": "No se pudo decodificar el archivo. Asegúrese de que sea un CSV válido."
-                })
+        # Etapa 1: lectura en streaming y COPY a staging
+        try:
+            registros = registros_anexos(leer_filas(file.file, file.filename or ""), progreso)
+            await cargar_staging(db, registros)
+        except ValueError as e:
+            await db.rollback()
+            return templates.TemplateResponse("carga_masiva_anexos.html", {
+                "request": request, 
+                "user": user,
+                "error": str(e)
+            })
         
         # Si no hay filas para procesar
-        if not rows:
+        if not progreso.filas:
+            await db.rollback()
             return templates.TemplateResponse("carga_masiva_anexos.html", {
                 "request": request, 
                 "user": user,
                 "error": "El archivo no contiene datos para procesar."
             })
         
-        # Mapear índices de columnas
-        column_indices = {}
-        for col in ['numero', 'usuario', 'area_nivel1', 'area_nivel2', 'area_nivel3', 'pin', 'saldo_actual']:
-            column_indices[col] = headers.index(col) if col in headers else -1
+        # Etapa 2: validación de todo el lote
+        progreso.etapa = "validando"
+        errores = await validar_staging(db)
+        progreso.errores = len(errores)
+        errores_mostrados = errores[:CARGA_MASIVA_MAX_ERRORES]
+        if len(errores) > CARGA_MASIVA_MAX_ERRORES:
+            errores_mostrados.append(f"... y {len(errores) - CARGA_MASIVA_MAX_ERRORES} filas más con errores.")
+        
+        if errores and not continuar_errores:
+            await db.rollback()
+            progreso.etapa = "error"
+            return templates.TemplateResponse("carga_masiva_anexos.html", {
+                "request": request,
+                "user": user,
+                "error": f"Se encontraron {len(errores)} filas con errores. Proceso abortado.",
+                "errores": errores_mostrados
+            })
+        
+        # Etapa 3: merge en anexos / saldo_anexos
+        progreso.etapa = "insertando"
+        creados = await fusionar_staging(db, generar_pin)
         
         # Obtener longitud configurada del PIN
-        pin_length_query = text("SELECT valor FROM configuracion WHERE clave = 'pin_length'")
-        pin_length_row = db.execute(pin_length_query).fetchone()
+        pin_length_row = (await db.execute(
+            text("SELECT valor FROM configuracion WHERE clave = 'pin_length'")
+        )).fetchone()
         pin_length = int(pin_length_row[0]) if pin_length_row else 6  # Valor por defecto: 6
         
-        # Procesar filas
-        for i, row in enumerate(rows, start=2):  # start=2 para considerar la fila 1 como encabezados
-            try:
-                # Asegurarse de que la fila tiene suficientes columnas
-                if len(row) <= max(idx for idx in column_indices.values() if idx >= 0):
-                    # Extender la fila con valores vacíos si es necesario
-                    row.extend([''] * (max(idx for idx in column_indices.values() if idx >= 0) - len(row) + 1))
-                
-                # Validar que tenga los campos requeridos
-                if column_indices['numero'] < 0 or column_indices['usuario'] < 0 or column_indices['area_nivel1'] < 0:
-                    raise ValueError("No se encontraron las columnas requeridas: numero, usuario, area_nivel1")
-                
-                # Verificar que los campos requeridos no estén vacíos
-                if not row[column_indices['numero']] or not row[column_indices['usuario']] or not row[column_indices['area_nivel1']]:
-                    raise ValueError("Faltan valores en campos requeridos: numero, usuario, area_nivel1")
-                
-                # Extraer datos básicos
-                numero = str(row[column_indices['numero']]).strip()
-                usuario = str(row[column_indices['usuario']]).strip()
-                area_nivel1 = str(row[column_indices['area_nivel1']]).strip()
-                
-                # Extraer datos opcionales
-                area_nivel2 = str(row[column_indices['area_nivel2']]).strip() if column_indices['area_nivel2'] >= 0 and len(row) > column_indices['area_nivel2'] else ''
-                area_nivel3 = str(row[column_indices['area_nivel3']]).strip() if column_indices['area_nivel3'] >= 0 and len(row) > column_indices['area_nivel3'] else ''
-                
-                # Extraer PIN si existe
-                pin = None
-                if column_indices['pin'] >= 0 and len(row) > column_indices['pin'] and row[column_indices['pin']]:
-                    pin = str(row[column_indices['pin']]).strip()
-                
-                # Extraer saldo inicial si existe
-                saldo_actual = 0.0
-                if column_indices['saldo_actual'] >= 0 and len(row) > column_indices['saldo_actual'] and row[column_indices['saldo_actual']]:
-                    try:
-                        saldo_value = str(row[column_indices['saldo_actual']]).strip().replace(',', '.')
-                        # Manejar casos donde el valor puede ser un float en formato de texto o tener caracteres no numéricos
-                        saldo_actual = float(''.join(c for c in saldo_value if c.isdigit() or c == '.'))
-                    except ValueError:
-                        print(f"⚠️ Error convirtiendo saldo: {row[column_indices['saldo_actual']]}")
-                        saldo_actual = 0.0
-                
-                # Verificar si el número ya existe
-                check_query = text("SELECT id FROM anexos WHERE numero = :numero")
-                existing = db.execute(check_query, {"numero": numero}).fetchone()
-                
-                if existing:
-                    raise ValueError(f"El anexo {numero} ya existe")
-                
-                # Generar PIN si no se proporcionó y está activada la opción
-                if not pin and generar_pin:
-                    import random
-                    pin = ''.join(random.choices('0123456789', k=pin_length))
-                    print(f"PIN generado para {numero}: {pin}")
-                
-                # Hashear el PIN
-                from passlib.context import CryptContext
-                pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-                hashed_pin = pwd_context.hash(pin) if pin else None
-                
-                # Insertar el nuevo anexo
-                insert_query = text("""
-                    INSERT INTO anexos (numero, usuario, area_nivel1, area_nivel2, area_nivel3, pin, saldo_actual, activo)
-                    VALUES (:numero, :usuario, :area_nivel1, :area_nivel2, :area_nivel3, :pin, :saldo_actual, TRUE)
-                    RETURNING id
-                """)
-                
-                result = db.execute(insert_query, {
-                    "numero": numero,
-                    "usuario": usuario,
-                    "area_nivel1": area_nivel1,
-                    "area_nivel2": area_nivel2,
-                    "area_nivel3": area_nivel3,
-                    "pin": hashed_pin,
-                    "saldo_actual": saldo_actual,
-                    "activo": True
-                })
-                
-                anexo_id = result.fetchone()[0]
-                
-                # Inicializar saldo en la tabla saldo_anexos si tiene saldo inicial
-                if saldo_actual > 0:
-                    saldo_query = text("""
-                        INSERT INTO saldo_anexos (calling_number, saldo, fecha_ultima_recarga)
-                        VALUES (:numero, :saldo, CURRENT_TIMESTAMP)
-                    """)
-                    db.execute(saldo_query, {"numero": numero, "saldo": saldo_actual})
-                    
-                    # Registrar en auditoría
-                    audit_query = text("""
-                        INSERT INTO saldo_auditoria (calling_number, saldo_anterior, saldo_nuevo, tipo_accion)
-                        VALUES (:numero, 0, :saldo, 'creacion_anexo')
-                    """)
-                    db.execute(audit_query, {"numero": numero, "saldo": saldo_actual})
-                
-                procesados += 1
-                exitosos += 1
-                
-            except Exception as e:
-                # Registrar error
-                error_msg = f"Fila {i}: {str(e)}"
-                errores.append(error_msg)
-                
-                # Si no debemos continuar ante errores, terminar
-                if not continuar_errores:
-                    db.rollback()
-                    return templates.TemplateResponse("carga_masiva_anexos.html", {
-                        "request": request,
-                        "user": user,
-                        "error": f"Error en la fila {i}: {str(e)}. Proceso abortado.",
-                        "errores": errores
-                    })
-        
         # Confirmar cambios en la base de datos
-        db.commit()
+        await db.commit()
+        progreso.creados = len(creados)
+        
+        for numero, _, saldo in creados:
+            if saldo > 0:
+                reservation_ledger.acreditar(numero, float(saldo))
+        
+        # Etapa 4: PINs en el pool de procesos, fuera del event loop
+        pines = pines_pendientes(creados, generar_pin, pin_length)
+        if pines:
+            asyncio.get_running_loop().run_in_executor(
+                None, aplicar_pines, SessionLocal, hasheador_pines, pines, progreso
+            )
+        else:
+            progreso.etapa = "terminado"
+        print(f"📇 Carga masiva de anexos: {progreso.filas} filas, {len(creados)} creados, "
+              f"{len(errores)} con errores, {len(pines)} PINs pendientes")
         
         # Mensaje de éxito
-        success_message = f"Se procesaron {procesados} registros. {exitosos} anexos creados con éxito."
+        success_message = f"Se procesaron {progreso.filas} registros. {len(creados)} anexos creados con éxito."
         if errores:
             success_message += f" Se encontraron {len(errores)} errores."
+        if pines:
+            success_message += f" Los PINs de {len(pines)} anexos se están generando en segundo plano."
         
         return templates.TemplateResponse("carga_masiva_anexos.html", {
             "request": request,
             "user": user,
             "success": success_message,
-            "errores": errores if errores else None
+            "errores": errores_mostrados if errores else None,
+            "carga_id": progreso.id if pines else None
         })
         
     except Exception as e:
         # En caso de error general, hacer rollback
-        db.rollback()
+        await db.rollback()
+        progreso.etapa = "error"
+        progreso.error = str(e)
         return templates.TemplateResponse("carga_masiva_anexos.html", {
             "request": request,
             "user": user,
             "error": f"Error general: {str(e)}"
         })
     finally:
-        db.close()
+        await db.close()
+
+@app.get("/api/anexos/carga_masiva/{carga_id}")
+async def progreso_carga_masiva_anexos(carga_id: str, user=Depends(admin_only)):
+    if isinstance(user, RedirectResponse):
+        return user
+    progreso = cargas_anexos.obtener(carga_id)
+    if progreso is None:
+        raise HTTPException(status_code=404, detail="Carga no encontrada")
+    return progreso.como_dict()
+
+@app.get("/api/anexos/carga_masiva/{carga_id}/pines")
+async def descargar_pines_carga_masiva(carga_id: str, user=Depends(admin_only)):
+    """CSV de los PINs generados en la carga; se descarga una sola vez"""
+    if isinstance(user, RedirectResponse):
+        return user
+    progreso = cargas_anexos.obtener(carga_id)
+    if progreso is None:
+        raise HTTPException(status_code=404, detail="Carga no encontrada o vencida")
+    if progreso.etapa not in ("terminado", "error"):
+        raise HTTPException(status_code=409, detail="Los PINs de la carga todavía se están generando")
+    archivo = progreso.retirar_csv()
+    if archivo is None:
+        raise HTTPException(status_code=410, detail="El CSV de PINs ya fue descargado o la carga no generó PINs")
+    contenido, filename = archivo
+    return StreamingResponse(
+        io.BytesIO(contenido),
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+@app.get("/anexos/pines_pendientes")
+async def contar_anexos_pines_pendientes(user=Depends(admin_only)):
+    if isinstance(user, RedirectResponse):
+        return user
+    def contar():
+        db = SessionLocal()
+        try:
+            return contar_pines_pendientes(db)
+        finally:
+            db.close()
+    return {"pendientes": await asyncio.to_thread(contar)}
+
+@app.post("/anexos/pines_pendientes")
+async def reanudar_pines_pendientes(user=Depends(admin_only)):
+    """
+    Asigna PINs nuevos a los anexos de cargas masivas que quedaron sin PIN
+    (reinicio o error durante el hash). Los PINs se descargan una vez como CSV.
+    """
+    if isinstance(user, RedirectResponse):
+        return user
+    # Una carga en curso todavía puede guardar sus propios PINs
+    if cargas_anexos.activas():
+        raise HTTPException(status_code=409, detail="Hay una carga masiva de anexos en curso")
+    
+    en_curso = trabajos_pines.activas()
+    if en_curso:
+        trabajo = en_curso[0]
+    else:
+        db = AsyncSessionLocal()
+        try:
+            pin_length_row = (await db.execute(
+                text("SELECT valor FROM configuracion WHERE clave = 'pin_length'")
+            )).fetchone()
+            pin_length = int(pin_length_row[0]) if pin_length_row else 6
+        finally:
+            await db.close()
+        
+        trabajo = trabajos_pines.nueva()
+        asyncio.get_running_loop().run_in_executor(
+            None, lambda: regenerar_pines(SessionLocal, hasheador_pines, trabajo, pin_length, solo_pendientes=True)
+        )
+    
+    return JSONResponse(status_code=202, content={
+        **trabajo.como_dict(),
+        "status_url": f"/anexos/generar_pines/{trabajo.id}",
+        "download_url": f"/anexos/generar_pines/{trabajo.id}/csv",
+    })
         
 # Modelo Pydantic para la configuración de CUCM
 class CucmConfigModel(BaseModel):
@@ -2837,6 +2937,9 @@ async def update_cucm_config(config: CucmConfigModel, user=Depends(admin_only)):
     
     db.commit()
     db.close()
+
+    # Los clientes AXL se rearman con la configuración nueva en el próximo uso
+    clientes_axl.invalidar()
     
     return {"message": "Configuración actualizada correctamente"}
 
@@ -3115,16 +3218,17 @@ def rejected_call(event: CallEvent):
     db = SessionLocal()
     
     # Registrar la llamada rechazada
-    cdr = CDR(
-        calling_number=event.calling_number,
-        called_number=event.called_number,
-        start_time=event.start_time,
-        end_time=event.end_time,
-        duration_seconds=0,
-        cost=0,
-        status="rejected_insufficient_balance"
-    )
-    db.add(cdr)
+    cdr_data = {
+        "calling_number": event.calling_number,
+        "called_number": event.called_number,
+        "start_time": event.start_time,
+        "end_time": event.end_time,
+        "duration_seconds": 0,
+        "cost": 0,
+        "status": "rejected_insufficient_balance"
+    }
+    db.add(CDR(**cdr_data))
+    acumular_resumenes(db, [cdr_data])
     db.commit()
     db.close()
     
@@ -3143,13 +3247,11 @@ async def monitoreo(request: Request):
         # Estadísticas básicas para mostrar inicialmente
         today = datetime.now().date()
 
-        llamadas_hoy = db.execute(
-            text("SELECT COUNT(*) FROM cdr WHERE DATE(start_time) = '{today}'")
-        ).scalar() or 0
-        
-        minutos_hoy = db.execute(
-            text("SELECT COALESCE(SUM(duration_seconds)/60, 0) FROM cdr WHERE DATE(start_time) = '{today}'")
-        ).scalar() or 0
+        # Del resumen diario (se actualiza con cada CDR)
+        llamadas_hoy, minutos_hoy = db.execute(
+            text("SELECT COALESCE(SUM(llamadas), 0), COALESCE(SUM(segundos)/60, 0) FROM cdr_resumen_dia WHERE dia = :hoy"),
+            {"hoy": today}
+        ).fetchone()
         
         alertas_saldo = db.execute(
             text("SELECT calling_number, saldo FROM saldo_anexos WHERE saldo < 5.0 ORDER BY saldo ASC LIMIT 5")
@@ -3181,12 +3283,12 @@ async def dashboard_zonas(request: Request, user=Depends(admin_only)):
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     query = text("SELECT id, nombre, descripcion FROM zonas ORDER BY nombre")
-    zonas = db.execute(query).fetchall()
+    zonas = (await db.execute(query)).fetchall()
     
-    db.close()
+    await db.close()
     
     return templates.TemplateResponse("dashboard_zonas.html", {
         "request": request, "zonas": zonas, "user": user
@@ -3197,10 +3299,10 @@ async def dashboard_prefijos(request: Request, zona_id: int = None, user=Depends
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     zonas_query = text("SELECT id, nombre FROM zonas ORDER BY nombre")
-    zonas = db.execute(zonas_query).fetchall()
+    zonas = (await db.execute(zonas_query)).fetchall()
     
     if zona_id:
         prefijos_query = text("""
@@ -3210,10 +3312,10 @@ async def dashboard_prefijos(request: Request, zona_id: int = None, user=Depends
             WHERE p.zona_id = :zona_id
             ORDER BY p.prefijo
         """)
-        prefijos = db.execute(prefijos_query, {"zona_id": zona_id}).fetchall()
+        prefijos = (await db.execute(prefijos_query, {"zona_id": zona_id})).fetchall()
         
         zona_query = text("SELECT id, nombre FROM zonas WHERE id = :zona_id")
-        zona_actual = db.execute(zona_query, {"zona_id": zona_id}).fetchone()
+        zona_actual = (await db.execute(zona_query, {"zona_id": zona_id})).fetchone()
     else:
         prefijos_query = text("""
             SELECT p.id, p.zona_id, p.prefijo, p.longitud_minima, p.longitud_maxima, z.nombre as zona_nombre
@@ -3221,10 +3323,10 @@ async def dashboard_prefijos(request: Request, zona_id: int = None, user=Depends
             JOIN zonas z ON p.zona_id = z.id
             ORDER BY z.nombre, p.prefijo
         """)
-        prefijos = db.execute(prefijos_query).fetchall()
+        prefijos = (await db.execute(prefijos_query)).fetchall()
         zona_actual = None
     
-    db.close()
+    await db.close()
     
     return templates.TemplateResponse("dashboard_prefijos.html", {
         "request": request, "prefijos": prefijos, "zonas": zonas, 
@@ -3236,10 +3338,10 @@ async def dashboard_tarifas(request: Request, zona_id: int = None, user=Depends(
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     zonas_query = text("SELECT id, nombre FROM zonas ORDER BY nombre")
-    zonas = db.execute(zonas_query).fetchall()
+    zonas = (await db.execute(zonas_query)).fetchall()
     
     if zona_id:
         tarifas_query = text("""
@@ -3249,10 +3351,10 @@ async def dashboard_tarifas(request: Request, zona_id: int = None, user=Depends(
             WHERE t.zona_id = :zona_id
             ORDER BY t.fecha_inicio DESC
         """)
-        tarifas = db.execute(tarifas_query, {"zona_id": zona_id}).fetchall()
+        tarifas = (await db.execute(tarifas_query, {"zona_id": zona_id})).fetchall()
         
         zona_query = text("SELECT id, nombre FROM zonas WHERE id = :zona_id")
-        zona_actual = db.execute(zona_query, {"zona_id": zona_id}).fetchone()
+        zona_actual = (await db.execute(zona_query, {"zona_id": zona_id})).fetchone()
     else:
         tarifas_query = text("""
             SELECT t.id, t.zona_id, t.tarifa_segundo, t.fecha_inicio, t.activa, z.nombre as zona_nombre
@@ -3260,10 +3362,10 @@ async def dashboard_tarifas(request: Request, zona_id: int = None, user=Depends(
             JOIN zonas z ON t.zona_id = z.id
             ORDER BY z.nombre, t.fecha_inicio DESC
         """)
-        tarifas = db.execute(tarifas_query).fetchall()
+        tarifas = (await db.execute(tarifas_query)).fetchall()
         zona_actual = None
     
-    db.close()
+    await db.close()
     
     return templates.TemplateResponse("dashboard_tarifas.html", {
         "request": request, "tarifas": tarifas, "zonas": zonas, 
@@ -3275,32 +3377,37 @@ def dashboard_estadisticas_zona(request: Request,
                                user=Depends(authenticated_user),
                                fecha_inicio: str = Query(None),
                                fecha_fin: str = Query(None)):
-    db = SessionLocal()
     # Establecer fechas por defecto si no se proporcionan
     if not fecha_inicio:
         fecha_inicio = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
     if not fecha_fin:
         fecha_fin = datetime.now().strftime('%Y-%m-%d')
+    try:
+        desde = datetime.strptime(fecha_inicio, '%Y-%m-%d').date()
+        hasta = datetime.strptime(fecha_fin, '%Y-%m-%d').date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fechas inválidas, usar YYYY-MM-DD")
     
-    # Consulta SQL
-    query = f"""
+    # Zona asignada al tarificar (zona_id), agregada desde el resumen diario
+    query = text("""
         SELECT 
             z.nombre as zona_nombre,
-            COUNT(*) as total_llamadas,
-            SUM(c.duration_seconds) / 60.0 as duracion_total_minutos,
-            SUM(c.cost) as costo_total,
-            AVG(c.cost) as costo_promedio,
-            AVG(c.duration_seconds) / 60.0 as duracion_promedio_minutos
-        FROM cdr c
-        JOIN prefijos p ON SUBSTR(c.called_number, 1, LENGTH(p.prefijo)) = p.prefijo
-        JOIN zonas z ON p.zona_id = z.id
-        WHERE c.start_time >= '{fecha_inicio} 00:00:00'
-          AND c.start_time <= '{fecha_fin} 23:59:59'
+            SUM(r.llamadas) as total_llamadas,
+            SUM(r.segundos) / 60.0 as duracion_total_minutos,
+            SUM(r.costo) as costo_total,
+            SUM(r.costo) / NULLIF(SUM(r.llamadas), 0) as costo_promedio,
+            SUM(r.segundos) / 60.0 / NULLIF(SUM(r.llamadas), 0) as duracion_promedio_minutos
+        FROM cdr_resumen_dia r
+        JOIN zonas z ON r.zona_id = z.id
+        WHERE r.dia >= :desde AND r.dia <= :hasta
         GROUP BY z.id, z.nombre
         ORDER BY costo_total DESC
-    """
-    estadisticas = db.execute(text(query)).fetchall()
-    db.close()
+    """)
+    db = SessionLocal()
+    try:
+        estadisticas = db.execute(query, {"desde": desde, "hasta": hasta}).fetchall()
+    finally:
+        db.close()
 
     # Calcular totales y porcentajes
     total_costo = sum(float(e.costo_total) if e.costo_total else 0 for e in estadisticas)
@@ -3341,6 +3448,87 @@ def dashboard_estadisticas_zona(request: Request,
         "fecha_fin": fecha_fin
     })
 
+def _respuesta_trabajo(trabajo, deduplicado: bool = False):
+    """202 con el estado del trabajo y las URLs para seguirlo"""
+    return JSONResponse(status_code=202, content={
+        **trabajo.como_dict(),
+        "deduplicado": deduplicado,
+        "status_url": f"/api/exportaciones/{trabajo.id}",
+        "download_url": f"/api/exportaciones/{trabajo.id}/descargar",
+    })
+
+def _archivo_trabajo(trabajo):
+    """Archivo del trabajo si ya terminó; si no, su estado"""
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail="Trabajo de exportación no encontrado o vencido")
+    if trabajo.estado == "error":
+        return JSONResponse(status_code=500, content={"error": f"Error al generar la exportación: {trabajo.error}"})
+    if trabajo.estado != "terminado":
+        return _respuesta_trabajo(trabajo)
+    return FileResponse(trabajo.archivo, media_type=trabajo.media_type, filename=trabajo.nombre)
+
+def _exportar_cdr(formato: str, filtros: dict, limit: Optional[int], background: bool = False):
+    """Respuesta en streaming de la exportación de CDR, o un trabajo en segundo plano con background=true"""
+    limite = limit or CDR_EXPORT_MAX_ROWS or None
+    if CDR_EXPORT_MAX_ROWS and limite > CDR_EXPORT_MAX_ROWS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"El límite máximo de exportación es {CDR_EXPORT_MAX_ROWS} registros"
+        )
+
+    if background:
+        trabajo, deduplicado = exportaciones.enviar(
+            f"cdr_{formato}", {"filtros": filtros, "limite": limite, "bloque": CDR_EXPORT_BLOQUE}
+        )
+        return _respuesta_trabajo(trabajo, deduplicado)
+
+    query, params = consulta_exportacion_cdr(filtros, limite)
+    print(f"🔍 Exportación CDR ({formato}), límite {limite or 'sin límite'}: {params}")
+
+    estado = EstadoExportacion(limite)
+    bloques = leer_por_bloques(SessionLocal, query, params, estado, bloque=CDR_EXPORT_BLOQUE)
+    if formato == "csv":
+        contenido = csv_por_bloques(bloques, estado)
+        media_type = "text/csv; charset=utf-8"
+    elif formato == "xlsx":
+        contenido = xlsx_por_bloques(bloques, estado, resumen_filtros(filtros))
+        media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        contenido = pdf_por_bloques(bloques, estado, resumen_filtros(filtros))
+        media_type = "application/pdf"
+
+    return StreamingResponse(
+        contenido,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f"attachment; filename={nombre_archivo(filtros, formato)}",
+            "X-Export-Limit": str(limite or 0),
+        }
+    )
+
+@app.get("/export/cdr/csv")
+def export_cdr_csv(
+    user=Depends(admin_only),
+    start_date: str = Query(None),
+    end_date: str = Query(None),
+    calling_number: str = Query(None),
+    called_number: str = Query(None),
+    phone_number: str = Query(None),
+    status: str = Query(None),
+    direction: str = Query(None),
+    limit: Optional[int] = Query(None, ge=1),
+    background: bool = Query(False)
+):
+    """Exporta los registros CDR a CSV con todos los filtros del dashboard."""
+    if isinstance(user, RedirectResponse):
+        return user
+    filtros = {
+        "start_date": start_date, "end_date": end_date, "calling_number": calling_number,
+        "called_number": called_number, "phone_number": phone_number, "status": status,
+        "direction": direction,
+    }
+    return _exportar_cdr("csv", filtros, limit, background)
+
 @app.get("/export/cdr/pdf")
 def export_cdr_pdf(
     user=Depends(admin_only),
@@ -3348,218 +3536,22 @@ def export_cdr_pdf(
     end_date: str = Query(None),
     calling_number: str = Query(None),
     called_number: str = Query(None),
-    # ✅ AGREGAR NUEVOS PARÁMETROS
     phone_number: str = Query(None),
     status: str = Query(None),
-    direction: str = Query(None)
+    direction: str = Query(None),
+    limit: Optional[int] = Query(None, ge=1),
+    background: bool = Query(False)
 ):
     """Exporta los registros CDR a un archivo PDF con todos los filtros del dashboard."""
-    from sqlalchemy import text
-    from datetime import datetime
-    from jinja2 import Template
-    from weasyprint import HTML
-    import io
-    
-    db = SessionLocal()
-    
-    try:
-        # ✅ CONSULTA BASE ADAPTADA A TU ESQUEMA
-        query = """
-            SELECT c.calling_number, c.called_number, 
-                   c.start_time, c.end_time, c.duration_seconds, 
-                   c.duration_billable, c.cost, c.status,
-                   z.nombre as zona
-            FROM cdr c
-            LEFT JOIN zonas z ON c.zona_id = z.id
-            WHERE 1=1
-        """
-        
-        params = {}
-        
-        # ✅ FILTRO DE NÚMERO MEJORADO (busca en origen Y destino)
-        if phone_number:
-            query += " AND (c.calling_number LIKE :phone_pattern OR c.called_number LIKE :phone_pattern)"
-            params["phone_pattern"] = f"%{phone_number}%"
-        
-        # ✅ MANTENER COMPATIBILIDAD CON FILTROS EXISTENTES
-        if calling_number and not phone_number:  # Solo si no se usa phone_number
-            query += " AND c.calling_number = :calling_number"
-            params["calling_number"] = calling_number
-        
-        if called_number and not phone_number:  # Solo si no se usa phone_number
-            query += " AND c.called_number = :called_number"
-            params["called_number"] = called_number
-        
-        # ✅ FILTROS DE FECHA (mantener igual)
-        if start_date:
-            query += " AND c.start_time >= :start_date"
-            params["start_date"] = f"{start_date} 00:00:00"
-        
-        if end_date:
-            query += " AND c.end_time <= :end_date"
-            params["end_date"] = f"{end_date} 23:59:59"
-        
-        # ✅ NUEVO: FILTRO DE ESTADO
-        if status:
-            query += " AND c.status = :status"
-            params["status"] = status
-        
-        # ✅ NUEVO: FILTRO DE DIRECCIÓN  
-        if direction:
-            query += " AND c.direction = :direction"
-            params["direction"] = direction
-        
-        # Ordenar por fecha descendente
-        query += " ORDER BY c.start_time DESC LIMIT 1000"
-        
-        print(f"🔍 Query PDF: {query}")
-        print(f"🔍 Params PDF: {params}")
-        
-        # Ejecutar la consulta
-        rows = db.execute(text(query), params).fetchall()
-        
-        print(f"📊 Registros encontrados para PDF: {len(rows)}")
-        
-        # ✅ HTML TEMPLATE MEJORADO CON INFO DE FILTROS
-        html_template = """
-        <html>
-        <head>
-            <style>
-                body { font-family: Arial, sans-serif; margin: 20px; }
-                table { width: 100%; border-collapse: collapse; margin-top: 20px; }
-                th, td { border: 1px solid #ddd; padding: 8px; text-align: left; font-size: 10px; }
-                th { background-color: #f2f2f2; font-weight: bold; }
-                .header { text-align: center; margin-bottom: 20px; }
-                .filters { background-color: #f9f9f9; padding: 10px; margin-bottom: 20px; border-radius: 5px; }
-                .footer { text-align: center; margin-top: 20px; font-size: 0.8em; color: #666; }
-                h1 { color: #333; margin-bottom: 10px; }
-                .filter-item { display: inline-block; margin-right: 15px; font-size: 0.9em; }
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1>📞 Registro de Llamadas (CDR)</h1>
-                <p><strong>Total de registros:</strong> {{ rows|length }}</p>
-                <p><strong>Generado:</strong> {{ datetime.now().strftime('%Y-%m-%d %H:%M:%S') }}</p>
-            </div>
-            
-            <!-- ✅ MOSTRAR FILTROS APLICADOS -->
-            {% if phone_number or calling_number or called_number or start_date or end_date or status or direction %}
-            <div class="filters">
-                <strong>🔍 Filtros aplicados:</strong><br/>
-                {% if phone_number %}
-                <span class="filter-item">📞 <strong>Número:</strong> {{ phone_number }}</span>
-                {% endif %}
-                {% if calling_number %}
-                <span class="filter-item">📞 <strong>Origen:</strong> {{ calling_number }}</span>
-                {% endif %}
-                {% if called_number %}
-                <span class="filter-item">📱 <strong>Destino:</strong> {{ called_number }}</span>
-                {% endif %}
-                {% if start_date %}
-                <span class="filter-item">📅 <strong>Desde:</strong> {{ start_date }}</span>
-                {% endif %}
-                {% if end_date %}
-                <span class="filter-item">📅 <strong>Hasta:</strong> {{ end_date }}</span>
-                {% endif %}
-                {% if status %}
-                <span class="filter-item">📊 <strong>Estado:</strong> {{ status }}</span>
-                {% endif %}
-                {% if direction %}
-                <span class="filter-item">🔄 <strong>Dirección:</strong> {{ direction }}</span>
-                {% endif %}
-            </div>
-            {% endif %}
-            
-            {% if rows %}
-            <table>
-                <thead>
-                    <tr>
-                        <th>📞 Origen</th>
-                        <th>📱 Destino</th>
-                        <th>📅 Fecha/Hora Inicio</th>
-                        <th>⏱️ Duración</th>
-                        <th>💰 Facturada</th>
-                        <th>🌍 Zona</th>
-                        <th>💵 Costo</th>
-                        <th>📊 Estado</th>
-                    </tr>
-                </thead>
-                <tbody>
-                {% for row in rows %}
-                    <tr>
-                        <td>{{ row[0] }}</td>
-                        <td>{{ row[1] }}</td>
-                        <td>{{ row[2].strftime('%Y-%m-%d %H:%M:%S') if row[2] else 'N/A' }}</td>
-                        <td>{{ "%d:%02d"|format(row[4]//60, row[4]%60) if row[4] else '0:00' }}</td>
-                        <td>{{ "%d:%02d"|format(row[5]//60, row[5]%60) if row[5] else '0:00' }}</td>
-                        <td>{{ row[8] or 'N/A' }}</td>
-                        <td>S/{{ "%.6f"|format(row[6]) if row[6] else '0.000000' }}</td>
-                        <td>{{ row[7] or 'N/A' }}</td>
-                    </tr>
-                {% endfor %}
-                </tbody>
-            </table>
-            {% else %}
-            <div style="text-align: center; padding: 40px; color: #666;">
-                <h3>📭 No se encontraron registros</h3>
-                <p>No hay llamadas que coincidan con los filtros aplicados.</p>
-            </div>
-            {% endif %}
-            
-            <div class="footer">
-                <p>📄 Reporte generado el {{ datetime.now().strftime('%Y-%m-%d %H:%M:%S') }} | 
-                   📊 Total: {{ rows|length }} registro{{ 's' if rows|length != 1 else '' }}</p>
-            </div>
-        </body>
-        </html>
-        """
-        
-        # Renderizar el HTML con Jinja2
-        template = Template(html_template)
-        html_content = template.render(
-            rows=rows, 
-            datetime=datetime,
-            start_date=start_date,
-            end_date=end_date,
-            calling_number=calling_number,
-            called_number=called_number,
-            phone_number=phone_number,
-            status=status,
-            direction=direction
-        )
-        
-        # Generar el PDF usando WeasyPrint
-        pdf = HTML(string=html_content).write_pdf()
-        
-        # ✅ NOMBRE DE ARCHIVO CON INFO DE FILTROS
-        filename_parts = ["cdr_report"]
-        if phone_number:
-            filename_parts.append(f"num_{phone_number}")
-        if status:
-            filename_parts.append(f"status_{status}")
-        if direction:
-            filename_parts.append(f"dir_{direction}")
-        
-        filename_parts.append(datetime.now().strftime('%Y%m%d_%H%M%S'))
-        filename = "_".join(filename_parts) + ".pdf"
-        
-        db.close()
-        
-        # Devolver el PDF como respuesta
-        return StreamingResponse(
-            io.BytesIO(pdf),
-            media_type="application/pdf",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
-        
-    except Exception as e:
-        db.close()
-        import traceback
-        traceback.print_exc()
-        return {"error": f"Error al generar PDF: {str(e)}"}
+    if isinstance(user, RedirectResponse):
+        return user
+    filtros = {
+        "start_date": start_date, "end_date": end_date, "calling_number": calling_number,
+        "called_number": called_number, "phone_number": phone_number, "status": status,
+        "direction": direction,
+    }
+    return _exportar_cdr("pdf", filtros, limit, background)
 
-# ✅ ENDPOINT EXCEL USANDO LA MISMA LÓGICA
 @app.get("/export/cdr/excel")
 def export_cdr_excel(
     user=Depends(admin_only),
@@ -3569,220 +3561,85 @@ def export_cdr_excel(
     called_number: str = Query(None),
     phone_number: str = Query(None),
     status: str = Query(None),
-    direction: str = Query(None)
+    direction: str = Query(None),
+    limit: Optional[int] = Query(None, ge=1),
+    background: bool = Query(False)
 ):
     """Exporta los registros CDR a un archivo Excel con todos los filtros."""
-    from sqlalchemy import text
-    from datetime import datetime
-    import pandas as pd
-    import io
-    
-    db = SessionLocal()
-    
-    try:
-        # ✅ USAR LA MISMA LÓGICA DE CONSULTA QUE EL PDF
-        query = """
-            SELECT c.calling_number, c.called_number, 
-                   c.start_time, c.end_time, c.duration_seconds, 
-                   c.duration_billable, c.cost, c.status,
-                   z.nombre as zona
-            FROM cdr c
-            LEFT JOIN zonas z ON c.zona_id = z.id
-            WHERE 1=1
-        """
-        
-        params = {}
-        
-        # Aplicar filtros (misma lógica que PDF)
-        if phone_number:
-            query += " AND (c.calling_number LIKE :phone_pattern OR c.called_number LIKE :phone_pattern)"
-            params["phone_pattern"] = f"%{phone_number}%"
-        
-        if calling_number and not phone_number:
-            query += " AND c.calling_number = :calling_number"
-            params["calling_number"] = calling_number
-        
-        if called_number and not phone_number:
-            query += " AND c.called_number = :called_number"
-            params["called_number"] = called_number
-        
-        if start_date:
-            query += " AND c.start_time >= :start_date"
-            params["start_date"] = f"{start_date} 00:00:00"
-        
-        if end_date:
-            query += " AND c.end_time <= :end_date"
-            params["end_date"] = f"{end_date} 23:59:59"
-        
-        if status:
-            query += " AND c.status = :status"
-            params["status"] = status
-        
-        if direction:
-            query += " AND c.direction = :direction"
-            params["direction"] = direction
-        
-        query += " ORDER BY c.start_time DESC LIMIT 1000"
-        
-        print(f"🔍 Query Excel: {query}")
-        print(f"🔍 Params Excel: {params}")
-        
-        # Ejecutar consulta
-        rows = db.execute(text(query), params).fetchall()
-        
-        print(f"📊 Registros encontrados para Excel: {len(rows)}")
-        
-        # Crear DataFrame
-        if rows:
-            df_data = []
-            for row in rows:
-                duration_min = round(row[4]/60, 2) if row[4] else 0
-                billable_min = round(row[5]/60, 2) if row[5] else 0
-                
-                df_data.append({
-                    'Número Origen': row[0],
-                    'Número Destino': row[1],
-                    'Fecha Inicio': row[2].strftime('%Y-%m-%d %H:%M:%S') if row[2] else '',
-                    'Fecha Fin': row[3].strftime('%Y-%m-%d %H:%M:%S') if row[3] else '',
-                    'Duración (seg)': row[4] if row[4] else 0,
-                    'Duración (min)': duration_min,
-                    'Facturable (seg)': row[5] if row[5] else 0,
-                    'Facturable (min)': billable_min,
-                    'Costo': row[6] if row[6] else 0,
-                    'Estado': row[7] if row[7] else '',
-                    'Zona': row[8] if row[8] else ''
-                })
-            
-            df = pd.DataFrame(df_data)
-        else:
-            df = pd.DataFrame()
-        
-        # Crear Excel
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            # Hoja principal con datos
-            df.to_excel(writer, sheet_name='CDR_Data', index=False)
-            
-            # Hoja de resumen con filtros aplicados
-            summary_data = {
-                'Filtro': [],
-                'Valor': []
-            }
-            
-            if phone_number:
-                summary_data['Filtro'].append('Número')
-                summary_data['Valor'].append(phone_number)
-            if calling_number:
-                summary_data['Filtro'].append('Origen')
-                summary_data['Valor'].append(calling_number)
-            if called_number:
-                summary_data['Filtro'].append('Destino')
-                summary_data['Valor'].append(called_number)
-            if start_date:
-                summary_data['Filtro'].append('Fecha Inicio')
-                summary_data['Valor'].append(start_date)
-            if end_date:
-                summary_data['Filtro'].append('Fecha Fin')
-                summary_data['Valor'].append(end_date)
-            if status:
-                summary_data['Filtro'].append('Estado')
-                summary_data['Valor'].append(status)
-            if direction:
-                summary_data['Filtro'].append('Dirección')
-                summary_data['Valor'].append(direction)
-            
-            summary_data['Filtro'].extend(['Total Registros', 'Fecha Generación'])
-            summary_data['Valor'].extend([len(rows), datetime.now().strftime('%Y-%m-%d %H:%M:%S')])
-            
-            summary_df = pd.DataFrame(summary_data)
-            summary_df.to_excel(writer, sheet_name='Resumen', index=False)
-        
-        buffer.seek(0)
-        
-        # Nombre de archivo
-        filename_parts = ["cdr_report"]
-        if phone_number:
-            filename_parts.append(f"num_{phone_number}")
-        if status:
-            filename_parts.append(f"status_{status}")
-        
-        filename_parts.append(datetime.now().strftime('%Y%m%d_%H%M%S'))
-        filename = "_".join(filename_parts) + ".xlsx"
-        
-        db.close()
-        
-        return StreamingResponse(
-            io.BytesIO(buffer.getvalue()),
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
-        
-    except Exception as e:
-        db.close()
-        import traceback
-        traceback.print_exc()
-        return {"error": f"Error al generar Excel: {str(e)}"}
-                    
+    if isinstance(user, RedirectResponse):
+        return user
+    filtros = {
+        "start_date": start_date, "end_date": end_date, "calling_number": calling_number,
+        "called_number": called_number, "phone_number": phone_number, "status": status,
+        "direction": direction,
+    }
+    return _exportar_cdr("xlsx", filtros, limit, background)
+
 # Exportar reporte de consumo por zona
 @app.get("/export/consumo_zona/pdf")
 async def export_consumo_zona_pdf(user=Depends(admin_only)):
     if isinstance(user, RedirectResponse):
         return user
     
-    db = SessionLocal()
-    
-    # Estadísticas de consumo por zona (últimos 30 días)
-    stats_query = text("""
-        SELECT z.nombre, COUNT(c.id) as total_llamadas, 
-               SUM(c.duration_seconds) as total_duracion, 
-               SUM(c.cost) as total_costo
-        FROM cdr c
-        JOIN zonas z ON c.zona_id = z.id
-        WHERE c.start_time >= NOW() - INTERVAL '30 days'
-        GROUP BY z.nombre
-        ORDER BY total_costo DESC
-    """)
-    estadisticas = db.execute(stats_query).fetchall()
-    db.close()
+    trabajo, _ = exportaciones.enviar("consumo_zona_pdf", {})
+    return _archivo_trabajo(await exportaciones.esperar(trabajo.id, EXPORTACIONES_ESPERA_SECONDS))
+
+# API de trabajos de exportación
+class ExportacionRequest(BaseModel):
+    tipo: str
+    filtros: Dict[str, Optional[str]] = {}
+    limit: Optional[int] = None
+
+@app.post("/api/exportaciones")
+async def crear_exportacion(data: ExportacionRequest, user=Depends(admin_only)):
+    if isinstance(user, RedirectResponse):
+        return user
+
+    if data.tipo not in TIPOS_EXPORTACION:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tipo de exportación no válido; opciones: {', '.join(sorted(TIPOS_EXPORTACION))}"
+        )
+
+    parametros = {}
+    if data.tipo.startswith("cdr_"):
+        limite = data.limit or CDR_EXPORT_MAX_ROWS or None
+        if CDR_EXPORT_MAX_ROWS and limite > CDR_EXPORT_MAX_ROWS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"El límite máximo de exportación es {CDR_EXPORT_MAX_ROWS} registros"
+            )
+        filtros = {k: v for k, v in data.filtros.items() if v}
+        parametros = {"filtros": filtros, "limite": limite, "bloque": CDR_EXPORT_BLOQUE}
+
+    trabajo, deduplicado = exportaciones.enviar(data.tipo, parametros)
+    return _respuesta_trabajo(trabajo, deduplicado)
 
-    html_template = """
-    <html>
-    <body>
-    <h1>Reporte de Consumo por Zona</h1>
-    <h3>Últimos 30 días</h3>
-    <table border="1">
-        <thead>
-            <tr>
-                <th>Zona</th>
-                <th>Total Llamadas</th>
-                <th>Duración Total (seg)</th>
-                <th>Costo Total</th>
-            </tr>
-        </thead>
-        <tbody>
-        {% for row in estadisticas %}
-            <tr>
-                <td>{{ row[0] }}</td>
-                <td>{{ row[1] }}</td>
-                <td>{{ row[2] if row[2] else 0 }}</td>
-                <td>${{ "%.2f"|format(row[3] if row[3] else 0) }}</td>
-            </tr>
-        {% endfor %}
-        </tbody>
-    </table>
-    </body>
-    </html>
-    """
-    template = Template(html_template)
-    html_content = template.render(estadisticas=estadisticas)
+@app.get("/api/exportaciones")
+async def estado_exportaciones(user=Depends(admin_only)):
+    if isinstance(user, RedirectResponse):
+        return user
+    return exportaciones.stats()
 
-    pdf = HTML(string=html_content).write_pdf()
+@app.get("/api/exportaciones/{job_id}")
+async def progreso_exportacion(job_id: str, user=Depends(admin_only)):
+    if isinstance(user, RedirectResponse):
+        return user
+    trabajo = exportaciones.obtener(job_id)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail="Trabajo de exportación no encontrado o vencido")
+    return trabajo.como_dict()
 
-    return StreamingResponse(
-        io.BytesIO(pdf),
-        media_type="application/pdf",
-        headers={"Content-Disposition": "attachment; filename=consumo_zona_report.pdf"}
-    )
+@app.get("/api/exportaciones/{job_id}/descargar")
+async def descargar_exportacion(job_id: str, user=Depends(admin_only)):
+    if isinstance(user, RedirectResponse):
+        return user
+    trabajo = exportaciones.obtener(job_id)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail="Trabajo de exportación no encontrado o vencido")
+    if trabajo.estado not in ("terminado", "error"):
+        raise HTTPException(status_code=409, detail=f"La exportación todavía está en curso ({trabajo.como_dict()['progreso']}%)")
+    return _archivo_trabajo(trabajo)
 
 # API para el módulo de zonas
 @app.get("/api/zonas")
@@ -3790,9 +3647,9 @@ async def listar_zonas(user=Depends(authenticated_user)):
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     query = text("SELECT id, nombre, descripcion FROM zonas ORDER BY nombre")
-    zonas = db.execute(query).fetchall()
+    zonas = (await db.execute(query)).fetchall()
     
     result = []
     for zona in zonas:
@@ -3802,7 +3659,7 @@ async def listar_zonas(user=Depends(authenticated_user)):
             "descripcion": zona[2]
         })
     
-    db.close()
+    await db.close()
     return result
 
 @app.post("/api/zonas")
@@ -3810,14 +3667,14 @@ async def crear_zona(zona: ZonaCreate, user=Depends(admin_only)):
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     # Verificar que no exista otra zona con el mismo nombre
     check_query = text("SELECT id FROM zonas WHERE nombre = :nombre")
-    existing = db.execute(check_query, {"nombre": zona.nombre}).fetchone()
+    existing = (await db.execute(check_query, {"nombre": zona.nombre})).fetchone()
     
     if existing:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=400, detail="Ya existe una zona con ese nombre")
     
     # Crear la zona
@@ -3827,7 +3684,7 @@ async def crear_zona(zona: ZonaCreate, user=Depends(admin_only)):
         RETURNING id
     """)
     
-    result = db.execute(insert_query, {
+    result = await db.execute(insert_query, {
         "nombre": zona.nombre,
         "descripcion": zona.descripcion
     })
@@ -3840,13 +3697,14 @@ async def crear_zona(zona: ZonaCreate, user=Depends(admin_only)):
         VALUES (:zona_id, :tarifa_segundo, CURRENT_TIMESTAMP, TRUE)
     """)
     
-    db.execute(insert_tarifa_query, {
+    await db.execute(insert_tarifa_query, {
         "zona_id": zona_id,
         "tarifa_segundo": 0.0005  # Tarifa por defecto: 0.03 por minuto
     })
     
-    db.commit()
-    db.close()
+    await db.commit()
+    await db.close()
+    await asyncio.to_thread(rating_snapshot.recargar)
     
     return {"id": zona_id, "nombre": zona.nombre, "descripcion": zona.descripcion}
 
@@ -3855,22 +3713,22 @@ async def actualizar_zona(zona_id: int, zona: ZonaCreate, user=Depends(admin_onl
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     # Verificar que la zona exista
     check_query = text("SELECT id FROM zonas WHERE id = :zona_id")
-    existing = db.execute(check_query, {"zona_id": zona_id}).fetchone()
+    existing = (await db.execute(check_query, {"zona_id": zona_id})).fetchone()
     
     if not existing:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=404, detail="Zona no encontrada")
     
     # Verificar que no exista otra zona con el mismo nombre
     check_name_query = text("SELECT id FROM zonas WHERE nombre = :nombre AND id != :zona_id")
-    existing_name = db.execute(check_name_query, {"nombre": zona.nombre, "zona_id": zona_id}).fetchone()
+    existing_name = (await db.execute(check_name_query, {"nombre": zona.nombre, "zona_id": zona_id})).fetchone()
     
     if existing_name:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=400, detail="Ya existe otra zona con ese nombre")
     
     # Actualizar la zona
@@ -3880,14 +3738,15 @@ async def actualizar_zona(zona_id: int, zona: ZonaCreate, user=Depends(admin_onl
         WHERE id = :zona_id
     """)
     
-    db.execute(update_query, {
+    await db.execute(update_query, {
         "zona_id": zona_id,
         "nombre": zona.nombre,
         "descripcion": zona.descripcion
     })
     
-    db.commit()
-    db.close()
+    await db.commit()
+    await db.close()
+    await asyncio.to_thread(rating_snapshot.recargar)
     
     return {"id": zona_id, "nombre": zona.nombre, "descripcion": zona.descripcion}
 
@@ -3896,25 +3755,25 @@ async def eliminar_zona(zona_id: int, user=Depends(admin_only)):
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     # Verificar que la zona exista
     check_query = text("SELECT id FROM zonas WHERE id = :zona_id")
-    existing = db.execute(check_query, {"zona_id": zona_id}).fetchone()
+    existing = (await db.execute(check_query, {"zona_id": zona_id})).fetchone()
     
     if not existing:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=404, detail="Zona no encontrada")
     
     # Verificar si tiene prefijos o tarifas asociadas
     check_prefijos_query = text("SELECT COUNT(*) FROM prefijos WHERE zona_id = :zona_id")
-    prefijos_count = db.execute(check_prefijos_query, {"zona_id": zona_id}).scalar()
+    prefijos_count = (await db.execute(check_prefijos_query, {"zona_id": zona_id})).scalar()
     
     check_tarifas_query = text("SELECT COUNT(*) FROM tarifas WHERE zona_id = :zona_id")
-    tarifas_count = db.execute(check_tarifas_query, {"zona_id": zona_id}).scalar()
+    tarifas_count = (await db.execute(check_tarifas_query, {"zona_id": zona_id})).scalar()
     
     if prefijos_count > 0 or tarifas_count > 0:
-        db.close()
+        await db.close()
         raise HTTPException(
             status_code=400, 
             detail="No se puede eliminar la zona porque tiene prefijos o tarifas asociadas"
@@ -3922,10 +3781,11 @@ async def eliminar_zona(zona_id: int, user=Depends(admin_only)):
     
     # Eliminar la zona
     delete_query = text("DELETE FROM zonas WHERE id = :zona_id")
-    db.execute(delete_query, {"zona_id": zona_id})
+    await db.execute(delete_query, {"zona_id": zona_id})
     
-    db.commit()
-    db.close()
+    await db.commit()
+    await db.close()
+    await asyncio.to_thread(rating_snapshot.recargar)
     
     return {"message": "Zona eliminada correctamente"}
 
@@ -3935,7 +3795,7 @@ async def listar_prefijos(zona_id: int = None, user=Depends(authenticated_user))
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     if zona_id:
         query = text("""
@@ -3945,7 +3805,7 @@ async def listar_prefijos(zona_id: int = None, user=Depends(authenticated_user))
             WHERE p.zona_id = :zona_id
             ORDER BY p.prefijo
         """)
-        prefijos = db.execute(query, {"zona_id": zona_id}).fetchall()
+        prefijos = (await db.execute(query, {"zona_id": zona_id})).fetchall()
     else:
         query = text("""
             SELECT p.id, p.zona_id, p.prefijo, p.longitud_minima, p.longitud_maxima, z.nombre as zona_nombre
@@ -3953,7 +3813,7 @@ async def listar_prefijos(zona_id: int = None, user=Depends(authenticated_user))
             JOIN zonas z ON p.zona_id = z.id
             ORDER BY z.nombre, p.prefijo
         """)
-        prefijos = db.execute(query).fetchall()
+        prefijos = (await db.execute(query)).fetchall()
     
     result = []
     for prefijo in prefijos:
@@ -3966,7 +3826,7 @@ async def listar_prefijos(zona_id: int = None, user=Depends(authenticated_user))
             "zona_nombre": prefijo[5]
         })
     
-    db.close()
+    await db.close()
     return result
 
 @app.post("/api/prefijos")
@@ -3974,19 +3834,19 @@ async def crear_prefijo(prefijo: PrefijoCreate, user=Depends(admin_only)):
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     # Verificar que la zona exista
     check_zona_query = text("SELECT id FROM zonas WHERE id = :zona_id")
-    existing_zona = db.execute(check_zona_query, {"zona_id": prefijo.zona_id}).fetchone()
+    existing_zona = (await db.execute(check_zona_query, {"zona_id": prefijo.zona_id})).fetchone()
     
     if not existing_zona:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=404, detail="Zona no encontrada")
     
     # Validar longitudes
     if prefijo.longitud_minima > prefijo.longitud_maxima:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=400, detail="La longitud mínima no puede ser mayor que la longitud máxima")
     
     # Insertar el prefijo
@@ -3996,7 +3856,7 @@ async def crear_prefijo(prefijo: PrefijoCreate, user=Depends(admin_only)):
         RETURNING id
     """)
     
-    result = db.execute(insert_query, {
+    result = await db.execute(insert_query, {
         "zona_id": prefijo.zona_id,
         "prefijo": prefijo.prefijo,
         "longitud_minima": prefijo.longitud_minima,
@@ -4007,10 +3867,11 @@ async def crear_prefijo(prefijo: PrefijoCreate, user=Depends(admin_only)):
     
     # Obtener el nombre de la zona
     zona_query = text("SELECT nombre FROM zonas WHERE id = :zona_id")
-    zona_nombre = db.execute(zona_query, {"zona_id": prefijo.zona_id}).fetchone()[0]
+    zona_nombre = (await db.execute(zona_query, {"zona_id": prefijo.zona_id})).fetchone()[0]
     
-    db.commit()
-    db.close()
+    await db.commit()
+    await db.close()
+    await asyncio.to_thread(rating_snapshot.recargar)
     
     return {
         "id": prefijo_id,
@@ -4026,27 +3887,27 @@ async def actualizar_prefijo(prefijo_id: int, prefijo: PrefijoCreate, user=Depen
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     # Verificar que el prefijo exista
     check_query = text("SELECT id FROM prefijos WHERE id = :prefijo_id")
-    existing = db.execute(check_query, {"prefijo_id": prefijo_id}).fetchone()
+    existing = (await db.execute(check_query, {"prefijo_id": prefijo_id})).fetchone()
     
     if not existing:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=404, detail="Prefijo no encontrado")
     
     # Verificar que la zona exista
     check_zona_query = text("SELECT id FROM zonas WHERE id = :zona_id")
-    existing_zona = db.execute(check_zona_query, {"zona_id": prefijo.zona_id}).fetchone()
+    existing_zona = (await db.execute(check_zona_query, {"zona_id": prefijo.zona_id})).fetchone()
     
     if not existing_zona:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=404, detail="Zona no encontrada")
     
     # Validar longitudes
     if prefijo.longitud_minima > prefijo.longitud_maxima:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=400, detail="La longitud mínima no puede ser mayor que la longitud máxima")
     
     # Actualizar el prefijo
@@ -4056,7 +3917,7 @@ async def actualizar_prefijo(prefijo_id: int, prefijo: PrefijoCreate, user=Depen
         WHERE id = :prefijo_id
     """)
     
-    db.execute(update_query, {
+    await db.execute(update_query, {
         "prefijo_id": prefijo_id,
         "zona_id": prefijo.zona_id,
         "prefijo": prefijo.prefijo,
@@ -4066,10 +3927,11 @@ async def actualizar_prefijo(prefijo_id: int, prefijo: PrefijoCreate, user=Depen
     
     # Obtener el nombre de la zona
     zona_query = text("SELECT nombre FROM zonas WHERE id = :zona_id")
-    zona_nombre = db.execute(zona_query, {"zona_id": prefijo.zona_id}).fetchone()[0]
+    zona_nombre = (await db.execute(zona_query, {"zona_id": prefijo.zona_id})).fetchone()[0]
     
-    db.commit()
-    db.close()
+    await db.commit()
+    await db.close()
+    await asyncio.to_thread(rating_snapshot.recargar)
     
     return {
         "id": prefijo_id,
@@ -4085,22 +3947,23 @@ async def eliminar_prefijo(prefijo_id: int, user=Depends(admin_only)):
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     # Verificar que el prefijo exista
     check_query = text("SELECT id FROM prefijos WHERE id = :prefijo_id")
-    existing = db.execute(check_query, {"prefijo_id": prefijo_id}).fetchone()
+    existing = (await db.execute(check_query, {"prefijo_id": prefijo_id})).fetchone()
     
     if not existing:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=404, detail="Prefijo no encontrado")
     
     # Eliminar el prefijo
     delete_query = text("DELETE FROM prefijos WHERE id = :prefijo_id")
-    db.execute(delete_query, {"prefijo_id": prefijo_id})
+    await db.execute(delete_query, {"prefijo_id": prefijo_id})
     
-    db.commit()
-    db.close()
+    await db.commit()
+    await db.close()
+    await asyncio.to_thread(rating_snapshot.recargar)
     
     return {"message": "Prefijo eliminado correctamente"}
 
@@ -4110,7 +3973,7 @@ async def listar_tarifas(zona_id: int = None, user=Depends(authenticated_user)):
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     if zona_id:
         query = text("""
@@ -4120,7 +3983,7 @@ async def listar_tarifas(zona_id: int = None, user=Depends(authenticated_user)):
             WHERE t.zona_id = :zona_id
             ORDER BY t.fecha_inicio DESC
         """)
-        tarifas = db.execute(query, {"zona_id": zona_id}).fetchall()
+        tarifas = (await db.execute(query, {"zona_id": zona_id})).fetchall()
     else:
         query = text("""
             SELECT t.id, t.zona_id, t.tarifa_segundo, t.fecha_inicio, t.activa, z.nombre as zona_nombre
@@ -4128,7 +3991,7 @@ async def listar_tarifas(zona_id: int = None, user=Depends(authenticated_user)):
             JOIN zonas z ON t.zona_id = z.id
             ORDER BY z.nombre, t.fecha_inicio DESC
         """)
-        tarifas = db.execute(query).fetchall()
+        tarifas = (await db.execute(query)).fetchall()
     
     result = []
     for tarifa in tarifas:
@@ -4141,7 +4004,7 @@ async def listar_tarifas(zona_id: int = None, user=Depends(authenticated_user)):
             "zona_nombre": tarifa[5]
         })
     
-    db.close()
+    await db.close()
     return result
 
 @app.post("/api/tarifas")
@@ -4149,14 +4012,14 @@ async def crear_tarifa(tarifa: TarifaCreate, user=Depends(admin_only)):
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     # Verificar que la zona exista
     check_zona_query = text("SELECT id FROM zonas WHERE id = :zona_id")
-    existing_zona = db.execute(check_zona_query, {"zona_id": tarifa.zona_id}).fetchone()
+    existing_zona = (await db.execute(check_zona_query, {"zona_id": tarifa.zona_id})).fetchone()
     
     if not existing_zona:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=404, detail="Zona no encontrada")
     
     # Desactivar las tarifas anteriores de esta zona
@@ -4166,7 +4029,7 @@ async def crear_tarifa(tarifa: TarifaCreate, user=Depends(admin_only)):
         WHERE zona_id = :zona_id AND activa = TRUE
     """)
     
-    db.execute(update_query, {"zona_id": tarifa.zona_id})
+    await db.execute(update_query, {"zona_id": tarifa.zona_id})
     
     # Insertar la nueva tarifa
     insert_query = text("""
@@ -4175,7 +4038,7 @@ async def crear_tarifa(tarifa: TarifaCreate, user=Depends(admin_only)):
         RETURNING id, fecha_inicio
     """)
     
-    result = db.execute(insert_query, {
+    result = await db.execute(insert_query, {
         "zona_id": tarifa.zona_id,
         "tarifa_segundo": tarifa.tarifa_segundo
     })
@@ -4186,10 +4049,11 @@ async def crear_tarifa(tarifa: TarifaCreate, user=Depends(admin_only)):
     
     # Obtener el nombre de la zona
     zona_query = text("SELECT nombre FROM zonas WHERE id = :zona_id")
-    zona_nombre = db.execute(zona_query, {"zona_id": tarifa.zona_id}).fetchone()[0]
+    zona_nombre = (await db.execute(zona_query, {"zona_id": tarifa.zona_id})).fetchone()[0]
     
-    db.commit()
-    db.close()
+    await db.commit()
+    await db.close()
+    await asyncio.to_thread(rating_snapshot.recargar)
     
     return {
         "id": tarifa_id,
@@ -4205,14 +4069,14 @@ async def activar_tarifa(tarifa_id: int, user=Depends(admin_only)):
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     # Verificar que la tarifa exista
     check_query = text("SELECT id, zona_id FROM tarifas WHERE id = :tarifa_id")
-    existing = db.execute(check_query, {"tarifa_id": tarifa_id}).fetchone()
+    existing = (await db.execute(check_query, {"tarifa_id": tarifa_id})).fetchone()
     
     if not existing:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=404, detail="Tarifa no encontrada")
     
     zona_id = existing[1]
@@ -4224,7 +4088,7 @@ async def activar_tarifa(tarifa_id: int, user=Depends(admin_only)):
         WHERE zona_id = :zona_id AND id != :tarifa_id AND activa = TRUE
     """)
     
-    db.execute(update_other_query, {"zona_id": zona_id, "tarifa_id": tarifa_id})
+    await db.execute(update_other_query, {"zona_id": zona_id, "tarifa_id": tarifa_id})
     
     # Activar esta tarifa
     update_query = text("""
@@ -4233,7 +4097,7 @@ async def activar_tarifa(tarifa_id: int, user=Depends(admin_only)):
         WHERE id = :tarifa_id
     """)
     
-    db.execute(update_query, {"tarifa_id": tarifa_id})
+    await db.execute(update_query, {"tarifa_id": tarifa_id})
     
     # Obtener datos actualizados de la tarifa
     tarifa_query = text("""
@@ -4243,10 +4107,11 @@ async def activar_tarifa(tarifa_id: int, user=Depends(admin_only)):
         WHERE t.id = :tarifa_id
     """)
     
-    tarifa = db.execute(tarifa_query, {"tarifa_id": tarifa_id}).fetchone()
+    tarifa = (await db.execute(tarifa_query, {"tarifa_id": tarifa_id})).fetchone()
     
-    db.commit()
-    db.close()
+    await db.commit()
+    await db.close()
+    await asyncio.to_thread(rating_snapshot.recargar)
     
     return {
         "id": tarifa[0],
@@ -4263,14 +4128,14 @@ async def eliminar_tarifa(tarifa_id: int, user=Depends(admin_only)):
     if isinstance(user, RedirectResponse):
         return user
         
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     
     # Verificar que la tarifa exista
     check_query = text("SELECT id, zona_id, activa FROM tarifas WHERE id = :tarifa_id")
-    existing = db.execute(check_query, {"tarifa_id": tarifa_id}).fetchone()
+    existing = (await db.execute(check_query, {"tarifa_id": tarifa_id})).fetchone()
     
     if not existing:
-        db.close()
+        await db.close()
         raise HTTPException(status_code=404, detail="Tarifa no encontrada")
     
     zona_id = existing[1]
@@ -4284,10 +4149,10 @@ async def eliminar_tarifa(tarifa_id: int, user=Depends(admin_only)):
             WHERE zona_id = :zona_id AND id != :tarifa_id
         """)
         
-        other_count = db.execute(check_others_query, {"zona_id": zona_id, "tarifa_id": tarifa_id}).scalar()
+        other_count = (await db.execute(check_others_query, {"zona_id": zona_id, "tarifa_id": tarifa_id})).scalar()
         
         if other_count == 0:
-            db.close()
+            await db.close()
             raise HTTPException(
                 status_code=400, 
                 detail="No se puede eliminar la única tarifa de la zona"
@@ -4302,18 +4167,18 @@ async def eliminar_tarifa(tarifa_id: int, user=Depends(admin_only)):
             LIMIT 1
         """)
         
-        db.execute(activate_query, {"zona_id": zona_id, "tarifa_id": tarifa_id})
+        await db.execute(activate_query, {"zona_id": zona_id, "tarifa_id": tarifa_id})
     
     # Eliminar la tarifa
     delete_query = text("DELETE FROM tarifas WHERE id = :tarifa_id")
-    db.execute(delete_query, {"tarifa_id": tarifa_id})
+    await db.execute(delete_query, {"tarifa_id": tarifa_id})
     
-    db.commit()
-    db.close()
+    await db.commit()
+    await db.close()
+    await asyncio.to_thread(rating_snapshot.recargar)
     
     return {"message": "Tarifa eliminada correctamente"}
 
-
 class FacCode(Base):
     __tablename__ = "fac_codes"
     id = Column(Integer, primary_key=True, index=True)
@@ -4443,8 +4308,6 @@ class UserAuthCodeResponse(UserAuthCodeBase):
     class Config:
         orm_mode = True
 
-from zeep import Client, Settings
-from zeep.transports import Transport
 from requests import Session
 from requests.auth import HTTPBasicAuth
 import urllib3
@@ -4455,32 +4318,25 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # Función para conectar con CUCM
 def get_cucm_client():
-    """Crea un cliente SOAP para conectarse a CUCM"""
+    """Servicio SOAP de AXL para CUCM (el WSDL se parsea una vez por proceso)"""
     # Cargar configuración
     CUCM_ADDRESS = os.getenv('CUCM_ADDRESS', '190.105.250.127')
     CUCM_USERNAME = os.getenv('CUCM_USERNAME', 'admin')
     CUCM_PASSWORD = os.getenv('CUCM_PASSWORD', 'fr4v4t3l')
-    WSDL_FILE = 'schema/AXLAPI.wsdl'
-    
-    # Configurar sesión
-    session = Session()
-    session.verify = False
-    session.auth = HTTPBasicAuth(CUCM_USERNAME, CUCM_PASSWORD)
-    
-    # Configurar transporte
-    transport = Transport(session=session, timeout=10)
-    settings = Settings(strict=False, xml_huge_tree=True)
-    
-    # Crear cliente
-    client = Client(WSDL_FILE, settings=settings, transport=transport)
-    
-    # Crear servicio
-    service = client.create_service(
-        '{http://www.cisco.com/AXLAPIService/}AXLAPIBinding',
-        f'https://{CUCM_ADDRESS}:8443/axl/'
-    )
-    
-    return service
+
+    return clientes_axl.servicio(CUCM_ADDRESS, CUCM_USERNAME, CUCM_PASSWORD)
+
+# Motor de sincronización FAC: listFacInfo paginado y escrituras AXL en un pool acotado
+# (FAC_SYNC_ESCRITURAS_POR_MINUTO debe respetar el límite de escrituras AXL configurado en CUCM; 0 = sin ritmo)
+sincronizador_fac = SincronizadorFac(
+    servicio=get_cucm_client,
+    session_factory=SessionLocal,
+    pagina=int(os.getenv("FAC_SYNC_PAGINA", "1000")),
+    trabajadores=int(os.getenv("FAC_SYNC_TRABAJADORES", "4")),
+    escrituras_por_minuto=int(os.getenv("FAC_SYNC_ESCRITURAS_POR_MINUTO", "0")),
+)
+# Sincronización incremental periódica de FAC (0 = desactivada; se puede lanzar a mano)
+FAC_SYNC_INTERVALO_SECONDS = int(os.getenv("FAC_SYNC_INTERVALO_SECONDS", "0"))
 
 # Clase para gestionar códigos FAC
 class CucmFacManager:
@@ -4632,10 +4488,9 @@ class CucmFacSyncManager:
         self.fac_manager = CucmFacManager()
     
     def get_all_cucm_fac_codes(self):
-        """Obtiene todos los códigos FAC desde CUCM"""
+        """Obtiene todos los códigos FAC desde CUCM (listFacInfo paginado)"""
         try:
-            response = self.fac_manager.list_fac_info()
-            return process_fac_info(response) if response else []
+            return [fac.como_dict() for fac in sincronizador_fac.leer_cucm(self.fac_manager.client).values()]
         except Exception as e:
             logger.error(f"Error obteniendo códigos FAC de CUCM: {e}")
             return []
@@ -4656,122 +4511,8 @@ class CucmFacSyncManager:
         - Códigos en BD pero no en CUCM → Se eliminan de BD
         - Códigos diferentes → Se actualizan en BD según CUCM
         """
-        db = SessionLocal()
-        
-        try:
-            logger.info("🔄 Iniciando sincronización con CUCM como autoridad")
-            
-            # 1. Obtener códigos de ambas fuentes
-            cucm_codes = self.get_all_cucm_fac_codes()
-            local_codes = self.get_all_local_fac_codes(db)
-            
-            # Crear diccionarios para comparación
-            cucm_dict = {code['code']: code for code in cucm_codes if code.get('code')}
-            local_dict = {code.authorization_code: code for code in local_codes}
-            
-            logger.info(f"📊 CUCM: {len(cucm_dict)} códigos, BD Local: {len(local_dict)} códigos")
-            
-            stats = {
-                "created": 0,
-                "updated": 0, 
-                "deleted": 0,
-                "unchanged": 0,
-                "errors": 0
-            }
-            
-            # 2. PROCESAR CÓDIGOS EN CUCM (crear/actualizar en BD)
-            for code, cucm_data in cucm_dict.items():
-                try:
-                    if code in local_dict:
-                        # Verificar si necesita actualización
-                        local_code = local_dict[code]
-                        needs_update = (
-                            local_code.authorization_code_name != cucm_data.get('name', '') or
-                            local_code.authorization_level != cucm_data.get('level', 0)
-                        )
-                        
-                        if needs_update:
-                            # ACTUALIZAR código existente
-                            local_code.authorization_code_name = cucm_data.get('name', '')
-                            local_code.authorization_level = cucm_data.get('level', 0)
-                            local_code.active = True
-                            local_code.cucm_synced = True
-                            local_code.updated_at = datetime.utcnow()
-                            
-                            stats["updated"] += 1
-                            self._audit_log(db, code, "sync_update_from_cucm", admin_username,
-                                          f"Actualizado desde CUCM: {cucm_data.get('name', '')}")
-                            logger.info(f"📝 Actualizado: {code}")
-                        else:
-                            # Marcar como sincronizado sin cambios
-                            local_code.cucm_synced = True
-                            stats["unchanged"] += 1
-                    else:
-                        # CREAR nuevo código desde CUCM
-                        new_code = FacCode(
-                            authorization_code=code,
-                            authorization_code_name=cucm_data.get('name', f'FAC_{code}'),
-                            authorization_level=cucm_data.get('level', 0),
-                            description=f"Sincronizado desde CUCM el {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}",
-                            active=True,
-                            cucm_synced=True
-                        )
-                        
-                        db.add(new_code)
-                        stats["created"] += 1
-                        self._audit_log(db, code, "sync_create_from_cucm", admin_username,
-                                      f"Creado desde CUCM: {cucm_data.get('name', '')}")
-                        logger.info(f"➕ Creado: {code}")
-                
-                except Exception as e:
-                    stats["errors"] += 1
-                    self._audit_log(db, code, "sync_error", admin_username, f"Error: {str(e)}", False)
-                    logger.error(f"❌ Error procesando {code}: {e}")
-            
-            # 3. ELIMINAR CÓDIGOS QUE ESTÁN EN BD PERO NO EN CUCM
-            for code, local_code in local_dict.items():
-                if code not in cucm_dict:
-                    try:
-                        # ELIMINAR código que no está en CUCM
-                        db.delete(local_code)
-                        stats["deleted"] += 1
-                        self._audit_log(db, code, "sync_delete_not_in_cucm", admin_username,
-                                      f"Eliminado - No encontrado en CUCM")
-                        logger.info(f"🗑️ Eliminado: {code}")
-                    except Exception as e:
-                        stats["errors"] += 1
-                        self._audit_log(db, code, "sync_delete_error", admin_username, f"Error eliminando: {str(e)}", False)
-                        logger.error(f"❌ Error eliminando {code}: {e}")
-            
-            # 4. CONFIRMAR CAMBIOS
-            db.commit()
-            
-            # 5. REGISTRAR RESUMEN
-            summary_msg = f"Sincronización completada - Creados: {stats['created']}, Actualizados: {stats['updated']}, Eliminados: {stats['deleted']}, Sin cambios: {stats['unchanged']}, Errores: {stats['errors']}"
-            self._audit_log(db, "SYNC_SUMMARY", "sync_complete", admin_username, summary_msg)
-            
-            logger.info(f"✅ {summary_msg}")
-            
-            return {
-                "success": True,
-                "message": summary_msg,
-                "stats": stats
-            }
-        
-        except Exception as e:
-            db.rollback()
-            error_msg = f"Error general en sincronización: {str(e)}"
-            self._audit_log(db, "SYNC_ERROR", "sync_error", admin_username, error_msg, False)
-            logger.error(f"❌ {error_msg}")
-            
-            return {
-                "success": False,
-                "message": error_msg,
-                "stats": {"errors": 1}
-            }
-        
-        finally:
-            db.close()
+        logger.info("🔄 Iniciando sincronización con CUCM como autoridad")
+        return sincronizador_fac.sincronizar(MODO_CUCM_AUTORIDAD, admin_username)
     
     def delete_fac_from_both_systems(self, code: str, admin_username: str):
         """
@@ -5018,11 +4759,11 @@ async def get_fac_list(user=Depends(admin_only)):
     if isinstance(user, RedirectResponse):
         return user
     
-    fac_manager = CucmFacManager()
-    response = fac_manager.list_fac_info()
-    
-    # Procesar resultados
-    fac_list = process_fac_info(response)
+    try:
+        fac_list = [fac.como_dict() for fac in sincronizador_fac.leer_cucm().values()]
+    except Exception as e:
+        print(f"Error en list_fac_info: {e}")
+        fac_list = []
 
     return {"fac_codes": fac_list}
 
@@ -5427,170 +5168,11 @@ async def sync_fac_with_cucm(
 
 # Función de sincronización que se ejecuta en segundo plano
 def sync_all_fac_with_cucm(admin_username: str, db: SessionLocal):
-    """Sincroniza todos los códigos FAC con CUCM"""
-    try:
-        # Obtener códigos FAC desde la base de datos
-        fac_codes = db.query(FacCode).filter(FacCode.active == True).all()
-        
-        # Conectar con CUCM
-        fac_manager = CucmFacManager()
-        
-        # Obtener códigos existentes en CUCM
-        cucm_codes = {}
-        try:
-            # Listar códigos FAC existentes en CUCM
-            response = fac_manager.listFacInfo()
-            
-            # Procesar respuesta para obtener códigos existentes
-            if hasattr(response, 'return_') and hasattr(response.return_, 'facInfo'):
-                fac_info = response.return_.facInfo
-                
-                # Si es una lista
-                if isinstance(fac_info, list):
-                    for fac in fac_info:
-                        if hasattr(fac, 'code') and hasattr(fac, 'name'):
-                            cucm_codes[fac.code] = {
-                                'name': fac.name,
-                                'level': fac.authorizationLevel if hasattr(fac, 'authorizationLevel') else None
-                            }
-                # Si es un solo objeto
-                elif hasattr(fac_info, 'code') and hasattr(fac_info, 'name'):
-                    cucm_codes[fac_info.code] = {
-                        'name': fac_info.name,
-                        'level': fac_info.authorizationLevel if hasattr(fac_info, 'authorizationLevel') else None
-                    }
-        except Exception as e:
-            # Registrar error al obtener códigos existentes
-            audit_entry = FacAudit(
-                authorization_code="N/A",
-                action="sync",
-                admin_user=admin_username,
-                details=f"Error obteniendo códigos de CUCM: {str(e)}",
-                success=False
-            )
-            db.add(audit_entry)
-            db.commit()
-            print(f"Error obteniendo códigos de CUCM: {str(e)}")
-        
-        # Sincronizar códigos
-        created_count = 0
-        updated_count = 0
-        error_count = 0
-        
-        for code in fac_codes:
-            try:
-                if code.authorization_code in cucm_codes:
-                    # Verificar si necesita actualización
-                    cucm_code = cucm_codes[code.authorization_code]
-                    needs_update = (
-                        code.authorization_code_name != cucm_code['name'] or
-                        code.authorization_level != cucm_code['level']
-                    )
-                    
-                    if needs_update:
-                        # Actualizar código existente usando el método corregido
-                        success = fac_manager.update_fac_info(
-                            code.authorization_code,
-                            code.authorization_code_name,
-                            code.authorization_level
-                        )
-                        
-                        if success:
-                            # Registrar auditoría
-                            audit_entry = FacAudit(
-                                authorization_code=code.authorization_code,
-                                action="sync_update",
-                                admin_user=admin_username,
-                                details=f"Código actualizado en CUCM",
-                                success=True
-                            )
-                            db.add(audit_entry)
-                            updated_count += 1
-                            
-                            # Marcar como sincronizado
-                            code.cucm_synced = True
-                            db.commit()
-                        else:
-                            raise Exception("Fallo al actualizar en CUCM")
-                else:
-                    # Crear nuevo código usando el método corregido
-                    success = fac_manager.add_fac_info(
-                        code.authorization_code,
-                        code.authorization_code_name,
-                        code.authorization_level
-                    )
-                    
-                    if success:
-                        # Registrar auditoría
-                        audit_entry = FacAudit(
-                            authorization_code=code.authorization_code,
-                            action="sync_create",
-                            admin_user=admin_username,
-                            details=f"Código creado en CUCM",
-                            success=True
-                        )
-                        db.add(audit_entry)
-                        created_count += 1
-                        
-                        # Marcar como sincronizado
-                        code.cucm_synced = True
-                        db.commit()
-                    else:
-                        raise Exception("Fallo al crear en CUCM")
-                
-            except Exception as e:
-                # Registrar error
-                error_count += 1
-                audit_entry = FacAudit(
-                    authorization_code=code.authorization_code,
-                    action="sync",
-                    admin_user=admin_username,
-                    details=f"Error de sincronización: {str(e)}",
-                    success=False
-                )
-                db.add(audit_entry)
-                db.commit()
-                print(f"Error sincronizando código {code.authorization_code}: {str(e)}")
-                
-        # Verificar si hay códigos en CUCM que no están en nuestro sistema
-        orphan_count = 0
-        for cucm_code in cucm_codes:
-            if not db.query(FacCode).filter(FacCode.authorization_code == cucm_code).first():
-                orphan_count += 1
-                audit_entry = FacAudit(
-                    authorization_code=cucm_code,
-                    action="sync_detect",
-                    admin_user=admin_username,
-                    details=f"Código encontrado en CUCM pero no en sistema local",
-                    success=True
-                )
-                db.add(audit_entry)
-                db.commit()
-        
-        # Registrar resumen final
-        summary_entry = FacAudit(
-            authorization_code="SUMMARY",
-            action="sync_complete",
-            admin_user=admin_username,
-            details=f"Sincronización completada. Creados: {created_count}, Actualizados: {updated_count}, Errores: {error_count}, Huérfanos detectados: {orphan_count}",
-            success=True
-        )
-        db.add(summary_entry)
-        db.commit()
-        print(f"Sincronización completada. Creados: {created_count}, Actualizados: {updated_count}, Errores: {error_count}, Huérfanos: {orphan_count}")
-                
-    except Exception as e:
-        # Registrar error general
-        audit_entry = FacAudit(
-            authorization_code="N/A",
-            action="sync",
-            admin_user=admin_username,
-            details=f"Error general de sincronización: {str(e)}",
-            success=False
-        )
-        db.add(audit_entry)
-        db.commit()
-        print(f"Error general en sincronización: {str(e)}")
+    """Sincroniza todos los códigos FAC activos locales hacia CUCM"""
+    # El motor usa sus propias sesiones; la del endpoint solo se cierra
+    db.close()
+    result = sincronizador_fac.sincronizar(MODO_HACIA_CUCM, admin_username)
+    print(result["message"])
 
 
 @app.get("/dashboard/fac/historial")
@@ -5690,197 +5272,14 @@ async def sync_fac_from_cucm(background_tasks: BackgroundTasks, user=Depends(adm
 
 def sync_fac_from_cucm_to_database(admin_username: str = "system"):
     """
-    NUEVA FUNCIÓN: Sincroniza códigos FAC desde CUCM hacia la base de datos
-    Esta función SÍ inserta los códigos que faltan
+    Sincroniza códigos FAC desde CUCM hacia la base de datos: crea los que
+    faltan, actualiza los que cambiaron y desactiva los que ya no están en CUCM
     """
-    db = SessionLocal()
-    
-    try:
-        # 1. Obtener códigos de CUCM usando tu función existente
-        fac_manager = CucmFacManager()
-        response = fac_manager.list_fac_info()
-        
-        # Usar tu función process_fac_info para procesar la respuesta
-        cucm_fac_list = process_fac_info(response)
-        logger.info(f"Obtenidos {len(cucm_fac_list)} códigos de CUCM")
-        
-        if not cucm_fac_list:
-            logger.warning("No se obtuvieron códigos de CUCM")
-            return {
-                "success": False,
-                "message": "No se pudieron obtener códigos de CUCM",
-                "stats": {"created": 0, "updated": 0, "errors": 1}
-            }
-        
-        # 2. Obtener códigos existentes en la base de datos
-        existing_codes = {fac.authorization_code: fac for fac in db.query(FacCode).all()}
-        logger.info(f"Códigos existentes en BD: {len(existing_codes)}")
-        
-        # 3. Estadísticas de sincronización
-        stats = {
-            "created": 0,
-            "updated": 0,
-            "deactivated": 0,
-            "errors": 0,
-            "cucm_total": len(cucm_fac_list),
-            "local_total": len(existing_codes)
-        }
-        
-        # 4. SINCRONIZAR: Para cada código en CUCM
-        for cucm_fac in cucm_fac_list:
-            code = cucm_fac['code']
-            
-            if not code:  # Saltar códigos sin código válido
-                continue
-                
-            try:
-                if code in existing_codes:
-                    # ACTUALIZAR código existente si hay diferencias
-                    local_fac = existing_codes[code]
-                    updated = False
-                    
-                    # Verificar si necesita actualización
-                    if local_fac.authorization_code_name != cucm_fac['name']:
-                        logger.info(f"Actualizando nombre para {code}: '{local_fac.authorization_code_name}' → '{cucm_fac['name']}'")
-                        local_fac.authorization_code_name = cucm_fac['name']
-                        updated = True
-                    
-                    if local_fac.authorization_level != cucm_fac['level']:
-                        logger.info(f"Actualizando nivel para {code}: {local_fac.authorization_level} → {cucm_fac['level']}")
-                        local_fac.authorization_level = cucm_fac['level']
-                        updated = True
-                    
-                    # Si está en CUCM, debe estar activo
-                    if not local_fac.active:
-                        logger.info(f"Reactivando código {code}")
-                        local_fac.active = True
-                        updated = True
-                    
-                    if updated:
-                        local_fac.cucm_synced = True
-                        local_fac.updated_at = datetime.utcnow()
-                        stats["updated"] += 1
-                        
-                        # Registrar auditoría
-                        audit = FacAudit(
-                            authorization_code=code,
-                            action="sync_update_from_cucm",
-                            admin_user=admin_username,
-                            details=f"Actualizado desde CUCM: {cucm_fac['name']} (Nivel: {cucm_fac['level']})",
-                            success=True
-                        )
-                        db.add(audit)
-                    else:
-                        # Marcar como sincronizado aunque no haya cambios
-                        if not local_fac.cucm_synced:
-                            local_fac.cucm_synced = True
-                            local_fac.updated_at = datetime.utcnow()
-                else:
-                    # CREAR nuevo código que está en CUCM pero no en BD
-                    logger.info(f"CREANDO nuevo código desde CUCM: {code} - {cucm_fac['name']}")
-                    
-                    new_fac = FacCode(
-                        authorization_code=code,
-                        authorization_code_name=cucm_fac['name'] or f"FAC_{code}",
-                        authorization_level=cucm_fac['level'] or 0,
-                        description=f"Sincronizado automáticamente desde CUCM el {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}",
-                        active=True,
-                        cucm_synced=True
-                    )
-                    
-                    db.add(new_fac)
-                    stats["created"] += 1
-                    
-                    # Registrar auditoría
-                    audit = FacAudit(
-                        authorization_code=code,
-                        action="sync_create_from_cucm",
-                        admin_user=admin_username,
-                        details=f"Creado automáticamente desde CUCM: {cucm_fac['name']} (Nivel: {cucm_fac['level']})",
-                        success=True
-                    )
-                    db.add(audit)
-                    
-            except Exception as e:
-                logger.error(f"Error sincronizando código {code}: {e}")
-                stats["errors"] += 1
-                
-                # Registrar error en auditoría
-                audit = FacAudit(
-                    authorization_code=code,
-                    action="sync_error",
-                    admin_user=admin_username,
-                    details=f"Error sincronizando desde CUCM: {str(e)}",
-                    success=False
-                )
-                db.add(audit)
-                continue
-        
-        # 5. Desactivar códigos que están en BD pero NO en CUCM
-        cucm_codes_set = {fac['code'] for fac in cucm_fac_list if fac['code']}
-        for code, local_fac in existing_codes.items():
-            if code not in cucm_codes_set and local_fac.active:
-                logger.info(f"Desactivando código {code} (no está en CUCM)")
-                local_fac.active = False
-                local_fac.cucm_synced = False
-                local_fac.description = f"DESACTIVADO - No encontrado en CUCM (Sync: {datetime.utcnow().strftime('%Y-%m-%d %H:%M')})"
-                local_fac.updated_at = datetime.utcnow()
-                stats["deactivated"] += 1
-                
-                # Auditoría
-                audit = FacAudit(
-                    authorization_code=code,
-                    action="sync_deactivate",
-                    admin_user=admin_username,
-                    details="Desactivado - No encontrado en CUCM",
-                    success=True
-                )
-                db.add(audit)
-        
-        # 6. Registrar resumen final
-        summary = FacAudit(
-            authorization_code="SYNC_SUMMARY",
-            action="sync_complete",
-            admin_user=admin_username,
-            details=f"Sincronización completada - CUCM: {stats['cucm_total']}, BD Local: {stats['local_total']}, Creados: {stats['created']}, Actualizados: {stats['updated']}, Desactivados: {stats['deactivated']}, Errores: {stats['errors']}",
-            success=True
-        )
-        db.add(summary)
-        
-        # Confirmar transacción
-        db.commit()
-        
-        logger.info(f"Sincronización completada: {stats}")
-        
-        return {
-            "success": True,
-            "message": f"Sincronización completada. Creados: {stats['created']}, Actualizados: {stats['updated']}, Desactivados: {stats['deactivated']}",
-            "stats": stats
-        }
-        
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Error en sincronización: {e}")
-        
-        # Registrar error general
-        error_audit = FacAudit(
-            authorization_code="SYNC_ERROR",
-            action="sync_error",
-            admin_user=admin_username,
-            details=f"Error general en sincronización: {str(e)}",
-            success=False
-        )
-        db.add(error_audit)
-        db.commit()
-        
-        return {
-            "success": False,
-            "message": f"Error en sincronización: {str(e)}",
-            "stats": {"errors": 1}
-        }
-        
-    finally:
-        db.close()
+    result = sincronizador_fac.sincronizar(MODO_DESDE_CUCM, admin_username)
+    if result["success"]:
+        stats = result["stats"]
+        result["message"] = f"Sincronización completada. Creados: {stats['created']}, Actualizados: {stats['updated']}, Desactivados: {stats['deactivated']}"
+    return result
 
 @app.post("/api/fac/sync-from-cucm-manual")
 async def sync_fac_manual(background_tasks: BackgroundTasks, user=Depends(admin_only)):
@@ -5897,6 +5296,44 @@ async def sync_fac_manual(background_tasks: BackgroundTasks, user=Depends(admin_
         "action": "sync_started"
     }
 
+@app.post("/api/fac/sync-incremental")
+async def sync_fac_incremental(user=Depends(admin_only)):
+    """Sincroniza solo los códigos FAC que cambiaron en CUCM o localmente"""
+    if isinstance(user, RedirectResponse):
+        return user
+
+    return await asyncio.to_thread(sincronizador_fac.sincronizar_incremental, user["username"])
+
+@app.get("/api/fac/sync-status")
+async def sync_fac_status(user=Depends(admin_only)):
+    """Estado de la última sincronización de FAC"""
+    if isinstance(user, RedirectResponse):
+        return user
+
+    return sincronizador_fac.estado()
+
+
+async def _sincronizacion_fac_periodica():
+    while True:
+        await asyncio.sleep(FAC_SYNC_INTERVALO_SECONDS)
+        try:
+            await asyncio.to_thread(sincronizador_fac.sincronizar_incremental, "sistema")
+        except Exception as e:
+            print(f"Error en la sincronización periódica de FAC: {str(e)}")
+
+
+@app.on_event("startup")
+async def iniciar_sincronizacion_fac():
+    db = SessionLocal()
+    try:
+        sincronizador_fac.preparar(db)
+    except Exception as e:
+        print(f"Error preparando índices de fac_codes: {str(e)}")
+    finally:
+        db.close()
+    if FAC_SYNC_INTERVALO_SECONDS > 0:
+        asyncio.create_task(_sincronizacion_fac_periodica())
+
 def run_sync_with_logging(username: str):
     """Ejecuta la sincronización con logging detallado"""
     logger.info(f"Iniciando sincronización manual por usuario: {username}")
@@ -5905,131 +5342,8 @@ def run_sync_with_logging(username: str):
 
 def import_fac_from_cucm(admin_username: str):
     """Importa códigos FAC desde CUCM a la base de datos local"""
-    db = SessionLocal()
-    
-    try:
-        # Conectar con CUCM
-        client = get_cucm_client()
-
-        # Listar códigos existentes en CUCM
-        returned_tags = {
-            "name": "",
-            "code": "",
-            "authorizationLevel": ""
-        }
-        
-        search_criteria = {
-            "name": "%"  # Wildcard para encontrar todos los FAC
-        }
-        
-        # Listar códigos FAC existentes en CUCM
-        response = client.listFacInfo(
-            returnedTags=returned_tags,
-            searchCriteria=search_criteria
-        )
-        
-        # Procesar respuesta para obtener códigos existentes
-        created_count = 0
-        updated_count = 0
-        unchanged_count = 0
-        
-        if hasattr(response, 'return_') and hasattr(response.return_, 'facInfo'):
-            fac_info = response.return_.facInfo
-            
-            # Procesar lista de códigos
-            fac_list = []
-            if isinstance(fac_info, list):
-                fac_list = fac_info
-            else:
-                fac_list = [fac_info]
-            
-            # Importar cada código
-            for fac in fac_list:
-                if hasattr(fac, 'code') and hasattr(fac, 'name'):
-                    code = fac.code
-                    name = fac.name
-                    level = fac.authorizationLevel if hasattr(fac, 'authorizationLevel') else 0
-                    
-                    # Verificar si el código ya existe
-                    existing = db.query(FacCode).filter(FacCode.authorization_code == code).first()
-                    
-                    if existing:
-                        # Verificar si necesita actualización
-                        if (existing.authorization_code_name != name or 
-                            existing.authorization_level != level):
-                            
-                            # Actualizar código existente
-                            existing.authorization_code_name = name
-                            existing.authorization_level = level
-                            existing.cucm_synced = True
-                            existing.updated_at = datetime.utcnow()
-                            
-                            # Registrar auditoría
-                            audit_entry = FacAudit(
-                                authorization_code=code,
-                                action="import_update",
-                                admin_user=admin_username,
-                                details=f"Código actualizado desde CUCM",
-                                success=True
-                            )
-                            db.add(audit_entry)
-                            updated_count += 1
-                        else:
-                            # No necesita actualización
-                            existing.cucm_synced = True
-                            unchanged_count += 1
-                    else:
-                        # Crear nuevo código
-                        new_fac = FacCode(
-                            authorization_code=code,
-                            authorization_code_name=name,
-                            authorization_level=level,
-                            description=f"Importado desde CUCM el {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}",
-                            active=True,
-                            cucm_synced=True
-                        )
-                        
-                        db.add(new_fac)
-                        
-                        # Registrar auditoría
-                        audit_entry = FacAudit(
-                            authorization_code=code,
-                            action="import_create",
-                            admin_user=admin_username,
-                            details=f"Código importado desde CUCM",
-                            success=True
-                        )
-                        db.add(audit_entry)
-                        created_count += 1
-            
-            # Registrar resumen
-            summary_entry = FacAudit(
-                authorization_code="SUMMARY",
-                action="import_complete",
-                admin_user=admin_username,
-                details=f"Importación completada. Creados: {created_count}, Actualizados: {updated_count}, Sin cambios: {unchanged_count}",
-                success=True
-            )
-            db.add(summary_entry)
-            
-            db.commit()
-            print(f"Importación completada. Creados: {created_count}, Actualizados: {updated_count}, Sin cambios: {unchanged_count}")
-        
-    except Exception as e:
-        # Registrar error
-        audit_entry = FacAudit(
-            authorization_code="N/A",
-            action="import",
-            admin_user=admin_username,
-            details=f"Error de importación: {str(e)}",
-            success=False
-        )
-        db.add(audit_entry)
-        db.commit()
-        print(f"Error importando códigos FAC desde CUCM: {str(e)}")
-    
-    finally:
-        db.close()
+    result = sincronizador_fac.sincronizar(MODO_IMPORTAR, admin_username)
+    print(result["message"])
 
 def is_internal_extension(number: str) -> bool:
     """Determina si un número es un anexo interno"""
@@ -0,0 +1,154 @@
+# tarificador/__init__.py
+"""
+Componentes de soporte del Sistema Tarificador.
+
+Este paquete no depende de main.py; main.py crea las instancias compartidas
+(índices, cachés) y las expone al resto de la aplicación.
+
+Contiene:
+- Motor de coincidencia de prefijos para determinar zonas
+- Instantánea versionada de zonas, prefijos y tarifas activas
+- Registro en memoria de llamadas activas con deltas para WebSocket
+- Difusión WebSocket con cola acotada por conexión
+- Libro de reservas de saldo para llamadas en curso
+- Particionado mensual y retención de la tabla cdr
+- Filtros de búsqueda de CDR alineados con sus índices
+- Paginación por cursor y conteo estimado de CDR
+- Resúmenes horarios y diarios de CDR para los dashboards
+- Reasignación de zona a CDR históricos sin zona
+- Exportación de CDR en streaming (CSV, XLSX y PDF)
+- Cola de trabajos de exportación en un pool de procesos
+- Recarga masiva de saldo con COPY y upsert por conjunto
+- Lectura en streaming de archivos de carga (CSV/XLSX)
+- Carga masiva de anexos en etapas con hash de PINs en un pool de procesos
+- Regeneración de PINs en segundo plano con CSV de descarga única
+- Registro de clientes AXL con el WSDL parseado una vez y sesiones keep-alive
+- Sincronización de códigos FAC con CUCM paginada, por conjuntos e incremental
+- Caché de usuarios para la autenticación con invalidación por NOTIFY
+- Verificación bcrypt del login en un pool de procesos y límite de intentos
+"""
+
+from .archivos import leer_en_hilo, leer_filas
+from .autenticacion import LimitadorIntentos, VerificacionSaturada, VerificadorPasswords, verificar_password
+from .broadcaster import WebSocketBroadcaster
+from .carga_anexos import (
+    ProgresoCarga, RegistroCargas, aplicar_pines, cargar_staging, contar_pines_pendientes, fusionar_staging,
+    pines_pendientes, preparar_pines_pendientes, registros_anexos, validar_staging,
+)
+from .cliente_axl import RegistroClientesAXL
+from .consultas_cdr import INDICES_CDR, asegurar_indices_cdr, filtros_cdr, orden_cdr, verificar_planes
+from .exportaciones import (
+    EstadoExportacion, consulta_exportacion_cdr, csv_por_bloques, leer_por_bloques,
+    nombre_archivo, pdf_por_bloques, resumen_filtros, xlsx_por_bloques,
+)
+from .llamadas_activas import ActiveCallRegistry, formatear_llamada
+from .paginacion import ConteoCDR, armar_pagina, codificar_cursor, condicion_cursor, decodificar_cursor
+from .particiones import CdrPartitionManager
+from .pines import HasheadorPines, generar_pin, hash_pin
+from .prefijos import PrefijoRegla, PrefixTrie, cargar_reglas, limpiar_numero
+from .reasignacion_zonas import ZONA_POR_DEFECTO, reasignar_zonas_cdr
+from .recargas import aplicar_recargas, filas_validas, leer_archivo_recargas, validar_fila
+from .regeneracion_pines import TrabajoPines, regenerar_pines
+from .reservas import Reserva, ReservationLedger
+from .resumenes import acumular_resumenes, completar_backfill, preparar_tablas_resumen, reconstruir_resumenes
+from .sincronizacion_fac import (
+    MODO_CUCM_AUTORIDAD, MODO_DESDE_CUCM, MODO_HACIA_CUCM, MODO_IMPORTAR, MODOS, FacCucm, FacLocal,
+    PlanSincronizacion, SincronizadorFac, calcular_plan, calcular_plan_incremental, es_limite_axl,
+    fac_de_respuesta, huella_pagina,
+)
+from .snapshot import RatingSnapshot, RatingSnapshotStore, TarifaActiva, ZonaInfo
+from .trabajos_exportacion import TIPOS_EXPORTACION, GestorExportaciones, TrabajoExportacion
+from .usuarios import (
+    CANAL_USUARIOS, CacheUsuarios, escuchar_invalidaciones, huella_password, notificar_cambio_usuario,
+    token_vigente,
+)
+
+__all__ = [
+    "ActiveCallRegistry",
+    "leer_en_hilo",
+    "leer_filas",
+    "LimitadorIntentos",
+    "VerificacionSaturada",
+    "VerificadorPasswords",
+    "verificar_password",
+    "ProgresoCarga",
+    "RegistroCargas",
+    "aplicar_pines",
+    "cargar_staging",
+    "contar_pines_pendientes",
+    "fusionar_staging",
+    "pines_pendientes",
+    "preparar_pines_pendientes",
+    "registros_anexos",
+    "validar_staging",
+    "CdrPartitionManager",
+    "RegistroClientesAXL",
+    "INDICES_CDR",
+    "asegurar_indices_cdr",
+    "filtros_cdr",
+    "orden_cdr",
+    "verificar_planes",
+    "EstadoExportacion",
+    "consulta_exportacion_cdr",
+    "csv_por_bloques",
+    "leer_por_bloques",
+    "nombre_archivo",
+    "pdf_por_bloques",
+    "resumen_filtros",
+    "xlsx_por_bloques",
+    "TIPOS_EXPORTACION",
+    "GestorExportaciones",
+    "TrabajoExportacion",
+    "ConteoCDR",
+    "armar_pagina",
+    "codificar_cursor",
+    "condicion_cursor",
+    "decodificar_cursor",
+    "formatear_llamada",
+    "HasheadorPines",
+    "generar_pin",
+    "hash_pin",
+    "PrefijoRegla",
+    "PrefixTrie",
+    "cargar_reglas",
+    "limpiar_numero",
+    "ZONA_POR_DEFECTO",
+    "reasignar_zonas_cdr",
+    "aplicar_recargas",
+    "filas_validas",
+    "leer_archivo_recargas",
+    "validar_fila",
+    "TrabajoPines",
+    "regenerar_pines",
+    "Reserva",
+    "ReservationLedger",
+    "acumular_resumenes",
+    "completar_backfill",
+    "preparar_tablas_resumen",
+    "reconstruir_resumenes",
+    "MODO_CUCM_AUTORIDAD",
+    "MODO_DESDE_CUCM",
+    "MODO_HACIA_CUCM",
+    "MODO_IMPORTAR",
+    "MODOS",
+    "FacCucm",
+    "FacLocal",
+    "PlanSincronizacion",
+    "SincronizadorFac",
+    "calcular_plan",
+    "calcular_plan_incremental",
+    "es_limite_axl",
+    "fac_de_respuesta",
+    "huella_pagina",
+    "RatingSnapshot",
+    "RatingSnapshotStore",
+    "TarifaActiva",
+    "ZonaInfo",
+    "CANAL_USUARIOS",
+    "CacheUsuarios",
+    "escuchar_invalidaciones",
+    "huella_password",
+    "notificar_cambio_usuario",
+    "token_vigente",
+    "WebSocketBroadcaster",
+]
@@ -0,0 +1,96 @@
+# tarificador/archivos.py
+"""
+Lectura en streaming de archivos de carga (CSV o Excel).
+
+Las cargas masivas (recargas, anexos) leen el archivo fila por fila sin
+materializarlo: el CSV se decodifica de a bloques y el XLSX se abre con
+openpyxl en modo read_only. La lectura y el parseo son bloqueantes:
+leer_en_hilo() los consume de a bloques en un hilo para que el COPY los
+reciba como iterador asíncrono sin frenar el event loop.
+"""
+import asyncio
+import codecs
+import csv
+import io
+from itertools import islice
+from typing import Any, AsyncIterator, Iterable, Iterator, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# Codificaciones que se prueban para el CSV, en orden
+CODIFICACIONES_CSV = ("utf-8-sig", "windows-1252")
+
+
+def leer_filas(archivo, nombre: str) -> Iterator[Tuple[int, List[Any]]]:
+    """
+    (línea, valores) de cada fila no vacía del archivo, encabezado incluido.
+
+    `archivo` es un objeto binario con seek (p.ej. UploadFile.file). El CSV
+    se decodifica en streaming; si el primer bloque no es UTF-8 se vuelve a
+    leer como windows-1252, que acepta cualquier byte. ValueError si el
+    archivo no se puede leer.
+    """
+    if nombre.lower().endswith((".xlsx", ".xls")):
+        yield from _leer_excel(archivo)
+        return
+
+    for codificacion in CODIFICACIONES_CSV:
+        archivo.seek(0)
+        lector = codecs.getreader(codificacion)(archivo)
+        try:
+            # Validar la codificación con el primer bloque antes de emitir filas
+            inicio = lector.read(64 * 1024)
+        except UnicodeDecodeError:
+            continue
+        try:
+            yield from _leer_csv(inicio, lector)
+            return
+        except UnicodeDecodeError as e:
+            # Byte inválido más adelante en el archivo: las filas previas ya se emitieron
+            raise ValueError(f"El archivo no es {codificacion} válido: {e}") from e
+    raise ValueError("No se pudo decodificar el archivo. Asegúrese de que sea un CSV válido.")
+
+
+async def leer_en_hilo(registros: Iterable[T], lote: int = 1000) -> AsyncIterator[T]:
+    """
+    Recorre un iterador bloqueante en un hilo, de a `lote` elementos. Las
+    excepciones del iterador (p.ej. ValueError de un archivo ilegible) se
+    propagan al consumidor.
+    """
+    iterador = iter(registros)
+    while True:
+        bloque = await asyncio.to_thread(lambda: list(islice(iterador, lote)))
+        if not bloque:
+            return
+        for registro in bloque:
+            yield registro
+
+
+def _leer_csv(inicio: str, lector) -> Iterator[Tuple[int, List[Any]]]:
+    def lineas():
+        yield from io.StringIO(inicio + lector.readline())
+        yield from lector
+
+    reader = csv.reader(lineas())
+    for fila in reader:
+        if any(campo.strip() for campo in fila):
+            yield reader.line_num, fila
+
+
+def _leer_excel(archivo) -> Iterator[Tuple[int, List[Any]]]:
+    try:
+        import openpyxl
+    except ImportError:
+        raise ValueError("No se pueden procesar archivos Excel en este servidor. Por favor, exporte a CSV e intente de nuevo.")
+
+    archivo.seek(0)
+    try:
+        libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+    except Exception as e:
+        raise ValueError(f"Error procesando archivo Excel: {str(e)}") from e
+    try:
+        for linea, fila in enumerate(libro.active.iter_rows(values_only=True), start=1):
+            if fila and any(valor is not None and str(valor).strip() != "" for valor in fila):
+                yield linea, list(fila)
+    finally:
+        libro.close()
@@ -0,0 +1,173 @@
+# tarificador/autenticacion.py
+"""
+Verificación de contraseñas del login fuera del event loop.
+
+bcrypt cuesta cientos de ms de CPU por intento. /auth/login era un endpoint
+síncrono: cada intento ocupaba un hilo del threadpool que comparten /cdr y
+/check_balance*, y una tanda de logins (cambio de turno, fuerza bruta) los
+dejaba esperando. VerificadorPasswords lleva bcrypt a un pool de procesos
+acotado y rechaza de inmediato cuando ya hay demasiadas verificaciones en
+cola, en lugar de encolarlas sin límite.
+
+LimitadorIntentos cuenta intentos por clave (usuario o IP) en una ventana
+deslizante; las claves bloqueadas se rechazan antes de tocar la base o
+hashear nada.
+"""
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+_contexto = None
+
+
+def verificar_password(password: str, hash_password: str) -> bool:
+    """bcrypt dentro del proceso del pool"""
+    global _contexto
+    if _contexto is None:
+        from passlib.context import CryptContext
+        _contexto = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    try:
+        return _contexto.verify(password, hash_password)
+    except (ValueError, TypeError):
+        # Hash vacío o con formato desconocido: credenciales inválidas
+        return False
+
+
+class VerificacionSaturada(Exception):
+    """Hay más verificaciones en curso de las que admite el pool"""
+
+
+class VerificadorPasswords:
+    """Pool de procesos para bcrypt con tope de verificaciones en curso"""
+
+    def __init__(self, max_procesos: int = 2, max_en_curso: Optional[int] = None):
+        self.max_procesos = max(1, max_procesos)
+        # Lo que excede al pool espera en su cola; más allá del tope se rechaza
+        self.max_en_curso = max_en_curso or self.max_procesos * 8
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._en_curso = 0
+        self._verificaciones = 0
+        self._rechazos = 0
+        self._segundos = 0.0
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_procesos,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    async def verificar(self, password: str, hash_password: str) -> bool:
+        """True si la contraseña corresponde al hash; VerificacionSaturada si no hay cupo"""
+        with self._lock:
+            if self._en_curso >= self.max_en_curso:
+                self._rechazos += 1
+                raise VerificacionSaturada()
+            self._en_curso += 1
+        inicio = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool(), verificar_password, password, hash_password)
+        finally:
+            with self._lock:
+                self._en_curso -= 1
+                self._verificaciones += 1
+                self._segundos += time.perf_counter() - inicio
+
+    def calentar(self) -> None:
+        """Arranca los procesos del pool (el spawn tarda) antes del primer login"""
+        pool = self._pool()
+        for futuro in [pool.submit(verificar_password, "", "") for _ in range(self.max_procesos)]:
+            futuro.result()
+
+    def detener(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "procesos": self.max_procesos,
+                "max_en_curso": self.max_en_curso,
+                "en_curso": self._en_curso,
+                "verificaciones": self._verificaciones,
+                "rechazos": self._rechazos,
+                "ms_promedio": round(self._segundos * 1000 / self._verificaciones, 1) if self._verificaciones else None,
+            }
+
+
+class LimitadorIntentos:
+    """
+    Hasta `max_intentos` por clave dentro de `ventana` segundos. Solo se
+    recuerdan `max_claves` claves (LRU), para que no crezca con usuarios o
+    IPs inventados.
+    """
+
+    def __init__(self, max_intentos: int, ventana: float, max_claves: int = 10000):
+        self.max_intentos = max_intentos
+        self.ventana = ventana
+        self.max_claves = max_claves
+        self._intentos: "OrderedDict[str, Deque[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bloqueos = 0
+
+    def _vigentes(self, clave: str, ahora: float) -> Optional[Deque[float]]:
+        marcas = self._intentos.get(clave)
+        if marcas is None:
+            return None
+        while marcas and marcas[0] <= ahora - self.ventana:
+            marcas.popleft()
+        if not marcas:
+            del self._intentos[clave]
+            return None
+        return marcas
+
+    def espera(self, clave: str) -> float:
+        """Segundos hasta que la clave pueda volver a intentar (0 si puede ya)"""
+        if self.max_intentos <= 0:
+            return 0.0
+        ahora = time.monotonic()
+        with self._lock:
+            marcas = self._vigentes(clave, ahora)
+            if marcas is None or len(marcas) < self.max_intentos:
+                return 0.0
+            self._bloqueos += 1
+            return max(0.0, marcas[-self.max_intentos] + self.ventana - ahora)
+
+    def registrar(self, clave: str) -> None:
+        if self.max_intentos <= 0:
+            return
+        ahora = time.monotonic()
+        with self._lock:
+            marcas = self._vigentes(clave, ahora)
+            if marcas is None:
+                marcas = self._intentos[clave] = deque(maxlen=self.max_intentos)
+            marcas.append(ahora)
+            self._intentos.move_to_end(clave)
+            while len(self._intentos) > self.max_claves:
+                self._intentos.popitem(last=False)
+
+    def limpiar(self, clave: str) -> None:
+        with self._lock:
+            self._intentos.pop(clave, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_intentos": self.max_intentos,
+                "ventana_seconds": self.ventana,
+                "claves": len(self._intentos),
+                "bloqueos": self._bloqueos,
+            }
@@ -0,0 +1,213 @@
+# tarificador/broadcaster.py
+"""
+Difusión de mensajes WebSocket con control de contrapresión.
+
+Cada conexión tiene su propia cola de salida acotada y una tarea que la
+envía, así un navegador lento no retrasa a los demás ni al endpoint que
+publica. Cada mensaje se serializa una sola vez para todos los clientes.
+
+Si la cola de un cliente se llena, los deltas pendientes se descartan y se
+reemplazan por una instantánea completa, que se genera al momento de enviar
+("gana la última instantánea"). Un cliente que desborda repetidamente, o
+que tarda demasiado en aceptar un envío, se desconecta.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Cliente:
+    __slots__ = (
+        "websocket", "id", "direccion", "conectado", "cola", "evento", "resync_desde",
+        "tarea", "enviados", "coalescidos", "desbordes", "ultimo_envio_ms", "desbordes_recientes",
+    )
+
+    def __init__(self, websocket, cliente_id: int):
+        self.websocket = websocket
+        self.id = cliente_id
+        client = getattr(websocket, "client", None)
+        self.direccion = f"{client.host}:{client.port}" if client else None
+        self.conectado = datetime.now()
+        # (instante de encolado, texto JSON)
+        self.cola: Deque[Tuple[float, str]] = deque()
+        self.evento = asyncio.Event()
+        # Instante desde el que hay una instantánea pendiente, o None
+        self.resync_desde: Optional[float] = None
+        self.tarea: Optional[asyncio.Task] = None
+        self.enviados = 0
+        self.coalescidos = 0
+        self.desbordes = 0
+        self.ultimo_envio_ms = 0.0
+        self.desbordes_recientes: Deque[float] = deque()
+
+    def lag_ms(self) -> float:
+        """Antigüedad del mensaje pendiente más viejo"""
+        pendientes = [t for t in (self.resync_desde, self.cola[0][0] if self.cola else None) if t is not None]
+        if not pendientes:
+            return 0.0
+        return round((time.monotonic() - min(pendientes)) * 1000, 1)
+
+
+class WebSocketBroadcaster:
+    """
+    Gestor de conexiones WebSocket.
+
+    `snapshot` devuelve el mensaje de estado completo que se envía al
+    conectar, cuando el cliente lo pide y cuando su cola se desborda.
+    """
+
+    def __init__(
+        self,
+        snapshot: Callable[[], Dict],
+        max_cola: int = 100,
+        timeout_envio: float = 10.0,
+        max_desbordes: int = 3,
+        ventana_desbordes: float = 60.0,
+    ):
+        self._snapshot = snapshot
+        self._clientes: Dict[object, _Cliente] = {}
+        self._siguiente_id = 0
+        self.max_cola = max_cola
+        self.timeout_envio = timeout_envio
+        self.max_desbordes = max_desbordes
+        self.ventana_desbordes = ventana_desbordes
+
+        self.total_conexiones = 0
+        self.mensajes_publicados = 0
+        self.clientes_expulsados = 0
+
+    @property
+    def active_connections(self) -> List:
+        return [cliente.websocket for cliente in self._clientes.values()]
+
+    @property
+    def connection_count(self) -> int:
+        return len(self._clientes)
+
+    async def connect(self, websocket) -> None:
+        """Acepta la conexión, arranca su tarea de envío y le encola una instantánea"""
+        await websocket.accept()
+        self._siguiente_id += 1
+        cliente = _Cliente(websocket, self._siguiente_id)
+        self._clientes[websocket] = cliente
+        self.total_conexiones += 1
+        cliente.tarea = asyncio.create_task(self._enviar(cliente))
+        self.request_snapshot(websocket)
+
+    def disconnect(self, websocket) -> None:
+        cliente = self._clientes.pop(websocket, None)
+        if cliente and cliente.tarea and cliente.tarea is not asyncio.current_task():
+            cliente.tarea.cancel()
+
+    def request_snapshot(self, websocket) -> None:
+        """Descarta lo pendiente del cliente y le envía el estado completo"""
+        cliente = self._clientes.get(websocket)
+        if cliente is None:
+            return
+        cliente.coalescidos += len(cliente.cola)
+        cliente.cola.clear()
+        if cliente.resync_desde is None:
+            cliente.resync_desde = time.monotonic()
+        cliente.evento.set()
+
+    async def broadcast(self, message: Dict) -> None:
+        """Encola el mensaje en todas las conexiones sin esperar a ningún envío"""
+        if not self._clientes:
+            return
+        texto = json.dumps(message, default=str)
+        ahora = time.monotonic()
+        self.mensajes_publicados += 1
+        for cliente in list(self._clientes.values()):
+            self._encolar(cliente, texto, ahora)
+
+    async def send(self, websocket, message: Dict) -> None:
+        """Encola un mensaje para una sola conexión"""
+        cliente = self._clientes.get(websocket)
+        if cliente is not None:
+            self._encolar(cliente, json.dumps(message, default=str), time.monotonic())
+
+    def _encolar(self, cliente: _Cliente, texto: str, ahora: float) -> None:
+        if len(cliente.cola) >= self.max_cola:
+            cliente.desbordes += 1
+            cliente.desbordes_recientes.append(ahora)
+            while cliente.desbordes_recientes and ahora - cliente.desbordes_recientes[0] > self.ventana_desbordes:
+                cliente.desbordes_recientes.popleft()
+
+            if len(cliente.desbordes_recientes) > self.max_desbordes:
+                logger.warning(f"Cliente WebSocket {cliente.id} ({cliente.direccion}) no da abasto, desconectando")
+                self._expulsar(cliente)
+                return
+
+            # Gana la última instantánea: los deltas pendientes ya no hacen falta
+            self.request_snapshot(cliente.websocket)
+            return
+
+        cliente.cola.append((ahora, texto))
+        cliente.evento.set()
+
+    def _expulsar(self, cliente: _Cliente) -> None:
+        self.clientes_expulsados += 1
+        self.disconnect(cliente.websocket)
+        # 1013: "try again later"
+        asyncio.create_task(self._cerrar(cliente.websocket, 1013))
+
+    @staticmethod
+    async def _cerrar(websocket, code: int) -> None:
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def _enviar(self, cliente: _Cliente) -> None:
+        """Tarea de envío de un cliente: vacía su cola en orden"""
+        try:
+            while True:
+                await cliente.evento.wait()
+                cliente.evento.clear()
+
+                while cliente.resync_desde is not None or cliente.cola:
+                    if cliente.resync_desde is not None:
+                        cliente.resync_desde = None
+                        texto = json.dumps(self._snapshot(), default=str)
+                    else:
+                        _, texto = cliente.cola.popleft()
+
+                    inicio = time.monotonic()
+                    await asyncio.wait_for(cliente.websocket.send_text(texto), self.timeout_envio)
+                    cliente.ultimo_envio_ms = round((time.monotonic() - inicio) * 1000, 1)
+                    cliente.enviados += 1
+
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            logger.warning(f"Envío a cliente WebSocket {cliente.id} excedió {self.timeout_envio}s, desconectando")
+            if cliente.websocket in self._clientes:
+                self._expulsar(cliente)
+        except Exception as e:
+            # Conexión cerrada por el navegador
+            logger.info(f"Cliente WebSocket {cliente.id} desconectado al enviar: {e}")
+            self.disconnect(cliente.websocket)
+
+    def stats(self) -> List[Dict]:
+        """Estado por conexión para /api/ws-stats"""
+        return [
+            {
+                "id": cliente.id,
+                "client": cliente.direccion,
+                "connected_at": cliente.conectado.isoformat(),
+                "queue_depth": len(cliente.cola),
+                "snapshot_pending": cliente.resync_desde is not None,
+                "lag_ms": cliente.lag_ms(),
+                "messages_sent": cliente.enviados,
+                "messages_dropped": cliente.coalescidos,
+                "overflows": cliente.desbordes,
+                "last_send_ms": cliente.ultimo_envio_ms,
+            }
+            for cliente in self._clientes.values()
+        ]
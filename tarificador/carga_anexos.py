@@ -0,0 +1,321 @@
+# tarificador/carga_anexos.py
+"""
+Carga masiva de anexos en etapas.
+
+1. Lectura en streaming del archivo (CSV u openpyxl read_only) y COPY de
+   las filas a una tabla temporal de staging.
+2. Validación de todo el lote a la vez en SQL: campos requeridos, saldo
+   inicial, números repetidos en el archivo y anexos ya existentes.
+3. Merge por conjunto: INSERT en anexos y, para los que traen saldo, en
+   saldo_anexos y saldo_auditoria, en una sola sentencia.
+4. Hash de PINs diferido: después del commit los PINs se hashean en el pool
+   de procesos de HasheadorPines y se guardan por lotes. Hasta entonces el
+   anexo queda con pin_pendiente = TRUE: si el proceso se reinicia o el hash
+   falla, contar_pines_pendientes() lo informa y regenerar_pines(...,
+   solo_pendientes=True) les asigna PINs nuevos.
+
+El avance de cada carga queda en un ProgresoCarga consultable por id.
+"""
+import csv
+import io
+import logging
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from .archivos import leer_en_hilo
+from .pines import HasheadorPines, generar_pin
+
+logger = logging.getLogger(__name__)
+
+COLUMNAS_ANEXOS = ("numero", "usuario", "area_nivel1", "area_nivel2", "area_nivel3", "pin", "saldo_actual")
+COLUMNAS_REQUERIDAS = ("numero", "usuario", "area_nivel1")
+
+
+@dataclass
+class ProgresoCarga:
+    id: str
+    # leyendo | validando | insertando | hasheando_pines | terminado | error
+    etapa: str = "leyendo"
+    filas: int = 0
+    errores: int = 0
+    creados: int = 0
+    pines_total: int = 0
+    pines_hechos: int = 0
+    pines_generados: int = 0
+    error: Optional[str] = None
+    creado: float = field(default_factory=time.time)
+    # CSV de los PINs generados (en claro); se borra al descargarlo
+    csv: Optional[bytes] = field(default=None, repr=False)
+    nombre_csv: Optional[str] = None
+
+    def como_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "etapa": self.etapa,
+            "filas": self.filas,
+            "errores": self.errores,
+            "creados": self.creados,
+            "pines_total": self.pines_total,
+            "pines_hechos": self.pines_hechos,
+            "progreso_pines": round(100 * self.pines_hechos / self.pines_total, 1) if self.pines_total else 100.0,
+            "pines_generados": self.pines_generados,
+            "csv_disponible": self.csv is not None,
+            "error": self.error,
+        }
+
+    def retirar_csv(self) -> Optional[Tuple[bytes, str]]:
+        """(contenido, nombre) la primera vez; None si ya se descargó o no hay"""
+        if self.etapa not in ("terminado", "error") or self.csv is None:
+            return None
+        contenido, self.csv = self.csv, None
+        return contenido, self.nombre_csv
+
+
+class RegistroCargas:
+    """
+    Cargas recientes por id; se olvidan `ttl` segundos después de creadas.
+
+    `fabrica(id=...)` crea el objeto de progreso (ProgresoCarga por defecto;
+    cualquier clase con atributos `id` y `creado`).
+    """
+
+    def __init__(self, ttl: float = 3600.0, fabrica: Callable = ProgresoCarga):
+        self.ttl = ttl
+        self.fabrica = fabrica
+        self._cargas: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def nueva(self):
+        progreso = self.fabrica(id=uuid.uuid4().hex)
+        ahora = time.time()
+        with self._lock:
+            for clave in [c for c, p in self._cargas.items() if ahora - p.creado >= self.ttl]:
+                del self._cargas[clave]
+            self._cargas[progreso.id] = progreso
+        return progreso
+
+    def obtener(self, carga_id: str):
+        return self._cargas.get(carga_id)
+
+    def activas(self) -> List:
+        """Las que todavía no terminaron ni fallaron"""
+        return [p for p in list(self._cargas.values()) if p.etapa not in ("terminado", "error")]
+
+
+def _texto(valor: Any) -> str:
+    if valor is None:
+        return ""
+    if isinstance(valor, float) and valor.is_integer():
+        # Excel guarda los números enteros como float
+        valor = int(valor)
+    return str(valor).strip()
+
+
+def registros_anexos(filas: Iterable[Tuple[int, List[Any]]], progreso: ProgresoCarga) -> Iterator[Tuple]:
+    """
+    Tuplas para el COPY a partir de las filas del archivo (la primera es el
+    encabezado). ValueError si faltan columnas requeridas.
+    """
+    filas = iter(filas)
+    primera = next(filas, None)
+    encabezados = [_texto(valor) for valor in primera[1]] if primera else []
+    if any(columna not in encabezados for columna in COLUMNAS_REQUERIDAS):
+        raise ValueError("El archivo no tiene los encabezados requeridos: numero, usuario, area_nivel1")
+    indices = [encabezados.index(c) if c in encabezados else -1 for c in COLUMNAS_ANEXOS]
+
+    for linea, fila in filas:
+        progreso.filas += 1
+        yield (linea,) + tuple(_texto(fila[i]) if 0 <= i < len(fila) else "" for i in indices)
+
+
+async def cargar_staging(db, registros: Iterable[Tuple]) -> None:
+    """
+    Tabla temporal de staging (se borra al commit) y COPY de los registros,
+    que se leen del archivo en un hilo
+    """
+    await db.execute(text("""
+        CREATE TEMP TABLE anexos_carga_tmp (
+            linea INTEGER NOT NULL,
+            numero VARCHAR NOT NULL,
+            usuario VARCHAR NOT NULL,
+            area_nivel1 VARCHAR NOT NULL,
+            area_nivel2 VARCHAR NOT NULL,
+            area_nivel3 VARCHAR NOT NULL,
+            pin VARCHAR NOT NULL,
+            saldo_texto VARCHAR NOT NULL,
+            saldo NUMERIC(10, 2) NOT NULL DEFAULT 0,
+            error VARCHAR
+        ) ON COMMIT DROP
+    """))
+    conexion = await db.connection()
+    crudo = await conexion.get_raw_connection()
+    await crudo.driver_connection.copy_records_to_table(
+        "anexos_carga_tmp",
+        records=leer_en_hilo(registros),
+        columns=["linea"] + list(COLUMNAS_ANEXOS[:-1]) + ["saldo_texto"],
+    )
+
+
+async def validar_staging(db) -> List[str]:
+    """Marca las filas con error y devuelve los mensajes ordenados por línea"""
+    resultado = await db.execute(text("""
+        WITH revision AS (
+            SELECT linea,
+                   CASE
+                       WHEN numero = '' OR usuario = '' OR area_nivel1 = ''
+                           THEN 'Faltan valores en campos requeridos: numero, usuario, area_nivel1'
+                       WHEN saldo_texto <> '' AND saldo_texto !~ '^[0-9]{1,8}([.,][0-9]{1,2})?$'
+                           THEN 'Saldo inicial no válido: ' || saldo_texto
+                       WHEN ROW_NUMBER() OVER (PARTITION BY numero ORDER BY linea) > 1
+                           THEN 'El anexo ' || numero || ' está repetido en el archivo'
+                       WHEN EXISTS (SELECT 1 FROM anexos a WHERE a.numero = s.numero)
+                           THEN 'El anexo ' || numero || ' ya existe'
+                   END AS error
+            FROM anexos_carga_tmp s
+        )
+        UPDATE anexos_carga_tmp s SET error = r.error
+        FROM revision r
+        WHERE s.linea = r.linea AND r.error IS NOT NULL
+        RETURNING s.linea, s.error
+    """))
+    errores = sorted(resultado.fetchall())
+    await db.execute(text("""
+        UPDATE anexos_carga_tmp SET saldo = CAST(replace(saldo_texto, ',', '.') AS NUMERIC(10, 2))
+        WHERE error IS NULL AND saldo_texto <> ''
+    """))
+    return [f"Fila {linea}: {error}" for linea, error in errores]
+
+
+def preparar_pines_pendientes(db) -> None:
+    """Columna anexos.pin_pendiente (anexo creado cuyo PIN todavía no se guardó)"""
+    db.execute(text("ALTER TABLE anexos ADD COLUMN IF NOT EXISTS pin_pendiente BOOLEAN NOT NULL DEFAULT FALSE"))
+    db.execute(text("CREATE INDEX IF NOT EXISTS ix_anexos_pin_pendiente ON anexos (numero) WHERE pin_pendiente"))
+    db.commit()
+
+
+def contar_pines_pendientes(db) -> int:
+    return db.execute(text("SELECT COUNT(*) FROM anexos WHERE pin_pendiente")).scalar()
+
+
+async def fusionar_staging(db, generar_pin: bool) -> List[Tuple[str, str, Decimal]]:
+    """
+    Inserta las filas válidas en anexos y sus saldos iniciales. No hace
+    commit. Los anexos que van a recibir PIN (del archivo o generado si
+    `generar_pin`) quedan con pin NULL y pin_pendiente. Devuelve (numero,
+    pin en claro, saldo) de los anexos creados, en orden de línea.
+    """
+    resultado = await db.execute(text("""
+        WITH insertados AS (
+            INSERT INTO anexos
+                (numero, usuario, area_nivel1, area_nivel2, area_nivel3, pin, pin_pendiente, saldo_actual, activo)
+            SELECT numero, usuario, area_nivel1, area_nivel2, area_nivel3, NULL,
+                   pin <> '' OR CAST(:generar_pin AS boolean), saldo, TRUE
+            FROM anexos_carga_tmp
+            WHERE error IS NULL
+            ORDER BY linea
+            ON CONFLICT (numero) DO NOTHING
+            RETURNING numero
+        ),
+        saldos AS (
+            INSERT INTO saldo_anexos (calling_number, saldo, fecha_ultima_recarga)
+            SELECT s.numero, s.saldo, CURRENT_TIMESTAMP
+            FROM anexos_carga_tmp s
+            JOIN insertados i ON i.numero = s.numero
+            WHERE s.error IS NULL AND s.saldo > 0
+            ORDER BY s.numero
+            ON CONFLICT (calling_number) DO UPDATE
+                SET saldo = saldo_anexos.saldo + EXCLUDED.saldo,
+                    fecha_ultima_recarga = CURRENT_TIMESTAMP
+            RETURNING calling_number, saldo
+        ),
+        auditoria AS (
+            INSERT INTO saldo_auditoria (calling_number, saldo_anterior, saldo_nuevo, tipo_accion)
+            SELECT a.calling_number, a.saldo - s.saldo, a.saldo, 'creacion_anexo'
+            FROM saldos a
+            JOIN anexos_carga_tmp s ON s.numero = a.calling_number AND s.error IS NULL
+        )
+        SELECT s.numero, s.pin, s.saldo
+        FROM insertados i
+        JOIN anexos_carga_tmp s ON s.numero = i.numero AND s.error IS NULL
+        ORDER BY s.linea
+    """), {"generar_pin": generar_pin})
+    return [tuple(fila) for fila in resultado.fetchall()]
+
+
+def pines_pendientes(
+    creados: Iterable[Tuple[str, str, Decimal]], generar: bool, longitud: int
+) -> List[Tuple[str, str, bool]]:
+    """(numero, pin, generado) a hashear: el PIN del archivo o uno generado si `generar`"""
+    pendientes = []
+    for numero, pin, _ in creados:
+        if pin:
+            pendientes.append((numero, pin, False))
+        elif generar:
+            pendientes.append((numero, generar_pin(longitud), True))
+    return pendientes
+
+
+def _csv_generados(progreso: ProgresoCarga, generados: List[Tuple[str, str]]) -> None:
+    progreso.pines_generados = len(generados)
+    if not generados:
+        return
+    contenido = io.StringIO()
+    writer = csv.writer(contenido)
+    writer.writerow(["Número de Anexo", "PIN"])
+    writer.writerows(generados)
+    progreso.nombre_csv = f"pines_carga_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
+    progreso.csv = contenido.getvalue().encode()
+
+
+def aplicar_pines(
+    session_factory: Callable,
+    hasheador: HasheadorPines,
+    pines: List[Tuple[str, str, bool]],
+    progreso: ProgresoCarga,
+    lote: int = 500,
+) -> None:
+    """
+    Hashea los PINs en el pool de procesos y los guarda de a `lote`
+    (bloqueante). Solo toca anexos que siguen con pin_pendiente. Los PINs
+    generados quedan en el CSV de la carga para descargarlos una vez.
+    """
+    progreso.etapa = "hasheando_pines"
+    progreso.pines_total = len(pines)
+    # PINs generados ya guardados: solo esos van al CSV, aunque la carga falle a mitad
+    guardados: List[Tuple[str, str]] = []
+    db = session_factory()
+    try:
+        numeros = [numero for numero, _, _ in pines]
+        for inicio, hashes in zip(range(0, len(pines), lote), hasheador.hashear([pin for _, pin, _ in pines], lote)):
+            bloque = pines[inicio:inicio + lote]
+            actualizados = {fila[0] for fila in db.execute(
+                text("""
+                    UPDATE anexos SET pin = d.pin, pin_pendiente = FALSE
+                    FROM unnest(CAST(:numeros AS varchar[]), CAST(:pines AS varchar[])) AS d(numero, pin)
+                    WHERE anexos.numero = d.numero AND anexos.pin_pendiente
+                    RETURNING anexos.numero
+                """),
+                {"numeros": numeros[inicio:inicio + lote], "pines": hashes}
+            )}
+            db.commit()
+            # Un anexo que ya no estaba pendiente (otro proceso le guardó PIN) no entra al CSV
+            guardados.extend((numero, pin) for numero, pin, generado in bloque if generado and numero in actualizados)
+            progreso.pines_hechos += len(hashes)
+        _csv_generados(progreso, guardados)
+        progreso.etapa = "terminado"
+    except Exception as e:
+        db.rollback()
+        _csv_generados(progreso, guardados)
+        progreso.error = (f"Error guardando PINs: {str(e)}. Los anexos sin PIN "
+                          f"({progreso.pines_total - progreso.pines_hechos}) quedan pendientes y se pueden reanudar.")
+        progreso.etapa = "error"
+        logger.error(f"Carga de anexos {progreso.id}: {progreso.error}")
+    finally:
+        db.close()
@@ -0,0 +1,175 @@
+# tarificador/cliente_axl.py
+"""
+Registro de clientes SOAP para la API AXL de CUCM.
+
+El WSDL de AXL (AXLAPI.wsdl más AXLSoap.xsd y AXLEnums.xsd, ~4.6 MB de XML)
+tarda segundos en parsearse. El registro lo parsea una sola vez por proceso
+y comparte el Document de zeep entre todos los clientes; se vuelve a
+parsear si cambia algún archivo del esquema. No se guarda en disco: el
+Document no es serializable con pickle (Settings guarda un threading.local,
+el esquema referencia QName de lxml y clases que zeep genera en runtime).
+
+Cada host de CUCM tiene una requests.Session con pool de conexiones
+keep-alive. El servicio (ServiceProxy) se arma por (host, usuario,
+contraseña) y se reutiliza hasta que cambian esas credenciales o se llama
+a invalidar().
+"""
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BINDING_AXL = "{http://www.cisco.com/AXLAPIService/}AXLAPIBinding"
+
+
+class RegistroClientesAXL:
+    """Document AXL parseado una vez y un servicio por host/credenciales"""
+
+    def __init__(
+        self,
+        wsdl: str,
+        timeout: float = 10,
+        conexiones_por_host: int = 10,
+    ):
+        self.wsdl = os.path.abspath(wsdl)
+        self.timeout = timeout
+        self.conexiones_por_host = conexiones_por_host
+        self._documento = None
+        self._clave_documento: Optional[str] = None
+        # host -> (clave de credenciales, Session)
+        self._sesiones: Dict[str, Tuple[str, object]] = {}
+        # (host, clave de credenciales) -> ServiceProxy
+        self._servicios: Dict[Tuple[str, str], object] = {}
+        self._lock = threading.RLock()
+        self.segundos_documento: Optional[float] = None
+
+    # --- Document WSDL ---
+
+    def _huella_esquema(self) -> str:
+        """Cambia si cambia algún archivo del esquema"""
+        partes = []
+        for ruta in sorted(glob.glob(os.path.join(os.path.dirname(self.wsdl), "*"))):
+            if os.path.isfile(ruta):
+                estado = os.stat(ruta)
+                partes.append(f"{os.path.basename(ruta)}:{estado.st_size}:{estado.st_mtime_ns}")
+        return hashlib.sha1("|".join(partes).encode()).hexdigest()
+
+    def _parsear(self):
+        from requests import Session
+        from zeep import Settings
+        from zeep.transports import Transport
+        from zeep.wsdl import Document
+
+        # Los archivos son locales: el transporte de carga no lleva credenciales
+        transporte = Transport(session=Session(), timeout=self.timeout)
+        return Document(self.wsdl, transporte, settings=Settings(strict=False, xml_huge_tree=True))
+
+    def documento(self):
+        """Document de zeep del WSDL AXL, parseado una vez por proceso"""
+        with self._lock:
+            huella = self._huella_esquema()
+            if self._documento is not None and self._clave_documento == huella:
+                return self._documento
+
+            inicio = time.perf_counter()
+            documento = self._parsear()
+            self._documento, self._clave_documento = documento, huella
+            self.segundos_documento = time.perf_counter() - inicio
+            # Los servicios armados con el Document anterior quedan obsoletos
+            self._servicios.clear()
+            logger.info(f"WSDL AXL parseado en {self.segundos_documento:.2f}s")
+            return documento
+
+    # --- Sesiones y servicios ---
+
+    @staticmethod
+    def _clave_credenciales(usuario: str, password: str) -> str:
+        return hashlib.sha256(f"{usuario}\0{password}".encode()).hexdigest()
+
+    def sesion(self, host: str, usuario: str, password: str):
+        """requests.Session keep-alive del host (se recrea si cambian las credenciales)"""
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        from requests.auth import HTTPBasicAuth
+
+        clave = self._clave_credenciales(usuario, password)
+        with self._lock:
+            actual = self._sesiones.get(host)
+            if actual and actual[0] == clave:
+                return actual[1]
+            if actual:
+                actual[1].close()
+
+            session = Session()
+            session.verify = False
+            session.auth = HTTPBasicAuth(usuario, password)
+            adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=self.conexiones_por_host)
+            session.mount("https://", adaptador)
+            session.mount("http://", adaptador)
+            self._sesiones[host] = (clave, session)
+            return session
+
+    def servicio(self, host: str, usuario: str, password: str):
+        """ServiceProxy AXL de https://host:8443/axl/, reutilizado entre llamadas"""
+        from zeep import Client, Settings
+        from zeep.transports import Transport
+
+        documento = self.documento()
+        clave = self._clave_credenciales(usuario, password)
+        with self._lock:
+            servicio = self._servicios.get((host, clave))
+            if servicio is not None:
+                return servicio
+
+            transporte = Transport(session=self.sesion(host, usuario, password), timeout=self.timeout)
+            client = Client(documento, settings=Settings(strict=False, xml_huge_tree=True), transport=transporte)
+            servicio = client.create_service(BINDING_AXL, f"https://{host}:8443/axl/")
+            # Un servicio por host: las credenciales viejas del mismo host se descartan
+            for vieja in [c for c in self._servicios if c[0] == host]:
+                del self._servicios[vieja]
+            self._servicios[(host, clave)] = servicio
+            return servicio
+
+    def invalidar(self, host: Optional[str] = None) -> None:
+        """Descarta servicios y sesiones (de un host o de todos); el Document se conserva"""
+        with self._lock:
+            hosts = [host] if host else list(self._sesiones)
+            for h in hosts:
+                actual = self._sesiones.pop(h, None)
+                if actual:
+                    actual[1].close()
+            for clave in [c for c in self._servicios if host is None or c[0] == host]:
+                del self._servicios[clave]
+
+    def calentar(self, host: str, usuario: str, password: str) -> Dict[str, float]:
+        """
+        Arma el servicio y mide en milisegundos el primer pedido (frío: parseo
+        del WSDL) contra uno siguiente (tibio: registro en memoria). No se
+        conecta a CUCM.
+        """
+        inicio = time.perf_counter()
+        self.servicio(host, usuario, password)
+        frio = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        self.servicio(host, usuario, password)
+        tibio = time.perf_counter() - inicio
+        return {
+            "frio_ms": round(frio * 1000, 1),
+            "tibio_ms": round(tibio * 1000, 3),
+        }
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "wsdl": self.wsdl,
+                "documento_cargado": self._documento is not None,
+                "segundos_documento": round(self.segundos_documento, 3) if self.segundos_documento else None,
+                "hosts": sorted(self._sesiones),
+                "servicios": len(self._servicios),
+            }
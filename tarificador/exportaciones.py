@@ -0,0 +1,364 @@
+# tarificador/exportaciones.py
+"""
+Exportación de CDR en streaming (CSV, XLSX y PDF).
+
+Las filas se leen con un cursor del lado del servidor, en bloques de
+`bloque` filas, y cada formato escribe a medida que llegan:
+
+- CSV:  cada bloque se convierte en texto y se envía
+- XLSX: workbook de openpyxl en modo write_only (las filas van a disco,
+        no quedan en memoria); el archivo se envía en trozos al terminar
+- PDF:  escritor propio de páginas de texto; cada página se emite en cuanto
+        se completa y solo se guarda el offset de cada objeto
+
+La memoria queda acotada por el tamaño del bloque, no por la cantidad de
+filas. El límite de filas es explícito: si la consulta tiene más, el
+archivo termina con una línea que avisa el corte.
+"""
+import csv
+import io
+import logging
+import os
+import tempfile
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+
+from .consultas_cdr import filtros_cdr, orden_cdr
+
+logger = logging.getLogger(__name__)
+
+SQL_EXPORTACION_CDR = """
+    SELECT c.calling_number, c.called_number,
+           c.start_time, c.end_time, c.duration_seconds,
+           c.duration_billable, c.cost, c.status, c.direction,
+           z.nombre as zona
+    FROM cdr c
+    LEFT JOIN zonas z ON c.zona_id = z.id
+    WHERE 1=1
+"""
+
+COLUMNAS_EXPORTACION = [
+    "Número Origen", "Número Destino", "Fecha Inicio", "Fecha Fin",
+    "Duración (seg)", "Duración (min)", "Facturable (seg)", "Facturable (min)",
+    "Costo", "Estado", "Dirección", "Zona",
+]
+
+# Nombre de cada filtro en el resumen de la exportación
+_NOMBRES_FILTRO = (
+    ("phone_number", "Número"), ("calling_number", "Origen"), ("called_number", "Destino"),
+    ("start_date", "Fecha Inicio"), ("end_date", "Fecha Fin"), ("status", "Estado"),
+    ("direction", "Dirección"),
+)
+
+
+class EstadoExportacion:
+    """Filas leídas y si se cortó por el límite; los escritores lo consultan al final"""
+
+    def __init__(self, limite: Optional[int]):
+        self.limite = limite
+        self.filas = 0
+        self.truncado = False
+
+    def nota_corte(self) -> str:
+        return f"Exportación limitada a {self.limite} registros; hay más registros que coinciden con los filtros"
+
+
+def resumen_filtros(filtros: Dict) -> List[Tuple[str, str]]:
+    """[(nombre, valor)] de los filtros usados, para el encabezado del archivo"""
+    return [(nombre, filtros[clave]) for clave, nombre in _NOMBRES_FILTRO if filtros.get(clave)]
+
+
+def nombre_archivo(filtros: Dict, extension: str) -> str:
+    partes = ["cdr_report"]
+    if filtros.get("phone_number"):
+        partes.append(f"num_{filtros['phone_number']}")
+    if filtros.get("status"):
+        partes.append(f"status_{filtros['status']}")
+    if filtros.get("direction"):
+        partes.append(f"dir_{filtros['direction']}")
+    partes.append(datetime.now().strftime("%Y%m%d_%H%M%S"))
+    return "_".join(partes) + f".{extension}"
+
+
+def filtros_exportacion(filtros: Dict, alias: str = "c") -> Tuple[str, Dict]:
+    """
+    Condiciones de la exportación con los mismos filtros que el dashboard.
+
+    `filtros` usa los nombres de parámetro de los endpoints; calling_number y
+    called_number se ignoran si hay phone_number.
+    """
+    phone_number = filtros.get("phone_number")
+    return filtros_cdr(
+        alias=alias,
+        phone_number=phone_number,
+        calling_number=None if phone_number else filtros.get("calling_number"),
+        called_number=None if phone_number else filtros.get("called_number"),
+        start_date=filtros.get("start_date"),
+        end_date=filtros.get("end_date"),
+        status=filtros.get("status"),
+        direction=filtros.get("direction"),
+    )
+
+
+def consulta_exportacion_cdr(filtros: Dict, limite: Optional[int]) -> Tuple[str, Dict]:
+    """SQL y parámetros de la exportación; se pide una fila más que el límite para saber si hubo corte"""
+    where, params = filtros_exportacion(filtros)
+    sql = SQL_EXPORTACION_CDR + where
+    if filtros.get("end_date"):
+        sql += " AND c.end_time <= :end_date"
+    sql += orden_cdr("c")
+    if limite:
+        sql += " LIMIT :limite_exportacion"
+        params["limite_exportacion"] = limite + 1
+    return sql, params
+
+
+def leer_por_bloques(
+    session_factory: Callable,
+    sql: str,
+    params: Dict,
+    estado: EstadoExportacion,
+    bloque: int = 2000,
+) -> Iterator[List[Tuple]]:
+    """Bloques de filas desde un cursor del lado del servidor; abre y cierra su propia sesión"""
+    db = session_factory()
+    try:
+        resultado = db.execute(text(sql), params, execution_options={"yield_per": bloque})
+        for particion in resultado.partitions():
+            if estado.limite and estado.filas + len(particion) > estado.limite:
+                particion = particion[:estado.limite - estado.filas]
+                estado.truncado = True
+            estado.filas += len(particion)
+            if particion:
+                yield [_formatear(row) for row in particion]
+            if estado.truncado:
+                break
+        resultado.close()
+    finally:
+        db.close()
+
+
+def _formatear(row) -> Tuple:
+    """Fila de la consulta con el formato de COLUMNAS_EXPORTACION"""
+    return (
+        row[0] or "",
+        row[1] or "",
+        row[2].strftime("%Y-%m-%d %H:%M:%S") if row[2] else "",
+        row[3].strftime("%Y-%m-%d %H:%M:%S") if row[3] else "",
+        row[4] or 0,
+        round(row[4] / 60, 2) if row[4] else 0,
+        row[5] or 0,
+        round(row[5] / 60, 2) if row[5] else 0,
+        float(row[6]) if row[6] else 0.0,
+        row[7] or "",
+        row[8] or "",
+        row[9] or "",
+    )
+
+
+def csv_por_bloques(bloques: Iterator[List[Tuple]], estado: EstadoExportacion) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM para que Excel reconozca UTF-8
+    buffer.write("\ufeff")
+    writer.writerow(COLUMNAS_EXPORTACION)
+    yield buffer.getvalue().encode("utf-8")
+
+    for filas in bloques:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(filas)
+        yield buffer.getvalue().encode("utf-8")
+
+    if estado.truncado:
+        yield f"# {estado.nota_corte()}\r\n".encode("utf-8")
+
+
+def xlsx_por_bloques(
+    bloques: Iterator[List[Tuple]],
+    estado: EstadoExportacion,
+    resumen: Sequence[Tuple[str, str]] = (),
+    trozo: int = 64 * 1024,
+) -> Iterator[bytes]:
+    """Workbook write_only en un archivo temporal, enviado en trozos"""
+    from openpyxl import Workbook
+
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet("CDR_Data")
+    hoja.append(COLUMNAS_EXPORTACION)
+    for filas in bloques:
+        for fila in filas:
+            hoja.append(fila)
+
+    hoja_resumen = libro.create_sheet("Resumen")
+    hoja_resumen.append(["Filtro", "Valor"])
+    for filtro, valor in resumen:
+        hoja_resumen.append([filtro, valor])
+    hoja_resumen.append(["Total Registros", estado.filas])
+    hoja_resumen.append(["Fecha Generación", datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
+    if estado.truncado:
+        hoja_resumen.append(["Aviso", estado.nota_corte()])
+
+    descriptor, ruta = tempfile.mkstemp(suffix=".xlsx")
+    os.close(descriptor)
+    try:
+        libro.save(ruta)
+        with open(ruta, "rb") as archivo:
+            while True:
+                datos = archivo.read(trozo)
+                if not datos:
+                    break
+                yield datos
+    finally:
+        os.unlink(ruta)
+
+
+class PdfTablaStream:
+    """
+    PDF de texto con una tabla paginada, escrito página por página.
+
+    Usa las fuentes estándar Helvetica (WinAnsiEncoding), así que no embebe
+    fuentes; los caracteres fuera de cp1252 (emojis) se omiten.
+    """
+
+    ANCHO, ALTO = 842, 595  # A4 apaisado
+    MARGEN = 30
+    TAMANO = 7
+    INTERLINEA = 10
+
+    def __init__(self, titulo: str, columnas: Sequence[Tuple[str, int]], encabezado: Sequence[str] = ()):
+        self.titulo = titulo
+        self.columnas = columnas
+        self.encabezado = list(encabezado)
+
+    @staticmethod
+    def _texto(valor) -> str:
+        limpio = str(valor).encode("cp1252", "ignore").decode("cp1252")
+        return limpio.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    def _linea(self, x: float, y: float, valor, fuente: str = "F1", tamano: Optional[int] = None) -> str:
+        return f"BT /{fuente} {tamano or self.TAMANO} Tf {x} {y} Td ({self._texto(valor)}) Tj ET\n"
+
+    def _fila(self, y: float, valores, fuente: str = "F1") -> str:
+        partes, x = [], self.MARGEN
+        for (_, ancho), valor in zip(self.columnas, valores):
+            # Recortar al ancho de la columna (aprox. 0.5 em por carácter)
+            maximo = max(1, int(ancho / (self.TAMANO * 0.5)))
+            partes.append(self._linea(x, y, str(valor)[:maximo], fuente))
+            x += ancho
+        return "".join(partes)
+
+    def generar(self, bloques: Iterator[List[Tuple]], pie_final: Callable[[], List[str]]) -> Iterator[bytes]:
+        offsets: Dict[int, int] = {}
+        posicion = 0
+        kids: List[int] = []
+        siguiente_obj = 5
+
+        def objeto(numero: int, cuerpo: bytes) -> bytes:
+            nonlocal posicion
+            offsets[numero] = posicion
+            datos = f"{numero} 0 obj\n".encode() + cuerpo + b"\nendobj\n"
+            posicion += len(datos)
+            return datos
+
+        inicio = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+        posicion += len(inicio)
+        yield inicio
+        yield objeto(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        yield objeto(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+        yield objeto(4, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>")
+
+        def pagina(contenido: str) -> Iterator[bytes]:
+            nonlocal siguiente_obj
+            stream = contenido.encode("cp1252", "ignore")
+            n_contenido, n_pagina = siguiente_obj, siguiente_obj + 1
+            siguiente_obj += 2
+            yield objeto(n_contenido, f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+            yield objeto(n_pagina, (
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {self.ANCHO} {self.ALTO}] "
+                f"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {n_contenido} 0 R >>"
+            ).encode())
+            kids.append(n_pagina)
+
+        def nueva_pagina() -> Tuple[List[str], float]:
+            partes = []
+            y = self.ALTO - self.MARGEN
+            if not kids:
+                partes.append(self._linea(self.MARGEN, y - 6, self.titulo, "F2", 14))
+                y -= 26
+                for linea in self.encabezado:
+                    partes.append(self._linea(self.MARGEN, y, linea))
+                    y -= self.INTERLINEA
+                y -= 6
+            partes.append(self._fila(y, [titulo for titulo, _ in self.columnas], "F2"))
+            return partes, y - self.INTERLINEA * 1.5
+
+        def cerrar(partes: List[str]) -> Iterator[bytes]:
+            partes.append(self._linea(self.ANCHO - self.MARGEN - 50, self.MARGEN / 2, f"Página {len(kids) + 1}"))
+            yield from pagina("".join(partes))
+
+        partes, y = nueva_pagina()
+        for filas in bloques:
+            for fila in filas:
+                if y < self.MARGEN + self.INTERLINEA:
+                    yield from cerrar(partes)
+                    partes, y = nueva_pagina()
+                partes.append(self._fila(y, fila))
+                y -= self.INTERLINEA
+
+        for linea in pie_final():
+            if y < self.MARGEN + self.INTERLINEA:
+                yield from cerrar(partes)
+                partes, y = nueva_pagina()
+            y -= self.INTERLINEA / 2
+            partes.append(self._linea(self.MARGEN, y, linea, "F2"))
+            y -= self.INTERLINEA
+        yield from cerrar(partes)
+
+        kids_ref = " ".join(f"{k} 0 R" for k in kids)
+        yield objeto(2, f"<< /Type /Pages /Kids [{kids_ref}] /Count {len(kids)} >>".encode())
+
+        total_obj = siguiente_obj
+        xref = [f"xref\n0 {total_obj}\n", "0000000000 65535 f \n"]
+        xref.extend(f"{offsets[n]:010d} 00000 n \n" for n in range(1, total_obj))
+        xref.append(f"trailer\n<< /Size {total_obj} /Root 1 0 R >>\nstartxref\n{posicion}\n%%EOF\n")
+        yield "".join(xref).encode()
+
+
+# Columnas del PDF: (título, ancho en puntos); suman el ancho útil de A4 apaisado
+_COLUMNAS_PDF = [
+    ("Origen", 80), ("Destino", 95), ("Inicio", 90), ("Fin", 90), ("Duración", 55),
+    ("Facturada", 55), ("Costo", 65), ("Estado", 90), ("Dirección", 60), ("Zona", 102),
+]
+
+
+def pdf_por_bloques(
+    bloques: Iterator[List[Tuple]],
+    estado: EstadoExportacion,
+    resumen: Sequence[Tuple[str, str]] = (),
+) -> Iterator[bytes]:
+    def minutos(segundos) -> str:
+        return f"{int(segundos) // 60}:{int(segundos) % 60:02d}"
+
+    def filas_pdf() -> Iterator[List[Tuple]]:
+        for filas in bloques:
+            yield [
+                (f[0], f[1], f[2] or "N/A", f[3] or "N/A", minutos(f[4]), minutos(f[6]),
+                 f"S/{f[8]:.6f}", f[9] or "N/A", f[10] or "N/A", f[11] or "N/A")
+                for f in filas
+            ]
+
+    encabezado = [f"Generado: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"]
+    if resumen:
+        encabezado.append("Filtros: " + " | ".join(f"{filtro}: {valor}" for filtro, valor in resumen))
+
+    def pie() -> List[str]:
+        lineas = [f"Total: {estado.filas} registro{'s' if estado.filas != 1 else ''}"]
+        if estado.truncado:
+            lineas.append(estado.nota_corte())
+        return lineas
+
+    documento = PdfTablaStream("Registro de Llamadas (CDR)", _COLUMNAS_PDF, encabezado)
+    yield from documento.generar(filas_pdf(), pie)
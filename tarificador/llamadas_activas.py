@@ -0,0 +1,232 @@
+# tarificador/llamadas_activas.py
+"""
+Registro en memoria de las llamadas activas.
+
+El registro es la fuente de verdad del monitoreo: los reportes del listener
+actualizan la memoria y generan deltas numerados (`upsert` / `remove`) que se
+envían a los clientes WebSocket. La tabla `active_calls` se escribe de forma
+diferida (write-behind) con `volcar()`, y `cargar()` reconstruye el registro
+desde la tabla al arrancar.
+
+Las llamadas registradas con su tarifa (`tarifa_segundo`) no necesitan más
+reportes del listener: la duración y el costo en curso se calculan al leer,
+a partir de `answer_time`, y `ticks()` arma el cuadro periódico que el
+servidor envía a los clientes.
+"""
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+DIRECTION_DISPLAYS = {
+    "inbound": "📱 Entrante",
+    "outbound": "📞 Saliente",
+    "internal": "🏢 Interna",
+    "transit": "🔄 Tránsito",
+}
+
+_COLUMNAS = (
+    "call_id", "calling_number", "called_number", "direction", "zone",
+    "start_time", "last_updated", "current_duration", "current_cost", "connection_id",
+    "answer_time", "zona_id", "tarifa_segundo",
+)
+
+# Columnas que no cuentan como cambio de estado de la llamada
+_COLUMNAS_VOLATILES = ("last_updated", "current_duration", "current_cost")
+
+
+def duracion_y_costo(fila: Dict, ahora: Optional[datetime] = None) -> Tuple[int, float]:
+    """
+    Duración facturable y costo en curso.
+
+    Con tarifa registrada se calculan desde answer_time; las llamadas sin
+    tarifa (reportes antiguos del listener) usan los valores reportados.
+    """
+    if fila.get("tarifa_segundo") is None:
+        return fila.get("current_duration") or 0, float(fila.get("current_cost") or 0.0)
+
+    answer_time = fila.get("answer_time")
+    if not answer_time:
+        return 0, 0.0
+    ahora = ahora or datetime.now()
+    duracion = max(0, int((ahora - answer_time).total_seconds()))
+    return duracion, round(duracion * float(fila["tarifa_segundo"]), 4)
+
+
+def formatear_llamada(fila: Dict, ahora: Optional[datetime] = None) -> Dict:
+    """Fila de active_calls -> formato que espera el cliente"""
+    direction = fila.get("direction") or "unknown"
+    start_time = fila.get("start_time")
+    duracion, costo = duracion_y_costo(fila, ahora)
+    return {
+        "call_id": fila["call_id"],
+        "calling_number": fila.get("calling_number"),
+        "called_number": fila.get("called_number"),
+        "direction": direction,
+        "direction_display": DIRECTION_DISPLAYS.get(direction, f"❓ {direction}"),
+        "start_time": start_time.isoformat() if isinstance(start_time, datetime) else start_time,
+        "current_duration": duracion,
+        "current_cost": costo,
+        "zone": fila.get("zone") or "Desconocida",
+        "connection_id": fila.get("connection_id"),
+    }
+
+
+class ActiveCallRegistry:
+    """
+    Llamadas activas en memoria con número de secuencia.
+
+    Cada cambio incrementa `seq`; un cliente que recibe un delta con
+    seq != último + 1 sabe que perdió mensajes y pide una instantánea.
+    """
+
+    def __init__(self):
+        self._filas: Dict[str, Dict] = {}
+        # call_id -> fila a escribir, o None si hay que borrarla
+        self._pendientes: Dict[str, Optional[Dict]] = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._filas)
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def upsert(self, fila: Dict) -> Optional[Dict]:
+        """Registra o actualiza una llamada; devuelve el delta o None si no cambió"""
+        call_id = fila["call_id"]
+        with self._lock:
+            anterior = self._filas.get(call_id)
+            if anterior is not None:
+                # Un reporte parcial (p.ej. solo answer_time) conserva el resto
+                fila = {**anterior, **{k: v for k, v in fila.items() if v is not None}}
+                # Las llamadas con tarifa calculan duración y costo solas
+                ignorar = _COLUMNAS_VOLATILES if fila.get("tarifa_segundo") is not None else ("last_updated",)
+                if all(anterior.get(c) == fila.get(c) for c in _COLUMNAS if c not in ignorar):
+                    return None
+            self._filas[call_id] = fila
+            self._pendientes[call_id] = fila
+            self._seq += 1
+            return {"type": "upsert", "seq": self._seq, "call": formatear_llamada(fila)}
+
+    def remove(self, call_id: str) -> Optional[Dict]:
+        """Elimina una llamada por call_id o connection_id; devuelve el delta o None"""
+        with self._lock:
+            if call_id not in self._filas:
+                # Buscar por connection_id como alternativa
+                call_id = next(
+                    (cid for cid, fila in self._filas.items() if fila.get("connection_id") == call_id),
+                    None,
+                )
+                if call_id is None:
+                    return None
+            del self._filas[call_id]
+            self._pendientes[call_id] = None
+            self._seq += 1
+            return {"type": "remove", "seq": self._seq, "call_id": call_id}
+
+    def get(self, call_id: str) -> Optional[Dict]:
+        fila = self._filas.get(call_id)
+        return formatear_llamada(fila) if fila else None
+
+    def filas(self) -> List[Dict]:
+        """Copia de las filas registradas (para reconstruir otros índices)"""
+        with self._lock:
+            return [dict(fila) for fila in self._filas.values()]
+
+    def listar(self) -> List[Dict]:
+        """Llamadas activas ordenadas de la más reciente a la más antigua"""
+        with self._lock:
+            filas = list(self._filas.values())
+        llamadas = [formatear_llamada(fila) for fila in filas]
+        llamadas.sort(key=lambda c: c["start_time"] or "", reverse=True)
+        return llamadas
+
+    def snapshot(self) -> Dict:
+        """Mensaje de estado completo para un cliente nuevo o desincronizado"""
+        with self._lock:
+            seq = self._seq
+            filas = list(self._filas.values())
+        llamadas = [formatear_llamada(fila) for fila in filas]
+        llamadas.sort(key=lambda c: c["start_time"] or "", reverse=True)
+        return {"type": "snapshot", "seq": seq, "active_calls": llamadas}
+
+    def ticks(self) -> Dict:
+        """Cuadro periódico con duración y costo de las llamadas contestadas"""
+        ahora = datetime.now()
+        with self._lock:
+            seq = self._seq
+            filas = [fila for fila in self._filas.values() if fila.get("answer_time")]
+        llamadas = []
+        for fila in filas:
+            duracion, costo = duracion_y_costo(fila, ahora)
+            llamadas.append({"call_id": fila["call_id"], "current_duration": duracion, "current_cost": costo})
+        return {"type": "tick", "seq": seq, "server_time": ahora.isoformat(), "calls": llamadas}
+
+    @staticmethod
+    def preparar_tabla(db) -> None:
+        """Agrega a active_calls las columnas de tarificación si aún no existen"""
+        db.execute(text("""
+            ALTER TABLE active_calls
+                ADD COLUMN IF NOT EXISTS answer_time TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS zona_id INTEGER,
+                ADD COLUMN IF NOT EXISTS tarifa_segundo NUMERIC(12, 6)
+        """))
+        db.commit()
+
+    def cargar(self, db) -> int:
+        """Reconstruye el registro desde la tabla active_calls"""
+        rows = db.execute(text(f"SELECT {', '.join(_COLUMNAS)} FROM active_calls")).fetchall()
+        with self._lock:
+            self._filas = {row[0]: dict(zip(_COLUMNAS, row)) for row in rows}
+            self._pendientes.clear()
+            self._seq += 1
+        logger.info(f"Registro de llamadas activas cargado: {len(rows)} llamadas")
+        return len(rows)
+
+    def volcar(self, db) -> int:
+        """Escribe en active_calls los cambios acumulados desde el último volcado"""
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+        if not pendientes:
+            return 0
+
+        ahora = datetime.now()
+        upserts = []
+        for fila in pendientes.values():
+            if fila is None:
+                continue
+            # Materializar duración y costo al momento del volcado
+            duracion, costo = duracion_y_costo(fila, ahora)
+            upserts.append({**fila, "current_duration": duracion, "current_cost": costo})
+        borrados = [call_id for call_id, fila in pendientes.items() if fila is None]
+        try:
+            if upserts:
+                columnas = ", ".join(_COLUMNAS)
+                valores = ", ".join(f":{c}" for c in _COLUMNAS)
+                set_clause = ", ".join(f"{c} = EXCLUDED.{c}" for c in _COLUMNAS if c != "call_id")
+                db.execute(
+                    text(f"""INSERT INTO active_calls ({columnas}) VALUES ({valores})
+                             ON CONFLICT (call_id) DO UPDATE SET {set_clause}"""),
+                    [{c: fila.get(c) for c in _COLUMNAS} for fila in upserts],
+                )
+            if borrados:
+                db.execute(
+                    text("DELETE FROM active_calls WHERE call_id = ANY(:ids)"),
+                    {"ids": borrados},
+                )
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Devolver los cambios que no fueron reemplazados por otros más nuevos
+            with self._lock:
+                for call_id, fila in pendientes.items():
+                    self._pendientes.setdefault(call_id, fila)
+            raise
+        return len(pendientes)
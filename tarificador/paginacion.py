@@ -0,0 +1,149 @@
+# tarificador/paginacion.py
+"""
+Paginación por cursor (keyset) de las búsquedas de CDR.
+
+Las páginas se recorren por la clave (start_time, id) en orden descendente,
+que coincide con el índice ix_cdr_start_time_id_desc: cada página es una
+búsqueda en el índice a partir de la última fila vista, así la página N
+cuesta lo mismo que la primera.
+
+Los cursores son opacos para el cliente (base64 de la clave y el sentido).
+
+El total de registros se estima con el planner, o se toma de un conteo
+exacto reciente del mismo filtro; el conteo exacto se hace solo cuando se
+pide explícitamente.
+"""
+import base64
+import json
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+
+
+def codificar_cursor(start_time: datetime, cdr_id: int, sentido: str) -> str:
+    """Cursor opaco a partir de la clave de una fila"""
+    datos = json.dumps({"t": start_time.isoformat(), "i": cdr_id, "s": sentido}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(datos.encode()).decode().rstrip("=")
+
+
+def decodificar_cursor(cursor: str) -> Tuple[datetime, int, str]:
+    """(start_time, id, sentido); ValueError si el cursor no es válido"""
+    try:
+        relleno = "=" * (-len(cursor) % 4)
+        datos = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+        sentido = datos["s"]
+        if sentido not in ("next", "prev"):
+            raise ValueError(sentido)
+        return datetime.fromisoformat(datos["t"]), int(datos["i"]), sentido
+    except (KeyError, TypeError, ValueError, json.JSONDecodeError) as e:
+        raise ValueError(f"Cursor inválido: {cursor}") from e
+
+
+def condicion_cursor(cursor: Optional[str], alias: str = "") -> Tuple[str, Dict, str, bool]:
+    """
+    Condición, parámetros y ORDER BY para leer la página que indica el cursor.
+
+    Devuelve (" AND ...", params, " ORDER BY ...", invertir). Con invertir=True
+    (página anterior) las filas llegan en orden ascendente y hay que darlas
+    vuelta antes de mostrarlas.
+    """
+    p = f"{alias}." if alias else ""
+    # Las filas sin start_time no tienen lugar en el orden por clave
+    condicion = f" AND {p}start_time IS NOT NULL"
+    if not cursor:
+        return condicion, {}, f" ORDER BY {p}start_time DESC, {p}id DESC", False
+
+    start_time, cdr_id, sentido = decodificar_cursor(cursor)
+    params = {"cursor_start_time": start_time, "cursor_id": cdr_id}
+    if sentido == "next":
+        condicion += f" AND ({p}start_time, {p}id) < (:cursor_start_time, :cursor_id)"
+        return condicion, params, f" ORDER BY {p}start_time DESC, {p}id DESC", False
+    condicion += f" AND ({p}start_time, {p}id) > (:cursor_start_time, :cursor_id)"
+    return condicion, params, f" ORDER BY {p}start_time ASC, {p}id ASC", True
+
+
+def armar_pagina(
+    filas: Sequence,
+    por_pagina: int,
+    cursor: Optional[str],
+    clave=lambda fila: (fila[0], fila[1]),
+) -> Tuple[List, Optional[str], Optional[str]]:
+    """
+    Recorta la página y arma los cursores.
+
+    `filas` es el resultado de la consulta con LIMIT por_pagina + 1 y
+    `clave(fila)` devuelve (start_time, id). Devuelve (filas, next, prev).
+    """
+    sentido = decodificar_cursor(cursor)[2] if cursor else None
+    hay_mas = len(filas) > por_pagina
+    filas = list(filas[:por_pagina])
+    if sentido == "prev":
+        filas.reverse()
+
+    if not filas:
+        return filas, None, None
+
+    # Hacia atrás siempre queda una página siguiente (la que se venía mirando)
+    hay_siguiente = hay_mas if sentido != "prev" else True
+    hay_anterior = sentido == "next" or (sentido == "prev" and hay_mas)
+
+    siguiente = codificar_cursor(*clave(filas[-1]), "next") if hay_siguiente else None
+    anterior = codificar_cursor(*clave(filas[0]), "prev") if hay_anterior else None
+    return filas, siguiente, anterior
+
+
+class ConteoCDR:
+    """
+    Total de registros por filtro sin COUNT(*) en cada página.
+
+    `total()` devuelve el conteo exacto si hay uno reciente para el mismo
+    filtro, y si no la estimación del planner. `exacto()` cuenta y guarda el
+    resultado durante `ttl` segundos.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_entradas: int = 500):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._exactos: Dict[Tuple, Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _clave(where: str, params: Dict) -> Tuple:
+        return where, tuple(sorted((k, str(v)) for k, v in params.items()))
+
+    def _guardado(self, clave: Tuple) -> Optional[int]:
+        with self._lock:
+            entrada = self._exactos.get(clave)
+            if entrada and time.monotonic() - entrada[0] < self.ttl:
+                return entrada[1]
+        return None
+
+    def exacto(self, db, where: str, params: Dict) -> int:
+        """COUNT(*) del filtro; el resultado queda en caché"""
+        total = db.execute(text(f"SELECT COUNT(*) FROM cdr WHERE 1=1{where}"), params).scalar() or 0
+        with self._lock:
+            if len(self._exactos) >= self.max_entradas:
+                # Descartar la entrada más vieja
+                del self._exactos[min(self._exactos, key=lambda k: self._exactos[k][0])]
+            self._exactos[self._clave(where, params)] = (time.monotonic(), total)
+        return total
+
+    @staticmethod
+    def estimado(db, where: str, params: Dict) -> int:
+        """Filas estimadas por el planner para el filtro"""
+        plan = db.execute(text(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM cdr WHERE 1=1{where}"), params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def total(self, db, where: str, params: Dict, exacto: bool = False) -> Tuple[int, bool]:
+        """(total, es_exacto)"""
+        if exacto:
+            return self.exacto(db, where, params), True
+        guardado = self._guardado(self._clave(where, params))
+        if guardado is not None:
+            return guardado, True
+        return self.estimado(db, where, params), False
@@ -0,0 +1,63 @@
+# tarificador/pines.py
+"""
+Generación y hash de PINs de anexos.
+
+bcrypt es deliberadamente lento (decenas a cientos de ms por PIN), así que
+los lotes grandes se reparten en un pool de procesos: cada proceso hashea
+con su propio CryptContext y la API no retiene el GIL mientras tanto.
+"""
+import logging
+import multiprocessing
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+_contexto = None
+
+
+def hash_pin(pin: str) -> str:
+    """Hash bcrypt del PIN (se ejecuta dentro del proceso del pool)"""
+    global _contexto
+    if _contexto is None:
+        from passlib.context import CryptContext
+        _contexto = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _contexto.hash(pin)
+
+
+def generar_pin(longitud: int) -> str:
+    return "".join(secrets.choice("0123456789") for _ in range(longitud))
+
+
+class HasheadorPines:
+    """Pool de procesos para hashear PINs en lote, creado al primer uso"""
+
+    def __init__(self, max_procesos: Optional[int] = None):
+        self.max_procesos = max_procesos or max(1, (os.cpu_count() or 2) - 1)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_procesos,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def hashear(self, pines: Sequence[str], lote: int = 500) -> Iterator[List[str]]:
+        """Hashes en el mismo orden que `pines`, de a `lote` por vez"""
+        pool = self._pool()
+        por_proceso = max(1, lote // (self.max_procesos * 4))
+        for inicio in range(0, len(pines), lote):
+            yield list(pool.map(hash_pin, pines[inicio:inicio + lote], chunksize=por_proceso))
+
+    def detener(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,130 @@
+# tarificador/prefijos.py
+"""
+Motor de coincidencia de prefijos para la determinación de zonas.
+
+Los prefijos de la tabla `prefijos` se cargan una sola vez en un trie de
+dígitos. Cada nodo del trie indexa además sus reglas por longitud del número,
+de modo que resolver la zona de un número cuesta O(dígitos) y no requiere
+consultar la base de datos.
+"""
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Rangos de longitud más anchos que esto se tratan como abiertos en lugar de
+# expandirse en el índice por longitud
+MAX_RANGO_INDEXADO = 32
+
+
+def limpiar_numero(numero) -> str:
+    """Deja solo los dígitos del número marcado"""
+    if not numero:
+        return ""
+    return "".join(filter(str.isdigit, str(numero)))
+
+
+@dataclass(frozen=True)
+class PrefijoRegla:
+    """Una fila de `prefijos` junto con los datos de su zona"""
+    prefijo_id: int
+    zona_id: int
+    prefijo: str
+    longitud_minima: Optional[int]
+    longitud_maxima: Optional[int]
+    zona_nombre: Optional[str] = None
+    zona_descripcion: Optional[str] = None
+
+    def admite_longitud(self, longitud: int) -> bool:
+        """Longitudes nulas o en cero se consideran sin límite"""
+        if self.longitud_minima and longitud < self.longitud_minima:
+            return False
+        if self.longitud_maxima and longitud > self.longitud_maxima:
+            return False
+        return True
+
+
+class _Nodo:
+    __slots__ = ("hijos", "por_longitud", "abiertas")
+
+    def __init__(self):
+        self.hijos: Dict[str, "_Nodo"] = {}
+        # longitud exacta del número -> regla
+        self.por_longitud: Dict[int, PrefijoRegla] = {}
+        # reglas con algún extremo abierto o rango muy amplio
+        self.abiertas: List[PrefijoRegla] = []
+
+
+class PrefixTrie:
+    """Trie inmutable de prefijos indexado por dígito y longitud de número"""
+
+    def __init__(self, reglas: Iterable[PrefijoRegla]):
+        self._raiz = _Nodo()
+        self.total_reglas = 0
+
+        # A igualdad de prefijo y longitud gana la regla de rango más estrecho
+        # y, después, la de menor id
+        def prioridad(regla: PrefijoRegla):
+            if regla.longitud_minima and regla.longitud_maxima:
+                ancho = regla.longitud_maxima - regla.longitud_minima
+            else:
+                ancho = float("inf")
+            return (ancho, regla.prefijo_id)
+
+        for regla in sorted(reglas, key=prioridad):
+            self._insertar(regla)
+
+    def _insertar(self, regla: PrefijoRegla) -> None:
+        digitos = limpiar_numero(regla.prefijo)
+        if not digitos:
+            logger.warning(f"Prefijo {regla.prefijo_id} sin dígitos ignorado: {regla.prefijo!r}")
+            return
+
+        nodo = self._raiz
+        for digito in digitos:
+            nodo = nodo.hijos.setdefault(digito, _Nodo())
+
+        minima, maxima = regla.longitud_minima, regla.longitud_maxima
+        if minima and maxima and 0 <= maxima - minima <= MAX_RANGO_INDEXADO:
+            for longitud in range(minima, maxima + 1):
+                nodo.por_longitud.setdefault(longitud, regla)
+        else:
+            nodo.abiertas.append(regla)
+        self.total_reglas += 1
+
+    def buscar(self, numero) -> Optional[PrefijoRegla]:
+        """Devuelve la regla del prefijo más largo que admite el número, o None"""
+        digitos = limpiar_numero(numero)
+        longitud = len(digitos)
+        mejor = None
+
+        nodo = self._raiz
+        for digito in digitos:
+            nodo = nodo.hijos.get(digito)
+            if nodo is None:
+                break
+
+            regla = nodo.por_longitud.get(longitud)
+            if regla is None:
+                for abierta in nodo.abiertas:
+                    if abierta.admite_longitud(longitud):
+                        regla = abierta
+                        break
+            if regla is not None:
+                mejor = regla
+
+        return mejor
+
+
+def cargar_reglas(db) -> List[PrefijoRegla]:
+    """Lee la tabla `prefijos` junto con el nombre y descripción de cada zona"""
+    rows = db.execute(text("""
+        SELECT p.id, p.zona_id, p.prefijo, p.longitud_minima, p.longitud_maxima,
+               z.nombre, z.descripcion
+        FROM prefijos p
+        LEFT JOIN zonas z ON p.zona_id = z.id
+    """)).fetchall()
+    return [PrefijoRegla(*row) for row in rows]
@@ -0,0 +1,122 @@
+# tarificador/recargas.py
+"""
+Recarga masiva de saldo.
+
+El archivo (CSV o XLSX) se lee como stream, cada línea se valida y las
+válidas se cargan con COPY a una tabla temporal. Luego una sola sentencia
+suma los montos por anexo con INSERT ... ON CONFLICT (calling_number) DO
+UPDATE y escribe la auditoría a partir de su RETURNING; las filas de
+recargas se insertan en bloque desde la misma tabla temporal.
+
+Así el costo no crece con idas y vueltas por fila: son unas pocas
+sentencias sin importar el tamaño del archivo.
+"""
+import logging
+from decimal import Decimal, InvalidOperation
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from .archivos import leer_en_hilo, leer_filas
+
+logger = logging.getLogger(__name__)
+
+# saldo_anexos.saldo y recargas.monto son NUMERIC(10,2)
+MONTO_MAXIMO = Decimal("99999999.99")
+
+
+def leer_archivo_recargas(archivo, nombre: str) -> Iterator[Tuple[int, Any, Any]]:
+    """(línea, anexo, monto) de cada fila del archivo, sin el encabezado"""
+    filas = leer_filas(archivo, nombre)
+    next(filas, None)  # encabezados
+    for linea, fila in filas:
+        yield linea, fila[0] if fila else None, fila[1] if len(fila) > 1 else None
+
+
+def validar_fila(linea: int, anexo: Any, monto: Any) -> Tuple[Optional[Tuple[int, str, Decimal]], Optional[str]]:
+    """((línea, anexo, monto), None) si la fila es válida, o (None, mensaje de error)"""
+    if isinstance(anexo, float) and anexo.is_integer():
+        # Excel guarda los anexos numéricos como float
+        anexo = int(anexo)
+    calling_number = str(anexo).strip() if anexo is not None else ""
+    if not calling_number:
+        return None, f"Línea {linea}: falta el número de anexo."
+
+    texto = str(monto).strip().replace(",", ".") if monto is not None else ""
+    try:
+        valor = Decimal(texto)
+    except InvalidOperation:
+        return None, f"Línea {linea}, anexo {calling_number}: '{monto}' no es un monto válido."
+    if not valor.is_finite() or valor <= 0:
+        return None, f"Línea {linea}, anexo {calling_number}: el monto debe ser un número positivo ({monto})."
+    if valor != valor.quantize(Decimal("0.01")):
+        return None, f"Línea {linea}, anexo {calling_number}: el monto admite como máximo 2 decimales ({monto})."
+    if valor > MONTO_MAXIMO:
+        return None, f"Línea {linea}, anexo {calling_number}: el monto excede el máximo permitido ({monto})."
+    return (linea, calling_number, valor), None
+
+
+def filas_validas(filas: Iterable[Tuple[int, Any, Any]], errores: List[str]) -> Iterator[Tuple[int, str, Decimal]]:
+    """Filas válidas para el COPY; los errores de validación se agregan a `errores`"""
+    for linea, anexo, monto in filas:
+        registro, error = validar_fila(linea, anexo, monto)
+        if error:
+            errores.append(error)
+        else:
+            yield registro
+
+
+async def aplicar_recargas(db, registros: Iterable[Tuple[int, str, Decimal]]) -> List[Tuple[str, Decimal, Decimal]]:
+    """
+    Carga los registros con COPY y aplica las recargas. No hace commit.
+
+    `db` es una AsyncSession sobre asyncpg. `registros` puede leer y validar
+    el archivo de forma bloqueante: se recorre en un hilo. Devuelve por anexo
+    (calling_number, saldo_anterior, saldo_nuevo).
+    """
+    await db.execute(text("""
+        CREATE TEMP TABLE recarga_masiva_tmp (
+            linea INTEGER NOT NULL,
+            calling_number VARCHAR NOT NULL,
+            monto NUMERIC(10, 2) NOT NULL
+        ) ON COMMIT DROP
+    """))
+
+    # COPY por la conexión asyncpg de la misma transacción
+    conexion = await db.connection()
+    crudo = await conexion.get_raw_connection()
+    await crudo.driver_connection.copy_records_to_table(
+        "recarga_masiva_tmp",
+        records=leer_en_hilo(registros),
+        columns=["linea", "calling_number", "monto"],
+    )
+
+    # Un anexo repetido en el archivo suma sus montos en una sola fila;
+    # el orden fijo evita interbloqueos con recargas concurrentes
+    resultado = await db.execute(text("""
+        WITH totales AS (
+            SELECT calling_number, SUM(monto) AS monto
+            FROM recarga_masiva_tmp
+            GROUP BY calling_number
+        ),
+        aplicadas AS (
+            INSERT INTO saldo_anexos (calling_number, saldo, fecha_ultima_recarga)
+            SELECT calling_number, monto, CURRENT_TIMESTAMP FROM totales ORDER BY calling_number
+            ON CONFLICT (calling_number) DO UPDATE
+                SET saldo = saldo_anexos.saldo + EXCLUDED.saldo,
+                    fecha_ultima_recarga = CURRENT_TIMESTAMP
+            RETURNING calling_number, saldo
+        )
+        INSERT INTO saldo_auditoria (calling_number, saldo_anterior, saldo_nuevo, tipo_accion)
+        SELECT a.calling_number, a.saldo - t.monto, a.saldo, 'recarga_masiva'
+        FROM aplicadas a
+        JOIN totales t ON t.calling_number = a.calling_number
+        RETURNING calling_number, saldo_anterior, saldo_nuevo
+    """))
+    aplicadas = [tuple(fila) for fila in resultado.fetchall()]
+
+    await db.execute(text("""
+        INSERT INTO recargas (calling_number, monto)
+        SELECT calling_number, monto FROM recarga_masiva_tmp ORDER BY linea
+    """))
+    return aplicadas
@@ -0,0 +1,126 @@
+# tarificador/regeneracion_pines.py
+"""
+Regeneración de PINs de todos los anexos activos como trabajo en segundo plano.
+
+Los PINs nuevos se hashean en el pool de procesos de HasheadorPines y se
+guardan en una sola transacción con UPDATE ... FROM (VALUES ...) por
+bloques. El CSV con los PINs en claro queda en memoria hasta que se
+descarga una vez (o vence el registro); después se descarta.
+
+Con `solo_pendientes` se limita a los anexos con pin_pendiente (cargas
+masivas cuyo hash de PINs no llegó a terminar).
+"""
+import csv
+import io
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from .pines import HasheadorPines, generar_pin
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TrabajoPines:
+    id: str
+    # hasheando | guardando | terminado | error
+    etapa: str = "hasheando"
+    total: int = 0
+    hechos: int = 0
+    error: Optional[str] = None
+    creado: float = field(default_factory=time.time)
+    terminado: Optional[float] = None
+    descargado: bool = False
+    # CSV de PINs en claro; se borra al descargarlo
+    csv: Optional[bytes] = field(default=None, repr=False)
+    nombre_csv: Optional[str] = None
+
+    def como_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "etapa": self.etapa,
+            "total": self.total,
+            "hechos": self.hechos,
+            "progreso": round(100 * self.hechos / self.total, 1) if self.total else (100.0 if self.etapa == "terminado" else 0.0),
+            "error": self.error,
+            "descargado": self.descargado,
+        }
+
+    def retirar_csv(self) -> Optional[Tuple[bytes, str]]:
+        """(contenido, nombre) la primera vez; None si ya se descargó o no está listo"""
+        if self.etapa != "terminado" or self.csv is None:
+            return None
+        contenido, self.csv = self.csv, None
+        self.descargado = True
+        return contenido, self.nombre_csv
+
+
+def _actualizar_pines(db, pares: List[Tuple[int, str]]) -> None:
+    valores = ", ".join(f"(:id{i}, :pin{i})" for i in range(len(pares)))
+    params = {}
+    for i, (anexo_id, hashed_pin) in enumerate(pares):
+        params[f"id{i}"] = anexo_id
+        params[f"pin{i}"] = hashed_pin
+    db.execute(
+        text(f"""
+            UPDATE anexos SET pin = v.pin, pin_pendiente = FALSE
+            FROM (VALUES {valores}) AS v(id, pin)
+            WHERE anexos.id = CAST(v.id AS integer)
+        """),
+        params
+    )
+
+
+def regenerar_pines(
+    session_factory: Callable,
+    hasheador: HasheadorPines,
+    trabajo: TrabajoPines,
+    longitud: int,
+    lote: int = 1000,
+    solo_pendientes: bool = False,
+) -> None:
+    """
+    Genera, hashea y guarda PINs nuevos para todos los anexos activos, o
+    solo para los que tienen pin_pendiente (bloqueante; pensado para un
+    hilo). Todo o nada: si falla, no cambia ningún PIN.
+    """
+    condicion = "pin_pendiente" if solo_pendientes else "activo = TRUE"
+    db = session_factory()
+    try:
+        anexos = db.execute(text(f"SELECT id, numero FROM anexos WHERE {condicion} ORDER BY numero")).fetchall()
+        db.rollback()
+        trabajo.total = len(anexos)
+        pines = [generar_pin(longitud) for _ in anexos]
+
+        hashes: List[str] = []
+        for bloque in hasheador.hashear(pines, lote):
+            hashes.extend(bloque)
+            trabajo.hechos = len(hashes)
+
+        trabajo.etapa = "guardando"
+        pares = [(anexo[0], hashed_pin) for anexo, hashed_pin in zip(anexos, hashes)]
+        for inicio in range(0, len(pares), lote):
+            _actualizar_pines(db, pares[inicio:inicio + lote])
+        db.commit()
+
+        contenido = io.StringIO()
+        writer = csv.writer(contenido)
+        writer.writerow(["Número de Anexo", "PIN"])
+        writer.writerows((anexo[1], pin) for anexo, pin in zip(anexos, pines))
+        trabajo.csv = contenido.getvalue().encode()
+        trabajo.nombre_csv = f"pines_anexos_{datetime.now().strftime('%Y%m%d%H%M%S')}.csv"
+        trabajo.etapa = "terminado"
+        logger.info(f"PINs regenerados para {len(anexos)} anexos (trabajo {trabajo.id})")
+    except Exception as e:
+        db.rollback()
+        trabajo.etapa = "error"
+        trabajo.error = f"Error generando PINs: {str(e)}"
+        logger.error(trabajo.error)
+    finally:
+        trabajo.terminado = time.time()
+        db.close()
@@ -0,0 +1,325 @@
+# tarificador/reservas.py
+"""
+Reservas de saldo (retenciones de crédito prepago) para llamadas salientes.
+
+El saldo solo se debita en BD cuando llega el CDR. Mientras la llamada está
+en curso, el libro de reservas retiene en memoria el crédito que puede
+consumir, en tramos de `segundos_tramo` segundos que se renuevan a medida
+que la llamada avanza. Así, varias llamadas simultáneas del mismo anexo ven
+el saldo ya comprometido por las demás y no pueden gastar más de lo que hay.
+
+Cada anexo tiene su propio lock; las consultas no tocan la BD. Al llegar el
+CDR la reserva se liquida: se libera la retención y se aplica el costo real
+al saldo en memoria. `cargar()` reconstruye el libro desde `saldo_anexos` y
+las llamadas abiertas del registro de llamadas activas.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Reserva:
+    call_id: str
+    calling_number: str
+    called_number: Optional[str]
+    tarifa_segundo: float
+    # Crédito retenido y segundos de llamada que cubre
+    monto: float = 0.0
+    segundos: int = 0
+    answer_time: Optional[datetime] = None
+    # Momento (time.monotonic) en que terminó la llamada, si ya terminó
+    finalizada: Optional[float] = None
+    # Ya se avisó que el crédito se agotó (se vuelve a avisar si después se amplía y se agota otra vez)
+    agotada_notificada: bool = False
+    creada: datetime = field(default_factory=datetime.now)
+
+
+class _Cuenta:
+    __slots__ = ("saldo", "reservas", "lock")
+
+    def __init__(self, saldo: float):
+        self.saldo = saldo
+        self.reservas: Dict[str, Reserva] = {}
+        self.lock = threading.Lock()
+
+    def retenido(self) -> float:
+        return sum(reserva.monto for reserva in self.reservas.values())
+
+
+class ReservationLedger:
+    """Libro de reservas en memoria indexado por anexo"""
+
+    def __init__(self, segundos_tramo: int = 60, margen_renovacion: int = 10):
+        self.segundos_tramo = segundos_tramo
+        # Se renueva cuando quedan menos de estos segundos cubiertos
+        self.margen_renovacion = margen_renovacion
+        self._cuentas: Dict[str, _Cuenta] = {}
+        # call_id -> anexo, para ubicar la cuenta de una reserva
+        self._por_llamada: Dict[str, str] = {}
+
+    # --- Saldos ---------------------------------------------------------
+
+    def _cuenta(self, calling_number: str) -> Optional[_Cuenta]:
+        return self._cuentas.get(calling_number)
+
+    def actualizar_saldo(self, calling_number: str, saldo: float) -> None:
+        """Fija el saldo en BD de un anexo (tras una recarga o una relectura)"""
+        cuenta = self._cuentas.get(calling_number)
+        if cuenta is None:
+            # setdefault es atómico: si otro hilo la creó primero se usa esa
+            cuenta = self._cuentas.setdefault(calling_number, _Cuenta(saldo))
+        with cuenta.lock:
+            cuenta.saldo = saldo
+
+    def refrescar_saldos(self, db, numeros: Optional[Iterable[str]] = None) -> int:
+        """Relee saldo_anexos (todos o solo los anexos indicados)"""
+        if numeros is None:
+            rows = db.execute(text("SELECT calling_number, saldo FROM saldo_anexos")).fetchall()
+        else:
+            rows = db.execute(
+                text("SELECT calling_number, saldo FROM saldo_anexos WHERE calling_number = ANY(:numeros)"),
+                {"numeros": list(numeros)},
+            ).fetchall()
+        for calling_number, saldo in rows:
+            self.actualizar_saldo(calling_number, float(saldo or 0))
+        return len(rows)
+
+    def acreditar(self, calling_number: str, monto: float) -> None:
+        """Suma una recarga ya confirmada en BD al saldo en memoria"""
+        cuenta = self._cuentas.get(calling_number)
+        if cuenta is None:
+            cuenta = self._cuentas.setdefault(calling_number, _Cuenta(0.0))
+        with cuenta.lock:
+            cuenta.saldo += monto
+
+    def tiene_cuenta(self, calling_number: str) -> bool:
+        return calling_number in self._cuentas
+
+    def consultar(self, calling_number: str, tarifa_segundo: float = 0.0) -> Optional[Dict]:
+        """Saldo, retenido y disponible de un anexo; None si no tiene cuenta"""
+        cuenta = self._cuenta(calling_number)
+        if cuenta is None:
+            return None
+        with cuenta.lock:
+            saldo = cuenta.saldo
+            retenido = cuenta.retenido()
+            llamadas = len(cuenta.reservas)
+        disponible = saldo - retenido
+        return {
+            "saldo": saldo,
+            "retenido": round(retenido, 4),
+            "disponible": round(disponible, 4),
+            "llamadas_con_reserva": llamadas,
+            "segundos_disponibles": int(disponible / tarifa_segundo) if tarifa_segundo > 0 else 999999,
+        }
+
+    # --- Reservas -------------------------------------------------------
+
+    def _ampliar(self, cuenta: _Cuenta, reserva: Reserva, segundos: int) -> int:
+        """Retiene hasta `segundos` más para la reserva; devuelve los obtenidos (con lock tomado)"""
+        if reserva.tarifa_segundo <= 0:
+            reserva.segundos += segundos
+            return segundos
+        disponible = cuenta.saldo - cuenta.retenido()
+        obtenidos = max(0, min(segundos, int(disponible / reserva.tarifa_segundo)))
+        reserva.segundos += obtenidos
+        reserva.monto += obtenidos * reserva.tarifa_segundo
+        return obtenidos
+
+    def reservar(
+        self,
+        call_id: str,
+        calling_number: str,
+        tarifa_segundo: float,
+        called_number: Optional[str] = None,
+        answer_time: Optional[datetime] = None,
+        segundos: Optional[int] = None,
+    ) -> Optional[Reserva]:
+        """
+        Abre la reserva de una llamada con un primer tramo.
+
+        Devuelve None si el anexo no tiene cuenta o no alcanza ni para un
+        segundo; si la llamada ya tenía reserva la devuelve sin cambios.
+        """
+        cuenta = self._cuenta(calling_number)
+        if cuenta is None:
+            return None
+        with cuenta.lock:
+            existente = cuenta.reservas.get(call_id)
+            if existente is not None:
+                return existente
+            reserva = Reserva(call_id, calling_number, called_number, float(tarifa_segundo or 0.0),
+                              answer_time=answer_time)
+            if self._ampliar(cuenta, reserva, segundos or self.segundos_tramo) == 0:
+                return None
+            cuenta.reservas[call_id] = reserva
+        self._por_llamada[call_id] = calling_number
+        return reserva
+
+    def contestada(self, call_id: str, answer_time: datetime) -> None:
+        """Registra el instante de respuesta: desde ahí corre el consumo"""
+        calling_number = self._por_llamada.get(call_id)
+        cuenta = self._cuenta(calling_number) if calling_number else None
+        if cuenta is None:
+            return
+        with cuenta.lock:
+            reserva = cuenta.reservas.get(call_id)
+            if reserva is not None and reserva.answer_time is None:
+                reserva.answer_time = answer_time
+
+    def renovar(self, ahora: Optional[datetime] = None) -> List[Reserva]:
+        """
+        Agrega un tramo a las llamadas contestadas que están por consumir su
+        retención. Devuelve las reservas que ya no pudieron ampliarse y cuyo
+        tiempo cubierto se agotó (saldo insuficiente para seguir), una sola
+        vez por agotamiento.
+        """
+        ahora = ahora or datetime.now()
+        agotadas = []
+        for cuenta in list(self._cuentas.values()):
+            if not cuenta.reservas:
+                continue
+            with cuenta.lock:
+                for reserva in cuenta.reservas.values():
+                    if reserva.finalizada is not None or reserva.answer_time is None:
+                        continue
+                    transcurridos = int((ahora - reserva.answer_time).total_seconds())
+                    if reserva.segundos - transcurridos > self.margen_renovacion:
+                        continue
+                    if self._ampliar(cuenta, reserva, self.segundos_tramo) > 0:
+                        reserva.agotada_notificada = False
+                    elif transcurridos >= reserva.segundos and not reserva.agotada_notificada:
+                        reserva.agotada_notificada = True
+                        agotadas.append(reserva)
+        return agotadas
+
+    def finalizar(self, call_id: str, ahora: Optional[datetime] = None) -> None:
+        """
+        La llamada terminó pero el CDR aún no llegó: la retención se reduce
+        a lo realmente consumido y queda a la espera de la liquidación.
+        """
+        calling_number = self._por_llamada.get(call_id)
+        cuenta = self._cuenta(calling_number) if calling_number else None
+        if cuenta is None:
+            return
+        ahora = ahora or datetime.now()
+        with cuenta.lock:
+            reserva = cuenta.reservas.get(call_id)
+            if reserva is None or reserva.finalizada is not None:
+                return
+            consumidos = int((ahora - reserva.answer_time).total_seconds()) if reserva.answer_time else 0
+            # Redondeo hacia arriba: el CDR puede diferir en un segundo
+            reserva.segundos = min(reserva.segundos, max(0, consumidos + 1))
+            reserva.monto = reserva.segundos * reserva.tarifa_segundo
+            reserva.finalizada = time.monotonic()
+
+    def liquidar(self, calling_number: str, costo: float, call_id: Optional[str] = None,
+                 called_number: Optional[str] = None) -> Optional[Reserva]:
+        """
+        Liquida la reserva contra el CDR ya guardado: libera la retención y
+        descuenta el costo del saldo en memoria (el débito en BD ya se hizo).
+        Sin call_id se toma la reserva más antigua del anexo hacia ese destino.
+        """
+        cuenta = self._cuenta(calling_number)
+        if cuenta is None:
+            return None
+        with cuenta.lock:
+            reserva = None
+            if call_id:
+                reserva = cuenta.reservas.pop(call_id, None)
+            if reserva is None and cuenta.reservas:
+                candidatas = sorted(
+                    (r for r in cuenta.reservas.values() if called_number is None or r.called_number == called_number),
+                    key=lambda r: (r.finalizada is None, r.creada),
+                )
+                if candidatas:
+                    reserva = cuenta.reservas.pop(candidatas[0].call_id)
+            cuenta.saldo -= costo
+        if reserva is not None:
+            self._por_llamada.pop(reserva.call_id, None)
+        return reserva
+
+    def liberar(self, call_id: str) -> Optional[Reserva]:
+        """Descarta una reserva sin cobrar nada (llamada sin CDR)"""
+        calling_number = self._por_llamada.pop(call_id, None)
+        cuenta = self._cuenta(calling_number) if calling_number else None
+        if cuenta is None:
+            return None
+        with cuenta.lock:
+            return cuenta.reservas.pop(call_id, None)
+
+    def liberar_vencidas(self, espera_cdr: float) -> int:
+        """Libera reservas de llamadas terminadas cuyo CDR no llegó en `espera_cdr` segundos"""
+        limite = time.monotonic() - espera_cdr
+        vencidas = []
+        for cuenta in list(self._cuentas.values()):
+            with cuenta.lock:
+                vencidas.extend(
+                    r.call_id for r in cuenta.reservas.values()
+                    if r.finalizada is not None and r.finalizada < limite
+                )
+        for call_id in vencidas:
+            self.liberar(call_id)
+        if vencidas:
+            logger.warning(f"Liberadas {len(vencidas)} reservas sin CDR tras {espera_cdr:.0f}s")
+        return len(vencidas)
+
+    # --- Reconstrucción y estadísticas ---------------------------------
+
+    def cargar(self, db, llamadas: Iterable[Dict] = ()) -> int:
+        """
+        Reconstruye el libro: saldos desde saldo_anexos y una reserva por cada
+        llamada saliente abierta (lo ya consumido más un tramo).
+        """
+        self._cuentas = {}
+        self._por_llamada = {}
+        self.refrescar_saldos(db)
+
+        ahora = datetime.now()
+        reservas = 0
+        for fila in llamadas:
+            if fila.get("direction") != "outbound" or fila.get("tarifa_segundo") is None:
+                continue
+            answer_time = fila.get("answer_time")
+            consumidos = int((ahora - answer_time).total_seconds()) if answer_time else 0
+            if self.reservar(
+                fila["call_id"], fila.get("calling_number"), float(fila["tarifa_segundo"]),
+                called_number=fila.get("called_number"), answer_time=answer_time,
+                segundos=consumidos + self.segundos_tramo,
+            ):
+                reservas += 1
+
+        logger.info(f"Libro de reservas cargado: {len(self._cuentas)} anexos, {reservas} reservas abiertas")
+        return reservas
+
+    def stats(self) -> Dict:
+        reservas = []
+        for cuenta in list(self._cuentas.values()):
+            with cuenta.lock:
+                reservas.extend(
+                    {
+                        "call_id": r.call_id,
+                        "calling_number": r.calling_number,
+                        "called_number": r.called_number,
+                        "tarifa_segundo": r.tarifa_segundo,
+                        "monto": round(r.monto, 4),
+                        "segundos": r.segundos,
+                        "answer_time": r.answer_time.isoformat() if r.answer_time else None,
+                        "finalizada": r.finalizada is not None,
+                    }
+                    for r in cuenta.reservas.values()
+                )
+        return {
+            "cuentas": len(self._cuentas),
+            "reservas": len(reservas),
+            "retenido_total": round(sum(r["monto"] for r in reservas), 4),
+            "detalle": reservas,
+        }
@@ -0,0 +1,755 @@
+# tarificador/sincronizacion_fac.py
+"""
+Sincronización de códigos FAC entre CUCM (AXL) y la tabla fac_codes.
+
+Un único motor para todas las variantes (CUCM como autoridad, importación,
+envío de los códigos locales a CUCM):
+
+1. Lectura paginada de listFacInfo con skip/first. Las páginas no son una
+   foto consistente: un alta o baja en CUCM durante la lectura corre las
+   páginas y un código puede no aparecer. Por eso, antes de borrar o
+   desactivar códigos locales, CUCM se vuelve a leer hasta que dos pasadas
+   seguidas coinciden; si no coinciden, las bajas se omiten en esa corrida.
+2. Diferencia en memoria contra una sola lectura de fac_codes.
+3. Cambios locales en una transacción: un upsert por conjunto, borrados o
+   desactivaciones con ANY(...) y toda la auditoría en un solo INSERT.
+4. Escrituras hacia CUCM (addFacInfo/updateFacInfo) en un pool de hilos
+   acotado, con ritmo opcional de escrituras por minuto y reintentos con
+   espera creciente cuando CUCM responde que está limitando AXL.
+
+La sincronización incremental (sincronizar_incremental) solo mueve lo que
+cambió: del lado local, el diario son las filas con cucm_synced falso o
+updated_at posterior a la última sincronización; del lado de CUCM, la huella
+de cada página de listFacInfo. Si ninguna página cambió y el diario está
+vacío, no se lee fac_codes completa ni se escribe nada (ni auditoría).
+"""
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# CUCM es la fuente de verdad; lo que falta en CUCM se borra localmente
+MODO_CUCM_AUTORIDAD = "cucm_autoridad"
+# CUCM -> BD; lo que falta en CUCM se desactiva localmente
+MODO_DESDE_CUCM = "desde_cucm"
+# CUCM -> BD; solo altas y cambios
+MODO_IMPORTAR = "importar"
+# BD -> CUCM; los códigos activos locales se crean o actualizan en CUCM
+MODO_HACIA_CUCM = "hacia_cucm"
+
+MODOS = (MODO_CUCM_AUTORIDAD, MODO_DESDE_CUCM, MODO_IMPORTAR, MODO_HACIA_CUCM)
+
+# Acciones de auditoría por modo (las mismas que registraban las funciones anteriores)
+ACCIONES = {
+    MODO_CUCM_AUTORIDAD: {
+        "crear": "sync_create_from_cucm", "actualizar": "sync_update_from_cucm",
+        "eliminar": "sync_delete_not_in_cucm", "resumen": ("SYNC_SUMMARY", "sync_complete"),
+    },
+    MODO_DESDE_CUCM: {
+        "crear": "sync_create_from_cucm", "actualizar": "sync_update_from_cucm",
+        "desactivar": "sync_deactivate", "resumen": ("SYNC_SUMMARY", "sync_complete"),
+    },
+    MODO_IMPORTAR: {
+        "crear": "import_create", "actualizar": "import_update", "resumen": ("SUMMARY", "import_complete"),
+    },
+    MODO_HACIA_CUCM: {
+        "crear": "sync_create", "actualizar": "sync_update", "error": "sync",
+        "huerfano": "sync_detect", "resumen": ("SUMMARY", "sync_complete"),
+    },
+}
+
+# Textos con los que CUCM avisa que está limitando las peticiones AXL
+_MARCAS_LIMITE_AXL = ("throttl", "maximum axl", "axl service is busy", "too many requests")
+
+
+class FacCucm(NamedTuple):
+    codigo: str
+    nombre: str
+    nivel: int
+    uuid: Optional[str]
+
+    def como_dict(self) -> Dict:
+        return {"uuid": self.uuid, "name": self.nombre, "code": self.codigo, "level": self.nivel, "source": "cucm"}
+
+
+class FacLocal(NamedTuple):
+    id: int
+    codigo: str
+    nombre: str
+    nivel: int
+    activo: bool
+    sincronizado: bool
+    actualizado: Optional[datetime] = None
+
+
+@dataclass
+class PlanSincronizacion:
+    crear_local: List[FacCucm] = field(default_factory=list)
+    actualizar_local: List[FacCucm] = field(default_factory=list)
+    marcar_sincronizado: List[str] = field(default_factory=list)
+    eliminar_local: List[str] = field(default_factory=list)
+    desactivar_local: List[str] = field(default_factory=list)
+    crear_cucm: List[FacLocal] = field(default_factory=list)
+    # (local, cucm): el update en AXL se identifica por el nombre actual en CUCM
+    actualizar_cucm: List[Tuple[FacLocal, FacCucm]] = field(default_factory=list)
+    huerfanos: List[str] = field(default_factory=list)
+    # Pendientes del diario que no requieren escritura en CUCM (ya coinciden o están inactivos)
+    confirmar: List[FacLocal] = field(default_factory=list)
+    sin_cambios: int = 0
+
+
+def _nivel(valor: Any) -> int:
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _campo(objeto: Any, nombre: str) -> Any:
+    if isinstance(objeto, dict):
+        return objeto.get(nombre)
+    return getattr(objeto, nombre, None)
+
+
+def fac_de_respuesta(respuesta: Any) -> List[FacCucm]:
+    """FACs de una respuesta de listFacInfo (lista vacía si no trae ninguno)"""
+    retorno = _campo(respuesta, "return") if respuesta is not None else None
+    fac_info = _campo(retorno, "facInfo") if retorno is not None else None
+    if not fac_info:
+        return []
+    if not isinstance(fac_info, list):
+        fac_info = [fac_info]
+    facs = []
+    for fac in fac_info:
+        codigo = _campo(fac, "code")
+        if not codigo:
+            continue
+        facs.append(FacCucm(
+            codigo=str(codigo),
+            nombre=_campo(fac, "name") or "",
+            nivel=_nivel(_campo(fac, "authorizationLevel")),
+            uuid=_campo(fac, "uuid"),
+        ))
+    return facs
+
+
+def huella_pagina(facs: List[FacCucm]) -> str:
+    """Huella de una página de listFacInfo (código, nombre y nivel, en el orden recibido)"""
+    contenido = "\n".join(f"{fac.codigo}\t{fac.nombre}\t{fac.nivel}" for fac in facs)
+    return hashlib.sha1(contenido.encode()).hexdigest()
+
+
+def calcular_plan(cucm: Dict[str, FacCucm], local: Dict[str, FacLocal], modo: str) -> PlanSincronizacion:
+    """Diferencia entre CUCM y fac_codes según el modo, sin tocar ninguno de los dos"""
+    plan = PlanSincronizacion()
+
+    if modo == MODO_HACIA_CUCM:
+        for codigo, fac in local.items():
+            if not fac.activo:
+                continue
+            remoto = cucm.get(codigo)
+            if remoto is None:
+                plan.crear_cucm.append(fac)
+            elif remoto.nombre != fac.nombre or remoto.nivel != fac.nivel:
+                plan.actualizar_cucm.append((fac, remoto))
+            else:
+                plan.sin_cambios += 1
+                if not fac.sincronizado:
+                    plan.marcar_sincronizado.append(codigo)
+        plan.huerfanos = [codigo for codigo in cucm if codigo not in local]
+        return plan
+
+    for codigo, remoto in cucm.items():
+        fac = local.get(codigo)
+        if fac is None:
+            plan.crear_local.append(remoto)
+        elif (fac.nombre != remoto.nombre or fac.nivel != remoto.nivel
+              or (not fac.activo and modo != MODO_IMPORTAR)):
+            plan.actualizar_local.append(remoto)
+        else:
+            plan.sin_cambios += 1
+            if not fac.sincronizado:
+                plan.marcar_sincronizado.append(codigo)
+
+    faltantes = [codigo for codigo in local if codigo not in cucm]
+    if modo == MODO_CUCM_AUTORIDAD:
+        plan.eliminar_local = faltantes
+    elif modo == MODO_DESDE_CUCM:
+        plan.desactivar_local = [codigo for codigo in faltantes if local[codigo].activo]
+    return plan
+
+
+def calcular_plan_incremental(
+    cucm: Dict[str, FacCucm],
+    local: Dict[str, FacLocal],
+    pendientes: Dict[str, FacLocal],
+    cambio_remoto: bool,
+) -> PlanSincronizacion:
+    """
+    Plan de la sincronización incremental. Los pendientes del diario local
+    ganan: los activos se crean o actualizan en CUCM y los inactivos solo se
+    confirman (desactivar no toca CUCM). Si cambió alguna página de CUCM, el
+    resto de los códigos se trae como en MODO_DESDE_CUCM. `local` solo se
+    usa si `cambio_remoto`.
+    """
+    plan = PlanSincronizacion()
+    for codigo, fac in pendientes.items():
+        remoto = cucm.get(codigo)
+        if not fac.activo:
+            plan.confirmar.append(fac)
+        elif remoto is None:
+            plan.crear_cucm.append(fac)
+        elif remoto.nombre != fac.nombre or remoto.nivel != fac.nivel:
+            plan.actualizar_cucm.append((fac, remoto))
+        else:
+            plan.confirmar.append(fac)
+
+    if cambio_remoto:
+        for codigo, remoto in cucm.items():
+            if codigo in pendientes:
+                continue
+            fac = local.get(codigo)
+            if fac is None:
+                plan.crear_local.append(remoto)
+            elif fac.nombre != remoto.nombre or fac.nivel != remoto.nivel:
+                plan.actualizar_local.append(remoto)
+            else:
+                plan.sin_cambios += 1
+        plan.desactivar_local = [
+            codigo for codigo, fac in local.items()
+            if fac.activo and codigo not in cucm and codigo not in pendientes
+        ]
+    return plan
+
+
+class _Ritmo:
+    """Espaciado mínimo entre escrituras AXL compartido por todos los hilos"""
+
+    def __init__(self, por_minuto: int):
+        self.intervalo = 60.0 / por_minuto if por_minuto else 0.0
+        self._siguiente = 0.0
+        self._lock = threading.Lock()
+
+    def esperar(self) -> None:
+        if not self.intervalo:
+            return
+        with self._lock:
+            ahora = time.monotonic()
+            turno = max(ahora, self._siguiente)
+            self._siguiente = turno + self.intervalo
+        if turno > ahora:
+            time.sleep(turno - ahora)
+
+
+def es_limite_axl(error: Exception) -> bool:
+    """True si el error es CUCM limitando AXL (HTTP 429/503 o fault de throttling)"""
+    if getattr(error, "status_code", None) in (429, 503):
+        return True
+    mensaje = str(error).lower()
+    return any(marca in mensaje for marca in _MARCAS_LIMITE_AXL)
+
+
+class SincronizadorFac:
+    """
+    Motor de sincronización FAC. `servicio()` devuelve el ServiceProxy AXL
+    (p.ej. get_cucm_client) y `session_factory()` una sesión síncrona.
+    Una sola sincronización a la vez por instancia.
+    """
+
+    def __init__(
+        self,
+        servicio: Callable[[], Any],
+        session_factory: Callable,
+        pagina: int = 1000,
+        trabajadores: int = 4,
+        escrituras_por_minuto: int = 0,
+        reintentos: int = 5,
+        espera_base: float = 1.0,
+        relecturas: int = 2,
+    ):
+        self.servicio = servicio
+        self.session_factory = session_factory
+        self.pagina = pagina
+        self.trabajadores = trabajadores
+        self.escrituras_por_minuto = escrituras_por_minuto
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.relecturas = relecturas
+        self._en_curso = threading.Lock()
+        # Estado de la última sincronización: huellas de las páginas de CUCM ya incorporadas
+        # (None = desconocidas) y desde cuándo leer el diario local
+        self._huellas: Optional[List[str]] = None
+        self._marca: Optional[datetime] = None
+        self.ultima_incremental: Optional[Dict] = None
+
+    def preparar(self, db) -> None:
+        """Índices para leer el diario de cambios de fac_codes sin recorrer la tabla"""
+        db.execute(text("CREATE INDEX IF NOT EXISTS ix_fac_codes_updated_at ON fac_codes (updated_at)"))
+        db.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_fac_codes_sin_sincronizar
+            ON fac_codes (authorization_code) WHERE cucm_synced IS NOT TRUE
+        """))
+        db.commit()
+
+    # --- Lecturas ---
+
+    def _con_reintentos(self, llamada: Callable[[], Any]) -> Any:
+        for intento in range(self.reintentos + 1):
+            try:
+                return llamada()
+            except Exception as e:
+                if intento >= self.reintentos or not es_limite_axl(e):
+                    raise
+                espera = self.espera_base * (2 ** intento)
+                logger.warning(f"CUCM limitando AXL, reintento en {espera:.1f}s: {str(e)}")
+                time.sleep(espera)
+
+    def leer_cucm(self, servicio: Any = None, huellas: Optional[List[str]] = None) -> Dict[str, FacCucm]:
+        """
+        Todos los FAC de CUCM por código, de a `pagina` por listFacInfo. Si se
+        pasa `huellas`, se le agrega la huella de cada página.
+        """
+        servicio = servicio or self.servicio()
+        codigos: Dict[str, FacCucm] = {}
+        skip = 0
+        while True:
+            respuesta = self._con_reintentos(lambda: servicio.listFacInfo(
+                searchCriteria={"name": "%"},
+                returnedTags={"name": "", "code": "", "authorizationLevel": ""},
+                skip=skip,
+                first=self.pagina,
+            ))
+            facs = fac_de_respuesta(respuesta)
+            if huellas is not None:
+                huellas.append(huella_pagina(facs))
+            for fac in facs:
+                codigos[fac.codigo] = fac
+            if len(facs) < self.pagina:
+                return codigos
+            skip += self.pagina
+
+    def releer_estable(
+        self, servicio: Any, huellas: List[str]
+    ) -> Optional[Tuple[Dict[str, FacCucm], List[str]]]:
+        """
+        Vuelve a leer CUCM hasta `relecturas` veces y devuelve (códigos,
+        huellas) de la primera pasada igual a la anterior (empezando por
+        `huellas`). None si CUCM siguió cambiando en todas las pasadas.
+        """
+        anteriores = huellas
+        for _ in range(self.relecturas):
+            nuevas: List[str] = []
+            cucm = self.leer_cucm(servicio, nuevas)
+            if nuevas == anteriores:
+                return cucm, nuevas
+            anteriores = nuevas
+        return None
+
+    @staticmethod
+    def _facs_locales(filas) -> Dict[str, FacLocal]:
+        return {
+            fila[1]: FacLocal(fila[0], fila[1], fila[2] or "", fila[3] or 0, bool(fila[4]), bool(fila[5]), fila[6])
+            for fila in filas
+        }
+
+    def leer_local(self, db) -> Dict[str, FacLocal]:
+        return self._facs_locales(db.execute(text("""
+            SELECT id, authorization_code, authorization_code_name, authorization_level, active, cucm_synced, updated_at
+            FROM fac_codes
+        """)).fetchall())
+
+    def leer_pendientes(self, db, desde: Optional[datetime] = None) -> Dict[str, FacLocal]:
+        """Diario local: sin sincronizar, o modificados después de `desde`"""
+        condicion = "cucm_synced IS NOT TRUE" + (" OR updated_at > :desde" if desde else "")
+        return self._facs_locales(db.execute(
+            text(f"""
+                SELECT id, authorization_code, authorization_code_name, authorization_level, active, cucm_synced, updated_at
+                FROM fac_codes
+                WHERE {condicion}
+            """),
+            {"desde": desde}
+        ).fetchall())
+
+    # --- Escrituras hacia CUCM ---
+
+    def escribir_cucm(self, servicio: Any, plan: PlanSincronizacion) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+        """
+        addFacInfo/updateFacInfo del plan en el pool acotado. Devuelve
+        (hechos, errores) como listas de (código, "crear"|"actualizar" o mensaje).
+        """
+        ritmo = _Ritmo(self.escrituras_por_minuto)
+
+        def crear(fac: FacLocal):
+            ritmo.esperar()
+            self._con_reintentos(lambda: servicio.addFacInfo(facInfo={
+                "name": fac.nombre, "code": fac.codigo, "authorizationLevel": fac.nivel,
+            }))
+            return fac.codigo, "crear"
+
+        def actualizar(par: Tuple[FacLocal, FacCucm]):
+            fac, remoto = par
+            cambios = {"authorizationLevel": fac.nivel}
+            if fac.nombre != remoto.nombre:
+                cambios["newName"] = fac.nombre
+            ritmo.esperar()
+            self._con_reintentos(lambda: servicio.updateFacInfo(name=remoto.nombre, **cambios))
+            return fac.codigo, "actualizar"
+
+        tareas = [(crear, fac) for fac in plan.crear_cucm] + [(actualizar, par) for par in plan.actualizar_cucm]
+        hechos: List[Tuple[str, str]] = []
+        errores: List[Tuple[str, str]] = []
+        if not tareas:
+            return hechos, errores
+        with ThreadPoolExecutor(max_workers=self.trabajadores, thread_name_prefix="axl-fac") as pool:
+            futuros = [(pool.submit(funcion, item), item) for funcion, item in tareas]
+            for futuro, item in futuros:
+                codigo = item.codigo if isinstance(item, FacLocal) else item[0].codigo
+                try:
+                    hechos.append(futuro.result())
+                except Exception as e:
+                    errores.append((codigo, str(e)))
+        return hechos, errores
+
+    # --- Cambios locales ---
+
+    @staticmethod
+    def _upsert_local(db, facs: List[FacCucm], descripcion: str, ahora: datetime) -> None:
+        if not facs:
+            return
+        db.execute(
+            text("""
+                INSERT INTO fac_codes (authorization_code, authorization_code_name, authorization_level,
+                                       description, active, cucm_synced, created_at, updated_at)
+                SELECT d.codigo, d.nombre, d.nivel, :descripcion, TRUE, TRUE, :ahora, :ahora
+                FROM unnest(CAST(:codigos AS varchar[]), CAST(:nombres AS varchar[]), CAST(:niveles AS integer[]))
+                     AS d(codigo, nombre, nivel)
+                ON CONFLICT (authorization_code) DO UPDATE
+                    SET authorization_code_name = EXCLUDED.authorization_code_name,
+                        authorization_level = EXCLUDED.authorization_level,
+                        active = TRUE,
+                        cucm_synced = TRUE,
+                        updated_at = EXCLUDED.updated_at
+            """),
+            {
+                "codigos": [fac.codigo for fac in facs],
+                "nombres": [fac.nombre or f"FAC_{fac.codigo}" for fac in facs],
+                "niveles": [fac.nivel for fac in facs],
+                "descripcion": descripcion,
+                "ahora": ahora,
+            }
+        )
+
+    @staticmethod
+    def _auditar(db, registros: List[Tuple[str, str, str, bool]], usuario: str, ahora: datetime) -> None:
+        """Un INSERT para todos los (código, acción, detalle, éxito)"""
+        if not registros:
+            return
+        codigos, acciones, detalles, exitos = (list(columna) for columna in zip(*registros))
+        db.execute(
+            text("""
+                INSERT INTO fac_audit (authorization_code, action, admin_user, timestamp, details, success)
+                SELECT d.codigo, d.accion, :usuario, :ahora, d.detalle, d.exito
+                FROM unnest(CAST(:codigos AS varchar[]), CAST(:acciones AS varchar[]),
+                            CAST(:detalles AS varchar[]), CAST(:exitos AS boolean[]))
+                     AS d(codigo, accion, detalle, exito)
+            """),
+            {"codigos": codigos, "acciones": acciones, "detalles": detalles, "exitos": exitos,
+             "usuario": usuario, "ahora": ahora}
+        )
+
+    @staticmethod
+    def _confirmar(db, facs: List[FacLocal]) -> None:
+        """cucm_synced = TRUE salvo que la fila haya vuelto a cambiar desde que se leyó"""
+        if not facs:
+            return
+        db.execute(
+            text("""
+                UPDATE fac_codes SET cucm_synced = TRUE
+                FROM unnest(CAST(:codigos AS varchar[]), CAST(:fechas AS timestamp[])) AS d(codigo, actualizado)
+                WHERE fac_codes.authorization_code = d.codigo
+                  AND fac_codes.updated_at IS NOT DISTINCT FROM d.actualizado
+            """),
+            {"codigos": [fac.codigo for fac in facs], "fechas": [fac.actualizado for fac in facs]}
+        )
+
+    @staticmethod
+    def _registros_envio(hechos: List[Tuple[str, str]], errores: List[Tuple[str, str]]) -> List[Tuple[str, str, str, bool]]:
+        acciones = ACCIONES[MODO_HACIA_CUCM]
+        registros = [
+            (codigo, acciones[tipo], "Código creado en CUCM" if tipo == "crear" else "Código actualizado en CUCM", True)
+            for codigo, tipo in hechos
+        ]
+        registros += [(codigo, acciones["error"], f"Error de sincronización: {mensaje}", False)
+                      for codigo, mensaje in errores]
+        return registros
+
+    def aplicar_local(self, db, plan: PlanSincronizacion, modo: str) -> List[Tuple[str, str, str, bool]]:
+        """Aplica la parte local del plan (sin commit) y devuelve los registros de auditoría"""
+        acciones = ACCIONES[modo]
+        ahora = datetime.utcnow()
+        origen = "Importado" if modo == MODO_IMPORTAR else "Sincronizado"
+        self._upsert_local(
+            db, plan.crear_local + plan.actualizar_local,
+            f"{origen} desde CUCM el {ahora.strftime('%Y-%m-%d %H:%M')}", ahora,
+        )
+        if plan.marcar_sincronizado:
+            db.execute(
+                text("UPDATE fac_codes SET cucm_synced = TRUE WHERE authorization_code = ANY(CAST(:codigos AS varchar[]))"),
+                {"codigos": plan.marcar_sincronizado}
+            )
+        if plan.eliminar_local:
+            db.execute(
+                text("DELETE FROM fac_codes WHERE authorization_code = ANY(CAST(:codigos AS varchar[]))"),
+                {"codigos": plan.eliminar_local}
+            )
+        if plan.desactivar_local:
+            db.execute(
+                text("""
+                    UPDATE fac_codes
+                    SET active = FALSE, cucm_synced = FALSE, description = :descripcion, updated_at = :ahora
+                    WHERE authorization_code = ANY(CAST(:codigos AS varchar[]))
+                """),
+                {
+                    "codigos": plan.desactivar_local,
+                    "descripcion": f"DESACTIVADO - No encontrado en CUCM (Sync: {ahora.strftime('%Y-%m-%d %H:%M')})",
+                    "ahora": ahora,
+                }
+            )
+
+        registros = [
+            (fac.codigo, acciones["crear"], f"Creado desde CUCM: {fac.nombre} (Nivel: {fac.nivel})", True)
+            for fac in plan.crear_local
+        ]
+        registros += [
+            (fac.codigo, acciones["actualizar"], f"Actualizado desde CUCM: {fac.nombre} (Nivel: {fac.nivel})", True)
+            for fac in plan.actualizar_local
+        ]
+        registros += [(codigo, acciones.get("eliminar"), "Eliminado - No encontrado en CUCM", True)
+                      for codigo in plan.eliminar_local]
+        registros += [(codigo, acciones.get("desactivar"), "Desactivado - No encontrado en CUCM", True)
+                      for codigo in plan.desactivar_local]
+        return registros
+
+    # --- Sincronización completa ---
+
+    def sincronizar(self, modo: str, admin_username: str = "system") -> Dict:
+        """Ejecuta una sincronización completa (bloqueante; pensado para segundo plano)"""
+        if modo not in MODOS:
+            raise ValueError(f"Modo de sincronización desconocido: {modo}")
+        if not self._en_curso.acquire(blocking=False):
+            return {"success": False, "message": "Ya hay una sincronización de FAC en curso", "stats": {"errors": 0}}
+
+        inicio = time.perf_counter()
+        db = self.session_factory()
+        try:
+            servicio = self.servicio()
+            huellas: Optional[List[str]] = []
+            cucm = self.leer_cucm(servicio, huellas)
+            segundos_cucm = time.perf_counter() - inicio
+            local = self.leer_local(db)
+            db.rollback()
+
+            if not cucm and modo != MODO_HACIA_CUCM:
+                # Una lista vacía suele ser un CUCM que no respondió bien: no borrar nada
+                return {
+                    "success": False,
+                    "message": "No se pudieron obtener códigos de CUCM",
+                    "stats": {"created": 0, "updated": 0, "errors": 1},
+                }
+
+            plan = calcular_plan(cucm, local, modo)
+            bajas_omitidas = 0
+            if plan.eliminar_local or plan.desactivar_local:
+                # Un código que falta puede ser solo una página corrida: confirmar con otra lectura
+                estable = self.releer_estable(servicio, huellas)
+                if estable is None:
+                    bajas_omitidas = len(plan.eliminar_local) + len(plan.desactivar_local)
+                    plan.eliminar_local, plan.desactivar_local = [], []
+                    huellas = None
+                    logger.warning(f"CUCM cambió durante la lectura de FAC: se omiten {bajas_omitidas} bajas locales")
+                else:
+                    cucm, huellas = estable
+                    plan = calcular_plan(cucm, local, modo)
+            acciones = ACCIONES[modo]
+            registros = self.aplicar_local(db, plan, modo)
+
+            hechos: List[Tuple[str, str]] = []
+            errores: List[Tuple[str, str]] = []
+            if modo == MODO_HACIA_CUCM:
+                # Lo local queda confirmado antes de salir a CUCM
+                db.commit()
+                hechos, errores = self.escribir_cucm(servicio, plan)
+                sincronizados = [codigo for codigo, _ in hechos]
+                if sincronizados:
+                    db.execute(
+                        text("UPDATE fac_codes SET cucm_synced = TRUE WHERE authorization_code = ANY(CAST(:codigos AS varchar[]))"),
+                        {"codigos": sincronizados}
+                    )
+                registros += self._registros_envio(hechos, errores)
+                registros += [(codigo, acciones["huerfano"], "Código encontrado en CUCM pero no en sistema local", True)
+                              for codigo in plan.huerfanos]
+
+            stats = {
+                "created": len(plan.crear_local),
+                "updated": len(plan.actualizar_local),
+                "deleted": len(plan.eliminar_local),
+                "deactivated": len(plan.desactivar_local),
+                "deletions_skipped": bajas_omitidas,
+                "unchanged": plan.sin_cambios,
+                "orphans": len(plan.huerfanos),
+                "errors": len(errores),
+                "cucm_total": len(cucm),
+                "local_total": len(local),
+            }
+            if modo == MODO_HACIA_CUCM:
+                fallidos = {codigo for codigo, _ in errores}
+                stats["created"] = sum(1 for fac in plan.crear_cucm if fac.codigo not in fallidos)
+                stats["updated"] = sum(1 for fac, _ in plan.actualizar_cucm if fac.codigo not in fallidos)
+
+            resumen = (
+                f"Sincronización completada - CUCM: {stats['cucm_total']}, BD Local: {stats['local_total']}, "
+                f"Creados: {stats['created']}, Actualizados: {stats['updated']}, Eliminados: {stats['deleted']}, "
+                f"Desactivados: {stats['deactivated']}, Sin cambios: {stats['unchanged']}, "
+                f"Huérfanos: {stats['orphans']}, Errores: {stats['errors']}"
+            )
+            if bajas_omitidas:
+                resumen += f", Bajas omitidas (CUCM cambió durante la lectura): {bajas_omitidas}"
+            codigo_resumen, accion_resumen = acciones["resumen"]
+            registros.append((codigo_resumen, accion_resumen, resumen, True))
+            self._auditar(db, registros, admin_username, datetime.utcnow())
+            db.commit()
+            # Lo leído de CUCM ya quedó incorporado (salvo que se acabe de escribir en CUCM
+            # o que se hayan omitido bajas: huellas es None)
+            self._huellas = None if hechos else huellas
+            self._marca = datetime.utcnow()
+
+            stats["segundos_cucm"] = round(segundos_cucm, 3)
+            stats["segundos"] = round(time.perf_counter() - inicio, 3)
+            logger.info(f"Sincronización FAC ({modo}): {resumen} en {stats['segundos']}s")
+            return {"success": True, "message": resumen, "stats": stats}
+
+        except Exception as e:
+            db.rollback()
+            mensaje = f"Error general en sincronización: {str(e)}"
+            logger.error(f"Sincronización FAC ({modo}): {mensaje}")
+            try:
+                self._auditar(db, [("SYNC_ERROR", "sync_error", mensaje, False)], admin_username, datetime.utcnow())
+                db.commit()
+            except Exception:
+                db.rollback()
+            return {"success": False, "message": mensaje, "stats": {"errors": 1}}
+
+        finally:
+            db.close()
+            self._en_curso.release()
+
+    def sincronizar_incremental(self, admin_username: str = "system") -> Dict:
+        """
+        Sincroniza solo lo que cambió desde la última sincronización (ver
+        calcular_plan_incremental). Sin cambios no escribe en la base ni en
+        fac_audit. Los errores se registran en el log, no en la auditoría,
+        para que una ejecución periódica con CUCM caído no la llene.
+        """
+        if not self._en_curso.acquire(blocking=False):
+            return {"success": False, "message": "Ya hay una sincronización de FAC en curso", "stats": {"errors": 0}}
+
+        inicio = time.perf_counter()
+        db = self.session_factory()
+        try:
+            servicio = self.servicio()
+            huellas: Optional[List[str]] = []
+            cucm = self.leer_cucm(servicio, huellas)
+            pendientes = self.leer_pendientes(db, self._marca)
+            cambio_remoto = huellas != self._huellas
+
+            if not cambio_remoto and not pendientes:
+                db.rollback()
+                stats = {"pulled": 0, "pushed": 0, "deactivated": 0, "confirmed": 0, "errors": 0,
+                         "pages_changed": False, "pending": 0,
+                         "segundos": round(time.perf_counter() - inicio, 3)}
+                self.ultima_incremental = {"success": True, "message": "Sin cambios", "stats": stats}
+                return self.ultima_incremental
+
+            if cambio_remoto and not cucm:
+                # Igual que en la completa: una lista vacía no desactiva todo
+                raise RuntimeError("No se pudieron obtener códigos de CUCM")
+
+            local = self.leer_local(db) if cambio_remoto else {}
+            db.rollback()
+            plan = calcular_plan_incremental(cucm, local, pendientes, cambio_remoto)
+            bajas_omitidas = 0
+            if plan.desactivar_local:
+                estable = self.releer_estable(servicio, huellas)
+                if estable is None:
+                    bajas_omitidas = len(plan.desactivar_local)
+                    plan.desactivar_local = []
+                    huellas = None
+                    logger.warning(f"CUCM cambió durante la lectura de FAC: se omiten {bajas_omitidas} desactivaciones")
+                else:
+                    cucm, huellas = estable
+                    plan = calcular_plan_incremental(cucm, local, pendientes, cambio_remoto)
+
+            registros = self.aplicar_local(db, plan, MODO_DESDE_CUCM)
+            self._confirmar(db, plan.confirmar)
+            db.commit()
+
+            hechos, errores = self.escribir_cucm(servicio, plan)
+            enviados = {codigo for codigo, _ in hechos}
+            self._confirmar(db, [fac for fac in plan.crear_cucm if fac.codigo in enviados]
+                            + [fac for fac, _ in plan.actualizar_cucm if fac.codigo in enviados])
+            registros += self._registros_envio(hechos, errores)
+
+            stats = {
+                "pulled": len(plan.crear_local) + len(plan.actualizar_local),
+                "pushed": len(hechos),
+                "deactivated": len(plan.desactivar_local),
+                "deactivations_skipped": bajas_omitidas,
+                "confirmed": len(plan.confirmar),
+                "errors": len(errores),
+                "pages_changed": cambio_remoto,
+                "pending": len(pendientes),
+            }
+            resumen = (
+                f"Sincronización incremental - Desde CUCM: {stats['pulled']}, Hacia CUCM: {stats['pushed']}, "
+                f"Desactivados: {stats['deactivated']}, Errores: {stats['errors']}"
+            )
+            if registros:
+                registros.append(("SYNC_SUMMARY", "sync_incremental", resumen, not errores))
+                self._auditar(db, registros, admin_username, datetime.utcnow())
+            db.commit()
+
+            # Las escrituras propias cambian las páginas de CUCM: la próxima vez se comparan de nuevo
+            self._huellas = None if hechos else huellas
+            self._marca = datetime.utcnow()
+
+            stats["segundos"] = round(time.perf_counter() - inicio, 3)
+            logger.info(f"Sincronización FAC incremental: {resumen} en {stats['segundos']}s")
+            self.ultima_incremental = {"success": True, "message": resumen, "stats": stats}
+            return self.ultima_incremental
+
+        except Exception as e:
+            db.rollback()
+            mensaje = f"Error en sincronización incremental: {str(e)}"
+            logger.error(f"Sincronización FAC: {mensaje}")
+            self.ultima_incremental = {"success": False, "message": mensaje, "stats": {"errors": 1}}
+            return self.ultima_incremental
+
+        finally:
+            db.close()
+            self._en_curso.release()
+
+    def estado(self) -> Dict:
+        return {
+            "en_curso": self._en_curso.locked(),
+            "paginas_conocidas": len(self._huellas) if self._huellas is not None else None,
+            "ultima_sincronizacion": self._marca.isoformat() if self._marca else None,
+            "ultima_incremental": self.ultima_incremental,
+        }
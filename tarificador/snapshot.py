@@ -0,0 +1,128 @@
+# tarificador/snapshot.py
+"""
+Instantánea versionada de zonas, prefijos y tarifas activas.
+
+Toda la tarificación (POST /cdr, /check_balance_for_call, etc.) lee de una
+instantánea inmutable en memoria. Los endpoints que modifican zonas, prefijos
+o tarifas construyen una instantánea nueva y la publican con una sola
+asignación; cada publicación incrementa la versión.
+"""
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+
+from sqlalchemy import text
+
+from .prefijos import PrefijoRegla, PrefixTrie, cargar_reglas
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ZonaInfo:
+    zona_id: int
+    nombre: str
+    descripcion: Optional[str]
+
+
+@dataclass(frozen=True)
+class TarifaActiva:
+    tarifa_id: int
+    zona_id: int
+    tarifa_segundo: float
+    fecha_inicio: Optional[datetime]
+
+
+@dataclass(frozen=True)
+class RatingSnapshot:
+    """Estado de tarificación inmutable en un instante dado"""
+    version: int
+    generado: datetime
+    zonas: Mapping[int, ZonaInfo]
+    tarifas: Mapping[int, TarifaActiva]
+    reglas: Tuple[PrefijoRegla, ...]
+    trie: PrefixTrie = field(repr=False)
+
+    def buscar(self, numero) -> Optional[PrefijoRegla]:
+        return self.trie.buscar(numero)
+
+    def tarifa(self, zona_id) -> Optional[TarifaActiva]:
+        return self.tarifas.get(zona_id)
+
+    def nombre_zona(self, zona_id, default: str = "Desconocida") -> str:
+        zona = self.zonas.get(zona_id)
+        return zona.nombre if zona else default
+
+
+class RatingSnapshotStore:
+    """
+    Publica la instantánea vigente.
+
+    Las lecturas no toman ningún lock: solo leen la referencia actual. Las
+    recargas se serializan para que la versión crezca de forma monótona.
+    """
+
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+        self._actual: Optional[RatingSnapshot] = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cargar(db):
+        zonas = {
+            row[0]: ZonaInfo(row[0], row[1], row[2])
+            for row in db.execute(text("SELECT id, nombre, descripcion FROM zonas")).fetchall()
+        }
+
+        # Tarifa activa más reciente por zona
+        tarifas = {
+            row[1]: TarifaActiva(row[0], row[1], float(row[2]), row[3])
+            for row in db.execute(text("""
+                SELECT DISTINCT ON (zona_id) id, zona_id, tarifa_segundo, fecha_inicio
+                FROM tarifas
+                WHERE activa = TRUE AND tarifa_segundo IS NOT NULL
+                ORDER BY zona_id, fecha_inicio DESC
+            """)).fetchall()
+        }
+
+        return zonas, tarifas, cargar_reglas(db)
+
+    def recargar(self, db=None) -> RatingSnapshot:
+        """Construye una instantánea nueva desde la BD y la publica"""
+        with self._lock:
+            if db is not None:
+                zonas, tarifas, reglas = self._cargar(db)
+            else:
+                with self._session_factory() as session:
+                    zonas, tarifas, reglas = self._cargar(session)
+
+            self._version += 1
+            snapshot = RatingSnapshot(
+                version=self._version,
+                generado=datetime.now(),
+                zonas=MappingProxyType(zonas),
+                tarifas=MappingProxyType(tarifas),
+                reglas=tuple(reglas),
+                trie=PrefixTrie(reglas),
+            )
+            self._actual = snapshot
+
+        logger.info(
+            f"Instantánea de tarifas v{snapshot.version}: {len(zonas)} zonas, "
+            f"{snapshot.trie.total_reglas} prefijos, {len(tarifas)} tarifas activas"
+        )
+        return snapshot
+
+    @property
+    def actual(self) -> RatingSnapshot:
+        snapshot = self._actual
+        if snapshot is None:
+            snapshot = self.recargar()
+        return snapshot
+
+    def buscar(self, numero) -> Optional[PrefijoRegla]:
+        return self.actual.buscar(numero)
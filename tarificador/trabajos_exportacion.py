@@ -0,0 +1,415 @@
+# tarificador/trabajos_exportacion.py
+"""
+Cola de trabajos de exportación.
+
+Los reportes grandes (CDR, saldos, consumo por zona) se generan en un pool
+de procesos acotado: el render de WeasyPrint y la escritura de XLSX/PDF no
+retienen el GIL de los workers de la API. Al enviar un trabajo se obtiene su
+id; el avance se consulta por id y el archivo terminado queda en disco hasta
+que vence su TTL.
+
+Dos pedidos con el mismo tipo y los mismos parámetros dentro de la ventana
+de deduplicación comparten un único trabajo.
+
+Cada proceso del pool abre su propio engine (sin pool de conexiones) y
+reporta el avance en un archivo `<archivo>.progreso` junto al resultado.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import partial
+from typing import Callable, Dict, Optional, Tuple
+
+from sqlalchemy import text
+
+from .exportaciones import (
+    EstadoExportacion, consulta_exportacion_cdr, csv_por_bloques, filtros_exportacion,
+    leer_por_bloques, nombre_archivo, pdf_por_bloques, resumen_filtros, xlsx_por_bloques,
+)
+from .paginacion import ConteoCDR
+
+logger = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------------------
+# Tipos de exportación (se ejecutan dentro del proceso del pool)
+# ---------------------------------------------------------------------------
+
+def _exportar_cdr(formato: str, session_factory, parametros: Dict, ruta: str, reportar: Callable) -> str:
+    filtros = parametros.get("filtros") or {}
+    limite = parametros.get("limite")
+
+    db = session_factory()
+    try:
+        where, params = filtros_exportacion(filtros, alias="")
+        total = ConteoCDR.estimado(db, where, params)
+    finally:
+        db.close()
+    total = min(total, limite) if limite else total
+    reportar(0, total)
+
+    query, params = consulta_exportacion_cdr(filtros, limite)
+    estado = EstadoExportacion(limite)
+
+    def bloques():
+        for filas in leer_por_bloques(session_factory, query, params, estado, bloque=parametros.get("bloque", 5000)):
+            yield filas
+            reportar(estado.filas, max(total, estado.filas))
+
+    if formato == "csv":
+        contenido = csv_por_bloques(bloques(), estado)
+    elif formato == "xlsx":
+        contenido = xlsx_por_bloques(bloques(), estado, resumen_filtros(filtros))
+    else:
+        contenido = pdf_por_bloques(bloques(), estado, resumen_filtros(filtros))
+    with open(ruta, "wb") as archivo:
+        for datos in contenido:
+            archivo.write(datos)
+    reportar(estado.filas, estado.filas)
+    return nombre_archivo(filtros, formato)
+
+
+_HTML_SALDOS = """
+<html>
+<body>
+<h1>Reporte de Saldos</h1>
+<table border="1">
+    <thead>
+        <tr><th>Anexo</th><th>Saldo</th></tr>
+    </thead>
+    <tbody>
+    {% for row in rows %}
+        <tr><td>{{ row[0] }}</td><td>${{ "%.2f"|format(row[1]) }}</td></tr>
+    {% endfor %}
+    </tbody>
+</table>
+</body>
+</html>
+"""
+
+_HTML_CONSUMO_ZONA = """
+<html>
+<body>
+<h1>Reporte de Consumo por Zona</h1>
+<h3>Últimos 30 días</h3>
+<table border="1">
+    <thead>
+        <tr>
+            <th>Zona</th>
+            <th>Total Llamadas</th>
+            <th>Duración Total (seg)</th>
+            <th>Costo Total</th>
+        </tr>
+    </thead>
+    <tbody>
+    {% for row in estadisticas %}
+        <tr>
+            <td>{{ row[0] }}</td>
+            <td>{{ row[1] }}</td>
+            <td>{{ row[2] if row[2] else 0 }}</td>
+            <td>${{ "%.2f"|format(row[3] if row[3] else 0) }}</td>
+        </tr>
+    {% endfor %}
+    </tbody>
+</table>
+</body>
+</html>
+"""
+
+
+def _render_pdf(html_template: str, ruta: str, **contexto) -> None:
+    from jinja2 import Template
+    from weasyprint import HTML
+
+    HTML(string=Template(html_template).render(**contexto)).write_pdf(ruta)
+
+
+def _reporte_saldos(session_factory, parametros: Dict, ruta: str, reportar: Callable) -> str:
+    db = session_factory()
+    try:
+        rows = db.execute(text("SELECT calling_number, saldo FROM saldo_anexos ORDER BY calling_number ASC")).fetchall()
+    finally:
+        db.close()
+    reportar(0, len(rows))
+    _render_pdf(_HTML_SALDOS, ruta, rows=rows)
+    reportar(len(rows), len(rows))
+    return "saldo_report.pdf"
+
+
+def _reporte_consumo_zona(session_factory, parametros: Dict, ruta: str, reportar: Callable) -> str:
+    db = session_factory()
+    try:
+        # Estadísticas de consumo por zona (últimos 30 días)
+        estadisticas = db.execute(text("""
+            SELECT z.nombre, SUM(r.llamadas) as total_llamadas,
+                   SUM(r.segundos) as total_duracion,
+                   SUM(r.costo) as total_costo
+            FROM cdr_resumen_dia r
+            JOIN zonas z ON r.zona_id = z.id
+            WHERE r.dia >= CURRENT_DATE - 30
+            GROUP BY z.nombre
+            ORDER BY total_costo DESC
+        """)).fetchall()
+    finally:
+        db.close()
+    reportar(0, len(estadisticas))
+    _render_pdf(_HTML_CONSUMO_ZONA, ruta, estadisticas=estadisticas)
+    reportar(len(estadisticas), len(estadisticas))
+    return "consumo_zona_report.pdf"
+
+
+# tipo -> (función, extensión, media type)
+TIPOS_EXPORTACION: Dict[str, Tuple[Callable, str, str]] = {
+    "cdr_csv": (partial(_exportar_cdr, "csv"), "csv", "text/csv; charset=utf-8"),
+    "cdr_xlsx": (
+        partial(_exportar_cdr, "xlsx"), "xlsx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ),
+    "cdr_pdf": (partial(_exportar_cdr, "pdf"), "pdf", "application/pdf"),
+    "saldo_pdf": (_reporte_saldos, "pdf", "application/pdf"),
+    "consumo_zona_pdf": (_reporte_consumo_zona, "pdf", "application/pdf"),
+}
+
+
+def _escribir_progreso(ruta_progreso: str, hechos: int, total: Optional[int]) -> None:
+    temporal = ruta_progreso + ".tmp"
+    with open(temporal, "w") as archivo:
+        json.dump({"hechos": hechos, "total": total}, archivo)
+    os.replace(temporal, ruta_progreso)
+
+
+def _ejecutar(tipo: str, parametros: Dict, ruta: str, database_url: str) -> str:
+    """Punto de entrada en el proceso del pool; devuelve el nombre sugerido del archivo"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import NullPool
+
+    funcion = TIPOS_EXPORTACION[tipo][0]
+    engine = create_engine(database_url, poolclass=NullPool)
+    try:
+        return funcion(
+            sessionmaker(bind=engine), parametros, ruta,
+            lambda hechos, total: _escribir_progreso(ruta + ".progreso", hechos, total),
+        )
+    finally:
+        engine.dispose()
+
+
+# ---------------------------------------------------------------------------
+# Gestor (proceso de la API)
+# ---------------------------------------------------------------------------
+
+# Archivos que crea el gestor: <id hex>.<extensión>, su .progreso y el temporal de éste
+_ARCHIVO_TRABAJO = re.compile(
+    r"^[0-9a-f]{32}\.(%s)(\.progreso(\.tmp)?)?$"
+    % "|".join(sorted({extension for _, extension, _ in TIPOS_EXPORTACION.values()}))
+)
+
+@dataclass
+class TrabajoExportacion:
+    id: str
+    tipo: str
+    parametros: Dict
+    clave: str
+    archivo: str
+    media_type: str
+    # pendiente | en_proceso | terminado | error
+    estado: str = "pendiente"
+    hechos: int = 0
+    total: Optional[int] = None
+    nombre: Optional[str] = None
+    error: Optional[str] = None
+    creado: float = field(default_factory=time.time)
+    terminado: Optional[float] = None
+
+    def como_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "tipo": self.tipo,
+            "estado": self.estado,
+            "hechos": self.hechos,
+            "total": self.total,
+            "progreso": round(100 * self.hechos / self.total, 1) if self.total else (100.0 if self.estado == "terminado" else 0.0),
+            "nombre": self.nombre,
+            "error": self.error,
+            "creado": datetime.fromtimestamp(self.creado).isoformat(),
+            "terminado": datetime.fromtimestamp(self.terminado).isoformat() if self.terminado else None,
+        }
+
+
+class GestorExportaciones:
+    """
+    Trabajos de exportación en un ProcessPoolExecutor de `max_procesos`.
+
+    Los trabajos viven en memoria del proceso de la API (cada worker de
+    uvicorn tiene su propia cola); los archivos se guardan en `directorio`.
+    """
+
+    def __init__(
+        self,
+        directorio: str,
+        database_url: str,
+        max_procesos: int = 2,
+        ttl: float = 3600.0,
+        ventana_dedup: float = 300.0,
+    ):
+        self.directorio = directorio
+        self.database_url = database_url
+        self.max_procesos = max_procesos
+        self.ttl = ttl
+        self.ventana_dedup = ventana_dedup
+        self._trabajos: Dict[str, TrabajoExportacion] = {}
+        self._por_clave: Dict[str, str] = {}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def iniciar(self) -> int:
+        """
+        Crea el directorio y borra los archivos de trabajos de ejecuciones
+        anteriores (solo los que crea el gestor); devuelve cuántos borró.
+        """
+        os.makedirs(self.directorio, exist_ok=True)
+        borrados = 0
+        for nombre in os.listdir(self.directorio):
+            if not _ARCHIVO_TRABAJO.match(nombre):
+                continue
+            try:
+                os.unlink(os.path.join(self.directorio, nombre))
+                borrados += 1
+            except OSError:
+                pass
+        return borrados
+
+    def detener(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: los procesos no heredan el event loop, hilos ni conexiones de la API
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_procesos,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    @staticmethod
+    def _clave(tipo: str, parametros: Dict) -> str:
+        datos = json.dumps({"tipo": tipo, "parametros": parametros}, sort_keys=True, default=str)
+        return hashlib.sha1(datos.encode()).hexdigest()
+
+    def enviar(self, tipo: str, parametros: Dict) -> Tuple[TrabajoExportacion, bool]:
+        """
+        Encola un trabajo, o devuelve el existente con los mismos parámetros
+        si se creó dentro de la ventana y no falló. Devuelve (trabajo, deduplicado).
+        """
+        if tipo not in TIPOS_EXPORTACION:
+            raise ValueError(f"Tipo de exportación desconocido: {tipo}")
+        clave = self._clave(tipo, parametros)
+        _, extension, media_type = TIPOS_EXPORTACION[tipo]
+
+        with self._lock:
+            existente = self._trabajos.get(self._por_clave.get(clave, ""))
+            if existente and existente.estado != "error" and time.time() - existente.creado < self.ventana_dedup:
+                return existente, True
+
+            trabajo_id = uuid.uuid4().hex
+            trabajo = TrabajoExportacion(
+                id=trabajo_id,
+                tipo=tipo,
+                parametros=parametros,
+                clave=clave,
+                archivo=os.path.join(self.directorio, f"{trabajo_id}.{extension}"),
+                media_type=media_type,
+            )
+            self._trabajos[trabajo_id] = trabajo
+            self._por_clave[clave] = trabajo_id
+            try:
+                futuro = self._pool().submit(_ejecutar, tipo, parametros, trabajo.archivo, self.database_url)
+            except BrokenProcessPool:
+                # Un proceso murió (p.ej. por memoria): rehacer el pool
+                self._executor = None
+                futuro = self._pool().submit(_ejecutar, tipo, parametros, trabajo.archivo, self.database_url)
+            trabajo.estado = "en_proceso"
+
+        futuro.add_done_callback(lambda f: self._finalizar(trabajo, f))
+        logger.info(f"Exportación {tipo} encolada: {trabajo_id}")
+        return trabajo, False
+
+    def _finalizar(self, trabajo: TrabajoExportacion, futuro) -> None:
+        with self._lock:
+            trabajo.terminado = time.time()
+            try:
+                trabajo.nombre = futuro.result()
+                trabajo.estado = "terminado"
+            except Exception as e:
+                trabajo.estado = "error"
+                trabajo.error = str(e) or e.__class__.__name__
+                logger.error(f"Exportación {trabajo.tipo} {trabajo.id} falló: {trabajo.error}")
+                if isinstance(e, BrokenProcessPool):
+                    self._executor = None
+        self._leer_progreso(trabajo)
+
+    @staticmethod
+    def _leer_progreso(trabajo: TrabajoExportacion) -> None:
+        try:
+            with open(trabajo.archivo + ".progreso") as archivo:
+                progreso = json.load(archivo)
+        except (OSError, ValueError):
+            return
+        trabajo.hechos = progreso.get("hechos") or 0
+        trabajo.total = progreso.get("total")
+
+    def obtener(self, trabajo_id: str) -> Optional[TrabajoExportacion]:
+        trabajo = self._trabajos.get(trabajo_id)
+        if trabajo and trabajo.estado == "en_proceso":
+            self._leer_progreso(trabajo)
+        return trabajo
+
+    async def esperar(self, trabajo_id: str, timeout: float, intervalo: float = 0.25) -> Optional[TrabajoExportacion]:
+        """Espera sin bloquear el event loop a que el trabajo termine o pase `timeout`"""
+        limite = time.monotonic() + timeout
+        trabajo = self.obtener(trabajo_id)
+        while trabajo and trabajo.estado == "en_proceso" and time.monotonic() < limite:
+            await asyncio.sleep(intervalo)
+            trabajo = self.obtener(trabajo_id)
+        return trabajo
+
+    def limpiar(self) -> int:
+        """Quita los trabajos terminados cuyo TTL venció y borra sus archivos"""
+        ahora = time.time()
+        with self._lock:
+            vencidos = [
+                t for t in self._trabajos.values()
+                if t.terminado and ahora - t.terminado >= self.ttl
+            ]
+            for trabajo in vencidos:
+                del self._trabajos[trabajo.id]
+                if self._por_clave.get(trabajo.clave) == trabajo.id:
+                    del self._por_clave[trabajo.clave]
+        for trabajo in vencidos:
+            for ruta in (trabajo.archivo, trabajo.archivo + ".progreso"):
+                try:
+                    os.unlink(ruta)
+                except FileNotFoundError:
+                    pass
+        return len(vencidos)
+
+    def stats(self) -> Dict:
+        estados: Dict[str, int] = {}
+        for trabajo in list(self._trabajos.values()):
+            estados[trabajo.estado] = estados.get(trabajo.estado, 0) + 1
+        return {"max_procesos": self.max_procesos, "trabajos": estados}
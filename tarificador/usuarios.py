@@ -0,0 +1,159 @@
+# tarificador/usuarios.py
+"""
+Caché de usuarios para la autenticación.
+
+Cada petición autenticada resolvía el usuario del token con un SELECT a
+usuarios. CacheUsuarios guarda el resultado por username con TTL y tamaño
+máximo (LRU); los usuarios inexistentes también se recuerdan, con un TTL
+más corto.
+
+Los cambios de usuarios o contraseñas se avisan con NOTIFY en el canal
+CANAL_USUARIOS (notificar_cambio_usuario, p.ej. desde cambiar_password.py)
+y escuchar_invalidaciones los aplica a la caché de la API. El token lleva
+el rol y una huella del hash de la contraseña: al cambiar la contraseña,
+los tokens emitidos antes dejan de valer.
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+CANAL_USUARIOS = "usuarios_cambios"
+
+
+def huella_password(hash_password: Optional[str]) -> str:
+    """Huella corta del hash de la contraseña para el claim `pv` del token"""
+    return hashlib.sha256((hash_password or "").encode()).hexdigest()[:16]
+
+
+def token_vigente(payload: Dict[str, Any], usuario: Dict[str, Any]) -> bool:
+    """False si la contraseña cambió después de emitir el token (tokens sin `pv` se aceptan)"""
+    huella = payload.get("pv")
+    return huella is None or huella == huella_password(usuario.get("password"))
+
+
+def notificar_cambio_usuario(db, username: Optional[str] = None) -> None:
+    """NOTIFY para que las APIs olviden al usuario (o a todos, sin username); no hace commit"""
+    db.execute(text("SELECT pg_notify(:canal, :username)"), {"canal": CANAL_USUARIOS, "username": username or ""})
+
+
+class CacheUsuarios:
+    """
+    Usuarios por username. `cargar(username)` consulta la base y devuelve el
+    dict del usuario o None; si lanza una excepción no se guarda nada.
+    """
+
+    def __init__(
+        self,
+        cargar: Callable[[str], Optional[Dict[str, Any]]],
+        ttl: float = 60.0,
+        ttl_ausente: float = 5.0,
+        max_entradas: int = 1024,
+    ):
+        self.cargar = cargar
+        self.ttl = ttl
+        self.ttl_ausente = ttl_ausente
+        self.max_entradas = max_entradas
+        # username -> (vence, usuario o None)
+        self._entradas: "OrderedDict[str, Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._aciertos = 0
+        self._fallos = 0
+        self._invalidaciones = 0
+        self._desalojos = 0
+
+    def buscar(self, username: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """(encontrado, usuario) sin tocar la base"""
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._entradas.get(username)
+            if entrada is not None and entrada[0] > ahora:
+                self._entradas.move_to_end(username)
+                self._aciertos += 1
+                return True, entrada[1]
+            if entrada is not None:
+                del self._entradas[username]
+            self._fallos += 1
+            return False, None
+
+    def guardar(self, username: str, usuario: Optional[Dict[str, Any]]) -> None:
+        vence = time.monotonic() + (self.ttl if usuario is not None else self.ttl_ausente)
+        with self._lock:
+            self._entradas[username] = (vence, usuario)
+            self._entradas.move_to_end(username)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+                self._desalojos += 1
+
+    def recargar(self, username: str) -> Optional[Dict[str, Any]]:
+        """Consulta la base (bloqueante) y actualiza la caché"""
+        usuario = self.cargar(username)
+        self.guardar(username, usuario)
+        return usuario
+
+    def obtener(self, username: str) -> Optional[Dict[str, Any]]:
+        """Usuario desde la caché o, si no está, desde la base (bloqueante)"""
+        encontrado, usuario = self.buscar(username)
+        if encontrado:
+            return usuario
+        return self.recargar(username)
+
+    def invalidar(self, username: Optional[str] = None) -> None:
+        """Olvida un usuario, o todos si no se indica"""
+        with self._lock:
+            if username:
+                self._entradas.pop(username, None)
+            else:
+                self._entradas.clear()
+            self._invalidaciones += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            consultas = self._aciertos + self._fallos
+            return {
+                "entradas": len(self._entradas),
+                "max_entradas": self.max_entradas,
+                "ttl_seconds": self.ttl,
+                "aciertos": self._aciertos,
+                "fallos": self._fallos,
+                "tasa_aciertos": round(self._aciertos / consultas, 4) if consultas else None,
+                "invalidaciones": self._invalidaciones,
+                "desalojos": self._desalojos,
+            }
+
+
+async def escuchar_invalidaciones(dsn: str, cache: CacheUsuarios, reintento: float = 5.0) -> None:
+    """
+    LISTEN en CANAL_USUARIOS con una conexión asyncpg propia; reconecta si se
+    cae. Al (re)conectar vacía la caché, porque pudo perderse algún aviso.
+    """
+    import asyncpg
+
+    def al_notificar(conexion, pid, canal, username):
+        cache.invalidar(username or None)
+
+    while True:
+        conexion = None
+        try:
+            conexion = await asyncpg.connect(dsn)
+            await conexion.add_listener(CANAL_USUARIOS, al_notificar)
+            cache.invalidar()
+            while True:
+                await asyncio.sleep(reintento)
+                # Detecta la conexión caída, que de otro modo pasaría inadvertida
+                await conexion.execute("SELECT 1")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Escucha de cambios de usuarios interrumpida: {str(e)}")
+        finally:
+            if conexion is not None and not conexion.is_closed():
+                await conexion.close()
+        await asyncio.sleep(reintento)